@@ -0,0 +1,171 @@
+#!/usr/local/sbin/charm-env python3
+#
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import sys
+
+sys.path.append('lib')
+
+from charms.layer import basic
+basic.bootstrap_charm_deps()
+basic.init_config_states()
+
+import charmhelpers.core.hookenv as hookenv
+import charmhelpers.core.unitdata as unitdata
+import charms.reactive as reactive
+
+import charm.openstack.benchmark as benchmark
+import charm.openstack.softhsm as softhsm
+import charm.openstack.timings as timings
+
+
+def republish():
+    """Send the current slots to the principal, if it is connected."""
+    hsm = reactive.RelationBase.from_state('hsm.connected')
+    if hsm is not None:
+        softhsm.on_hsm_connected(hsm)
+
+
+def migrate_objectstore(*args):
+    """Migrate the token store to the 'db' object store backend."""
+    results = softhsm.migrate_objectstore(
+        hookenv.action_get('batch-size'))
+    republish()
+    softhsm.assess_status()
+    hookenv.action_set({'backup': results['backup']})
+    for label, totals in results['tokens'].items():
+        # action result keys can't contain underscores
+        key = label.replace('_', '-')
+        hookenv.action_set({
+            '{}.objects'.format(key): totals['objects'],
+            '{}.checksum'.format(key): totals['checksum'],
+        })
+
+
+def relocate_token_store(*args):
+    """Move the token store to the configured token-dir."""
+    results = softhsm.relocate_token_store()
+    republish()
+    softhsm.assess_status()
+    hookenv.action_set(results)
+
+
+def discard_relocated_token_store(*args):
+    """Delete the token store left behind by relocate-token-store."""
+    hookenv.action_set(softhsm.discard_relocated_token_store())
+
+
+def backup_token_store(*args):
+    """Back up the token store and its pins to a file."""
+    hookenv.action_set(softhsm.backup_token_store(
+        hookenv.action_get('path'), hookenv.action_get('incremental')))
+
+
+def restore_token_store(*args):
+    """Restore the token store and its pins from backups."""
+    paths = hookenv.action_get('paths').replace(',', ' ').split()
+    results = softhsm.restore_token_store(paths)
+    republish()
+    softhsm.assess_status()
+    hookenv.action_set(results)
+
+
+def run_benchmark(*args):
+    """Benchmark PKCS#11 operations on the token store."""
+    report = softhsm.run_benchmark(
+        operations=benchmark.parse_operations(
+            hookenv.action_get('operations')),
+        payload_sizes=benchmark.parse_sizes(
+            hookenv.action_get('payload-sizes')),
+        threads=hookenv.action_get('threads'),
+        processes=hookenv.action_get('processes'),
+        duration=hookenv.action_get('duration'),
+        scratch=hookenv.action_get('scratch'))
+    hookenv.action_set({'results': json.dumps(report, sort_keys=True)})
+
+
+def autotune(*args):
+    """Find and publish the concurrency the token store handles best."""
+    result = softhsm.autotune_concurrency(
+        levels=benchmark.parse_levels(hookenv.action_get('levels')),
+        operation=hookenv.action_get('operation'),
+        payload_size=hookenv.action_get('payload-size'),
+        duration=hookenv.action_get('duration'))
+    republish()
+    hookenv.action_set({
+        'recommended': result['recommended'],
+        'results': json.dumps(result, sort_keys=True),
+    })
+
+
+def hook_timings(*args):
+    """Report histograms of the recorded hook timing spans."""
+    spans = timings.get_spans()
+    hook = hookenv.action_get('hook')
+    if hook:
+        spans = [s for s in spans if s['hook'] == hook]
+    hookenv.action_set({
+        'spans': len(spans),
+        'histograms': json.dumps(timings.histograms(spans)),
+    })
+    if hookenv.action_get('reset'):
+        timings.clear()
+
+
+def trace_summary(*args):
+    """Summarise the PKCS#11 calls in the trace log."""
+    summaries = softhsm.trace_summary(reset=hookenv.action_get('reset'))
+    hookenv.action_set({
+        'calls': sum(s['count'] for s in summaries),
+        'functions': json.dumps(summaries, sort_keys=True),
+    })
+
+
+# Actions to function mapping, to allow for illegal python action names that
+# can map to a python function.
+ACTIONS = {
+    "autotune": autotune,
+    "backup": backup_token_store,
+    "benchmark": run_benchmark,
+    "discard-relocated-token-store": discard_relocated_token_store,
+    "hook-timings": hook_timings,
+    "migrate-objectstore": migrate_objectstore,
+    "relocate-token-store": relocate_token_store,
+    "restore": restore_token_store,
+    "trace-summary": trace_summary,
+}
+
+
+def main(args):
+    action_name = os.path.basename(args[0])
+    try:
+        action = ACTIONS[action_name]
+    except KeyError:
+        return "Action %s undefined" % action_name
+    else:
+        try:
+            action(args)
+        except Exception as e:
+            hookenv.action_fail(str(e))
+        finally:
+            # hookenv's atexit callbacks aren't run for actions.
+            timings.flush()
+            unitdata.kv().flush()
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,296 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Stream full and incremental backups of a token store and its pins.
+#
+# A backup is a gzipped tar stream of the token files, the pins record and,
+# last, a manifest of every file in the store with its size, mtime and
+# sha256.  The files are hashed as they are streamed into the archive, so the
+# store is read once and never staged on disk.  An incremental backup is
+# taken against the manifest of the previous backup: only the files whose
+# size or mtime have changed are archived, but its manifest still lists the
+# whole store, so that restoring a full backup and its incrementals in order
+# can remove deleted files and verify every file that is left.
+
+import hashlib
+import io
+import json
+import os
+import stat
+import tarfile
+import time
+import uuid
+
+import charm.openstack.relocate as relocate
+
+
+MANIFEST_VERSION = 1
+MANIFEST_NAME = "manifest.json"
+PINS_NAME = "pins.json"
+TOKENS_NAME = "tokens"
+
+
+class BackupError(Exception):
+    """Raised when a backup can't be taken, or fails verification when it is
+    restored."""
+    pass
+
+
+class _HashingReader(object):
+    # hash the data tarfile reads from a file as it is streamed.
+
+    def __init__(self, f):
+        self._f = f
+        self.digest = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self._f.read(size)
+        self.digest.update(data)
+        return data
+
+
+def _add_bytes(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mode = 0o600
+    info.mtime = time.time()
+    tar.addfile(info, io.BytesIO(data))
+
+
+def _tarinfo(name, st):
+    info = tarfile.TarInfo(name)
+    info.mode = stat.S_IMODE(st.st_mode)
+    info.uid = st.st_uid
+    info.gid = st.st_gid
+    info.mtime = st.st_mtime
+    if stat.S_ISDIR(st.st_mode):
+        info.type = tarfile.DIRTYPE
+    else:
+        info.size = st.st_size
+    return info
+
+
+def create(store, pins, out, previous=None, extra=None):
+    """Stream a backup of the directory `store` and the `pins` to `out`.
+
+    :param store: the token store directory
+    :param pins: dict pins record, saved as it is
+    :param out: a binary file object to write the gzipped tar stream to
+    :param previous: the manifest of the previous backup, to only archive the
+        files changed since it, or None for a full backup
+    :param extra: dict of other values to record in the manifest
+    :returns: the manifest dict, with the 'id' of this backup, the 'base' id
+        it was taken on top of, the 'files' and 'dirs' of the store and the
+        number of files 'archived'.
+    :raises BackupError: if the store holds anything other than files and
+        directories.
+    """
+    manifest = dict(extra or {})
+    manifest.update({
+        'version': MANIFEST_VERSION,
+        'id': uuid.uuid4().hex,
+        'base': previous['id'] if previous else None,
+        'created': round(time.time(), 3),
+        'dirs': [],
+        'files': {},
+    })
+    known = previous['files'] if previous else {}
+    archived = 0
+    with tarfile.open(fileobj=out, mode='w|gz',
+                      format=tarfile.PAX_FORMAT) as tar:
+        pins_data = json.dumps(pins).encode()
+        manifest['pins'] = hashlib.sha256(pins_data).hexdigest()
+        _add_bytes(tar, PINS_NAME, pins_data)
+        tar.addfile(_tarinfo(TOKENS_NAME, os.stat(store)))
+        for name, st in relocate.walk(store):
+            arcname = '/'.join([TOKENS_NAME, name])
+            if stat.S_ISDIR(st.st_mode):
+                # directories are cheap, and an incremental needs them for
+                # any new files.
+                manifest['dirs'].append(name)
+                tar.addfile(_tarinfo(arcname, st))
+            elif stat.S_ISREG(st.st_mode):
+                entry = known.get(name)
+                if (entry is not None and
+                        (entry['size'], entry['mtime_ns']) ==
+                        (st.st_size, st.st_mtime_ns)):
+                    manifest['files'][name] = entry
+                    continue
+                with open(os.path.join(store, name), 'rb') as f:
+                    reader = _HashingReader(f)
+                    tar.addfile(_tarinfo(arcname, st), reader)
+                manifest['files'][name] = {
+                    'size': st.st_size,
+                    'mtime_ns': st.st_mtime_ns,
+                    'sha256': reader.digest.hexdigest(),
+                }
+                archived += 1
+            else:
+                raise BackupError(
+                    "Unexpected {!r} in the token store; only files and "
+                    "directories can be backed up".format(name))
+        manifest['archived'] = archived
+        _add_bytes(tar, MANIFEST_NAME,
+                   json.dumps(manifest, sort_keys=True).encode())
+    return manifest
+
+
+def read_manifest(path):
+    """Return the manifest saved by write_manifest().
+
+    :param path: the manifest file
+    :returns: dict, or None if there isn't a usable one.
+    """
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('version') != MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def write_manifest(path, manifest):
+    """Save the `manifest` of a backup, for the next incremental backup.
+
+    :param path: the manifest file
+    :param manifest: the dict returned by create()
+    """
+    tmp = path + '.tmp'
+    with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                           0o600), 'w') as f:
+        json.dump(manifest, f, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, path)
+
+
+def _token_name(member):
+    # the path of a token store member relative to the store, '' for the
+    # store itself.
+    name = os.path.normpath(member.name)
+    if name == TOKENS_NAME:
+        return ''
+    prefix = TOKENS_NAME + os.sep
+    relative = name[len(prefix):]
+    if (not name.startswith(prefix) or os.path.isabs(relative) or
+            relative == '..' or relative.startswith('..' + os.sep)):
+        raise BackupError("Unexpected {!r} in backup".format(member.name))
+    if not (member.isdir() or member.isfile()):
+        raise BackupError("Unexpected {!r} in backup, only files and "
+                          "directories are restored".format(member.name))
+    return relative
+
+
+def extract(archive, path, base=None):
+    """Extract the token files of the backup `archive` over the directory
+    `path`, as a stream.
+
+    :param archive: the backup file
+    :param path: the directory to extract into
+    :param base: the manifest of the backup restored before this one, for an
+        incremental backup
+    :returns: (manifest, pins) of the backup
+    :raises BackupError: if the archive isn't a backup, holds unexpected
+        entries, or wasn't taken on top of `base`.
+    """
+    manifest = pins = None
+    with open(archive, 'rb') as f, \
+            tarfile.open(fileobj=f, mode='r|gz') as tar:
+        for member in tar:
+            if member.name == MANIFEST_NAME:
+                manifest = json.loads(tar.extractfile(member).read().decode())
+            elif member.name == PINS_NAME:
+                data = tar.extractfile(member).read()
+                pins = (hashlib.sha256(data).hexdigest(),
+                        json.loads(data.decode()))
+            else:
+                name = _token_name(member)
+                if not name:
+                    continue
+                member.name = name
+                tar.extract(member, path, numeric_owner=True)
+    if manifest is None or pins is None:
+        raise BackupError("{} isn't a complete backup".format(archive))
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise BackupError("{} has an unknown manifest version {!r}"
+                          .format(archive, manifest.get('version')))
+    if pins[0] != manifest['pins']:
+        raise BackupError("The pins in {} don't match its manifest"
+                          .format(archive))
+    expected = base['id'] if base else None
+    if manifest['base'] != expected:
+        if expected is None:
+            raise BackupError("{} is an incremental backup; restore the full "
+                              "backup it was taken on first".format(archive))
+        raise BackupError("{} was taken on top of backup {}, not {}"
+                          .format(archive, manifest['base'], expected))
+    return manifest, pins[1]
+
+
+def verify(path, manifest):
+    """Make the directory `path` hold just what `manifest` lists, and check
+    every file against it.
+
+    Entries that aren't in the manifest were deleted from the store after an
+    earlier backup in the chain, and are removed.
+
+    :param path: the directory the backups were extracted into
+    :param manifest: the manifest of the last backup extracted
+    :returns: (number of files, total bytes)
+    :raises BackupError: if a file is missing or doesn't match.
+    """
+    dirs = set(manifest['dirs'])
+    files = manifest['files']
+    # remove what has gone, children before their parents.
+    for name, st in sorted(relocate.walk(path), reverse=True):
+        if stat.S_ISDIR(st.st_mode):
+            if name not in dirs:
+                os.rmdir(os.path.join(path, name))
+        elif name not in files:
+            os.remove(os.path.join(path, name))
+    size = 0
+    for name in sorted(dirs):
+        if not os.path.isdir(os.path.join(path, name)):
+            raise BackupError("{} is missing from the backup".format(name))
+    for name, entry in sorted(files.items()):
+        target = os.path.join(path, name)
+        if not os.path.isfile(target):
+            raise BackupError("{} is missing from the backup".format(name))
+        if (os.path.getsize(target) != entry['size'] or
+                relocate.file_digest(target) != entry['sha256']):
+            raise BackupError("{} doesn't match the backup manifest"
+                              .format(name))
+        size += entry['size']
+    return len(files), size
+
+
+def restore(archives, path):
+    """Restore a full backup and the incremental backups taken after it, in
+    order, into the empty directory `path`.
+
+    :param archives: list of backup files, the full backup first
+    :param path: the directory to restore into
+    :returns: (manifest, pins, files, bytes) of the last backup
+    :raises BackupError: if the backups don't form a chain or the result
+        doesn't match the last manifest.
+    """
+    if not archives:
+        raise BackupError("No backups to restore")
+    manifest = pins = None
+    for archive in archives:
+        manifest, pins = extract(archive, path, manifest)
+    files, size = verify(path, manifest)
+    return manifest, pins, files, size
@@ -0,0 +1,532 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Measure the throughput and latency of PKCS#11 operations on a token.
+#
+# This is used by the charm's benchmark and autotune actions, and can also be
+# run as a script, e.g. against a scratch token in a temporary directory:
+#
+#   python3 benchmark.py --scratch --threads 4 --payload-sizes 64,4096
+#
+# Every benchmark thread has its own session and session (non-token) keys,
+# so nothing is written to the token.  Each process loads and initialises the
+# library itself, and all threads in all processes start each operation
+# together.  Each thread counts its latencies in a fixed size histogram, so a
+# long run of fast operations doesn't grow the memory of the processes, or
+# what they send back.
+
+import argparse
+import binascii
+import concurrent.futures
+import contextlib
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+if __name__ == '__main__':
+    # allow running as a script from the charm's lib directory.
+    sys.path.insert(0, os.path.abspath(
+        os.path.join(os.path.dirname(__file__), '..', '..')))
+
+import charm.openstack.migrate as migrate
+import charm.openstack.pkcs11 as pkcs11
+import charm.openstack.stats as stats
+
+
+DEFAULT_LIB_PATH = "/usr/lib/x86_64-linux-gnu/softhsm/libsofthsm2.so"
+DEFAULT_LABEL = "barbican_token"
+OPERATIONS = ['generate', 'encrypt', 'decrypt', 'wrap', 'unwrap', 'sign']
+# the operations whose cost depends on the payload size.
+PAYLOAD_OPERATIONS = frozenset(['encrypt', 'decrypt', 'sign'])
+DEFAULT_PAYLOAD_SIZES = [64, 1024, 16384]
+PERCENTILES = [50, 95, 99]
+# the latency histogram buckets, from 1us to a minute, 2% apart, so the
+# percentiles are within 2% of the measured ones.
+LATENCY_BUCKETS = stats.log_buckets(1e-6, 60, 1.02)
+# how long to wait for all of the benchmark threads to be ready.
+BARRIER_TIMEOUT = 60
+# the numbers of concurrent processes autotune() tries, and the least
+# throughput gain over the previous level, and the most p99 latency growth
+# over the first level, for a level to be worth it.
+DEFAULT_CONCURRENCY_LEVELS = [1, 2, 4, 8, 16]
+MIN_THROUGHPUT_GAIN = 0.1
+MAX_LATENCY_FACTOR = 4
+
+
+def aes_key_attributes():
+    """The attributes of an AES-256 session key for the benchmarks"""
+    return {
+        pkcs11.CKA_CLASS: pkcs11.CKO_SECRET_KEY,
+        pkcs11.CKA_KEY_TYPE: pkcs11.CKK_AES,
+        pkcs11.CKA_VALUE_LEN: 32,
+        pkcs11.CKA_TOKEN: False,
+        pkcs11.CKA_PRIVATE: True,
+        pkcs11.CKA_SENSITIVE: True,
+        pkcs11.CKA_EXTRACTABLE: True,
+        pkcs11.CKA_ENCRYPT: True,
+        pkcs11.CKA_DECRYPT: True,
+        pkcs11.CKA_WRAP: True,
+        pkcs11.CKA_UNWRAP: True,
+    }
+
+
+def hmac_key_attributes():
+    """The attributes of an HMAC session key for the benchmarks"""
+    return {
+        pkcs11.CKA_CLASS: pkcs11.CKO_SECRET_KEY,
+        pkcs11.CKA_KEY_TYPE: pkcs11.CKK_GENERIC_SECRET,
+        pkcs11.CKA_VALUE_LEN: 32,
+        pkcs11.CKA_TOKEN: False,
+        pkcs11.CKA_PRIVATE: True,
+        pkcs11.CKA_SENSITIVE: True,
+        pkcs11.CKA_SIGN: True,
+        pkcs11.CKA_VERIFY: True,
+    }
+
+
+class Worker(object):
+    """The keys and data that one benchmark thread uses on its session.
+
+    Each operation is a method taking the payload size.
+
+    :param session: a logged in pkcs11.Session
+    :param payload_sizes: list of payload sizes in bytes
+    """
+
+    def __init__(self, session, payload_sizes):
+        self.session = session
+        self.key = session.generate_key(pkcs11.CKM_AES_KEY_GEN,
+                                        aes_key_attributes())
+        self.kek = session.generate_key(pkcs11.CKM_AES_KEY_GEN,
+                                        aes_key_attributes())
+        self.hmac_key = session.generate_key(
+            pkcs11.CKM_GENERIC_SECRET_KEY_GEN, hmac_key_attributes())
+        self.iv = os.urandom(16)
+        self.payloads = {size: os.urandom(size) for size in payload_sizes}
+        self.ciphertexts = {
+            size: session.encrypt(pkcs11.CKM_AES_CBC_PAD, self.key, payload,
+                                  self.iv)
+            for size, payload in self.payloads.items()}
+        self.wrapped = session.wrap_key(pkcs11.CKM_AES_KEY_WRAP, self.kek,
+                                        self.key)
+
+    def generate(self, size):
+        """Generate (and destroy) an AES-256 key"""
+        self.session.destroy_object(self.session.generate_key(
+            pkcs11.CKM_AES_KEY_GEN, aes_key_attributes()))
+
+    def encrypt(self, size):
+        """AES-CBC encrypt a `size` byte payload"""
+        self.session.encrypt(pkcs11.CKM_AES_CBC_PAD, self.key,
+                             self.payloads[size], self.iv)
+
+    def decrypt(self, size):
+        """AES-CBC decrypt a `size` byte payload"""
+        self.session.decrypt(pkcs11.CKM_AES_CBC_PAD, self.key,
+                             self.ciphertexts[size], self.iv)
+
+    def wrap(self, size):
+        """AES key wrap an AES-256 key"""
+        self.session.wrap_key(pkcs11.CKM_AES_KEY_WRAP, self.kek, self.key)
+
+    def unwrap(self, size):
+        """AES key unwrap (and destroy) an AES-256 key"""
+        attributes = aes_key_attributes()
+        del attributes[pkcs11.CKA_VALUE_LEN]
+        self.session.destroy_object(self.session.unwrap_key(
+            pkcs11.CKM_AES_KEY_WRAP, self.kek, self.wrapped, attributes))
+
+    def sign(self, size):
+        """HMAC-SHA256 a `size` byte payload"""
+        self.session.sign(pkcs11.CKM_SHA256_HMAC, self.hmac_key,
+                          self.payloads[size])
+
+
+def parse_operations(text):
+    """Parse a comma separated list of OPERATIONS
+
+    :param text: the string to parse; empty means all of them.
+    :returns: list of operation names
+    :raises ValueError: for an unknown operation
+    """
+    operations = [op.strip() for op in (text or '').split(',') if op.strip()]
+    for op in operations:
+        if op not in OPERATIONS:
+            raise ValueError("Unknown operation '{}'; choose from {}"
+                             .format(op, ", ".join(OPERATIONS)))
+    return operations or list(OPERATIONS)
+
+
+def parse_sizes(text):
+    """Parse a comma separated list of payload sizes in bytes
+
+    :param text: the string to parse; empty means DEFAULT_PAYLOAD_SIZES.
+    :returns: list of int sizes
+    :raises ValueError: for a size that isn't a positive integer
+    """
+    sizes = []
+    for size in (text or '').split(','):
+        if not size.strip():
+            continue
+        value = int(size)
+        if value < 1:
+            raise ValueError("Payload size must be positive: {}".format(size))
+        sizes.append(value)
+    return sizes or list(DEFAULT_PAYLOAD_SIZES)
+
+
+def parse_levels(text):
+    """Parse a comma separated list of concurrency levels
+
+    :param text: the string to parse; empty means DEFAULT_CONCURRENCY_LEVELS.
+    :returns: sorted list of distinct int levels
+    :raises ValueError: for a level that isn't a positive integer
+    """
+    levels = set()
+    for level in (text or '').split(','):
+        if not level.strip():
+            continue
+        value = int(level)
+        if value < 1:
+            raise ValueError("Concurrency must be positive: {}".format(level))
+        levels.add(value)
+    return sorted(levels) or list(DEFAULT_CONCURRENCY_LEVELS)
+
+
+def build_plan(operations, payload_sizes):
+    """The (operation, payload size) pairs to run, in order.
+
+    Operations that don't take a payload are run once, with a size of None.
+    """
+    plan = []
+    for op in operations:
+        if op in PAYLOAD_OPERATIONS:
+            plan.extend((op, size) for size in payload_sizes)
+        else:
+            plan.append((op, None))
+    return plan
+
+
+def time_operation(func, size, duration):
+    """Call `func(size)` repeatedly for `duration` seconds.
+
+    :returns: (stats.Histogram of the latency of the calls, elapsed seconds)
+    """
+    timer = time.perf_counter
+    latencies = stats.Histogram(LATENCY_BUCKETS)
+    started = timer()
+    end = started + duration
+    while True:
+        start = timer()
+        func(size)
+        stop = timer()
+        latencies.add(stop - start)
+        if stop >= end:
+            return latencies, stop - started
+
+
+def _run_thread(worker, plan, duration, barrier):
+    runs = []
+    for op, size in plan:
+        barrier.wait(BARRIER_TIMEOUT)
+        runs.append(time_operation(getattr(worker, op), size, duration))
+    return runs
+
+
+def _run_process(lib_path, label, slot_id, pin, plan, payload_sizes,
+                 threads, duration, barrier):
+    """Run the plan on `threads` threads; this runs in a benchmark process.
+
+    :returns: list, in plan order, of lists of the (latency histogram,
+        elapsed) of each thread.
+    """
+    try:
+        with pkcs11.initialized(lib_path) as lib:
+            if slot_id is None:
+                slot_id = pkcs11.find_token_slot(lib, label)
+            elif lib.get_token_info(slot_id).label != label:
+                slot_id = None
+            if slot_id is None:
+                raise RuntimeError("No {} token to benchmark".format(label))
+            sessions = [lib.open_session(slot_id) for _ in range(threads)]
+            try:
+                # logging in one session logs in all of them.
+                sessions[0].login(pin)
+                workers = [Worker(s, payload_sizes) for s in sessions]
+                with concurrent.futures.ThreadPoolExecutor(threads) as e:
+                    futures = [
+                        e.submit(_run_thread, w, plan, duration, barrier)
+                        for w in workers]
+                    per_thread = [f.result() for f in futures]
+            finally:
+                for session in sessions:
+                    session.close()
+    except Exception:
+        # don't leave the other processes waiting for this one.
+        barrier.abort()
+        raise
+    return [list(runs) for runs in zip(*per_thread)]
+
+
+def summarise(op, size, runs):
+    """Summarise the runs of all of the threads for one operation.
+
+    :param op: the operation name
+    :param size: the payload size, or None
+    :param runs: list of the (latency histogram, elapsed) of each thread
+    :returns: dict for the report
+    """
+    latencies = stats.Histogram(LATENCY_BUCKETS)
+    for run, _ in runs:
+        latencies.merge(run)
+    return {
+        'operation': op,
+        'payload_size': size,
+        'ops': latencies.count,
+        'ops_per_second': round(
+            sum(run.count / elapsed for run, elapsed in runs if elapsed), 1),
+        'latency_ms': {
+            'p{}'.format(pct): round(latencies.percentile(pct) * 1000, 3)
+            for pct in PERCENTILES},
+    }
+
+
+def run_benchmark(lib_path, label, pin, operations=None, payload_sizes=None,
+                  threads=1, processes=1, duration=5, user=None, env=None,
+                  slot_id=None):
+    """Benchmark the `label` token with `threads` threads in each of
+    `processes` processes.
+
+    A process that hasn't finished once every step of the plan could have
+    waited BARRIER_TIMEOUT for the others and run for `duration`, and it
+    could have taken BARRIER_TIMEOUT to start, is killed.
+
+    :param lib_path: the path to the PKCS#11 library
+    :param label: the token label
+    :param pin: the user pin of the token
+    :param operations: list of OPERATIONS to run, or None for all
+    :param payload_sizes: list of payload sizes, or None for the defaults
+    :param threads: the number of threads (and sessions) per process
+    :param processes: the number of processes
+    :param duration: the seconds to run each operation for
+    :param user: if not None, the user to run the processes as
+    :param env: dict of environment variables for the processes, e.g.
+        SOFTHSM2_CONF
+    :param slot_id: the slot that `lib_path` presents the token in, or None
+        to look it up by its label
+    :returns: dict report with the 'config' used and the 'results' of each
+        operation and payload size.
+    :raises ValueError: if threads or processes is less than 1.
+    :raises TimeoutError: if a benchmark process didn't finish in time.
+    :raises Exception: whatever failed in a benchmark process.
+    """
+    if threads < 1 or processes < 1:
+        raise ValueError("threads and processes must be at least 1")
+    operations = operations or list(OPERATIONS)
+    payload_sizes = payload_sizes or list(DEFAULT_PAYLOAD_SIZES)
+    plan = build_plan(operations, payload_sizes)
+    barrier = multiprocessing.get_context('fork').Barrier(threads * processes)
+    deadline = (time.monotonic() + (len(plan) + 1) * BARRIER_TIMEOUT +
+                len(plan) * duration)
+    children = [
+        pkcs11.Child(_run_process,
+                     (lib_path, label, slot_id, pin, plan, payload_sizes,
+                      threads, duration, barrier),
+                     user=user, env=env)
+        for _ in range(processes)]
+    per_process, errors = [], []
+    for child in children:
+        try:
+            per_process.append(
+                child.result(max(0, deadline - time.monotonic())))
+        except Exception as e:
+            errors.append(e)
+    if errors:
+        # report the first real error rather than a broken barrier.
+        errors.sort(key=lambda e: isinstance(e, threading.BrokenBarrierError))
+        raise errors[0]
+    results = []
+    for i, (op, size) in enumerate(plan):
+        runs = [run for process in per_process for run in process[i]]
+        results.append(summarise(op, size, runs))
+    return {
+        'config': {
+            'label': label,
+            'operations': operations,
+            'payload_sizes': payload_sizes,
+            'threads': threads,
+            'processes': processes,
+            'duration': duration,
+        },
+        'results': results,
+    }
+
+
+def find_knee(points, min_gain=MIN_THROUGHPUT_GAIN,
+              max_latency_factor=MAX_LATENCY_FACTOR):
+    """Find the knee of the throughput and latency curve of `points`.
+
+    Each level is worth it if its throughput is at least `min_gain` more
+    than the last level that was, and its p99 latency is at most
+    `max_latency_factor` times that of the first level.  The knee is the
+    level before the first one that isn't.
+
+    :param points: list of dicts with the 'concurrency', 'ops_per_second'
+        and 'latency_ms' of each level, lowest concurrency first
+    :param min_gain: the least fractional throughput gain
+    :param max_latency_factor: the most p99 latency growth
+    :returns: the int concurrency at the knee
+    """
+    knee = points[0]
+    limit = points[0]['latency_ms']['p99'] * max_latency_factor
+    for point in points[1:]:
+        if (point['ops_per_second'] < knee['ops_per_second'] * (1 + min_gain)
+                or point['latency_ms']['p99'] > limit):
+            break
+        knee = point
+    return knee['concurrency']
+
+
+def autotune(lib_path, label, pin, levels=None, operation='encrypt',
+             payload_size=1024, duration=3, user=None, env=None,
+             slot_id=None):
+    """Run `operation` on the `label` token with each of `levels`
+    processes, which stand in for barbican's workers, each with a session,
+    and find the knee of the curve.
+
+    :param lib_path: the path to the PKCS#11 library
+    :param label: the token label
+    :param pin: the user pin of the token
+    :param levels: list of concurrency levels, or None for the defaults
+    :param operation: one of OPERATIONS
+    :param payload_size: the payload size, for the PAYLOAD_OPERATIONS
+    :param duration: the seconds to run each level for
+    :param user: if not None, the user to run the processes as
+    :param env: dict of environment variables for the processes
+    :param slot_id: as run_benchmark()
+    :returns: dict with the 'operation', 'payload_size', the 'levels' as
+        find_knee() takes them, and the 'recommended' concurrency.
+    """
+    points = []
+    for level in sorted(levels or DEFAULT_CONCURRENCY_LEVELS):
+        report = run_benchmark(lib_path, label, pin, [operation],
+                               [payload_size], threads=1, processes=level,
+                               duration=duration, user=user, env=env,
+                               slot_id=slot_id)
+        result = report['results'][0]
+        points.append({
+            'concurrency': level,
+            'ops_per_second': result['ops_per_second'],
+            'latency_ms': result['latency_ms'],
+        })
+    return {
+        'operation': operation,
+        'payload_size': (payload_size if operation in PAYLOAD_OPERATIONS
+                         else None),
+        'levels': points,
+        'recommended': find_knee(points),
+    }
+
+
+def _init_scratch_token(lib_path, label, so_pin, pin):
+    with pkcs11.initialized(lib_path) as lib:
+        pkcs11.init_free_token(lib, label, so_pin, pin)
+
+
+@contextlib.contextmanager
+def scratch_token(lib_path, label=DEFAULT_LABEL, backend='file', user=None):
+    """Create a throwaway token store with a `label` token in a temporary
+    directory, and remove it afterwards.
+
+    :param lib_path: the path to the PKCS#11 library
+    :param label: the label of the token
+    :param backend: the object store backend, 'file' or 'db'
+    :param user: if not None, the user to initialise the token as
+    :returns: context manager yielding (path of its softhsm2.conf, pin)
+    """
+    workdir = tempfile.mkdtemp(prefix='softhsm-benchmark-')
+    try:
+        os.chmod(workdir, 0o755)
+        tokendir = os.path.join(workdir, 'tokens')
+        os.makedirs(tokendir)
+        os.chmod(tokendir, 0o1777)
+        conf = os.path.join(workdir, 'softhsm2.conf')
+        migrate.write_conf(conf, tokendir + '/', backend)
+        pin = binascii.hexlify(os.urandom(16)).decode()
+        so_pin = binascii.hexlify(os.urandom(16)).decode()
+        pkcs11.run_in_child(_init_scratch_token,
+                            (lib_path, label, so_pin, pin),
+                            user=user, env={'SOFTHSM2_CONF': conf})
+        yield conf, pin
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark PKCS#11 operations on a SoftHSM token and "
+                    "print the results as JSON.")
+    parser.add_argument('--lib', default=DEFAULT_LIB_PATH,
+                        help="the PKCS#11 library (default: %(default)s)")
+    parser.add_argument('--label', default=DEFAULT_LABEL,
+                        help="the token label (default: %(default)s)")
+    parser.add_argument('--pin', default=os.environ.get('SOFTHSM2_PIN'),
+                        help="the user pin (default: $SOFTHSM2_PIN)")
+    parser.add_argument('--scratch', action='store_true',
+                        help="benchmark a new token in a temporary "
+                             "directory rather than the one in "
+                             "$SOFTHSM2_CONF")
+    parser.add_argument('--backend', default='file', choices=['file', 'db'],
+                        help="the object store backend of a scratch token")
+    parser.add_argument('--operations', default='',
+                        help="comma separated operations (default: all of "
+                             "{})".format(",".join(OPERATIONS)))
+    parser.add_argument('--payload-sizes', default='',
+                        help="comma separated payload sizes in bytes "
+                             "(default: {})".format(
+                                 ",".join(map(str, DEFAULT_PAYLOAD_SIZES))))
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--duration', type=float, default=5,
+                        help="seconds to run each operation for")
+    args = parser.parse_args(argv)
+    try:
+        kwargs = {
+            'operations': parse_operations(args.operations),
+            'payload_sizes': parse_sizes(args.payload_sizes),
+            'threads': args.threads,
+            'processes': args.processes,
+            'duration': args.duration,
+        }
+    except ValueError as e:
+        parser.error(str(e))
+    if args.scratch:
+        with scratch_token(args.lib, args.label, args.backend) as (conf, pin):
+            report = run_benchmark(args.lib, args.label, pin,
+                                   env={'SOFTHSM2_CONF': conf}, **kwargs)
+    else:
+        if args.pin is None:
+            parser.error("--pin or $SOFTHSM2_PIN is needed without --scratch")
+        report = run_benchmark(args.lib, args.label, args.pin, **kwargs)
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
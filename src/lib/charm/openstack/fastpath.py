@@ -0,0 +1,176 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Let update-status skip loading the charm's dependencies when nothing has
+# changed.
+#
+# At the end of each hook the charm saves its workload status together with
+# a digest of the files, and the relation data, the status depends on.  The
+# update-status hook checks the digest first and, if it still matches, just
+# re-asserts the saved status with status-set.  Only the standard library may
+# be used here, as this runs before the charm's virtualenv is set up.
+
+import glob
+import hashlib
+import json
+import os
+import subprocess
+
+
+STATE_FILE = ".softhsm-fastpath.json"
+# statuses that are about to change and so are never re-asserted.
+TRANSIENT_STATUSES = ('maintenance', 'error', 'unknown')
+
+
+def directory_fingerprint(path):
+    """Return a fingerprint of the directory `path`.
+
+    The directory's inode, mtime and the names in it change whenever it is
+    re-created or an entry is added or removed.
+
+    :param path: the directory
+    :returns: hex digest string, or None if it can't be read.
+    """
+    try:
+        st = os.stat(path)
+        names = sorted(os.listdir(path))
+    except OSError:
+        return None
+    data = json.dumps([st.st_ino, st.st_mtime_ns, names])
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def _file_stat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_ino, st.st_size, st.st_mtime_ns]
+
+
+def _hook_tool(args):
+    try:
+        output = subprocess.check_output(args + ['--format=json'],
+                                         stderr=subprocess.DEVNULL)
+        return json.loads(output.decode() or 'null')
+    except (OSError, subprocess.CalledProcessError, ValueError):
+        return None
+
+
+def relation_data(name):
+    """Return the settings of every unit on the `name` relations.
+
+    :param name: the relation name, e.g. 'hsm'
+    :returns: list of [relation id, [[unit, settings], ...]], sorted.
+    """
+    data = []
+    for rid in sorted(_hook_tool(['relation-ids', name]) or []):
+        units = sorted(_hook_tool(['relation-list', '-r', rid]) or [])
+        data.append([rid, [
+            [unit, _hook_tool(['relation-get', '-r', rid, '-', unit])]
+            for unit in units]])
+    return data
+
+
+def digest(watch):
+    """Return a digest of the state of the watched paths and relations.
+
+    :param watch: dict with lists of 'files' whose inode, size and mtime,
+        'dirs' whose directory_fingerprint(), 'globs' whose matches and
+        'relations' whose relation_data() are included.
+    :returns: hex digest string
+    """
+    data = [
+        [[path, _file_stat(path)] for path in watch.get('files', [])],
+        [[path, directory_fingerprint(path)]
+         for path in watch.get('dirs', [])],
+        [[pattern, sorted(glob.glob(pattern))]
+         for pattern in watch.get('globs', [])],
+        [[name, relation_data(name)]
+         for name in watch.get('relations', [])],
+    ]
+    return hashlib.sha256(json.dumps(data).encode()).hexdigest()
+
+
+def save_state(charm_dir, watch, status, message):
+    """Save the workload status and the digest of the watched paths.
+
+    A transient status is never re-asserted, so the state is removed
+    instead.
+
+    :param charm_dir: the charm directory
+    :param watch: the paths the status depends on, as for digest()
+    :param status: the workload status
+    :param message: the status message
+    """
+    if status in TRANSIENT_STATUSES:
+        clear_state(charm_dir)
+        return
+    state = {
+        'watch': watch,
+        'digest': digest(watch),
+        'status': status,
+        'message': message,
+    }
+    path = os.path.join(charm_dir, STATE_FILE)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+    os.rename(tmp, path)
+
+
+def load_state(charm_dir):
+    """Return the state saved by save_state().
+
+    :param charm_dir: the charm directory
+    :returns: dict, or None if there isn't a usable one.
+    """
+    try:
+        with open(os.path.join(charm_dir, STATE_FILE)) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not all(k in state for k in ('watch', 'digest', 'status', 'message')):
+        return None
+    return state
+
+
+def clear_state(charm_dir):
+    """Remove the saved state, so that the next update-status runs in full.
+
+    :param charm_dir: the charm directory
+    """
+    try:
+        os.remove(os.path.join(charm_dir, STATE_FILE))
+    except FileNotFoundError:
+        pass
+
+
+def update_status(charm_dir):
+    """Re-assert the saved workload status if nothing it depends on has
+    changed.
+
+    :param charm_dir: the charm directory
+    :returns: True if the status was re-asserted, False if the hook needs to
+        run in full.
+    """
+    state = load_state(charm_dir)
+    if state is None or digest(state['watch']) != state['digest']:
+        return False
+    try:
+        subprocess.check_call(
+            ['status-set', state['status'], state['message']])
+    except (OSError, subprocess.CalledProcessError):
+        return False
+    return True
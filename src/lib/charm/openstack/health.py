@@ -0,0 +1,231 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Probe whether the barbican token is usable, and how fast it answers.
+#
+# An update-status that finds the last sample older than the probe interval
+# opens a session on the published slot, logs in with the stored pin and
+# encrypts and decrypts a block with a session key, in a child process that
+# is killed if it takes longer than PROBE_TIMEOUT; the others don't fork.
+# The last WINDOW_SIZE samples are kept, and the token is only reported as
+# degraded or failing when most of them are, so that one bad sample doesn't
+# flap the workload status.  The verdict is saved in its own file, which is
+# only rewritten when it changes, so that the update-status fast path can
+# watch it.  Only the standard library may be used here.
+
+import json
+import os
+import time
+
+import charm.openstack.benchmark as benchmark
+import charm.openstack.pkcs11 as pkcs11
+
+
+STATE_FILE = ".softhsm-health.json"
+WINDOW_FILE = ".softhsm-health-window.json"
+VERDICT_FILE = ".softhsm-health-verdict.json"
+WINDOW_SIZE = 5
+PROBE_TIMEOUT = 10
+
+
+def _load(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _save(path, data):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f, sort_keys=True)
+    os.rename(tmp, path)
+
+
+def save_state(charm_dir, state):
+    """Save what update() needs to probe the token.
+
+    :param charm_dir: the charm directory
+    :param state: dict with the PKCS#11 'library', the softhsm2 'conf', the
+        'user' to probe as, the token 'label', its published 'slot_id' (or
+        None), the 'pins_file', the latency 'threshold' and the probe
+        'interval' in seconds.
+    """
+    _save(os.path.join(charm_dir, STATE_FILE), state)
+
+
+def clear_state(charm_dir):
+    """Stop probing the token, and forget the samples.
+
+    :param charm_dir: the charm directory
+    """
+    for name in (STATE_FILE, WINDOW_FILE, VERDICT_FILE):
+        try:
+            os.remove(os.path.join(charm_dir, name))
+        except FileNotFoundError:
+            pass
+
+
+def probe(library, label, pin, slot_id=None):
+    """Open a session on the `label` token, log in and do an encrypt and
+    decrypt round-trip; run in a child with the token store's SOFTHSM2_CONF.
+
+    :param library: the path of the PKCS#11 module
+    :param label: the token label
+    :param pin: the user pin
+    :param slot_id: the slot the token was published in, or None to look it
+        up by its label
+    :returns: dict with the 'login' and 'encrypt' seconds
+    :raises LookupError: if the token isn't in `slot_id`.
+    :raises ValueError: if the round-trip doesn't return the plaintext.
+    """
+    with pkcs11.initialized(library) as lib:
+        if slot_id is None:
+            slot_id = pkcs11.find_token_slot(lib, label)
+        elif lib.get_token_info(slot_id).label != label:
+            slot_id = None
+        if slot_id is None:
+            raise LookupError("The {} token isn't in its published slot"
+                              .format(label))
+        start = time.perf_counter()
+        with lib.open_session(slot_id, rw=False) as session:
+            session.login(pin)
+            login = time.perf_counter()
+            key = session.generate_key(pkcs11.CKM_AES_KEY_GEN,
+                                       benchmark.aes_key_attributes())
+            iv = os.urandom(16)
+            plaintext = os.urandom(16)
+            ciphertext = session.encrypt(pkcs11.CKM_AES_CBC_PAD, key,
+                                         plaintext, iv)
+            if session.decrypt(pkcs11.CKM_AES_CBC_PAD, key, ciphertext,
+                               iv) != plaintext:
+                raise ValueError("The encrypt round-trip failed")
+            done = time.perf_counter()
+            session.logout()
+        return {'login': login - start, 'encrypt': done - login}
+
+
+def run_probe(state, now=None):
+    """Probe the token described by `state` and return the sample.
+
+    :param state: the state saved by save_state()
+    :param now: the time of the sample, time.time() by default
+    :returns: dict with the time 'at', whether it was 'ok', and either the
+        'login', 'encrypt' and total 'seconds' or the 'error'.
+    """
+    sample = {'at': time.time() if now is None else now}
+    try:
+        with open(state['pins_file']) as f:
+            pin = json.load(f)['pin']
+        timings = pkcs11.run_in_child(
+            probe, (state['library'], state['label'], pin,
+                    state.get('slot_id')),
+            user=state['user'], env={'SOFTHSM2_CONF': state['conf']},
+            timeout=PROBE_TIMEOUT)
+        sample.update(timings)
+        # the fork and C_Initialize are left out, they aren't paid by
+        # barbican's long lived sessions.
+        sample['seconds'] = timings['login'] + timings['encrypt']
+        sample['ok'] = True
+    except Exception as e:
+        sample['ok'] = False
+        sample['error'] = str(e) or e.__class__.__name__
+    return sample
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2
+
+
+def assess(samples, threshold):
+    """Return the workload status the `samples` call for.
+
+    The token is failing if the latest sample failed and at least half of
+    the samples did, and degraded if the median latency of the successful
+    samples is above `threshold`.  A degraded token still serves barbican,
+    and a busy host can make it so, so it is reported as active, with a
+    "Degraded" message, and only a failing token blocks the unit.
+
+    :param samples: list of samples, oldest first
+    :param threshold: the latency threshold in seconds
+    :returns: (state, message), or (None, None) if the token is healthy or
+        there are no samples.
+    """
+    if not samples:
+        return None, None
+    failed = [s for s in samples if not s['ok']]
+    if not samples[-1]['ok'] and len(failed) * 2 >= len(samples):
+        return ('blocked', "Token probe failing ({} of the last {}): {}"
+                .format(len(failed), len(samples), samples[-1]['error']))
+    latencies = [s['seconds'] for s in samples if s['ok']]
+    if latencies and _median(latencies) > threshold:
+        return ('active', "Degraded: token probe median latency {:.0f}ms "
+                "is above {:.0f}ms".format(_median(latencies) * 1000,
+                                           threshold * 1000))
+    return None, None
+
+
+def load_samples(charm_dir):
+    """Return the samples in the rolling window, oldest first.
+
+    :param charm_dir: the charm directory
+    :returns: list of samples
+    """
+    return _load(os.path.join(charm_dir, WINDOW_FILE)) or []
+
+
+def verdict(charm_dir):
+    """Return the workload status the last update() called for.
+
+    :param charm_dir: the charm directory
+    :returns: (state, message), or (None, None) if the token is healthy or
+        hasn't been probed.
+    """
+    saved = _load(os.path.join(charm_dir, VERDICT_FILE))
+    if not saved:
+        return None, None
+    return tuple(saved)
+
+
+def update(charm_dir, now=None):
+    """Probe the token, if the charm has saved a state and the last sample is
+    at least the probe interval old, add the sample to the rolling window and
+    save the verdict if it has changed.
+
+    :param charm_dir: the charm directory
+    :param now: the time of the sample, time.time() by default
+    :returns: the sample, or None if there is no state or the token wasn't
+        probed.
+    """
+    state = _load(os.path.join(charm_dir, STATE_FILE))
+    if not state:
+        return None
+    now = time.time() if now is None else now
+    samples = load_samples(charm_dir)
+    # a clock stepped back mustn't stop the probes.
+    if samples and 0 <= now - samples[-1]['at'] < state.get('interval', 0):
+        return None
+    sample = run_probe(state, now)
+    samples = (samples + [sample])[-WINDOW_SIZE:]
+    _save(os.path.join(charm_dir, WINDOW_FILE), samples)
+    verdict = list(assess(samples, state['threshold']))
+    path = os.path.join(charm_dir, VERDICT_FILE)
+    if _load(path) != verdict:
+        _save(path, verdict)
+    return sample
@@ -0,0 +1,291 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Write metrics about the token store to a node-exporter textfile.
+#
+# At the end of each hook the charm saves what is needed to collect the
+# metrics (the paths, the token label and the last slot lookup latency), and
+# the update-status hook collects them and writes the textfile, even when it
+# otherwise takes the fast path.  So only the standard library may be used
+# here.  The textfile is only rewritten when the health probe ran in the same
+# update-status or, if it didn't, once it is the probe interval old, so that
+# the login probe doesn't fork in every update-status either.  Token
+# directories are only scanned again when their inode or mtime have changed,
+# or the last scan is older than RESCAN_INTERVAL, so the cost of a collection
+# doesn't grow with the number of objects.
+
+import json
+import os
+import stat
+import time
+
+import charm.openstack.pkcs11 as pkcs11
+
+
+STATE_FILE = ".softhsm-metrics.json"
+CACHE_FILE = ".softhsm-metrics-cache.json"
+TEXTFILE_NAME = "barbican_softhsm.prom"
+# seconds after which an unchanged token directory is scanned again, to pick
+# up objects rewritten in place.
+RESCAN_INTERVAL = 3600
+PROBE_TIMEOUT = 10
+
+
+def _load(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _save(path, data):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f, sort_keys=True)
+    os.rename(tmp, path)
+
+
+def save_state(charm_dir, state):
+    """Save what update() needs to collect the metrics.
+
+    :param charm_dir: the charm directory
+    :param state: dict with the 'textfile' to write, the token 'store'
+        directory, the 'pins_file', the PKCS#11 'library', the softhsm2
+        'conf', the 'user' to probe the token as, the token 'label', the
+        'read_slot' latency in seconds, or None, and the probe 'interval' in
+        seconds.
+    """
+    _save(os.path.join(charm_dir, STATE_FILE), state)
+
+
+def clear_state(charm_dir):
+    """Stop collecting metrics, and remove the last textfile written.
+
+    :param charm_dir: the charm directory
+    """
+    path = os.path.join(charm_dir, STATE_FILE)
+    state = _load(path)
+    for name in ([state.get('textfile')] if state else []) + [path]:
+        try:
+            os.remove(name)
+        except (FileNotFoundError, TypeError):
+            pass
+
+
+def scan_tokens(store, cache=None, now=None):
+    """Count the objects and bytes in each token directory of `store`.
+
+    A directory whose inode and mtime match `cache`, which changes whenever
+    an object is added or removed, isn't listed again until the cached scan
+    is RESCAN_INTERVAL old.  The objects of a 'db' backend token can't be
+    counted from its files, and are None.
+
+    :param store: the token store directory
+    :param cache: the cache returned by the previous scan
+    :param now: the time of the scan, time.time() by default
+    :returns: (tokens, cache) where tokens maps each token directory name to
+        (objects, bytes)
+    """
+    cache = cache or {}
+    now = time.time() if now is None else now
+    tokens = {}
+    scanned = {}
+    for name in sorted(os.listdir(store)):
+        try:
+            st = os.stat(os.path.join(store, name))
+        except OSError:
+            continue
+        if not stat.S_ISDIR(st.st_mode):
+            continue
+        key = [st.st_ino, st.st_mtime_ns]
+        entry = cache.get(name)
+        if (entry is None or entry['key'] != key or
+                now - entry['at'] >= RESCAN_INTERVAL):
+            objects = size = 0
+            db = False
+            for f in os.scandir(os.path.join(store, name)):
+                if not f.is_file(follow_symlinks=False):
+                    continue
+                size += f.stat(follow_symlinks=False).st_size
+                if f.name.endswith('.object') and f.name != 'token.object':
+                    objects += 1
+                elif f.name == 'sqlite3.db':
+                    db = True
+            entry = {'key': key, 'at': now, 'bytes': size,
+                     'objects': None if db and not objects else objects}
+        scanned[name] = entry
+        tokens[name] = (entry['objects'], entry['bytes'])
+    return tokens, scanned
+
+
+def probe_login(library, label, pin):
+    """Time opening a session on the `label` token and logging in and out;
+    run in a child with the token store's SOFTHSM2_CONF.
+
+    :param library: the path of the PKCS#11 module
+    :param label: the token label
+    :param pin: the user pin
+    :returns: float seconds
+    :raises LookupError: if there is no such token.
+    """
+    with pkcs11.initialized(library) as lib:
+        slot_id = pkcs11.find_token_slot(lib, label)
+        if slot_id is None:
+            raise LookupError("No {} token".format(label))
+        start = time.perf_counter()
+        with lib.open_session(slot_id, rw=False) as session:
+            session.login(pin)
+            session.logout()
+        return time.perf_counter() - start
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def render(metrics):
+    """Format `metrics` in the Prometheus text exposition format.
+
+    :param metrics: list of (name, help, samples) where samples is a list of
+        (labels dict, value); samples whose value is None are left out.
+    :returns: str
+    """
+    lines = []
+    for name, help_text, samples in metrics:
+        samples = [(labels, value) for labels, value in samples
+                   if value is not None]
+        if not samples:
+            continue
+        lines.append("# HELP {} {}".format(name, help_text))
+        lines.append("# TYPE {} gauge".format(name))
+        for labels, value in samples:
+            label_text = ','.join('{}="{}"'.format(k, _escape(v))
+                                  for k, v in sorted(labels.items()))
+            lines.append("{}{} {}".format(
+                name, '{' + label_text + '}' if label_text else '',
+                repr(float(value))))
+    return '\n'.join(lines) + '\n'
+
+
+def collect(state, cache=None, now=None, sample=None):
+    """Collect the metrics described by `state`.
+
+    :param state: the state saved by save_state()
+    :param cache: the token scan cache from the previous collection
+    :param now: the time of the collection, time.time() by default
+    :param sample: the health probe sample taken in this update-status, which
+        is reported instead of probing the login again, or None
+    :returns: (metrics, cache) where metrics is as render() takes.
+    """
+    now = time.time() if now is None else now
+    try:
+        tokens, cache = scan_tokens(state['store'], cache, now)
+    except OSError:
+        tokens = {}
+    try:
+        pins_age = now - os.stat(state['pins_file']).st_mtime
+        with open(state['pins_file']) as f:
+            pin = json.load(f)['pin']
+    except (OSError, ValueError, KeyError):
+        pins_age = pin = None
+    login = encrypt = None
+    if sample is not None:
+        if sample['ok']:
+            login, encrypt = sample['login'], sample['encrypt']
+    elif pin is not None:
+        try:
+            login = pkcs11.run_in_child(
+                probe_login, (state['library'], state['label'], pin),
+                user=state['user'], env={'SOFTHSM2_CONF': state['conf']},
+                timeout=PROBE_TIMEOUT)
+        except Exception:
+            pass
+    metrics = [
+        ('barbican_softhsm_tokens',
+         "The number of tokens in the token store.",
+         [({}, len(tokens))]),
+        ('barbican_softhsm_token_objects',
+         "The number of objects in each token.",
+         [({'token': name}, objects)
+          for name, (objects, _) in sorted(tokens.items())]),
+        ('barbican_softhsm_token_bytes',
+         "The bytes used by each token.",
+         [({'token': name}, size)
+          for name, (_, size) in sorted(tokens.items())]),
+        ('barbican_softhsm_pins_age_seconds',
+         "The time since the pins file was written.",
+         [({}, pins_age)]),
+        ('barbican_softhsm_read_slot_seconds',
+         "The time the last slot lookup by the charm took.",
+         [({}, state.get('read_slot'))]),
+        ('barbican_softhsm_login_probe_success',
+         "Whether a session could be opened and logged in to.",
+         [({'token': state['label']}, 0 if login is None else 1)]),
+        ('barbican_softhsm_login_probe_seconds',
+         "The time C_OpenSession, C_Login and C_Logout took.",
+         [({'token': state['label']}, login)]),
+        ('barbican_softhsm_encrypt_probe_seconds',
+         "The time the health probe's encrypt round-trip took.",
+         [({'token': state['label']}, encrypt)]),
+        ('barbican_softhsm_metrics_timestamp_seconds',
+         "When these metrics were collected.",
+         [({}, now)]),
+    ]
+    return metrics, cache
+
+
+def write_textfile(path, text):
+    """Atomically replace the textfile `path`, so that node-exporter never
+    reads a partial file.
+
+    :param path: the textfile, ending in .prom
+    :param text: its contents
+    """
+    # node-exporter only reads files ending in .prom.
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.chmod(tmp, 0o644)
+    os.rename(tmp, path)
+
+
+def update(charm_dir, sample=None, now=None):
+    """Collect the metrics and write the textfile, if the charm has saved a
+    state, the textfile's directory exists and either there is a `sample` or
+    the textfile is at least the probe interval old.
+
+    :param charm_dir: the charm directory
+    :param sample: the health probe sample taken in this update-status, or
+        None
+    :param now: the time of the collection, time.time() by default
+    :returns: True if the textfile was written.
+    """
+    state = _load(os.path.join(charm_dir, STATE_FILE))
+    if not state or not os.path.isdir(os.path.dirname(state['textfile'])):
+        return False
+    now = time.time() if now is None else now
+    if sample is None:
+        try:
+            age = now - os.stat(state['textfile']).st_mtime
+        except FileNotFoundError:
+            age = None
+        if age is not None and 0 <= age < state.get('interval', 0):
+            return False
+    cache_path = os.path.join(charm_dir, CACHE_FILE)
+    metrics, cache = collect(state, _load(cache_path), now, sample)
+    write_textfile(state['textfile'], render(metrics))
+    _save(cache_path, cache)
+    return True
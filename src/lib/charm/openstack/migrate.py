@@ -0,0 +1,361 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Copy the objects of a token in one SoftHSM token store into a new token in
+# another store, e.g. to move a 'file' backend store to the 'db' backend.
+#
+# libsofthsm2 can only use one softhsm2.conf per process, so the source and
+# target tokens are each driven from their own child process, with the
+# objects streamed between them over a pipe in bounded batches.  Sensitive
+# keys are moved by wrapping them with a transport key that only exists as a
+# session object in the two children.
+
+import multiprocessing
+import os
+
+import charm.openstack.pkcs11 as pkcs11
+
+
+# The attributes copied to the new object.
+METADATA_ATTRIBUTES = [
+    pkcs11.CKA_CLASS,
+    pkcs11.CKA_TOKEN,
+    pkcs11.CKA_PRIVATE,
+    pkcs11.CKA_LABEL,
+    pkcs11.CKA_APPLICATION,
+    pkcs11.CKA_OBJECT_ID,
+    pkcs11.CKA_CERTIFICATE_TYPE,
+    pkcs11.CKA_ISSUER,
+    pkcs11.CKA_SERIAL_NUMBER,
+    pkcs11.CKA_TRUSTED,
+    pkcs11.CKA_KEY_TYPE,
+    pkcs11.CKA_SUBJECT,
+    pkcs11.CKA_ID,
+    pkcs11.CKA_SENSITIVE,
+    pkcs11.CKA_ENCRYPT,
+    pkcs11.CKA_DECRYPT,
+    pkcs11.CKA_WRAP,
+    pkcs11.CKA_UNWRAP,
+    pkcs11.CKA_SIGN,
+    pkcs11.CKA_SIGN_RECOVER,
+    pkcs11.CKA_VERIFY,
+    pkcs11.CKA_VERIFY_RECOVER,
+    pkcs11.CKA_DERIVE,
+    pkcs11.CKA_START_DATE,
+    pkcs11.CKA_END_DATE,
+    pkcs11.CKA_EXTRACTABLE,
+    pkcs11.CKA_MODIFIABLE,
+    pkcs11.CKA_WRAP_WITH_TRUSTED,
+]
+
+# The (readable) key material copied to the new object if it isn't wrapped.
+MATERIAL_ATTRIBUTES = [
+    pkcs11.CKA_VALUE,
+    pkcs11.CKA_MODULUS,
+    pkcs11.CKA_PUBLIC_EXPONENT,
+    pkcs11.CKA_EC_PARAMS,
+    pkcs11.CKA_EC_POINT,
+]
+
+# The attributes that must be the same on both objects.  CKA_CHECK_VALUE
+# covers the material of sensitive secret keys.
+CHECKSUM_ATTRIBUTES = (METADATA_ATTRIBUTES + MATERIAL_ATTRIBUTES +
+                       [pkcs11.CKA_CHECK_VALUE])
+
+WRAP_MECHANISMS = [pkcs11.CKM_AES_KEY_WRAP_PAD, pkcs11.CKM_AES_KEY_WRAP]
+
+CONF_TEMPLATE = """\
+directories.tokendir = {tokendir}
+objectstore.backend = {backend}
+log.level = ERROR
+slots.removable = false
+"""
+
+
+class MigrationError(Exception):
+    """Raised when a token can't be migrated or fails verification."""
+    pass
+
+
+def write_conf(path, tokendir, backend):
+    """Write a minimal softhsm2.conf for a token store.
+
+    :param path: the path of the file to write
+    :param tokendir: the token directory
+    :param backend: the object store backend, 'file' or 'db'
+    """
+    with open(path, 'w') as f:
+        f.write(CONF_TEMPLATE.format(tokendir=tokendir, backend=backend))
+    os.chmod(path, 0o644)
+
+
+class Totals(object):
+    """A count of objects and an order independent checksum of them."""
+
+    def __init__(self):
+        self.objects = 0
+        self._sum = 0
+
+    def add(self, checksum):
+        """Add an object's checksum
+
+        :param checksum: hex digest string from pkcs11.object_checksum()
+        """
+        self.objects += 1
+        self._sum = (self._sum + int(checksum, 16)) % (1 << 256)
+
+    def as_dict(self):
+        return {'objects': self.objects,
+                'checksum': '{:064x}'.format(self._sum)}
+
+
+def transport_key_attributes(value):
+    """The attributes of the session key used to wrap sensitive keys.
+
+    :param value: the AES key bytes
+    :returns: dict of attribute type to value
+    """
+    return {
+        pkcs11.CKA_CLASS: pkcs11.CKO_SECRET_KEY,
+        pkcs11.CKA_KEY_TYPE: pkcs11.CKK_AES,
+        pkcs11.CKA_TOKEN: False,
+        pkcs11.CKA_PRIVATE: True,
+        pkcs11.CKA_SENSITIVE: True,
+        pkcs11.CKA_EXTRACTABLE: False,
+        pkcs11.CKA_WRAP: True,
+        pkcs11.CKA_UNWRAP: True,
+        pkcs11.CKA_VALUE: value,
+    }
+
+
+def export_object(session, handle, transport):
+    """Read the object `handle` into a record that import_object() can
+    re-create.
+
+    :param session: a logged in pkcs11.Session
+    :param handle: the object handle
+    :param transport: the handle of the transport key
+    :returns: dict record
+    :raises MigrationError: if the object is a sensitive key that can't be
+        extracted.
+    """
+    values = session.get_attributes(handle, CHECKSUM_ATTRIBUTES)
+    attributes = {attr: values[attr]
+                  for attr in METADATA_ATTRIBUTES if attr in values}
+    # only the SO can set CKA_TRUSTED, and false is the default anyway.
+    if not attributes.get(pkcs11.CKA_TRUSTED, True):
+        del attributes[pkcs11.CKA_TRUSTED]
+    record = {
+        'attributes': attributes,
+        'mechanism': None,
+        'wrapped': None,
+        'checksum': pkcs11.object_checksum(values),
+    }
+    cls = values.get(pkcs11.CKA_CLASS)
+    if (cls == pkcs11.CKO_PRIVATE_KEY or
+            (cls == pkcs11.CKO_SECRET_KEY and
+             values.get(pkcs11.CKA_SENSITIVE))):
+        if not values.get(pkcs11.CKA_EXTRACTABLE):
+            raise MigrationError(
+                "Key {!r} is sensitive and not extractable"
+                .format(values.get(pkcs11.CKA_LABEL, handle)))
+        record['mechanism'], record['wrapped'] = wrap(
+            session, transport, handle)
+    else:
+        for attr in MATERIAL_ATTRIBUTES:
+            if attr in values:
+                attributes[attr] = values[attr]
+    return record
+
+
+def wrap(session, transport, handle):
+    """Wrap the key `handle` with the first supported of WRAP_MECHANISMS
+
+    :param session: a logged in pkcs11.Session
+    :param transport: the handle of the transport key
+    :param handle: the handle of the key to wrap
+    :returns: (mechanism, wrapped bytes)
+    """
+    for mechanism in WRAP_MECHANISMS[:-1]:
+        try:
+            return mechanism, session.wrap_key(mechanism, transport, handle)
+        except pkcs11.PKCS11Error as e:
+            if e.rv != pkcs11.CKR_MECHANISM_INVALID:
+                raise
+    mechanism = WRAP_MECHANISMS[-1]
+    return mechanism, session.wrap_key(mechanism, transport, handle)
+
+
+def import_object(session, record, transport):
+    """Create an object from a record made by export_object() and verify
+    it.
+
+    :param session: a logged in pkcs11.Session
+    :param record: the dict record
+    :param transport: the handle of the transport key
+    :returns: the checksum of the new object
+    :raises MigrationError: if the new object's checksum doesn't match.
+    """
+    if record['wrapped'] is not None:
+        handle = session.unwrap_key(record['mechanism'], transport,
+                                    record['wrapped'], record['attributes'])
+    else:
+        handle = session.create_object(record['attributes'])
+    checksum = pkcs11.object_checksum(
+        session.get_attributes(handle, CHECKSUM_ATTRIBUTES))
+    if checksum != record['checksum']:
+        raise MigrationError(
+            "Object {!r} doesn't match after migration"
+            .format(record['attributes'].get(pkcs11.CKA_LABEL)))
+    return checksum
+
+
+def export_token(lib_path, label, pin, transport_value, conn, batch_size):
+    """Send every token object of the `label` token down `conn` in batches,
+    followed by None.
+
+    This runs in the source child process.
+
+    :param lib_path: the path to the PKCS#11 library
+    :param label: the token label
+    :param pin: the user pin
+    :param transport_value: the transport key bytes
+    :param conn: the sending multiprocessing Connection
+    :param batch_size: the number of objects per batch
+    :returns: Totals.as_dict() of the exported objects
+    """
+    try:
+        totals = Totals()
+        with pkcs11.initialized(lib_path) as lib:
+            slot_id = pkcs11.find_token_slot(lib, label)
+            if slot_id is None:
+                raise MigrationError("No {} token to migrate".format(label))
+            # finding and reading the objects use separate sessions so that
+            # the find operation stays active between the batches.
+            with lib.open_session(slot_id) as finder, \
+                    lib.open_session(slot_id) as session:
+                session.login(pin)
+                transport = session.create_object(
+                    transport_key_attributes(transport_value))
+                for handles in finder.find_objects({pkcs11.CKA_TOKEN: True},
+                                                   batch_size):
+                    records = [export_object(session, handle, transport)
+                               for handle in handles]
+                    for record in records:
+                        totals.add(record['checksum'])
+                    conn.send(records)
+        conn.send(None)
+        return totals.as_dict()
+    finally:
+        conn.close()
+
+
+def import_token(lib_path, label, so_pin, pin, transport_value, conn):
+    """Initialise a new `label` token and create the objects received from
+    `conn` in it until None is received.
+
+    This runs in the target child process.
+
+    :param lib_path: the path to the PKCS#11 library
+    :param label: the token label
+    :param so_pin: the security officer pin for the new token
+    :param pin: the user pin for the new token
+    :param transport_value: the transport key bytes
+    :param conn: the receiving multiprocessing Connection
+    :returns: Totals.as_dict() of the imported objects
+    """
+    try:
+        totals = Totals()
+        with pkcs11.initialized(lib_path) as lib:
+            slot_id = pkcs11.init_free_token(lib, label, so_pin, pin)
+            with lib.open_session(slot_id) as session:
+                session.login(pin)
+                transport = session.create_object(
+                    transport_key_attributes(transport_value))
+                while True:
+                    records = conn.recv()
+                    if records is None:
+                        break
+                    for record in records:
+                        totals.add(import_object(session, record, transport))
+        return totals.as_dict()
+    finally:
+        conn.close()
+
+
+def _export_token(unused, *args):
+    # the child inherits both ends of the pipe; close the one it doesn't
+    # use so that the other child sees EOF or EPIPE if this one dies.
+    unused.close()
+    return export_token(*args)
+
+
+def _import_token(unused, *args):
+    unused.close()
+    return import_token(*args)
+
+
+def migrate_token(lib_path, label, pin, so_pin, source_conf, target_conf,
+                  user, batch_size=100):
+    """Copy the `label` token from the store described by `source_conf` to
+    a new token with the same label and pins in the store described by
+    `target_conf`, and verify the copy.
+
+    :param lib_path: the path to the PKCS#11 library
+    :param label: the token label
+    :param pin: the user pin
+    :param so_pin: the security officer pin
+    :param source_conf: path of the softhsm2.conf for the source store
+    :param target_conf: path of the softhsm2.conf for the target store
+    :param user: the user to access the token stores as
+    :param batch_size: the number of objects per batch
+    :returns: Totals.as_dict() of the migrated objects
+    :raises MigrationError: if the token can't be migrated or the object
+        counts or checksums don't match.
+    """
+    transport = os.urandom(32)
+    receiver, sender = multiprocessing.get_context('fork').Pipe(
+        duplex=False)
+    source = pkcs11.Child(
+        _export_token,
+        (receiver, lib_path, label, pin, transport, sender, batch_size),
+        user=user, env={'SOFTHSM2_CONF': source_conf})
+    target = pkcs11.Child(
+        _import_token,
+        (sender, lib_path, label, so_pin, pin, transport, receiver),
+        user=user, env={'SOFTHSM2_CONF': target_conf})
+    sender.close()
+    receiver.close()
+    try:
+        imported = target.result()
+    except EOFError as e:
+        # the source stopped sending; report why.
+        try:
+            source.result()
+        except Exception as source_error:
+            raise source_error from e
+        raise
+    except Exception:
+        # reap the source, but report why the target failed.
+        try:
+            source.result()
+        except Exception:
+            pass
+        raise
+    exported = source.result()
+    if exported != imported:
+        raise MigrationError(
+            "Token {} doesn't match after migration: exported {}, imported {}"
+            .format(label, exported, imported))
+    return imported
@@ -0,0 +1,992 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# A minimal ctypes binding to a PKCS#11 module (e.g. libsofthsm2.so).
+#
+# This module deliberately only depends on the standard library so that it
+# can be loaded into the hook process without any extra wheels, and only
+# binds the handful of Cryptoki functions that the charm needs.
+
+import collections
+import contextlib
+import ctypes
+import hashlib
+import multiprocessing
+import os
+import pwd
+
+
+CK_ULONG = ctypes.c_ulong
+CK_RV = CK_ULONG
+CK_SLOT_ID = CK_ULONG
+CK_SESSION_HANDLE = CK_ULONG
+CK_OBJECT_HANDLE = CK_ULONG
+CK_FLAGS = CK_ULONG
+CK_BBOOL = ctypes.c_ubyte
+
+CK_UNAVAILABLE_INFORMATION = CK_ULONG(-1).value
+
+CKR_OK = 0x00000000
+CKR_ATTRIBUTE_SENSITIVE = 0x00000011
+CKR_ATTRIBUTE_TYPE_INVALID = 0x00000012
+CKR_MECHANISM_INVALID = 0x00000070
+CKR_BUFFER_TOO_SMALL = 0x00000150
+CKR_CRYPTOKI_ALREADY_INITIALIZED = 0x00000191
+
+CKF_TOKEN_PRESENT = 0x00000001
+CKF_OS_LOCKING_OK = 0x00000002
+CKF_RW_SESSION = 0x00000002
+CKF_SERIAL_SESSION = 0x00000004
+CKF_USER_PIN_INITIALIZED = 0x00000008
+CKF_TOKEN_INITIALIZED = 0x00000400
+
+# Mechanism flags
+CKF_HW = 0x00000001
+CKF_ENCRYPT = 0x00000100
+CKF_DECRYPT = 0x00000200
+CKF_SIGN = 0x00000800
+CKF_VERIFY = 0x00002000
+CKF_GENERATE = 0x00008000
+CKF_WRAP = 0x00020000
+CKF_UNWRAP = 0x00040000
+
+CKU_SO = 0
+CKU_USER = 1
+
+CK_TRUE = 1
+CK_FALSE = 0
+
+# Object classes
+CKO_DATA = 0x0
+CKO_CERTIFICATE = 0x1
+CKO_PUBLIC_KEY = 0x2
+CKO_PRIVATE_KEY = 0x3
+CKO_SECRET_KEY = 0x4
+
+# Key types
+CKK_GENERIC_SECRET = 0x10
+CKK_AES = 0x1f
+
+# Attributes
+CKA_CLASS = 0x000
+CKA_TOKEN = 0x001
+CKA_PRIVATE = 0x002
+CKA_LABEL = 0x003
+CKA_APPLICATION = 0x010
+CKA_VALUE = 0x011
+CKA_OBJECT_ID = 0x012
+CKA_CERTIFICATE_TYPE = 0x080
+CKA_ISSUER = 0x081
+CKA_SERIAL_NUMBER = 0x082
+CKA_TRUSTED = 0x086
+CKA_CHECK_VALUE = 0x090
+CKA_KEY_TYPE = 0x100
+CKA_SUBJECT = 0x101
+CKA_ID = 0x102
+CKA_SENSITIVE = 0x103
+CKA_ENCRYPT = 0x104
+CKA_DECRYPT = 0x105
+CKA_WRAP = 0x106
+CKA_UNWRAP = 0x107
+CKA_SIGN = 0x108
+CKA_SIGN_RECOVER = 0x109
+CKA_VERIFY = 0x10a
+CKA_VERIFY_RECOVER = 0x10b
+CKA_DERIVE = 0x10c
+CKA_START_DATE = 0x110
+CKA_END_DATE = 0x111
+CKA_MODULUS = 0x120
+CKA_MODULUS_BITS = 0x121
+CKA_PUBLIC_EXPONENT = 0x122
+CKA_VALUE_LEN = 0x161
+CKA_EXTRACTABLE = 0x162
+CKA_LOCAL = 0x163
+CKA_NEVER_EXTRACTABLE = 0x164
+CKA_ALWAYS_SENSITIVE = 0x165
+CKA_MODIFIABLE = 0x170
+CKA_EC_PARAMS = 0x180
+CKA_EC_POINT = 0x181
+CKA_WRAP_WITH_TRUSTED = 0x210
+
+# Mechanisms
+CKM_SHA256_HMAC = 0x251
+CKM_GENERIC_SECRET_KEY_GEN = 0x350
+CKM_AES_KEY_GEN = 0x1080
+CKM_AES_CBC = 0x1082
+CKM_AES_CBC_PAD = 0x1085
+CKM_AES_CTR = 0x1086
+CKM_AES_GCM = 0x1087
+CKM_AES_KEY_WRAP = 0x2109
+CKM_AES_KEY_WRAP_PAD = 0x210a
+
+# Names of the mechanisms that the charm checks for in the PKCS#11 module.
+MECHANISMS = {
+    'CKM_SHA256_HMAC': CKM_SHA256_HMAC,
+    'CKM_GENERIC_SECRET_KEY_GEN': CKM_GENERIC_SECRET_KEY_GEN,
+    'CKM_AES_KEY_GEN': CKM_AES_KEY_GEN,
+    'CKM_AES_CBC': CKM_AES_CBC,
+    'CKM_AES_CBC_PAD': CKM_AES_CBC_PAD,
+    'CKM_AES_CTR': CKM_AES_CTR,
+    'CKM_AES_GCM': CKM_AES_GCM,
+    'CKM_AES_KEY_WRAP': CKM_AES_KEY_WRAP,
+    'CKM_AES_KEY_WRAP_PAD': CKM_AES_KEY_WRAP_PAD,
+}
+
+# Names of the key types and key generation mechanisms that can be set in
+# the charm config.
+KEY_TYPES = {
+    'CKK_GENERIC_SECRET': CKK_GENERIC_SECRET,
+    'CKK_AES': CKK_AES,
+}
+KEY_GEN_MECHANISMS = {
+    'CKM_GENERIC_SECRET_KEY_GEN': CKM_GENERIC_SECRET_KEY_GEN,
+    'CKM_AES_KEY_GEN': CKM_AES_KEY_GEN,
+}
+
+# The attributes whose values are CK_BBOOL or CK_ULONG; all others are
+# treated as byte strings.
+BOOL_ATTRIBUTES = frozenset([
+    CKA_TOKEN, CKA_PRIVATE, CKA_TRUSTED, CKA_SENSITIVE, CKA_ENCRYPT,
+    CKA_DECRYPT, CKA_WRAP, CKA_UNWRAP, CKA_SIGN, CKA_SIGN_RECOVER,
+    CKA_VERIFY, CKA_VERIFY_RECOVER, CKA_DERIVE, CKA_EXTRACTABLE, CKA_LOCAL,
+    CKA_NEVER_EXTRACTABLE, CKA_ALWAYS_SENSITIVE, CKA_MODIFIABLE,
+    CKA_WRAP_WITH_TRUSTED])
+ULONG_ATTRIBUTES = frozenset([
+    CKA_CLASS, CKA_CERTIFICATE_TYPE, CKA_KEY_TYPE, CKA_MODULUS_BITS,
+    CKA_VALUE_LEN])
+
+
+class CK_VERSION(ctypes.Structure):
+    _fields_ = [
+        ('major', ctypes.c_ubyte),
+        ('minor', ctypes.c_ubyte),
+    ]
+
+
+class CK_C_INITIALIZE_ARGS(ctypes.Structure):
+    _fields_ = [
+        ('CreateMutex', ctypes.c_void_p),
+        ('DestroyMutex', ctypes.c_void_p),
+        ('LockMutex', ctypes.c_void_p),
+        ('UnlockMutex', ctypes.c_void_p),
+        ('flags', CK_FLAGS),
+        ('pReserved', ctypes.c_void_p),
+    ]
+
+
+class CK_ATTRIBUTE(ctypes.Structure):
+    _fields_ = [
+        ('type', CK_ULONG),
+        ('pValue', ctypes.c_void_p),
+        ('ulValueLen', CK_ULONG),
+    ]
+
+
+class CK_MECHANISM(ctypes.Structure):
+    _fields_ = [
+        ('mechanism', CK_ULONG),
+        ('pParameter', ctypes.c_void_p),
+        ('ulParameterLen', CK_ULONG),
+    ]
+
+
+class CK_MECHANISM_INFO(ctypes.Structure):
+    _fields_ = [
+        ('ulMinKeySize', CK_ULONG),
+        ('ulMaxKeySize', CK_ULONG),
+        ('flags', CK_FLAGS),
+    ]
+
+
+class CK_SLOT_INFO(ctypes.Structure):
+    _fields_ = [
+        ('slotDescription', ctypes.c_char * 64),
+        ('manufacturerID', ctypes.c_char * 32),
+        ('flags', CK_FLAGS),
+        ('hardwareVersion', CK_VERSION),
+        ('firmwareVersion', CK_VERSION),
+    ]
+
+
+class CK_TOKEN_INFO(ctypes.Structure):
+    _fields_ = [
+        ('label', ctypes.c_char * 32),
+        ('manufacturerID', ctypes.c_char * 32),
+        ('model', ctypes.c_char * 16),
+        ('serialNumber', ctypes.c_char * 16),
+        ('flags', CK_FLAGS),
+        ('ulMaxSessionCount', CK_ULONG),
+        ('ulSessionCount', CK_ULONG),
+        ('ulMaxRwSessionCount', CK_ULONG),
+        ('ulRwSessionCount', CK_ULONG),
+        ('ulMaxPinLen', CK_ULONG),
+        ('ulMinPinLen', CK_ULONG),
+        ('ulTotalPublicMemory', CK_ULONG),
+        ('ulFreePublicMemory', CK_ULONG),
+        ('ulTotalPrivateMemory', CK_ULONG),
+        ('ulFreePrivateMemory', CK_ULONG),
+        ('hardwareVersion', CK_VERSION),
+        ('firmwareVersion', CK_VERSION),
+        ('utcTime', ctypes.c_char * 16),
+    ]
+
+
+# The records returned for a slot and the token in it.  These are shared with
+# the softhsm2-util output parser so that callers get the same records
+# whichever way the slots were read.
+SlotInfo = collections.namedtuple(
+    'SlotInfo',
+    ['slot_id', 'description', 'token_present', 'hardware_version',
+     'firmware_version', 'token'])
+
+TokenInfo = collections.namedtuple(
+    'TokenInfo',
+    ['label', 'manufacturer_id', 'model', 'serial', 'initialized',
+     'user_pin_initialized', 'hardware_version', 'firmware_version'])
+
+MechanismInfo = collections.namedtuple(
+    'MechanismInfo', ['min_key_size', 'max_key_size', 'flags'])
+
+
+class PKCS11Error(Exception):
+    """Raised when a Cryptoki function returns anything other than CKR_OK."""
+
+    def __init__(self, function, rv):
+        self.function = function
+        self.rv = rv
+        # keep the args so that the exception can be pickled back from a
+        # child process.
+        super(PKCS11Error, self).__init__(function, rv)
+
+    def __str__(self):
+        return "{} failed with CKR 0x{:08x}".format(self.function, self.rv)
+
+
+def _text(value):
+    """Decode a blank padded, fixed length PKCS#11 string.
+
+    :param value: bytes from a CK_UTF8CHAR array
+    :returns: str with the padding removed
+    """
+    return value.decode('utf-8', 'replace').rstrip(' \x00')
+
+
+def _version(version):
+    """Format a CK_VERSION the way softhsm2-util does, e.g. '2.0'
+
+    :param version: a CK_VERSION structure
+    :returns: str
+    """
+    return "{}.{}".format(version.major, version.minor)
+
+
+def _pad(text, length):
+    """Encode `text` as a blank padded, fixed length PKCS#11 string.
+
+    :param text: str to encode
+    :param length: the length of the field
+    :returns: bytes
+    :raises ValueError: if `text` doesn't fit in the field.
+    """
+    value = text.encode('utf-8')
+    if len(value) > length:
+        raise ValueError("'{}' is longer than {} bytes".format(text, length))
+    return value.ljust(length)
+
+
+def _mechanism(mechanism, parameter=None):
+    """Build a CK_MECHANISM, with `parameter` bytes if it has any.
+
+    :returns: (CK_MECHANISM, buffer) where the buffer must be kept alive for
+        as long as the mechanism is used.
+    """
+    if parameter is None:
+        return CK_MECHANISM(mechanism, None, 0), None
+    buf = ctypes.create_string_buffer(parameter, len(parameter))
+    return (CK_MECHANISM(mechanism, ctypes.cast(buf, ctypes.c_void_p),
+                         len(parameter)),
+            buf)
+
+
+def _ulong_bytes(value):
+    """Return the bytes of `value` as a native CK_ULONG"""
+    return bytes(CK_ULONG(value))
+
+
+class Template(object):
+    """A CK_ATTRIBUTE array built from a dictionary of attribute type to
+    value, keeping the value buffers alive for as long as the template is.
+
+    Values are bools for the BOOL_ATTRIBUTES, ints for the ULONG_ATTRIBUTES,
+    and bytes (or str, which is encoded as UTF-8) for the others.
+
+    :param attributes: dict of attribute type to value
+    """
+
+    def __init__(self, attributes):
+        items = sorted(attributes.items())
+        self.count = len(items)
+        self.array = (CK_ATTRIBUTE * self.count)()
+        self._buffers = []
+        for i, (attr, value) in enumerate(items):
+            value = encode_attribute(attr, value)
+            buf = ctypes.create_string_buffer(value, len(value))
+            self._buffers.append(buf)
+            self.array[i].type = attr
+            self.array[i].pValue = ctypes.cast(buf, ctypes.c_void_p)
+            self.array[i].ulValueLen = len(value)
+
+
+def encode_attribute(attr, value):
+    """Encode an attribute `value` as the bytes PKCS#11 expects.
+
+    :param attr: the CKA_ attribute type
+    :param value: the value, as described in Template
+    :returns: bytes
+    """
+    if attr in BOOL_ATTRIBUTES:
+        return bytes([CK_TRUE if value else CK_FALSE])
+    if attr in ULONG_ATTRIBUTES:
+        return _ulong_bytes(value)
+    if isinstance(value, str):
+        return value.encode('utf-8')
+    return bytes(value)
+
+
+def decode_attribute(attr, value):
+    """Decode the bytes of an attribute into a Python value; the inverse of
+    encode_attribute().
+
+    :param attr: the CKA_ attribute type
+    :param value: bytes
+    :returns: bool, int or bytes
+    """
+    if attr in BOOL_ATTRIBUTES:
+        return value != bytes([CK_FALSE])
+    if attr in ULONG_ATTRIBUTES:
+        return CK_ULONG.from_buffer_copy(value).value
+    return value
+
+
+class Library(object):
+    """A loaded PKCS#11 module.
+
+    :param path: the path to the PKCS#11 shared object to load.
+    :raises OSError: if the shared object can't be loaded.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lib = ctypes.CDLL(path)
+
+    def _call(self, function, *args):
+        """Call the Cryptoki `function` and check its return value.
+
+        :param function: the name of the C_ function to call
+        :param args: the ctypes arguments to pass
+        :raises PKCS11Error: if the function doesn't return CKR_OK
+        """
+        rv = self._call_rv(function, *args)
+        if rv != CKR_OK:
+            raise PKCS11Error(function, rv)
+
+    def _call_rv(self, function, *args):
+        """Call the Cryptoki `function` and return its CK_RV.
+
+        :param function: the name of the C_ function to call
+        :param args: the ctypes arguments to pass
+        :returns: int
+        """
+        f = getattr(self._lib, function)
+        f.restype = CK_RV
+        return f(*args)
+
+    def initialize(self):
+        """Initialise the library, telling it that it may use OS locking so
+        that it can be used from several threads.
+        """
+        args = CK_C_INITIALIZE_ARGS()
+        args.flags = CKF_OS_LOCKING_OK
+        try:
+            self._call('C_Initialize', ctypes.byref(args))
+        except PKCS11Error as e:
+            if e.rv != CKR_CRYPTOKI_ALREADY_INITIALIZED:
+                raise
+
+    def finalize(self):
+        """Finalise the library."""
+        self._call('C_Finalize', None)
+
+    def get_slot_list(self, token_present=True):
+        """Return the list of slot ids.
+
+        :param token_present: only return slots that have a token present.
+        :returns: list of int slot ids
+        """
+        flag = CK_BBOOL(CK_TRUE if token_present else CK_FALSE)
+        count = CK_ULONG(0)
+        while True:
+            self._call('C_GetSlotList', flag, None, ctypes.byref(count))
+            slots = (CK_SLOT_ID * count.value)()
+            try:
+                self._call('C_GetSlotList', flag, slots, ctypes.byref(count))
+            except PKCS11Error as e:
+                # a slot appeared between the two calls; try again.
+                if e.rv == CKR_BUFFER_TOO_SMALL:
+                    continue
+                raise
+            return [slots[i] for i in range(count.value)]
+
+    def get_token_info(self, slot_id):
+        """Return the TokenInfo for the token in `slot_id`
+
+        :param slot_id: the slot to query
+        :returns: TokenInfo record
+        """
+        info = CK_TOKEN_INFO()
+        self._call('C_GetTokenInfo', CK_SLOT_ID(slot_id), ctypes.byref(info))
+        return TokenInfo(
+            label=_text(info.label),
+            manufacturer_id=_text(info.manufacturerID),
+            model=_text(info.model),
+            serial=_text(info.serialNumber),
+            initialized=bool(info.flags & CKF_TOKEN_INITIALIZED),
+            user_pin_initialized=bool(info.flags & CKF_USER_PIN_INITIALIZED),
+            hardware_version=_version(info.hardwareVersion),
+            firmware_version=_version(info.firmwareVersion))
+
+    def get_slot_info(self, slot_id):
+        """Return the SlotInfo for `slot_id`, including the token if one is
+        present in the slot.
+
+        :param slot_id: the slot to query
+        :returns: SlotInfo record
+        """
+        info = CK_SLOT_INFO()
+        self._call('C_GetSlotInfo', CK_SLOT_ID(slot_id), ctypes.byref(info))
+        token_present = bool(info.flags & CKF_TOKEN_PRESENT)
+        return SlotInfo(
+            slot_id=slot_id,
+            description=_text(info.slotDescription),
+            token_present=token_present,
+            hardware_version=_version(info.hardwareVersion),
+            firmware_version=_version(info.firmwareVersion),
+            token=self.get_token_info(slot_id) if token_present else None)
+
+    def get_mechanism_list(self, slot_id):
+        """Return the mechanisms the token in `slot_id` supports.
+
+        :param slot_id: the slot to query
+        :returns: list of int CKM_ values
+        """
+        count = CK_ULONG(0)
+        self._call('C_GetMechanismList', CK_SLOT_ID(slot_id), None,
+                   ctypes.byref(count))
+        mechanisms = (CK_ULONG * count.value)()
+        self._call('C_GetMechanismList', CK_SLOT_ID(slot_id), mechanisms,
+                   ctypes.byref(count))
+        return [mechanisms[i] for i in range(count.value)]
+
+    def get_mechanism_info(self, slot_id, mechanism):
+        """Return the MechanismInfo for `mechanism` on the token in
+        `slot_id`.
+
+        :param slot_id: the slot to query
+        :param mechanism: the CKM_ mechanism
+        :returns: MechanismInfo record
+        """
+        info = CK_MECHANISM_INFO()
+        self._call('C_GetMechanismInfo', CK_SLOT_ID(slot_id),
+                   CK_ULONG(mechanism), ctypes.byref(info))
+        return MechanismInfo(min_key_size=info.ulMinKeySize,
+                             max_key_size=info.ulMaxKeySize,
+                             flags=info.flags)
+
+    def init_token(self, slot_id, so_pin, label):
+        """Initialise the token in `slot_id` with the `label` and SO pin.
+
+        :param slot_id: the slot of the token to initialise
+        :param so_pin: the security officer pin string
+        :param label: the token label string
+        """
+        pin = so_pin.encode('utf-8')
+        self._call('C_InitToken', CK_SLOT_ID(slot_id), pin, CK_ULONG(len(pin)),
+                   _pad(label, 32))
+
+    def open_session(self, slot_id, rw=True):
+        """Open a session on the token in `slot_id`
+
+        :param slot_id: the slot to open the session on
+        :param rw: whether to open a read/write session
+        :returns: Session
+        """
+        flags = CKF_SERIAL_SESSION | (CKF_RW_SESSION if rw else 0)
+        handle = CK_SESSION_HANDLE()
+        self._call('C_OpenSession', CK_SLOT_ID(slot_id), CK_FLAGS(flags),
+                   None, None, ctypes.byref(handle))
+        return Session(self, handle.value)
+
+
+class Session(object):
+    """An open PKCS#11 session; use Library.open_session() to create one.
+
+    A Session is a context manager that closes the session on exit.
+    """
+
+    def __init__(self, lib, handle):
+        self.lib = lib
+        self.handle = handle
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _call(self, function, *args):
+        self.lib._call(function, CK_SESSION_HANDLE(self.handle), *args)
+
+    def close(self):
+        """Close the session."""
+        self._call('C_CloseSession')
+
+    def login(self, pin, user_type=CKU_USER):
+        """Log the session in.
+
+        :param pin: the pin string
+        :param user_type: CKU_USER or CKU_SO
+        """
+        pin = pin.encode('utf-8')
+        self._call('C_Login', CK_ULONG(user_type), pin, CK_ULONG(len(pin)))
+
+    def logout(self):
+        """Log the session out."""
+        self._call('C_Logout')
+
+    def init_pin(self, pin):
+        """Set the user pin; the session must be logged in as the SO.
+
+        :param pin: the user pin string
+        """
+        pin = pin.encode('utf-8')
+        self._call('C_InitPIN', pin, CK_ULONG(len(pin)))
+
+    def find_objects(self, attributes=None, batch_size=100):
+        """Find the objects matching `attributes`, yielding them in batches.
+
+        Only one find operation may be active on a session at a time, and
+        the session should not be used for anything else until the
+        generator is exhausted or closed.
+
+        :param attributes: dict of attribute type to value to match
+        :param batch_size: the number of handles to fetch per C_FindObjects
+        :returns: generator of lists of object handles
+        """
+        template = Template(attributes or {})
+        self._call('C_FindObjectsInit', template.array,
+                   CK_ULONG(template.count))
+        try:
+            handles = (CK_OBJECT_HANDLE * batch_size)()
+            count = CK_ULONG(0)
+            while True:
+                self._call('C_FindObjects', handles, CK_ULONG(batch_size),
+                           ctypes.byref(count))
+                if count.value == 0:
+                    break
+                yield [handles[i] for i in range(count.value)]
+        finally:
+            self._call('C_FindObjectsFinal')
+
+    def find_object(self, attributes):
+        """Return the first object matching `attributes`
+
+        :param attributes: dict of attribute type to value to match
+        :returns: the object handle, or None if there is no match.
+        """
+        found = self.find_objects(attributes, batch_size=1)
+        try:
+            return next(found, [None])[0]
+        finally:
+            found.close()
+
+    def get_attributes(self, handle, attributes):
+        """Return the values of the `attributes` of the object `handle`.
+
+        Attributes that the object doesn't have, or that are sensitive, are
+        left out of the returned dict.
+
+        :param handle: the object handle
+        :param attributes: list of attribute types to read
+        :returns: dict of attribute type to value, as decode_attribute()
+        """
+        tolerated = (CKR_OK, CKR_ATTRIBUTE_SENSITIVE,
+                     CKR_ATTRIBUTE_TYPE_INVALID)
+        template = (CK_ATTRIBUTE * len(attributes))()
+        for i, attr in enumerate(attributes):
+            template[i].type = attr
+        args = (CK_SESSION_HANDLE(self.handle), CK_OBJECT_HANDLE(handle),
+                template, CK_ULONG(len(attributes)))
+        # the first call gets the lengths, the second the values.
+        rv = self.lib._call_rv('C_GetAttributeValue', *args)
+        if rv not in tolerated:
+            raise PKCS11Error('C_GetAttributeValue', rv)
+        buffers = {}
+        for i, attr in enumerate(attributes):
+            length = template[i].ulValueLen
+            if length == CK_UNAVAILABLE_INFORMATION:
+                template[i].pValue = None
+                template[i].ulValueLen = 0
+                continue
+            buf = ctypes.create_string_buffer(max(length, 1))
+            buffers[i] = buf
+            template[i].pValue = ctypes.cast(buf, ctypes.c_void_p)
+        rv = self.lib._call_rv('C_GetAttributeValue', *args)
+        if rv not in tolerated:
+            raise PKCS11Error('C_GetAttributeValue', rv)
+        values = {}
+        for i, buf in buffers.items():
+            length = template[i].ulValueLen
+            if length == CK_UNAVAILABLE_INFORMATION:
+                continue
+            attr = attributes[i]
+            values[attr] = decode_attribute(attr, buf.raw[:length])
+        return values
+
+    def create_object(self, attributes):
+        """Create an object from the `attributes`
+
+        :param attributes: dict of attribute type to value
+        :returns: the new object handle
+        """
+        template = Template(attributes)
+        handle = CK_OBJECT_HANDLE()
+        self._call('C_CreateObject', template.array, CK_ULONG(template.count),
+                   ctypes.byref(handle))
+        return handle.value
+
+    def generate_key(self, mechanism, attributes):
+        """Generate a secret key with `attributes`
+
+        :param mechanism: the CKM_ key generation mechanism
+        :param attributes: dict of attribute type to value for the new key
+        :returns: the new key handle
+        """
+        mech = CK_MECHANISM(mechanism, None, 0)
+        template = Template(attributes)
+        handle = CK_OBJECT_HANDLE()
+        self._call('C_GenerateKey', ctypes.byref(mech), template.array,
+                   CK_ULONG(template.count), ctypes.byref(handle))
+        return handle.value
+
+    def destroy_object(self, handle):
+        """Destroy the object `handle`
+
+        :param handle: the object handle
+        """
+        self._call('C_DestroyObject', CK_OBJECT_HANDLE(handle))
+
+    def _single_part(self, init, function, mechanism, key, data,
+                     parameter=None):
+        mech, buf = _mechanism(mechanism, parameter)
+        self._call(init, ctypes.byref(mech), CK_OBJECT_HANDLE(key))
+        # the first call gets the output length, the second the output.
+        length = CK_ULONG(0)
+        self._call(function, data, CK_ULONG(len(data)), None,
+                   ctypes.byref(length))
+        out = ctypes.create_string_buffer(max(length.value, 1))
+        self._call(function, data, CK_ULONG(len(data)), out,
+                   ctypes.byref(length))
+        return out.raw[:length.value]
+
+    def encrypt(self, mechanism, key, data, parameter=None):
+        """Encrypt `data` with `key` in a single part.
+
+        :param mechanism: the CKM_ encryption mechanism
+        :param key: the key handle
+        :param data: the plaintext bytes
+        :param parameter: the mechanism parameter bytes (e.g. an IV)
+        :returns: the ciphertext bytes
+        """
+        return self._single_part('C_EncryptInit', 'C_Encrypt', mechanism,
+                                 key, data, parameter)
+
+    def decrypt(self, mechanism, key, data, parameter=None):
+        """Decrypt `data` with `key` in a single part.
+
+        :param mechanism: the CKM_ encryption mechanism
+        :param key: the key handle
+        :param data: the ciphertext bytes
+        :param parameter: the mechanism parameter bytes (e.g. an IV)
+        :returns: the plaintext bytes
+        """
+        return self._single_part('C_DecryptInit', 'C_Decrypt', mechanism,
+                                 key, data, parameter)
+
+    def sign(self, mechanism, key, data):
+        """Sign (or MAC) `data` with `key` in a single part.
+
+        :param mechanism: the CKM_ signing mechanism
+        :param key: the key handle
+        :param data: the bytes to sign
+        :returns: the signature bytes
+        """
+        return self._single_part('C_SignInit', 'C_Sign', mechanism, key,
+                                 data)
+
+    def wrap_key(self, mechanism, wrapping_key, key):
+        """Wrap (encrypt) `key` with `wrapping_key`
+
+        :param mechanism: the CKM_ wrapping mechanism
+        :param wrapping_key: the handle of the wrapping key
+        :param key: the handle of the key to wrap
+        :returns: the wrapped key bytes
+        """
+        mech = CK_MECHANISM(mechanism, None, 0)
+        length = CK_ULONG(0)
+        self._call('C_WrapKey', ctypes.byref(mech),
+                   CK_OBJECT_HANDLE(wrapping_key), CK_OBJECT_HANDLE(key),
+                   None, ctypes.byref(length))
+        buf = ctypes.create_string_buffer(length.value)
+        self._call('C_WrapKey', ctypes.byref(mech),
+                   CK_OBJECT_HANDLE(wrapping_key), CK_OBJECT_HANDLE(key),
+                   buf, ctypes.byref(length))
+        return buf.raw[:length.value]
+
+    def unwrap_key(self, mechanism, unwrapping_key, wrapped, attributes):
+        """Unwrap the `wrapped` key into a new object with `attributes`
+
+        :param mechanism: the CKM_ wrapping mechanism
+        :param unwrapping_key: the handle of the unwrapping key
+        :param wrapped: the wrapped key bytes
+        :param attributes: dict of attribute type to value for the new key
+        :returns: the new key handle
+        """
+        mech = CK_MECHANISM(mechanism, None, 0)
+        template = Template(attributes)
+        handle = CK_OBJECT_HANDLE()
+        self._call('C_UnwrapKey', ctypes.byref(mech),
+                   CK_OBJECT_HANDLE(unwrapping_key),
+                   wrapped, CK_ULONG(len(wrapped)),
+                   template.array, CK_ULONG(template.count),
+                   ctypes.byref(handle))
+        return handle.value
+
+
+@contextlib.contextmanager
+def initialized(path):
+    """Load and initialise the PKCS#11 module at `path` for the duration of
+    the context, finalising it on exit.
+
+    :param path: the path to the PKCS#11 shared object.
+    :raises OSError: if the shared object can't be loaded.
+    :raises PKCS11Error: if the module can't be initialised.
+    """
+    lib = Library(path)
+    lib.initialize()
+    try:
+        yield lib
+    finally:
+        lib.finalize()
+
+
+def find_slot(path, label):
+    """Find the slot holding the initialised token labelled `label`
+
+    :param path: the path to the PKCS#11 shared object.
+    :param label: the exact token label to look for.
+    :returns: SlotInfo for the slot, or None if there is no such token.
+    """
+    with initialized(path) as lib:
+        slot_id = find_token_slot(lib, label)
+        if slot_id is not None:
+            return lib.get_slot_info(slot_id)
+    return None
+
+
+def read_mechanisms(path):
+    """Read the MECHANISMS that the PKCS#11 module at `path` supports.
+
+    SoftHSM offers the same mechanisms in every slot, so the first slot is
+    queried, which always holds at least the free token.
+
+    :param path: the path to the PKCS#11 shared object.
+    :returns: dict of mechanism name to MechanismInfo, for the supported
+        MECHANISMS.
+    """
+    names = {value: name for name, value in MECHANISMS.items()}
+    with initialized(path) as lib:
+        slot_id = lib.get_slot_list(token_present=False)[0]
+        return {names[mechanism]: lib.get_mechanism_info(slot_id, mechanism)
+                for mechanism in lib.get_mechanism_list(slot_id)
+                if mechanism in names}
+
+
+def find_token_slot(lib, label):
+    """Return the slot id of the initialised token labelled `label`
+
+    :param lib: an initialised Library
+    :param label: the exact token label to look for.
+    :returns: int slot id, or None if there is no such token.
+    """
+    for slot_id in lib.get_slot_list(token_present=True):
+        token = lib.get_token_info(slot_id)
+        if token.initialized and token.label == label:
+            return slot_id
+    return None
+
+
+def init_free_token(lib, label, so_pin, pin):
+    """Initialise the free (uninitialised) token with `label` and pins.
+
+    SoftHSM always presents one uninitialised token; once it is initialised
+    the token is reassigned to a new slot, which is found by its serial.
+
+    :param lib: an initialised Library
+    :param label: the label for the token
+    :param so_pin: the security officer pin string
+    :param pin: the user pin string
+    :returns: the int slot id of the new token
+    :raises RuntimeError: if there is no free token or it can't be found
+        after initialisation.
+    """
+    free = None
+    for slot_id in lib.get_slot_list(token_present=True):
+        if not lib.get_token_info(slot_id).initialized:
+            free = slot_id
+            break
+    if free is None:
+        raise RuntimeError("No free token to initialise")
+    lib.init_token(free, so_pin, label)
+    with lib.open_session(free) as session:
+        session.login(so_pin, CKU_SO)
+        session.init_pin(pin)
+        session.logout()
+    serial = lib.get_token_info(free).serial
+    for slot_id in lib.get_slot_list(token_present=True):
+        token = lib.get_token_info(slot_id)
+        if token.initialized and token.serial == serial:
+            return slot_id
+    raise RuntimeError("Initialised token {} has gone away".format(label))
+
+
+def object_checksum(values):
+    """Return a checksum of an object's attribute values.
+
+    :param values: dict of attribute type to value, as get_attributes()
+    :returns: hex digest string
+    """
+    digest = hashlib.sha256()
+    for attr, value in sorted(values.items()):
+        value = encode_attribute(attr, value)
+        digest.update(_ulong_bytes(attr))
+        digest.update(_ulong_bytes(len(value)))
+        digest.update(value)
+    return digest.hexdigest()
+
+
+def drop_privileges(user):
+    """Switch the current process to `user` and its groups.
+
+    :param user: the user name
+    """
+    pw = pwd.getpwnam(user)
+    os.setgroups(os.getgrouplist(user, pw.pw_gid))
+    os.setgid(pw.pw_gid)
+    os.setuid(pw.pw_uid)
+    os.environ['HOME'] = pw.pw_dir
+    os.environ['USER'] = user
+    os.environ['LOGNAME'] = user
+
+
+def _child_main(conn, func, args, user, env):
+    """The entry point of a Child process."""
+    try:
+        if env:
+            os.environ.update(env)
+        if user is not None:
+            drop_privileges(user)
+        result = (True, func(*args))
+    except Exception as e:
+        result = (False, e)
+    try:
+        conn.send(result)
+    except Exception as e:
+        # the result or exception couldn't be pickled.
+        conn.send((False, RuntimeError(str(e))))
+    finally:
+        conn.close()
+
+
+class Child(object):
+    """Run `func(*args)` in a forked child process.
+
+    libsofthsm2 reads SOFTHSM2_CONF when it is initialised and keeps its
+    state per process, so work against a particular token store, or as a
+    particular user, is done in a child with its own environment and
+    credentials.  The parent must not have the library initialised when the
+    child is started.
+
+    :param func: the function to call in the child
+    :param args: the arguments to pass to func
+    :param user: if not None, the user to switch to before calling func
+    :param env: dict of environment variables to set before calling func
+    """
+
+    def __init__(self, func, args=(), user=None, env=None):
+        ctx = multiprocessing.get_context('fork')
+        self._conn, child_conn = ctx.Pipe(duplex=False)
+        self._process = ctx.Process(
+            target=_child_main, args=(child_conn, func, args, user, env))
+        self._process.start()
+        child_conn.close()
+
+    def result(self, timeout=None):
+        """Wait for and return the result of the child.
+
+        :param timeout: seconds to wait before killing the child, or None to
+            wait forever.
+        :returns: the value returned by func
+        :raises TimeoutError: if the child doesn't finish within timeout.
+        :raises ChildProcessError: if the child died without a result.
+        :raises Exception: whatever func raised in the child.
+        """
+        try:
+            if timeout is not None and not self._conn.poll(timeout):
+                self._process.terminate()
+                raise TimeoutError(
+                    "Child didn't finish in {}s".format(timeout))
+            ok, value = self._conn.recv()
+        except EOFError:
+            self._process.join()
+            raise ChildProcessError(
+                "Child exited with {}".format(self._process.exitcode))
+        finally:
+            self._process.join()
+            self._conn.close()
+        if not ok:
+            raise value
+        return value
+
+
+def run_in_child(func, args=(), user=None, env=None, timeout=None):
+    """Run `func(*args)` in a Child and return its result.
+
+    :param func: the function to call in the child
+    :param args: the arguments to pass to func
+    :param user: if not None, the user to switch to before calling func
+    :param env: dict of environment variables to set before calling func
+    :param timeout: seconds to wait for the child, or None to wait forever.
+    :returns: the value returned by func
+    """
+    return Child(func, args, user=user, env=env).result(timeout)
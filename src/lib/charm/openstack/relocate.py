@@ -0,0 +1,166 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Copy a token store to another directory while it is in use.
+#
+# The store is copied once while barbican keeps using it, and then synced
+# again, which only copies the files that changed during the first pass, for
+# the cut-over.  Every file is streamed in chunks and hashed as it is read,
+# and the copies are checked against those hashes before the new store is
+# used.
+
+import hashlib
+import os
+import stat
+
+
+CHUNK_SIZE = 1 << 20
+
+
+class RelocationError(Exception):
+    """Raised when a token store can't be copied or fails verification."""
+    pass
+
+
+def walk(root):
+    """Yield the relative path and lstat() of everything below `root`,
+    parents first.
+
+    :param root: the directory
+    """
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in dirnames + sorted(filenames):
+            path = os.path.join(dirpath, name)
+            yield os.path.relpath(path, root), os.lstat(path)
+
+
+def _copy_attributes(path, st):
+    os.chown(path, st.st_uid, st.st_gid)
+    os.chmod(path, stat.S_IMODE(st.st_mode))
+
+
+def copy_file(source, target, st, chunk_size=CHUNK_SIZE):
+    """Stream `source` to `target`, with the owner, mode and mtime of `st`,
+    and sync it.
+
+    :param source: the path of the file to copy
+    :param target: the path of the copy
+    :param st: the os.stat_result of `source`
+    :param chunk_size: the number of bytes to copy at a time
+    :returns: the sha256 hex digest of the data copied
+    """
+    digest = hashlib.sha256()
+    with open(source, 'rb') as fsource, open(target, 'wb') as ftarget:
+        while True:
+            chunk = fsource.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+            ftarget.write(chunk)
+        ftarget.flush()
+        os.fsync(ftarget.fileno())
+    _copy_attributes(target, st)
+    os.utime(target, ns=(st.st_atime_ns, st.st_mtime_ns))
+    return digest.hexdigest()
+
+
+def file_digest(path, chunk_size=CHUNK_SIZE):
+    """Return the sha256 hex digest of the file `path`.
+
+    :param path: the file
+    :param chunk_size: the number of bytes to read at a time
+    :returns: str
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def sync(source, target, copied=None):
+    """Make the directory `target` a copy of the directory `source`.
+
+    Only the files that are new, or whose size or mtime have changed, since
+    the sync that returned `copied` are copied, and the entries that have
+    gone from `source` are removed from `target`.
+
+    :param source: the directory to copy
+    :param target: the existing directory to copy it into
+    :param copied: the result of a previous sync of the same directories
+    :returns: dict of relative path to (size, mtime_ns, sha256 digest) for
+        each file copied, or None for a directory.
+    :raises RelocationError: if `source` holds anything other than files and
+        directories.
+    """
+    copied = dict(copied or {})
+    seen = set()
+    for name, st in walk(source):
+        seen.add(name)
+        path = os.path.join(target, name)
+        if stat.S_ISDIR(st.st_mode):
+            if not os.path.isdir(path):
+                os.mkdir(path)
+            _copy_attributes(path, st)
+            copied[name] = None
+        elif stat.S_ISREG(st.st_mode):
+            previous = copied.get(name)
+            if (previous is not None and
+                    tuple(previous[:2]) == (st.st_size, st.st_mtime_ns) and
+                    os.path.exists(path)):
+                continue
+            copied[name] = (st.st_size, st.st_mtime_ns,
+                            copy_file(os.path.join(source, name), path, st))
+        else:
+            raise RelocationError(
+                "Unexpected {!r} in the token store; only files and "
+                "directories can be relocated".format(name))
+    # remove what has gone, children before their parents.
+    for name in sorted(set(copied) - seen, reverse=True):
+        path = os.path.join(target, name)
+        if copied.pop(name) is None:
+            os.rmdir(path)
+        else:
+            os.remove(path)
+    return copied
+
+
+def verify(target, copied):
+    """Check that `target` holds exactly what a sync() copied into it.
+
+    :param target: the directory copied into
+    :param copied: the result of the sync
+    :returns: (number of files, total bytes)
+    :raises RelocationError: if anything is missing, extra or different.
+    """
+    found = {name for name, _ in walk(target)}
+    if found != set(copied):
+        raise RelocationError(
+            "The relocated token store doesn't have the same entries: "
+            "missing {}, extra {}".format(sorted(set(copied) - found),
+                                          sorted(found - set(copied))))
+    files = size = 0
+    for name, entry in sorted(copied.items()):
+        if entry is None:
+            continue
+        if file_digest(os.path.join(target, name)) != entry[2]:
+            raise RelocationError(
+                "{} doesn't match after relocation".format(name))
+        files += 1
+        size += entry[0]
+    return files, size
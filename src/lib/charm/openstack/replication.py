@@ -0,0 +1,503 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Replicate the leader's token store to the other units of the application.
+#
+# The leader copies the files of its token store, named by their sha256, to a
+# directory owned by an unprivileged user, and saves a manifest listing the
+# sha256 of every file, with the pins, in a file only that user can read.  It
+# publishes just the id of the manifest in the leader settings.  The token
+# store itself never goes through juju: each of the other units publishes an
+# ssh key on the peer relation, which the leader authorises for that user
+# with a restricted forced command that runs this script:
+#
+#   python3 replication.py serve /var/lib/softhsm-replica/source.json
+#
+# It can only send the manifest and pins, or the copied files that are asked
+# for by their sha256.  The other units fetch the manifest, and then only the
+# files whose digest differs from their copy, check each one against its
+# digest, and then write them into their store.
+
+import base64
+import hashlib
+import json
+import os
+import re
+import stat
+import subprocess
+import sys
+import zlib
+
+if __name__ == '__main__':
+    # allow running as a script from the charm's lib directory.
+    sys.path.insert(0, os.path.abspath(
+        os.path.join(os.path.dirname(__file__), '..', '..')))
+
+import charm.openstack.relocate as relocate
+
+
+MANIFEST_VERSION = 2
+# the most objects, and the most bytes of them, fetched at a time, so that a
+# large sync doesn't hold the whole token store in memory.
+BATCH_OBJECTS = 100
+BATCH_BYTES = 4 << 20
+SSH_KEY_RE = re.compile(r'^ssh-ed25519 [A-Za-z0-9+/]+={0,2}$')
+# marks the authorized_keys lines of the replicas.
+AUTHORIZED_KEY_COMMENT = "juju-barbican-softhsm-replica"
+
+
+class ReplicationError(Exception):
+    """Raised when a token store can't be published or replicated."""
+    pass
+
+
+def scan(store, cache=None):
+    """Return the manifest of the directory `store`.
+
+    Files whose size and mtime are unchanged since the scan that returned
+    `cache` aren't hashed again.
+
+    :param store: the token store directory
+    :param cache: the cache returned by a previous scan of `store`
+    :returns: (manifest, cache) where the manifest has the 'dirs' mapped to
+        their mode and the 'files' mapped to their [sha256, mode, size].
+    :raises ReplicationError: if the store holds anything other than files
+        and directories.
+    """
+    cache = cache or {}
+    manifest = {'version': MANIFEST_VERSION, 'dirs': {}, 'files': {}}
+    scanned = {}
+    for name, st in relocate.walk(store):
+        mode = stat.S_IMODE(st.st_mode)
+        if stat.S_ISDIR(st.st_mode):
+            manifest['dirs'][name] = mode
+        elif stat.S_ISREG(st.st_mode):
+            entry = cache.get(name)
+            if entry is not None and entry[:2] == [st.st_size,
+                                                   st.st_mtime_ns]:
+                digest = entry[2]
+            else:
+                digest = relocate.file_digest(os.path.join(store, name))
+            scanned[name] = [st.st_size, st.st_mtime_ns, digest]
+            manifest['files'][name] = [digest, mode, st.st_size]
+        else:
+            raise ReplicationError(
+                "Unexpected {!r} in the token store; only files and "
+                "directories can be replicated".format(name))
+    return manifest, scanned
+
+
+def manifest_id(manifest):
+    """Return an id that changes whenever anything in `manifest` does.
+
+    :param manifest: dict manifest, without an 'id'
+    :returns: hex digest string
+    """
+    data = json.dumps(manifest, sort_keys=True)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def encode(path, digest):
+    """Return the contents of the file `path`, compressed, to send to a
+    replica.
+
+    :param path: the file
+    :param digest: the sha256 the file had when it was scanned
+    :returns: str
+    :raises ReplicationError: if the file has changed since it was scanned.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if hashlib.sha256(data).hexdigest() != digest:
+        raise ReplicationError("{} changed since the manifest was made"
+                               .format(path))
+    return base64.b64encode(zlib.compress(data)).decode()
+
+
+def decode(value, digest):
+    """Return the file contents sent as `value`.
+
+    :param value: the str returned by encode()
+    :param digest: the sha256 the contents must have
+    :returns: bytes
+    :raises ReplicationError: if they don't match `digest`.
+    """
+    try:
+        data = zlib.decompress(base64.b64decode(value))
+    except (ValueError, zlib.error) as e:
+        raise ReplicationError("Object {} is corrupt: {}".format(digest, e))
+    if hashlib.sha256(data).hexdigest() != digest:
+        raise ReplicationError("Object {} doesn't match its digest"
+                               .format(digest))
+    return data
+
+
+def _write(path, data, mode, owner):
+    tmp = path + '.replica-tmp'
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    if owner is not None:
+        os.chown(tmp, *owner)
+    os.chmod(tmp, mode)
+    os.rename(tmp, path)
+
+
+def _apply_batch(store, manifest, needed, batch, fetch, owner):
+    values = fetch(batch)
+    written = 0
+    for digest in batch:
+        value = values.get(digest)
+        if not value:
+            raise ReplicationError("Object {} for {} wasn't sent"
+                                   .format(digest, needed[digest][0]))
+        data = decode(value, digest)
+        for name in needed[digest]:
+            _write(os.path.join(store, name), data,
+                   manifest['files'][name][1], owner)
+            written += 1
+    return written
+
+
+def apply(store, manifest, fetch, owner=None, batch_objects=BATCH_OBJECTS,
+          batch_bytes=BATCH_BYTES):
+    """Make the directory `store` a replica of the leader's `manifest`.
+
+    The changed files are fetched in batches of at most `batch_objects`
+    objects and `batch_bytes` bytes (or a single larger object), and each
+    batch is checked and written before the next is fetched.  The files the
+    leader doesn't have are only removed once every batch has been written.
+
+    :param store: the token store directory
+    :param manifest: the leader's manifest
+    :param fetch: callable taking a list of digests and returning a dict of
+        each digest to its encode()d file, e.g. from fetch_objects()
+    :param owner: (uid, gid) to give the directories and files written
+    :param batch_objects: the most objects to fetch at a time
+    :param batch_bytes: the most bytes of objects to fetch at a time
+    :returns: the number of files written
+    :raises ReplicationError: if an object is missing or corrupt, in which
+        case the batches written before it are kept, and the sync is finished
+        by the next apply().
+    """
+    current, _ = scan(store)
+    # the names of the files that need each digest.
+    needed = {}
+    for name, entry in sorted(manifest['files'].items()):
+        if current['files'].get(name, [None])[0] != entry[0]:
+            needed.setdefault(entry[0], []).append(name)
+    # directories sort before their contents.
+    for name, mode in sorted(manifest['dirs'].items()):
+        path = os.path.join(store, name)
+        if not os.path.isdir(path):
+            os.mkdir(path)
+            if owner is not None:
+                os.chown(path, *owner)
+        os.chmod(path, mode)
+    written = 0
+    batch = []
+    size = 0
+    for digest, names in sorted(needed.items()):
+        object_size = manifest['files'][names[0]][2]
+        if batch and (len(batch) >= batch_objects or
+                      size + object_size > batch_bytes):
+            written += _apply_batch(store, manifest, needed, batch, fetch,
+                                    owner)
+            batch = []
+            size = 0
+        batch.append(digest)
+        size += object_size
+    if batch:
+        written += _apply_batch(store, manifest, needed, batch, fetch, owner)
+    changed = {name for names in needed.values() for name in names}
+    for name, entry in sorted(manifest['files'].items()):
+        if name not in changed:
+            os.chmod(os.path.join(store, name), entry[1])
+    # remove what the leader doesn't have, children before their parents.
+    for name in sorted(set(current['files']) - set(manifest['files']),
+                       reverse=True):
+        os.remove(os.path.join(store, name))
+    for name in sorted(set(current['dirs']) - set(manifest['dirs']),
+                       reverse=True):
+        os.rmdir(os.path.join(store, name))
+    return written
+
+
+def export(store, manifest, objects, owner=None):
+    """Copy the files of the `manifest` of `store` that aren't already in the
+    directory `objects` there, named by their sha256, for serve().
+
+    :param store: the token store directory
+    :param manifest: the manifest returned by scan()
+    :param objects: the directory to copy them to
+    :param owner: (uid, gid) to give the copies
+    :returns: the number of files copied
+    :raises ReplicationError: if a file has changed since it was scanned.
+    """
+    names = {}
+    for name, entry in sorted(manifest['files'].items()):
+        names.setdefault(entry[0], name)
+    present = set(os.listdir(objects))
+    copied = 0
+    for digest, name in sorted(names.items()):
+        if digest in present:
+            continue
+        tmp = os.path.join(objects, digest + '.tmp')
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        hashed = hashlib.sha256()
+        with open(os.path.join(store, name), 'rb') as fsource, \
+                os.fdopen(fd, 'wb') as ftarget:
+            while True:
+                chunk = fsource.read(relocate.CHUNK_SIZE)
+                if not chunk:
+                    break
+                hashed.update(chunk)
+                ftarget.write(chunk)
+        if hashed.hexdigest() != digest:
+            os.remove(tmp)
+            raise ReplicationError("{} changed since the manifest was made"
+                                   .format(name))
+        if owner is not None:
+            os.chown(tmp, *owner)
+        os.rename(tmp, os.path.join(objects, digest))
+        copied += 1
+    return copied
+
+
+def prune(objects, manifest):
+    """Remove the copies in the directory `objects` that aren't in the
+    `manifest`, once it has replaced the one they were copied for.
+
+    :param objects: the directory passed to export()
+    :param manifest: the manifest saved by write_source()
+    :returns: the number of copies removed
+    """
+    wanted = {entry[0] for entry in manifest['files'].values()}
+    removed = 0
+    for name in sorted(os.listdir(objects)):
+        if name not in wanted:
+            os.remove(os.path.join(objects, name))
+            removed += 1
+    return removed
+
+
+def write_source(path, objects, manifest, pins, owner=None):
+    """Save the `manifest` of the files export()ed to `objects`, and its
+    `pins`, for serve().
+
+    The file is only readable by its owner, and is written to a temporary
+    file that is renamed into place, so that a replica is never sent half of
+    it.
+
+    :param path: the file
+    :param objects: the directory the files were export()ed to
+    :param manifest: the manifest returned by scan(), with its 'id'
+    :param pins: dict of the 'pin' and 'so_pin' of the store
+    :param owner: (uid, gid) to give the file
+    """
+    tmp = path + '.tmp'
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'objects': objects, 'manifest': manifest, 'pins': pins},
+                  f, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+    if owner is not None:
+        os.chown(tmp, *owner)
+    os.rename(tmp, path)
+
+
+def read_source(path):
+    """Return what write_source() saved in `path`.
+
+    :param path: the file
+    :returns: dict of the 'objects', 'manifest' and 'pins', or None if there
+        is no file.
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def serve(command, source, stdin, stdout):
+    """Answer a replica's `command`.
+
+    'manifest' sends the manifest and pins saved by write_source() as a JSON
+    object.  'objects' reads a JSON list of sha256 digests from `stdin`, and
+    sends a JSON list of the digest and its encode()d file for each one, a
+    line at a time.
+
+    :param command: 'manifest' or 'objects'
+    :param source: the file written by write_source()
+    :param stdin: text file to read the request from
+    :param stdout: text file to write the answer to
+    :raises ReplicationError: if the command isn't known, or a digest isn't
+        in the manifest, or its copy is corrupt.
+    """
+    saved = read_source(source)
+    if saved is None:
+        raise ReplicationError("No token store has been saved in {}"
+                               .format(source))
+    manifest = saved['manifest']
+    if command == 'manifest':
+        json.dump({'manifest': manifest, 'pins': saved['pins']}, stdout,
+                  sort_keys=True)
+        return
+    if command != 'objects':
+        raise ReplicationError("Unknown command {!r}".format(command))
+    digests = {entry[0] for entry in manifest['files'].values()}
+    for digest in json.load(stdin):
+        if digest not in digests:
+            raise ReplicationError("Object {} isn't in manifest {}"
+                                   .format(digest, manifest['id']))
+        value = encode(os.path.join(saved['objects'], digest), digest)
+        stdout.write(json.dumps([digest, value]) + '\n')
+
+
+def install(lib):
+    """Copy this script, and the modules it imports, below the directory
+    `lib`, for a user that can't read the charm to run serve().
+
+    :param lib: the directory
+    :returns: the path of the copy of this script
+    """
+    target = os.path.join(lib, 'charm', 'openstack')
+    os.makedirs(target, exist_ok=True)
+    for module in (__file__, relocate.__file__):
+        path = os.path.join(target, os.path.basename(module))
+        with open(module, 'rb') as f:
+            data = f.read()
+        try:
+            with open(path, 'rb') as f:
+                if f.read() == data:
+                    continue
+        except FileNotFoundError:
+            pass
+        fd = os.open(path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                     0o644)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(path + '.tmp', path)
+    return os.path.join(target, os.path.basename(__file__))
+
+
+def authorized_key(key, script, source):
+    """Return the authorized_keys line that lets the holder of `key` fetch
+    the token store saved in `source`, and nothing else.
+
+    :param key: the replica's public ssh key, 'ssh-ed25519 <base64>'
+    :param script: the copy of this script made by install()
+    :param source: the file written by write_source()
+    :returns: str
+    :raises ReplicationError: if `key` isn't an ed25519 public key.
+    """
+    if not SSH_KEY_RE.match(key or ''):
+        raise ReplicationError("{!r} isn't an ed25519 public key"
+                               .format(key))
+    return ('command="/usr/bin/python3 {script} serve {source}",restrict '
+            '{key} {comment}'.format(script=script, source=source, key=key,
+                                     comment=AUTHORIZED_KEY_COMMENT))
+
+
+def ssh_command(address, user, key, known_hosts):
+    """Return the command that runs serve() on the leader.
+
+    :param address: the leader's address
+    :param user: the user that serves the token store on the leader
+    :param key: the private key this unit authenticates with
+    :param known_hosts: the file with the leader's host key
+    :returns: list of args, to which the serve() command is appended
+    """
+    return ['ssh', '-i', key,
+            '-o', 'BatchMode=yes',
+            '-o', 'IdentitiesOnly=yes',
+            '-o', 'StrictHostKeyChecking=yes',
+            '-o', 'UserKnownHostsFile={}'.format(known_hosts),
+            '-o', 'ConnectTimeout=30',
+            '{}@{}'.format(user, address)]
+
+
+def _request(ssh, command, data=None):
+    proc = subprocess.Popen(ssh + [command], stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate(data)
+    if proc.returncode != 0:
+        raise ReplicationError("Fetching the {} from the leader failed: {}"
+                               .format(command, err.decode().strip()))
+    return out.decode()
+
+
+def fetch_manifest(ssh):
+    """Fetch the leader's manifest and pins, and check that they match.
+
+    :param ssh: the ssh_command() for the leader
+    :returns: (manifest, pins dict)
+    :raises ReplicationError: if they can't be fetched or don't match.
+    """
+    try:
+        answer = json.loads(_request(ssh, 'manifest'))
+        manifest, pins = answer['manifest'], answer['pins']
+        unchecked = dict(manifest)
+        del unchecked['id']
+    except (ValueError, KeyError, TypeError) as e:
+        raise ReplicationError("The leader's manifest is corrupt: {}"
+                               .format(e))
+    if manifest_id(unchecked) != manifest['id']:
+        raise ReplicationError("The leader's manifest doesn't match its id")
+    digest = hashlib.sha256(
+        json.dumps(pins, sort_keys=True).encode()).hexdigest()
+    if digest != manifest.get('pins'):
+        raise ReplicationError("The leader's pins don't match its manifest")
+    return manifest, pins
+
+
+def fetch_objects(ssh, digests):
+    """Fetch the files with the sha256 `digests` from the leader, which
+    apply() asks for a batch at a time.
+
+    :param ssh: the ssh_command() for the leader
+    :param digests: list of sha256 hex digest strings
+    :returns: dict of digest to the encode()d file, for decode()
+    :raises ReplicationError: if they can't be fetched.
+    """
+    out = _request(ssh, 'objects', json.dumps(digests).encode())
+    try:
+        return dict(json.loads(line) for line in out.splitlines())
+    except (ValueError, TypeError) as e:
+        raise ReplicationError("The leader sent corrupt objects: {}"
+                               .format(e))
+
+
+def main(argv=None):
+    # run by sshd as the forced command of a replica's key, which passes
+    # what the replica asked for in SSH_ORIGINAL_COMMAND.
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 2 or argv[0] != 'serve':
+        print("usage: replication.py serve SOURCE", file=sys.stderr)
+        return 2
+    try:
+        serve(os.environ.get('SSH_ORIGINAL_COMMAND', ''), argv[1],
+              sys.stdin, sys.stdout)
+    except (OSError, ValueError, KeyError, ReplicationError) as e:
+        print("Replication failed: {}".format(e), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,144 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Save a token store to, and restore it from, a tarball on persistent disk.
+#
+# This keeps a tmpfs token store across reboots.  It only uses the standard
+# library so that it can also be run as a script from cron:
+#
+#   python3 snapshot.py save /var/lib/softhsm/tokens snapshot.tar.gz
+#
+# A snapshot is written to a temporary file that is synced and renamed into
+# place, so the previous snapshot is kept if the unit dies while saving.
+
+import argparse
+import contextlib
+import fcntl
+import os
+import sys
+import tarfile
+
+
+class SnapshotError(Exception):
+    """Raised when a snapshot can't be restored."""
+    pass
+
+
+def _sync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def save(path, snapshot):
+    """Save the contents of the directory `path` to the `snapshot` tarball,
+    preserving the owners and modes.
+
+    :param path: the directory to save
+    :param snapshot: the path of the tarball
+    """
+    # the pid keeps a save from cron and one from a hook apart.
+    tmp = '{}.{}.tmp'.format(snapshot, os.getpid())
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            with tarfile.open(fileobj=f, mode='w:gz') as tar:
+                for name in sorted(os.listdir(path)):
+                    tar.add(os.path.join(path, name), arcname=name)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, snapshot)
+    except Exception:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    _sync_dir(os.path.dirname(os.path.abspath(snapshot)))
+
+
+def _check_member(member):
+    name = os.path.normpath(member.name)
+    if (os.path.isabs(name) or name == '..' or
+            name.startswith('..' + os.sep)):
+        raise SnapshotError("Unsafe path {!r} in snapshot"
+                            .format(member.name))
+    if not (member.isdir() or member.isfile()):
+        raise SnapshotError("Unexpected {!r} in snapshot, only files and "
+                            "directories are restored".format(member.name))
+
+
+def restore(snapshot, path):
+    """Restore the `snapshot` tarball into the directory `path`, preserving
+    the owners and modes.
+
+    :param snapshot: the path of the tarball
+    :param path: the directory to restore into
+    :returns: the number of entries restored
+    :raises SnapshotError: if the tarball holds anything other than files
+        and directories below `path`, in which case nothing is restored.
+    """
+    with tarfile.open(snapshot, mode='r:gz') as tar:
+        members = tar.getmembers()
+        for member in members:
+            _check_member(member)
+        tar.extractall(path, members=members, numeric_owner=True)
+    return len(members)
+
+
+@contextlib.contextmanager
+def _locked(path):
+    if path is None:
+        yield
+        return
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Save or restore a SoftHSM token store snapshot.")
+    parser.add_argument('command', choices=['save', 'restore'])
+    parser.add_argument('path', help="the token store directory")
+    parser.add_argument('snapshot', help="the snapshot tarball")
+    parser.add_argument('--lock',
+                        help="hold an exclusive flock on this file, as the "
+                             "charm does while it changes the store")
+    parser.add_argument('--mounted', action='store_true',
+                        help="only save the store if it is a mount point, "
+                             "so that an unmounted (e.g. after a reboot) "
+                             "store doesn't replace the snapshot")
+    args = parser.parse_args(argv)
+    try:
+        with _locked(args.lock):
+            if args.command == 'save':
+                if args.mounted and not os.path.ismount(args.path):
+                    return 0
+                save(args.path, args.snapshot)
+            else:
+                restore(args.snapshot, args.path)
+    except (OSError, tarfile.TarError, SnapshotError) as e:
+        print("{} failed: {}".format(args.command, e), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
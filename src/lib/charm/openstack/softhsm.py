@@ -12,18 +12,44 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import concurrent.futures
+import contextlib
+import fcntl
+import functools
+import glob
+import grp
+import hashlib
 import json
 import os
 import os.path
+import pwd
+import re
 import shutil
 import subprocess
+import tempfile
+import time
 
 import charmhelpers.core.hookenv as hookenv
 import charmhelpers.core.host as ch_core_host
+import charmhelpers.core.unitdata as unitdata
+import charmhelpers.fetch as ch_fetch
 
 import charms_openstack.adapters
 import charms_openstack.charm
 
+import charm.openstack.backup as backup
+import charm.openstack.benchmark as benchmark
+import charm.openstack.fastpath as fastpath
+import charm.openstack.health as health
+import charm.openstack.metrics as metrics
+import charm.openstack.migrate as migrate
+import charm.openstack.pkcs11 as pkcs11
+import charm.openstack.relocate as relocate
+import charm.openstack.replication as replication
+import charm.openstack.snapshot as snapshot
+import charm.openstack.timings as timings
+import charm.openstack.trace as trace
+
 
 SOFTHSM2_UTIL_CMD = "/usr/bin/softhsm2-util"
 TOKEN_STORE = "/var/lib/softhsm/tokens/"
@@ -31,7 +57,120 @@ SOFTHSM2_CONF = "/etc/softhsm/softhsm2.conf"
 SOFTHSM2_LIB_PATH = "/usr/lib/x86_64-linux-gnu/softhsm/libsofthsm2.so"
 PIN_LENGTH = 32
 BARBICAN_TOKEN_LABEL = "barbican_token"
+TOKEN_STORE_USER = "barbican"
 STORED_PINS_FILE = "/var/lib/softhsm/stored_pins.txt"
+PINS_VERSION = 1
+TOKEN_STORE_LOCK = "/var/lib/softhsm/token-store.lock"
+TOKEN_STORE_MARKER = "/var/lib/softhsm/token-store.ready"
+TOKEN_STORE_SNAPSHOT = "/var/lib/softhsm/tokens-snapshot.tar.gz"
+BACKUP_MANIFEST = "/var/lib/softhsm/backup-manifest.json"
+SNAPSHOT_CRON_FILE = "/etc/cron.d/barbican-softhsm-snapshot"
+TMPFS_KEY = "softhsm.tmpfs-size"
+SLOT_CACHE_KEY = "softhsm.slot-cache"
+OBJECTSTORE_BACKEND_KEY = "softhsm.objectstore-backend"
+TOKEN_DIR_KEY = "softhsm.token-dir"
+# the directory a relocated token store was copied from, until it is
+# discarded.
+RELOCATED_KEY = "softhsm.relocated-from"
+DEFAULT_OBJECTSTORE_BACKEND = "file"
+# the values of the config rendered into softhsm2.conf that libsofthsm2
+# accepts.
+OBJECTSTORE_BACKENDS = ['file', 'db']
+LOG_LEVELS = ['ERROR', 'WARNING', 'INFO', 'DEBUG']
+SLOTS_MECHANISM_RE = re.compile(r'^-?CKM_[A-Z0-9_]+$')
+MIGRATION_BATCH_SIZE = 100
+DEFAULT_SNAPSHOT_INTERVAL = 5
+RECLAIM_KEY = "softhsm.reclaim"
+MASTER_KEYS_KEY = "softhsm.master-keys"
+PUBLISHED_KEY = "softhsm.hsm-published"
+PLUGIN_NAME = "softhsm2"
+PEER_RELATION = "cluster"
+# the id of the manifest this unit last published or replicated.
+REPLICA_KEY = "softhsm.replica"
+REPLICATION_CACHE_KEY = "softhsm.replication-cache"
+# the leader setting with the id of the leader's manifest and the unit to
+# fetch it from.
+MANIFEST_SETTING = "softhsm-manifest"
+# the leader settings with the pins and objects published by older charms,
+# which are withdrawn.
+PINS_SETTING = "softhsm-pins"
+OBJECT_SETTING_PREFIX = "softhsm-object-"
+# the peer relation settings for replication: the id a unit has replicated,
+# a replica's public key, and the leader's host key and the replicas whose
+# keys it has authorised.
+REPLICA_SETTING = "token-replica"
+REPLICATION_KEY_SETTING = "replication-key"
+HOST_KEY_SETTING = "replication-host-key"
+AUTHORIZED_SETTING = "replication-authorized"
+# the unprivileged user the other units fetch the leader's token store as.
+# It owns only the copy of the store in REPLICATION_OBJECTS and its manifest,
+# with the pins, in REPLICATION_SOURCE, and its authorized_keys, which the
+# charm owns, only let it run REPLICATION_SCRIPT.
+REPLICATION_USER = "softhsm-replica"
+REPLICATION_HOME = "/var/lib/softhsm-replica"
+REPLICATION_SOURCE = "/var/lib/softhsm-replica/source.json"
+REPLICATION_OBJECTS = "/var/lib/softhsm-replica/objects"
+REPLICATION_LIB = "/var/lib/softhsm-replica/lib"
+REPLICATION_SCRIPT = (
+    "/var/lib/softhsm-replica/lib/charm/openstack/replication.py")
+REPLICATION_AUTHORIZED_KEYS = "/var/lib/softhsm-replica/.ssh/authorized_keys"
+# the ssh key and known_hosts a replica fetches the token store with.
+REPLICATION_SSH_KEY = "/var/lib/softhsm/replication-key"
+REPLICATION_KNOWN_HOSTS = "/var/lib/softhsm/replication-known-hosts"
+SSH_HOST_KEY = "/etc/ssh/ssh_host_ed25519_key.pub"
+MECHANISM_CACHE_KEY = "softhsm.mechanisms"
+# the result of the last autotune action.
+CONCURRENCY_KEY = "softhsm.concurrency"
+# the mechanisms barbican's PKCS#11 plugin needs; SoftHSM2 only has RFC 5649
+# key wrapping when it is built with OpenSSL >= 1.0.2h.
+REQUIRED_MECHANISMS = ['CKM_AES_KEY_GEN', 'CKM_AES_CBC_PAD',
+                       'CKM_SHA256_HMAC', 'CKM_AES_KEY_WRAP_PAD']
+# the mechanisms published for the principal to choose from, fastest first.
+FAST_MECHANISMS = ['CKM_AES_GCM', 'CKM_AES_KEY_WRAP_PAD', 'CKM_AES_KEY_WRAP',
+                   'CKM_AES_CTR', 'CKM_AES_CBC_PAD', 'CKM_AES_CBC']
+# the optional PKCS#11 proxy: a p11-kit server holding libsofthsm2 for the
+# barbican processes, which load p11-kit's client module instead.
+PROXY_SERVICE = "barbican-softhsm-proxy"
+PROXY_UNIT_FILE = "/etc/systemd/system/barbican-softhsm-proxy.service"
+PROXY_SOCKET = "/run/barbican-softhsm/pkcs11"
+P11_KIT_CMD = "/usr/bin/p11-kit"
+P11_KIT_CLIENT_PATH = "/usr/lib/x86_64-linux-gnu/pkcs11/p11-kit-client.so"
+PROXY_PACKAGES = ['p11-kit', 'p11-kit-modules']
+# the optional call trace: OpenSC's pkcs11-spy, loaded by barbican in place
+# of the library it wraps, logs every call to TRACE_LOG, which logrotate keeps
+# under TRACE_LOG_SIZE (plus one rotated copy).
+PKCS11_SPY_PATH = "/usr/lib/x86_64-linux-gnu/pkcs11-spy.so"
+TRACE_PACKAGES = ['opensc-pkcs11']
+TRACE_LOG_DIR = "/var/log/barbican-softhsm"
+TRACE_LOG = "/var/log/barbican-softhsm/pkcs11-spy.log"
+TRACE_LOG_SIZE = "50M"
+TRACE_LOGROTATE_FILE = "/etc/logrotate.d/barbican-softhsm-trace"
+TRACE_CRON_FILE = "/etc/cron.d/barbican-softhsm-trace"
+# delete discarded token stores at idle IO and lowest CPU priority
+RECLAIM_CMD = ['ionice', '-c3', 'nice', '-n', '19', 'rm', '-rf', '--']
+
+# ((path, inode, size, mtime), (pin, so_pin)) of the last pins file read.
+_pins_cache = None
+
+
+@charms_openstack.adapters.config_property
+def token_store_dir(config):
+    """The directory holding the tokens, for softhsm2.conf
+
+    :param config: the ConfigurationAdapter instance
+    :returns: str
+    """
+    return get_token_store_dir(config.token_dir)
+
+
+@charms_openstack.adapters.config_property
+def token_store_backend(config):
+    """The object store backend of the token store, for softhsm2.conf
+
+    :param config: the ConfigurationAdapter instance
+    :returns: str, one of 'file' or 'db'
+    """
+    return get_token_store_backend(config.objectstore_backend)
 
 
 def install():
@@ -50,6 +189,130 @@ def on_hsm_connected(hsm):
     BarbicanSoftHSMCharm.singleton.on_hsm_connected(hsm)
 
 
+def render_config():
+    """Use the singleton from the BarbicanSoftHSMCharm to render the
+    softhsm2.conf file
+    """
+    BarbicanSoftHSMCharm.singleton.render_config()
+
+
+def configure_tmpfs():
+    """Use the singleton from the BarbicanSoftHSMCharm to put the token store
+    on, or take it off, a tmpfs.
+    """
+    BarbicanSoftHSMCharm.singleton.configure_tmpfs()
+
+
+def configure_proxy():
+    """Use the singleton from the BarbicanSoftHSMCharm to run, or remove,
+    the PKCS#11 proxy service.
+    """
+    BarbicanSoftHSMCharm.singleton.configure_proxy()
+
+
+def configure_trace():
+    """Use the singleton from the BarbicanSoftHSMCharm to set up, or remove,
+    the rotation of the PKCS#11 call trace.
+    """
+    BarbicanSoftHSMCharm.singleton.configure_trace()
+
+
+def replicate_token_store():
+    """Use the singleton from the BarbicanSoftHSMCharm to publish the token
+    store to, or replicate it from, the leader.
+
+    :returns: True if the token store was replaced by the leader's.
+    """
+    return BarbicanSoftHSMCharm.singleton.replicate_token_store()
+
+
+def migrate_objectstore(batch_size=MIGRATION_BATCH_SIZE):
+    """Use the singleton from the BarbicanSoftHSMCharm to migrate the token
+    store to the 'db' object store backend.
+
+    :param batch_size: the number of objects to copy at a time
+    :returns: dict of the results of the migration
+    """
+    return BarbicanSoftHSMCharm.singleton.migrate_objectstore(batch_size)
+
+
+def relocate_token_store():
+    """Use the singleton from the BarbicanSoftHSMCharm to move the token store
+    to the configured 'token-dir'.
+
+    :returns: dict of the results of the relocation
+    """
+    return BarbicanSoftHSMCharm.singleton.relocate_token_store()
+
+
+def discard_relocated_token_store():
+    """Use the singleton from the BarbicanSoftHSMCharm to delete the token
+    store that a relocation left behind.
+
+    :returns: dict of the results
+    """
+    return BarbicanSoftHSMCharm.singleton.discard_relocated_token_store()
+
+
+def backup_token_store(path, incremental=False):
+    """Use the singleton from the BarbicanSoftHSMCharm to back up the token
+    store and its pins to `path`.
+
+    :param path: the backup file to write
+    :param incremental: only back up what has changed since the last backup
+    :returns: dict of the results of the backup
+    """
+    return BarbicanSoftHSMCharm.singleton.backup_token_store(
+        path, incremental)
+
+
+def restore_token_store(paths):
+    """Use the singleton from the BarbicanSoftHSMCharm to restore the token
+    store and its pins from backups.
+
+    :param paths: list of backup files, the full backup first
+    :returns: dict of the results of the restore
+    """
+    return BarbicanSoftHSMCharm.singleton.restore_token_store(paths)
+
+
+def run_benchmark(**kwargs):
+    """Use the singleton from the BarbicanSoftHSMCharm to benchmark the
+    token store.
+
+    :param kwargs: the arguments for BarbicanSoftHSMCharm.run_benchmark()
+    :returns: dict benchmark report
+    """
+    return BarbicanSoftHSMCharm.singleton.run_benchmark(**kwargs)
+
+
+def autotune_concurrency(**kwargs):
+    """Use the singleton from the BarbicanSoftHSMCharm to find the
+    concurrency the token store handles best.
+
+    :param kwargs: the arguments for
+        BarbicanSoftHSMCharm.autotune_concurrency()
+    :returns: dict autotune result
+    """
+    return BarbicanSoftHSMCharm.singleton.autotune_concurrency(**kwargs)
+
+
+def trace_summary(reset=False):
+    """Summarise the PKCS#11 calls in the trace log, oldest first.
+
+    :param reset: empty the trace log once it has been read
+    :returns: list of the per function summaries, as trace.summarise()
+    """
+    paths = trace.log_files(TRACE_LOG)
+    summaries = trace.summarise(paths)
+    if reset:
+        for path in paths:
+            # truncated rather than removed, barbican has TRACE_LOG open.
+            with open(path, 'w'):
+                pass
+    return summaries
+
+
 def assess_status():
     """Call the charm assess_status function"""
     BarbicanSoftHSMCharm.singleton.assess_status()
@@ -64,6 +327,16 @@ class BarbicanSoftHSMCharm(charms_openstack.charm.OpenStackCharm):
     # Packages that the service needs installed
     packages = ['softhsm2']
 
+    # The softhsm2.conf is read by libsofthsm2 in the barbican processes,
+    # which are members of the softhsm group.
+    group = 'softhsm'
+
+    # There are no services to restart; barbican is notified of changes to
+    # the config file via the hsm relation instead.
+    restart_map = {
+        SOFTHSM2_CONF: [],
+    }
+
     # Standard interface adapters class to use.
     adapters_class = charms_openstack.adapters.OpenStackRelationAdapters
 
@@ -71,66 +344,908 @@ class BarbicanSoftHSMCharm(charms_openstack.charm.OpenStackCharm):
         """Perform the normal charm install, and then kick off setting up the
         barbican_token in the softhsm2 token store.
         """
-        super(BarbicanSoftHSMCharm, self).install()
+        with timings.span('install.packages'):
+            super(BarbicanSoftHSMCharm, self).install()
         # now add the barbican user to the softhsm group so that the
         # barbican-worker can access the softhsm2.conf file.
         ch_core_host.add_user_to_group('barbican', 'softhsm')
+        self.render_config()
         self.setup_token_store()
         hookenv.status_set(
             'waiting', 'Charm installed and token store configured')
 
+    @timings.timed()
     def setup_token_store(self):
         """Set up the token store for barbican to use, create a pin and
         user_pin and store those details locally so that they can be used when
         Barbican connects.
 
-        Performs as needed:
-
-        softhsm2-util --init-token --free --label "barbican_token" --pin <pin>
-                      --so-pin <so-pin>
+        Initialises, as needed, a token for each of the token_labels() with
+        the <pin> and <so-pin>, using init_tokens().
 
         The <pin> and <so-pin> are generated randomly and saved to a
-        configuration file.
+        configuration file, and are shared by all of the tokens.
 
         If the <pin> and <so-pin> configuration file don't exist, then the
         token directory is deleted and re-initialised.
 
         Thus if we are upgrading a charm, the charm checks to see if it has
         already been run on this host, and if so, doesn't re-initialise the
-        token store, otherwise the token store is re-initialised.
+        token store, otherwise the token store is re-initialised.  If the
+        store exists but 'token-count' has been raised, only the missing
+        tokens are initialised.
+
+        The configuration file for the softhsm2 library is also written, and
+        the master keys are provisioned with provision_master_keys().
 
-        The configuration file for the softhsm2 library is also written.
+        Nothing is done while the config is invalid_config(), or on a unit
+        other than the leader until it has replicated the leader's token
+        store, which would replace its own.  A tmpfs store
+        is mounted, and its snapshot restored, by configure_tmpfs() first, so
+        that a restored store isn't mistaken for a missing one.
+
+        Only one process sets up the token store at a time; the others wait
+        on TOKEN_STORE_LOCK and then find the work done.  A completely set up
+        store is recorded in TOKEN_STORE_MARKER, so that later calls return
+        without checking each token.
         """
+        invalid = self.invalid_config()
+        if invalid:
+            hookenv.log("Not setting up the token store: {}".format(invalid),
+                        level=hookenv.WARNING)
+            return
+        if not hookenv.is_leader() and not token_store_replicated():
+            hookenv.log("Not setting up a token store until the leader's is "
+                        "replicated", level=hookenv.DEBUG)
+            return
+        self.configure_tmpfs()
+        labels = self.token_labels()
+        if not token_store_ready(labels):
+            with token_store_lock():
+                # the store may have been set up while waiting for the lock.
+                if not token_store_ready(labels):
+                    self._setup_token_store(labels)
+                    mark_token_store_ready(labels)
+        self.provision_master_keys()
+
+    def _setup_token_store(self, labels):
         # see if the <pin> and <so_pin> exist?
         pin, so_pin = read_pins_from_store()
         if pin is not None:
-            # return as the token store is already set up
+            # the token store is already set up; just add missing tokens.
+            missing = [label for label in labels
+                       if get_slot_id(label) is None]
+            if missing:
+                init_tokens(missing, pin, so_pin)
+                hookenv.log("Initialised tokens: {}"
+                            .format(", ".join(missing)))
             return
-        # see if the token directory exists - if so, delete it.
-        if os.path.exists(TOKEN_STORE):
-            if os.path.isdir(TOKEN_STORE):
-                shutil.rmtree(TOKEN_STORE)
-            else:
-                os.remove(TOKEN_STORE)
-        os.makedirs(TOKEN_STORE)
+        # see if the token directory exists - if so, move it aside to be
+        # deleted in the background.
+        discard_token_store()
+        # a new token store is made in the configured directory, with the
+        # configured object store backend; the backend is then fixed for the
+        # life of the store.
+        store = self.token_dir()
+        kv = unitdata.kv()
+        kv.set(TOKEN_DIR_KEY, store)
+        kv.set(OBJECTSTORE_BACKEND_KEY,
+               self.config.get('objectstore-backend') or
+               DEFAULT_OBJECTSTORE_BACKEND)
+        os.makedirs(store, exist_ok=True)
         # We need the token store to be 1777 so that whoever creates a token
         # can also gain access to it - the token will be created by the
         # barbican user.
-        os.chmod(TOKEN_STORE, 0o1777)
+        os.chmod(store, 0o1777)
+        self.render_config()
         # now create the token store
         pin = ch_core_host.pwgen(PIN_LENGTH)
         so_pin = ch_core_host.pwgen(PIN_LENGTH)
         write_pins_to_store(pin, so_pin)
-        cmd = [
-            'sudo', '-u', 'barbican',
-            SOFTHSM2_UTIL_CMD,
-            '--init-token', '--free',
-            '--label', BARBICAN_TOKEN_LABEL,
-            '--pin', pin,
-            '--so-pin', so_pin]
-        subprocess.check_call(cmd)
+        init_tokens(labels, pin, so_pin)
         hookenv.log("Initialised token store.")
 
+    def token_dir(self):
+        """The configured 'token-dir' for a new token store.
+
+        :returns: str, with a trailing '/'
+        """
+        return (self.config.get('token-dir') or TOKEN_STORE).rstrip('/') + '/'
+
+    def configure_tmpfs(self):
+        """Keep the token store on a tmpfs of the configured 'tmpfs-size',
+        snapshotting it to TOKEN_STORE_SNAPSHOT every
+        'tmpfs-snapshot-interval' minutes, or move it back to disk if
+        'tmpfs-size' is unset.
+
+        The tmpfs isn't in fstab, so after a reboot the token store is the
+        empty directory under the mount point until this mounts the tmpfs
+        again and restores the snapshot into it.
+        """
+        size = self.config.get('tmpfs-size')
+        store = get_token_store_dir(self.token_dir()).rstrip('/')
+        mounted = os.path.ismount(store)
+        kv = unitdata.kv()
+        if size:
+            if not mounted or kv.get(TMPFS_KEY) != size:
+                with token_store_lock():
+                    if not mounted:
+                        mount_tmpfs(store, size)
+                    else:
+                        subprocess.check_call(
+                            ['mount', '-o', 'remount,size={}'.format(size),
+                             store])
+                kv.set(TMPFS_KEY, size)
+            write_snapshot_cron(store,
+                                self.config.get('tmpfs-snapshot-interval') or
+                                DEFAULT_SNAPSHOT_INTERVAL)
+        elif mounted:
+            with token_store_lock():
+                unmount_tmpfs(store)
+            kv.unset(TMPFS_KEY)
+        if not size and os.path.exists(SNAPSHOT_CRON_FILE):
+            os.remove(SNAPSHOT_CRON_FILE)
+
+    def configure_proxy(self):
+        """Run the PKCS#11 proxy service, serving the token_labels() tokens,
+        if 'pkcs11-proxy' is set, or stop and remove it if it isn't.
+
+        The p11-kit packages are installed the first time it is needed, and
+        the service is restarted when the tokens it serves change.
+        """
+        if self.config.get('pkcs11-proxy'):
+            missing = ch_fetch.filter_installed_packages(PROXY_PACKAGES)
+            if missing:
+                ch_fetch.apt_install(missing, fatal=True)
+            if write_proxy_unit(self.token_labels()):
+                subprocess.check_call(['systemctl', 'daemon-reload'])
+                ch_core_host.service('enable', PROXY_SERVICE)
+                ch_core_host.service_restart(PROXY_SERVICE)
+            elif not ch_core_host.service_running(PROXY_SERVICE):
+                ch_core_host.service_start(PROXY_SERVICE)
+        elif os.path.exists(PROXY_UNIT_FILE):
+            ch_core_host.service_stop(PROXY_SERVICE)
+            ch_core_host.service('disable', PROXY_SERVICE)
+            os.remove(PROXY_UNIT_FILE)
+            subprocess.check_call(['systemctl', 'daemon-reload'])
+
+    def configure_trace(self):
+        """Create the trace log directory and rotate TRACE_LOG from cron, if
+        'trace' is set, or stop rotating it if it isn't.
+
+        The pkcs11-spy package is installed the first time it is needed.  The
+        logs are left behind when tracing is turned off, for the trace-summary
+        action to read.
+        """
+        if self.config.get('trace'):
+            missing = ch_fetch.filter_installed_packages(TRACE_PACKAGES)
+            if missing:
+                ch_fetch.apt_install(missing, fatal=True)
+            ch_core_host.mkdir(TRACE_LOG_DIR, owner=TOKEN_STORE_USER,
+                               group='softhsm', perms=0o770)
+            write_trace_logrotate()
+        else:
+            for path in (TRACE_CRON_FILE, TRACE_LOGROTATE_FILE):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def render_config(self):
+        """Render the softhsm2.conf from the charm config.
+
+        The object store backend and token directory are those of the token
+        store in use, so that changing 'objectstore-backend' doesn't hide an
+        existing store from libsofthsm2.  An invalid_config() isn't rendered,
+        so that libsofthsm2 keeps using the last valid one.
+        """
+        invalid = self.invalid_config()
+        if invalid:
+            hookenv.log("Not rendering {}: {}".format(SOFTHSM2_CONF, invalid),
+                        level=hookenv.WARNING)
+            return
+        self.render_configs([SOFTHSM2_CONF])
+        configured = (self.config.get('objectstore-backend') or
+                      DEFAULT_OBJECTSTORE_BACKEND)
+        in_use = get_token_store_backend(configured)
+        if configured != in_use:
+            hookenv.log("objectstore-backend '{}' only applies to a new token "
+                        "store; the existing store uses '{}'"
+                        .format(configured, in_use),
+                        level=hookenv.WARNING)
+
+    def invalid_config(self):
+        """Check the config rendered into softhsm2.conf against the values
+        libsofthsm2 accepts.
+
+        :returns: str message naming the first bad value, or None if the
+            config is valid.
+        """
+        backend = self.config.get('objectstore-backend')
+        if backend and backend not in OBJECTSTORE_BACKENDS:
+            return ("objectstore-backend '{}' isn't one of {}"
+                    .format(backend, ', '.join(OBJECTSTORE_BACKENDS)))
+        level = self.config.get('log-level')
+        if level and level not in LOG_LEVELS:
+            return ("log-level '{}' isn't one of {}"
+                    .format(level, ', '.join(LOG_LEVELS)))
+        mechanisms = self.config.get('slots-mechanisms')
+        if mechanisms and mechanisms != 'ALL':
+            for name in mechanisms.split(','):
+                if not SLOTS_MECHANISM_RE.match(name.strip()):
+                    return ("slots-mechanisms '{}' isn't ALL or a comma "
+                            "separated list of mechanisms".format(mechanisms))
+        return None
+
+    def custom_assess_status_check(self):
+        """Check that the config is valid, and that the object store backend
+        and directory in use are the configured ones.
+
+        :returns: (state, message) or (None, None) if the unit is fine.
+        """
+        invalid = self.invalid_config()
+        if invalid:
+            return 'blocked', invalid
+        try:
+            self.master_keys()
+        except ValueError as e:
+            return 'blocked', str(e)
+        missing = self.missing_mechanisms()
+        if missing:
+            return ('blocked',
+                    "libsofthsm2 doesn't support {}: upgrade to a SoftHSM2 "
+                    "built with OpenSSL >= 1.0.2h".format(', '.join(missing)))
+        configured = (self.config.get('objectstore-backend') or
+                      DEFAULT_OBJECTSTORE_BACKEND)
+        in_use = get_token_store_backend(configured)
+        if configured != in_use:
+            if in_use == 'file' and configured == 'db':
+                return ('blocked',
+                        "objectstore-backend is 'db' but the token store "
+                        "uses 'file': run the migrate-objectstore action")
+            return ('blocked',
+                    "objectstore-backend can't be changed from '{}' for an "
+                    "existing token store".format(in_use))
+        configured_dir = self.token_dir()
+        in_use_dir = get_token_store_dir(configured_dir)
+        if configured_dir != in_use_dir:
+            return ('blocked',
+                    "token-dir is {} but the token store is in {}: run the "
+                    "relocate-token-store action"
+                    .format(configured_dir, in_use_dir))
+        tokens = sum(reclaim_token_stores().values())
+        if tokens:
+            return ('maintenance',
+                    "Deleting old token store: {} tokens left"
+                    .format(tokens))
+        probed = health_status()
+        if probed[0] == 'blocked':
+            return probed
+        if not hookenv.is_leader():
+            if not token_store_replicated():
+                return ('waiting',
+                        "Waiting to replicate the leader's token store")
+            return probed
+        synced, peers = replication_status()
+        if synced < peers:
+            return ('active',
+                    "Unit is ready; token store replicated to {} of {} "
+                    "peers".format(synced, peers))
+        return probed
+
+    def migrate_objectstore(self, batch_size=MIGRATION_BATCH_SIZE):
+        """Migrate the token store from the 'file' to the 'db' object store
+        backend.
+
+        Each of the token_labels() tokens is copied, with the same label and
+        pins, into a new db backed token store next to the current one.  The
+        objects are streamed in batches of `batch_size` and each one is
+        verified against its source.  The new store is then swapped into
+        place, the old one is kept alongside it, and softhsm2.conf is
+        re-rendered.  The tokens get new slots, so the caller should publish
+        them again.
+
+        :param batch_size: the number of objects to copy at a time
+        :returns: dict with the 'backup' path of the old store and the
+            per label 'tokens' object counts and checksums.
+        :raises RuntimeError: if the token store isn't a set up file store.
+        :raises migrate.MigrationError: if the migration or its verification
+            fails, in which case the token store is left as it was.
+        """
+        backend = get_token_store_backend(None)
+        if backend != 'file':
+            raise RuntimeError("The token store already uses the '{}' "
+                               "backend".format(backend))
+        pin, so_pin = read_pins_from_store()
+        if pin is None:
+            raise RuntimeError("The token store isn't set up")
+        store = get_token_store_dir().rstrip('/')
+        if os.path.ismount(store):
+            raise RuntimeError("A token store on a tmpfs can't be migrated")
+        staging = store + '.migrating'
+        if os.path.exists(staging):
+            shutil.rmtree(staging)
+        os.makedirs(staging)
+        os.chmod(staging, 0o1777)
+        workdir = tempfile.mkdtemp(prefix='softhsm-migrate-')
+        os.chmod(workdir, 0o755)
+        try:
+            source_conf = os.path.join(workdir, 'source.conf')
+            migrate.write_conf(source_conf, store + '/', 'file')
+            target_conf = os.path.join(workdir, 'target.conf')
+            migrate.write_conf(target_conf, staging + '/', 'db')
+            before = token_store_state()
+            results = {}
+            for label in self.token_labels():
+                hookenv.log("Migrating token {}".format(label))
+                results[label] = migrate.migrate_token(
+                    SOFTHSM2_LIB_PATH, label, pin, so_pin,
+                    source_conf, target_conf, TOKEN_STORE_USER, batch_size)
+            if token_store_state() != before:
+                raise migrate.MigrationError(
+                    "The token store changed during the migration; run the "
+                    "migration again")
+            backup = "{}.file-{}".format(store, time.strftime('%Y%m%d%H%M%S'))
+            os.rename(store, backup)
+            try:
+                os.rename(staging, store)
+            except OSError:
+                os.rename(backup, store)
+                raise
+        except Exception:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        unitdata.kv().set(OBJECTSTORE_BACKEND_KEY, 'db')
+        self.render_config()
+        hookenv.log("Migrated token store to the db backend; the old store "
+                    "is in {}".format(backup))
+        return {'backup': backup, 'tokens': results}
+
+    def relocate_token_store(self):
+        """Move the token store to the configured 'token-dir', e.g. on a
+        faster device, without re-initialising the tokens.
+
+        The store is copied while barbican keeps using it.  Then, holding the
+        token store lock, the files changed since are copied again, every
+        file is verified, and softhsm2.conf is re-rendered to use the new
+        directory.  The caller should publish the relation data again so
+        that the principal restarts barbican with the new softhsm2.conf.
+        Barbican's workers keep using the old store until they restart, so
+        it is kept, in place, until discard_relocated_token_store() is
+        called; it is also the way back if the new store is faulty.
+
+        :returns: dict with the 'source' and 'target' directories and the
+            number of 'files' and 'bytes' copied.
+        :raises RuntimeError: if the token store isn't set up, is on a tmpfs
+            or is already in 'token-dir', 'token-dir' isn't empty, or the
+            store of an earlier relocation hasn't been discarded.
+        :raises relocate.RelocationError: if the copy fails verification, in
+            which case the token store is left where it was.
+        """
+        source = get_token_store_dir()
+        target = self.token_dir()
+        pin, _ = read_pins_from_store()
+        if pin is None:
+            raise RuntimeError("The token store isn't set up")
+        if source == target:
+            raise RuntimeError("The token store is already in {}"
+                               .format(target))
+        if os.path.ismount(source.rstrip('/')):
+            raise RuntimeError("A token store on a tmpfs can't be relocated")
+        if os.path.isdir(target) and os.listdir(target):
+            raise RuntimeError("{} isn't empty".format(target))
+        kv = unitdata.kv()
+        if kv.get(RELOCATED_KEY):
+            raise RuntimeError(
+                "The token store relocated from {} is still kept: run the "
+                "discard-relocated-token-store action once barbican has "
+                "restarted".format(kv.get(RELOCATED_KEY)))
+        os.makedirs(target, exist_ok=True)
+        os.chmod(target, 0o1777)
+        try:
+            hookenv.log("Copying the token store from {} to {}"
+                        .format(source, target))
+            copied = relocate.sync(source, target)
+            with token_store_lock():
+                copied = relocate.sync(source, target, copied)
+                files, size = relocate.verify(target, copied)
+                kv.set(TOKEN_DIR_KEY, target)
+                self.render_config()
+        except Exception:
+            kv.set(TOKEN_DIR_KEY, source)
+            clear_directory(target)
+            raise
+        kv.set(RELOCATED_KEY, source)
+        hookenv.log("Relocated the token store to {}; the old store is kept "
+                    "in {} until barbican has restarted"
+                    .format(target, source))
+        return {'source': source, 'target': target,
+                'files': files, 'bytes': size}
+
+    def discard_relocated_token_store(self):
+        """Delete, in the background, the token store that
+        relocate_token_store() left behind.
+
+        Only call this once barbican has restarted with the new
+        softhsm2.conf, as its workers use the old store until then.
+
+        :returns: dict with the 'discarded' directory.
+        :raises RuntimeError: if there isn't a relocated store to discard.
+        """
+        kv = unitdata.kv()
+        source = kv.get(RELOCATED_KEY)
+        if not source:
+            raise RuntimeError("There isn't a relocated token store to "
+                               "discard")
+        if source == get_token_store_dir():
+            # relocated back again; this is the store in use.
+            kv.unset(RELOCATED_KEY)
+            raise RuntimeError("{} is the token store in use".format(source))
+        discard_token_store(source)
+        kv.unset(RELOCATED_KEY)
+        hookenv.log("Discarding the relocated token store in {}"
+                    .format(source))
+        return {'discarded': source}
+
+    def backup_token_store(self, path, incremental=False):
+        """Stream a backup of the token store and its pins to `path`.
+
+        A full backup archives every file.  An incremental backup only
+        archives the files that have changed since the last backup, whose
+        manifest is kept in BACKUP_MANIFEST; a full backup is taken instead
+        if there isn't one.  The backup is written to a temporary file that
+        is renamed to `path` once it is complete.  It holds the pins, so it
+        is only readable by root.
+
+        :param path: the backup file to write
+        :param incremental: only back up what has changed since the last
+            backup
+        :returns: dict with the 'path', 'id' and 'base' id of the backup, the
+            number of 'files' in the store and the number of them 'archived'.
+        :raises RuntimeError: if the token store isn't set up.
+        :raises backup.BackupError: if the store can't be backed up.
+        """
+        pin, so_pin = read_pins_from_store()
+        if pin is None:
+            raise RuntimeError("The token store isn't set up")
+        previous = None
+        if incremental:
+            previous = backup.read_manifest(BACKUP_MANIFEST)
+            if previous is None:
+                hookenv.log("No previous backup, taking a full backup",
+                            level=hookenv.WARNING)
+        store = get_token_store_dir()
+        tmp = path + '.tmp'
+        try:
+            with os.fdopen(os.open(tmp,
+                                   os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                                   0o600), 'wb') as f:
+                # keep the charm from changing the store while it is read.
+                with token_store_lock():
+                    manifest = backup.create(
+                        store, {'pin': pin, 'so_pin': so_pin}, f, previous,
+                        {'backend': get_token_store_backend(None)})
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp, path)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        backup.write_manifest(BACKUP_MANIFEST, manifest)
+        hookenv.log("Backed up {} of {} token store files to {}"
+                    .format(manifest['archived'], len(manifest['files']),
+                            path))
+        return {'path': path,
+                'id': manifest['id'],
+                'base': manifest['base'] or '',
+                'files': len(manifest['files']),
+                'archived': manifest['archived']}
+
+    def restore_token_store(self, paths):
+        """Replace the token store and its pins with those of a full backup
+        and the incremental backups taken after it.
+
+        The backups are streamed into a staging directory next to the store
+        and every file is verified against the manifest of the last one.
+        Then, holding the token store lock, the store is swapped for the
+        staging directory (or, on a tmpfs, its contents are replaced), the
+        pins and object store backend are restored and softhsm2.conf is
+        re-rendered.  The slots of the restored tokens are then re-read, so
+        the caller should publish them again.
+
+        :param paths: list of backup files, the full backup first
+        :returns: dict with the 'id' of the last backup, the number of 'files'
+            and 'bytes' restored and the 'slots' of the token_labels().
+        :raises backup.BackupError: if the backups don't form a chain or fail
+            verification, in which case the token store is left as it was.
+        :raises RuntimeError: if the restored store has no
+            BARBICAN_TOKEN_LABEL token.
+        """
+        store = get_token_store_dir().rstrip('/')
+        staging = store + '.restoring'
+        if os.path.exists(staging):
+            shutil.rmtree(staging)
+        os.makedirs(staging)
+        try:
+            manifest, pins, files, size = backup.restore(paths, staging)
+            os.chmod(staging, 0o1777)
+            with token_store_lock():
+                if os.path.ismount(store):
+                    clear_directory(store)
+                    relocate.sync(staging, store)
+                else:
+                    discard_token_store(store)
+                    os.rename(staging, store)
+                write_pins_to_store(pins['pin'], pins['so_pin'])
+                unitdata.kv().set(OBJECTSTORE_BACKEND_KEY,
+                                  manifest['backend'])
+                self.render_config()
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+        unitdata.kv().unset(SLOT_CACHE_KEY)
+        slots = {label: read_slot_id(label) for label in self.token_labels()}
+        if slots[BARBICAN_TOKEN_LABEL] is None:
+            raise RuntimeError("The restored token store has no {} token"
+                               .format(BARBICAN_TOKEN_LABEL))
+        hookenv.log("Restored the token store from backup {}"
+                    .format(manifest['id']))
+        return {'id': manifest['id'],
+                'files': files,
+                'bytes': size,
+                'slots': json.dumps(slots, sort_keys=True)}
+
+    def replicate_token_store(self):
+        """Publish the token store to the other units if this is the leader,
+        and otherwise replicate the leader's token store.
+
+        The leader copies its token store to REPLICATION_OBJECTS, saves a
+        manifest of it, with the pins, in REPLICATION_SOURCE, and publishes
+        only its id in the leader settings.  It authorises the ssh key that
+        each of the other units publishes on the peer relation to fetch the
+        manifest and the files in it as REPLICATION_USER, and nothing else,
+        with replication.serve().  The keys of departed units are revoked.
+        The other units fetch the
+        files they don't have, check each one against the manifest, and
+        remove those the leader doesn't have, so that every unit has the same
+        tokens, pins and keys.  A new leader that isn't in sync with the
+        published store replicates it before publishing its own.
+
+        :returns: True if the token store was replaced by the leader's, in
+            which case the slots should be published again.
+        """
+        published = get_published_manifest()
+        kv = unitdata.kv()
+        if hookenv.is_leader():
+            changed = False
+            if (published is not None and
+                    published['source'] != hookenv.local_unit() and
+                    kv.get(REPLICA_KEY) != published['id']):
+                changed = self._replicate_from_leader(published)
+            self._publish_token_store(published)
+            self._authorize_replicas()
+            return changed
+        stop_serving_token_store()
+        key = replication_public_key()
+        for rid in hookenv.relation_ids(PEER_RELATION):
+            hookenv.relation_set(rid, {REPLICATION_KEY_SETTING: key})
+        if published is None or kv.get(REPLICA_KEY) == published['id']:
+            return False
+        return self._replicate_from_leader(published)
+
+    def _publish_token_store(self, published):
+        pin, so_pin = read_pins_from_store()
+        if pin is None:
+            return
+        kv = unitdata.kv()
+        store = get_token_store_dir()
+        pins = {'pin': pin, 'so_pin': so_pin}
+        owner = setup_replication_user()
+        try:
+            with token_store_lock():
+                manifest, cache = replication.scan(
+                    store, kv.get(REPLICATION_CACHE_KEY))
+                manifest['backend'] = get_token_store_backend(None)
+                manifest['pins'] = hashlib.sha256(
+                    json.dumps(pins, sort_keys=True).encode()).hexdigest()
+                manifest['id'] = replication.manifest_id(manifest)
+                saved = replication.read_source(REPLICATION_SOURCE)
+                if saved is None or saved['manifest']['id'] != manifest['id']:
+                    replication.export(store, manifest, REPLICATION_OBJECTS,
+                                       owner)
+                    replication.write_source(REPLICATION_SOURCE,
+                                             REPLICATION_OBJECTS, manifest,
+                                             pins, owner)
+                    replication.prune(REPLICATION_OBJECTS, manifest)
+        except replication.ReplicationError as e:
+            hookenv.log("Couldn't publish the token store: {}".format(e),
+                        level=hookenv.WARNING)
+            return
+        kv.set(REPLICATION_CACHE_KEY, cache)
+        setting = {'version': replication.MANIFEST_VERSION,
+                   'id': manifest['id'],
+                   'source': hookenv.local_unit()}
+        if published != setting:
+            settings = {MANIFEST_SETTING: json.dumps(setting, sort_keys=True),
+                        PINS_SETTING: None}
+            for key in hookenv.leader_get() or {}:
+                if key.startswith(OBJECT_SETTING_PREFIX):
+                    settings[key] = None
+            hookenv.leader_set(settings)
+            hookenv.log("Published token store manifest {}"
+                        .format(manifest['id']))
+        kv.set(REPLICA_KEY, manifest['id'])
+
+    def _authorize_replicas(self):
+        keys = {}
+        for rid in hookenv.relation_ids(PEER_RELATION):
+            for unit in hookenv.related_units(rid):
+                key = hookenv.relation_get(REPLICATION_KEY_SETTING, unit, rid)
+                if key:
+                    keys[unit] = key
+        authorized = authorize_replicas(keys)
+        try:
+            with open(SSH_HOST_KEY) as f:
+                host_key = ' '.join(f.read().split()[:2])
+        except FileNotFoundError:
+            hookenv.log("No {}: the other units can't replicate the token "
+                        "store".format(SSH_HOST_KEY), level=hookenv.WARNING)
+            return
+        for rid in hookenv.relation_ids(PEER_RELATION):
+            hookenv.relation_set(rid, {
+                HOST_KEY_SETTING: host_key,
+                AUTHORIZED_SETTING: json.dumps(authorized)})
+
+    def _replicate_from_leader(self, published):
+        kv = unitdata.kv()
+        ssh = replication_ssh_command(published['source'])
+        if ssh is None:
+            hookenv.log("Waiting for {} to let this unit replicate its token "
+                        "store".format(published['source']),
+                        level=hookenv.DEBUG)
+            return False
+        store = get_token_store_dir()
+        user = pwd.getpwnam(TOKEN_STORE_USER)
+        try:
+            manifest, pins = replication.fetch_manifest(ssh)
+            if manifest['id'] != published['id']:
+                hookenv.log("The leader's token store has changed since it "
+                            "was published", level=hookenv.DEBUG)
+                return False
+            with token_store_lock():
+                pin, so_pin = read_pins_from_store()
+                if (pin is not None and kv.get(PUBLISHED_KEY) and
+                        (pin, so_pin) != (pins['pin'], pins['so_pin'])):
+                    set_aside_token_store(store)
+                os.makedirs(store, exist_ok=True)
+                os.chmod(store, 0o1777)
+                written = replication.apply(
+                    store, manifest,
+                    functools.partial(replication.fetch_objects, ssh),
+                    (user.pw_uid, user.pw_gid))
+                write_pins_to_store(pins['pin'], pins['so_pin'])
+                kv.set(OBJECTSTORE_BACKEND_KEY, manifest['backend'])
+                kv.set(REPLICA_KEY, manifest['id'])
+                self.render_config()
+        except replication.ReplicationError as e:
+            hookenv.log("Couldn't replicate the leader's token store: {}"
+                        .format(e), level=hookenv.WARNING)
+            return False
+        kv.unset(SLOT_CACHE_KEY)
+        for rid in hookenv.relation_ids(PEER_RELATION):
+            hookenv.relation_set(rid, {REPLICA_SETTING: manifest['id']})
+        hookenv.log("Replicated the leader's token store: {} files written"
+                    .format(written))
+        return True
+
+    def run_benchmark(self, operations=None, payload_sizes=None, threads=1,
+                      processes=1, duration=5, scratch=False):
+        """Benchmark PKCS#11 operations on the barbican_token, as the
+        barbican user, through the library and in the slot published to
+        barbican.
+
+        Only session objects are created, so the token isn't changed.  With
+        `scratch`, a throwaway token in a temporary store with the same
+        object store backend is benchmarked instead, through libsofthsm2.
+
+        :param operations: list of benchmark.OPERATIONS, or None for all
+        :param payload_sizes: list of payload sizes, or None for defaults
+        :param threads: the number of threads (and sessions) per process
+        :param processes: the number of processes
+        :param duration: the seconds to run each operation for
+        :param scratch: whether to benchmark a scratch token
+        :returns: dict report from benchmark.run_benchmark()
+        :raises RuntimeError: if the token store isn't set up.
+        """
+        kwargs = {
+            'operations': operations,
+            'payload_sizes': payload_sizes,
+            'threads': threads,
+            'processes': processes,
+            'duration': duration,
+            'user': TOKEN_STORE_USER,
+        }
+        if scratch:
+            backend = get_token_store_backend(
+                self.config.get('objectstore-backend'))
+            token = benchmark.scratch_token(
+                SOFTHSM2_LIB_PATH, BARBICAN_TOKEN_LABEL, backend,
+                user=TOKEN_STORE_USER)
+            with token as (conf, pin):
+                return benchmark.run_benchmark(
+                    SOFTHSM2_LIB_PATH, BARBICAN_TOKEN_LABEL, pin,
+                    env={'SOFTHSM2_CONF': conf}, **kwargs)
+        pin, _ = read_pins_from_store()
+        if pin is None:
+            raise RuntimeError("The token store isn't set up")
+        library_path, slot_id, env = self._published_token()
+        return benchmark.run_benchmark(
+            library_path, BARBICAN_TOKEN_LABEL, pin, env=env,
+            slot_id=slot_id, **kwargs)
+
+    def autotune_concurrency(self, levels=None, operation='encrypt',
+                             payload_size=1024, duration=3):
+        """Find the number of barbican workers that the barbican_token
+        serves best, by benchmarking it with increasing numbers of processes
+        as the barbican user, through the library and in the slot published
+        to barbican, and record it to publish on the hsm relation.
+
+        :param levels: list of concurrency levels, or None for the defaults
+        :param operation: the benchmark.OPERATIONS operation to run
+        :param payload_size: the payload size of the operation
+        :param duration: the seconds to run each level for
+        :returns: dict result from benchmark.autotune()
+        :raises RuntimeError: if the token store isn't set up.
+        """
+        pin, _ = read_pins_from_store()
+        if pin is None:
+            raise RuntimeError("The token store isn't set up")
+        library_path, slot_id, env = self._published_token()
+        result = benchmark.autotune(
+            library_path, BARBICAN_TOKEN_LABEL, pin, levels=levels,
+            operation=operation, payload_size=payload_size,
+            duration=duration, user=TOKEN_STORE_USER, env=env,
+            slot_id=slot_id)
+        unitdata.kv().set(CONCURRENCY_KEY, result)
+        return result
+
+    def _published_token(self):
+        """Return how barbican reaches the barbican_token.
+
+        :returns: (library_path, slot id int, env) as published_library(),
+            with the SOFTHSM2_CONF in env.
+        :raises RuntimeError: if a token of the pool has no slot.
+        """
+        slot_ids = [get_slot_id(label) for label in self.token_labels()]
+        if None in slot_ids:
+            raise RuntimeError("The token store isn't set up")
+        library_path, slot_ids, env = self.published_library(slot_ids)
+        env['SOFTHSM2_CONF'] = SOFTHSM2_CONF
+        return library_path, int(slot_ids[0]), env
+
+    def master_keys(self):
+        """The master keys to provision in each token, from the config.
+
+        The MKEK is provisioned if 'mkek-label' is set and the HMAC key if
+        'hmac-label' is set.
+
+        :returns: list of dicts with the 'label', 'key_type', 'length',
+            'mechanism' and 'usage' ('wrap' or 'sign') of each key.
+        :raises ValueError: if a key type or mechanism isn't known.
+        """
+        keys = []
+        if self.config.get('mkek-label'):
+            keys.append({
+                'label': self.config['mkek-label'],
+                'key_type': 'CKK_AES',
+                'length': self.config.get('mkek-length') or 32,
+                'mechanism': (self.config.get('mkek-mechanism') or
+                              'CKM_AES_KEY_GEN'),
+                'usage': 'wrap',
+            })
+        if self.config.get('hmac-label'):
+            keys.append({
+                'label': self.config['hmac-label'],
+                'key_type': self.config.get('hmac-key-type') or 'CKK_AES',
+                'length': self.config.get('hmac-length') or 32,
+                'mechanism': (self.config.get('hmac-mechanism') or
+                              'CKM_AES_KEY_GEN'),
+                'usage': 'sign',
+            })
+        for key in keys:
+            if key['key_type'] not in pkcs11.KEY_TYPES:
+                raise ValueError("Unknown key type '{}' for {}"
+                                 .format(key['key_type'], key['label']))
+            if key['mechanism'] not in pkcs11.KEY_GEN_MECHANISMS:
+                raise ValueError("Unknown key generation mechanism '{}' for "
+                                 "{}".format(key['mechanism'], key['label']))
+        return keys
+
+    def missing_mechanisms(self):
+        """The REQUIRED_MECHANISMS, and those that generate the
+        master_keys(), that libsofthsm2 doesn't support.
+
+        :returns: sorted list of mechanism names; empty if the library's
+            mechanisms can't be read.
+        """
+        mechanisms = get_mechanisms()
+        if mechanisms is None:
+            return []
+        required = set(REQUIRED_MECHANISMS)
+        required.update(key['mechanism'] for key in self.master_keys())
+        return sorted(required - set(mechanisms))
+
+    @timings.timed()
+    def provision_master_keys(self):
+        """Generate any of the master_keys() that are missing from the tokens,
+        so that barbican doesn't create them on its first request.
+
+        The tokens are only checked again when the token store or the keys
+        have changed since they were last provisioned.
+        """
+        try:
+            keys = self.master_keys()
+        except ValueError as e:
+            hookenv.log("Not provisioning master keys: {}".format(e),
+                        level=hookenv.WARNING)
+            return
+        pin, _ = read_pins_from_store()
+        if not keys or pin is None:
+            return
+        labels = self.token_labels()
+        state = {
+            'fingerprint': token_store_fingerprint(),
+            'labels': labels,
+            'keys': keys,
+        }
+        kv = unitdata.kv()
+        if (state['fingerprint'] is not None and
+                kv.get(MASTER_KEYS_KEY) == state):
+            return
+        created = pkcs11.run_in_child(
+            _provision_master_keys, (labels, pin, keys),
+            user=TOKEN_STORE_USER, env={'SOFTHSM2_CONF': SOFTHSM2_CONF})
+        for label, key_label in created:
+            hookenv.log("Generated {} in token {}".format(key_label, label))
+        kv.set(MASTER_KEYS_KEY, state)
+
+    def token_labels(self):
+        """Return the labels of the tokens in the pool configured by the
+        'token-count' option.
+
+        The first label is always BARBICAN_TOKEN_LABEL so that the token used
+        before the pool existed remains the first slot; the others are
+        suffixed with their index, e.g. barbican_token_1.
+
+        :returns: list of label strings
+        """
+        count = max(1, int(self.config.get('token-count') or 1))
+        return [BARBICAN_TOKEN_LABEL] + [
+            "{}_{}".format(BARBICAN_TOKEN_LABEL, i) for i in range(1, count)]
+
+    def published_library(self, slot_ids):
+        """Return the PKCS#11 library that barbican is given, the slots it
+        presents the tokens in, and the environment barbican loads it with.
+
+        With 'pkcs11-proxy' set, that is p11-kit's client module and the
+        slots the proxy presents; with 'trace' set, it is pkcs11-spy wrapping
+        whichever module barbican would otherwise be given.
+
+        :param slot_ids: list of the libsofthsm2 slot id strings of the tokens
+        :returns: (library_path, slot_ids, env)
+        """
+        library_path = SOFTHSM2_LIB_PATH
+        env = {}
+        if self.config.get('pkcs11-proxy'):
+            library_path = P11_KIT_CLIENT_PATH
+            slot_ids = proxy_slot_ids(slot_ids)
+            env['P11_KIT_SERVER_ADDRESS'] = "unix:path=" + PROXY_SOCKET
+        if self.config.get('trace'):
+            env['PKCS11SPY'] = library_path
+            env['PKCS11SPY_OUTPUT'] = TRACE_LOG
+            library_path = PKCS11_SPY_PATH
+        return library_path, slot_ids, env
+
     def on_hsm_connected(self, hsm):
         """Called when the hsm interface becomes connected.  This means the
         plugin has connected to the principal Barbican charm.
@@ -139,15 +1254,52 @@ class BarbicanSoftHSMCharm(charms_openstack.charm.OpenStackCharm):
         plugin needs to provide a PKCS#11 libary for barbican to access, a
         password to access the token and a slot_id for the token.
 
+        A hash of the softhsm2.conf is also sent so that the principal sees a
+        relation change, and can restart barbican, when it is re-rendered.
+
+        Every token in the pool is published in 'slot_ids', in the order of
+        token_labels(), so that the principal can shard work across them;
+        'slot_id' is the first of them.  The labels of the provisioned master
+        keys are sent as 'mkek_label' and 'hmac_label', and the
+        FAST_MECHANISMS that libsofthsm2 supports as 'mechanisms', so that the
+        principal can pick the best one.  Once the autotune action has run,
+        the number of workers it recommends is sent as 'concurrency'.
+
+        With 'pkcs11-proxy' set, the 'library_path' is p11-kit's client
+        module, the slots are those the proxy presents, and the address the
+        client must be given in P11_KIT_SERVER_ADDRESS is sent as
+        'p11_kit_server_address'.  The proxy is restarted before changed data
+        is published, so that it serves the current tokens.
+
+        With 'trace' set, the 'library_path' is pkcs11-spy, and the module it
+        wraps and the log it writes, which the principal must give it in
+        PKCS11SPY and PKCS11SPY_OUTPUT, are sent as 'pkcs11spy' and
+        'pkcs11spy_output'.  Turning 'trace' off publishes the wrapped module
+        as the 'library_path' again.
+
         This sets the plugin_data on the hsm relation for the Barbican charm to
-        pick up.
+        pick up.  Every write makes the principal run relation-changed, so the
+        relation is only written when the data differs from what was last
+        published on one of its relation ids.
+
+        The units other than the leader publish the leader's token store
+        once they have replicated it, and never set up or change their own.
+        Nothing is published while the config is invalid_config().
 
         :param hsm: a BarbicanProvides instance for the relation.
         :raises RuntimeError: if the token_store can't be setup - which is
         FATAL.
         """
-        hookenv.log("Setting plugin name to softhsm2", level=hookenv.DEBUG)
-        hsm.set_name('softhsm2')
+        invalid = self.invalid_config()
+        if invalid:
+            hookenv.log("Not publishing the token store: {}".format(invalid),
+                        level=hookenv.WARNING)
+            return
+        replica = not hookenv.is_leader()
+        if replica and not token_store_replicated():
+            hookenv.log("Waiting to replicate the leader's token store",
+                        level=hookenv.DEBUG)
+            return
         pin, so_pin = read_pins_from_store()
         if pin is None:
             self.setup_token_store()
@@ -156,18 +1308,745 @@ class BarbicanSoftHSMCharm(charms_openstack.charm.OpenStackCharm):
                 hookenv.status_set('error', "Couldn't set up the token store?")
                 raise RuntimeError(
                     "BarbicanSoftHSMCharm.setup_token_store() failed?")
-        slot_id = read_slot_id(BARBICAN_TOKEN_LABEL)
-        if slot_id is None:
-            raise RuntimeError("No {} slot in token store?"
-                               .format(BARBICAN_TOKEN_LABEL))
+        labels = self.token_labels()
+        slot_ids = [get_slot_id(label) for label in labels]
+        if None in slot_ids:
+            if replica:
+                hookenv.log("Waiting for the leader to initialise the "
+                            "tokens", level=hookenv.DEBUG)
+                return
+            # the pool has grown; initialise the missing tokens.
+            self.setup_token_store()
+            slot_ids = [get_slot_id(label) for label in labels]
+        for label, slot_id in zip(labels, slot_ids):
+            if slot_id is None:
+                raise RuntimeError("No {} slot in token store?"
+                                   .format(label))
+        if not replica:
+            self.provision_master_keys()
+        library_path, slot_ids, env = self.published_library(slot_ids)
         plugin_data = {
-            "library_path": SOFTHSM2_LIB_PATH,
+            "library_path": library_path,
             "login": pin,
-            "slot_id": slot_id
+            "slot_id": slot_ids[0],
+            "slot_ids": slot_ids,
+            "conf_hash": ch_core_host.file_hash(SOFTHSM2_CONF),
         }
-        hsm.set_plugin_data(plugin_data)
+        proxy = 'P11_KIT_SERVER_ADDRESS' in env
+        if proxy:
+            plugin_data["p11_kit_server_address"] = (
+                env['P11_KIT_SERVER_ADDRESS'])
+        if 'PKCS11SPY' in env:
+            plugin_data["pkcs11spy"] = env['PKCS11SPY']
+            plugin_data["pkcs11spy_output"] = env['PKCS11SPY_OUTPUT']
+        mechanisms = get_mechanisms()
+        if mechanisms is not None:
+            plugin_data["mechanisms"] = [name for name in FAST_MECHANISMS
+                                         if name in mechanisms]
+        if self.config.get('mkek-label'):
+            plugin_data["mkek_label"] = self.config['mkek-label']
+        if self.config.get('hmac-label'):
+            plugin_data["hmac_label"] = self.config['hmac-label']
+        kv = unitdata.kv()
+        tuned = kv.get(CONCURRENCY_KEY)
+        if tuned:
+            plugin_data["concurrency"] = tuned['recommended']
+        digest = plugin_data_digest(PLUGIN_NAME, plugin_data)
+        published = kv.get(PUBLISHED_KEY) or {}
+        relation_ids = hookenv.relation_ids('hsm')
+        if relation_ids and all(published.get(rid) == digest
+                                for rid in relation_ids):
+            hookenv.log("hsm relation data is unchanged", level=hookenv.DEBUG)
+            return
+        if proxy:
+            # the proxy has the old tokens loaded.
+            ch_core_host.service_restart(PROXY_SERVICE)
+        hookenv.log("Setting plugin name to {}".format(PLUGIN_NAME),
+                    level=hookenv.DEBUG)
+        hsm.set_name(PLUGIN_NAME)
+        with timings.span('set_plugin_data'):
+            hsm.set_plugin_data(plugin_data)
+        # departed relation ids are dropped, as they are never reused.
+        kv.set(PUBLISHED_KEY, {rid: digest for rid in relation_ids})
+
+
+def plugin_data_digest(name, plugin_data):
+    """Return a digest of the data published on the hsm relation.
+
+    :param name: the plugin name
+    :param plugin_data: the plugin data dict
+    :returns: hex digest string
+    """
+    data = json.dumps({'name': name, 'plugin_data': plugin_data},
+                      sort_keys=True)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def get_published_manifest():
+    """Return the id of the leader's token store manifest, and the unit it
+    can be fetched from, as published by the leader.
+
+    :returns: dict of the 'version', 'id' and 'source', or None if the
+        leader hasn't published one.
+    """
+    manifest = hookenv.leader_get(MANIFEST_SETTING)
+    if not manifest:
+        return None
+    manifest = json.loads(manifest)
+    if manifest.get('version') != replication.MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def token_store_replicated():
+    """Check whether the token store is a replica of the one published by the
+    leader.
+
+    :returns: bool
+    """
+    published = get_published_manifest()
+    return (published is not None and
+            unitdata.kv().get(REPLICA_KEY) == published['id'])
+
+
+def replication_status():
+    """Count the peers that have replicated the token store last published
+    by this unit.
+
+    :returns: (peers in sync, peers)
+    """
+    replica = unitdata.kv().get(REPLICA_KEY)
+    synced = peers = 0
+    for rid in hookenv.relation_ids(PEER_RELATION):
+        for unit in hookenv.related_units(rid):
+            peers += 1
+            if hookenv.relation_get(REPLICA_SETTING, unit, rid) == replica:
+                synced += 1
+    return synced, peers
+
+
+def replication_public_key():
+    """Return the public ssh key this unit fetches the leader's token store
+    with, making the key pair first if needed.
+
+    :returns: str, 'ssh-ed25519 <base64>'
+    """
+    if not os.path.exists(REPLICATION_SSH_KEY):
+        subprocess.check_call(['ssh-keygen', '-q', '-t', 'ed25519', '-N', '',
+                               '-C', replication.AUTHORIZED_KEY_COMMENT,
+                               '-f', REPLICATION_SSH_KEY])
+    with open(REPLICATION_SSH_KEY + '.pub') as f:
+        return ' '.join(f.read().split()[:2])
+
+
+def setup_replication_user():
+    """Create REPLICATION_USER and the directories it serves the token store
+    from, and install the copy of replication.py its keys run.
+
+    Its home and .ssh directory are owned by root, so that it can't change
+    its authorized_keys; it owns only REPLICATION_OBJECTS.
+
+    :returns: (uid, gid) of REPLICATION_USER
+    """
+    ch_core_host.adduser(REPLICATION_USER, shell='/bin/sh', system_user=True,
+                         home_dir=REPLICATION_HOME)
+    user = pwd.getpwnam(REPLICATION_USER)
+    ch_core_host.mkdir(REPLICATION_HOME, perms=0o755)
+    ch_core_host.mkdir(os.path.dirname(REPLICATION_AUTHORIZED_KEYS),
+                       perms=0o755)
+    ch_core_host.mkdir(REPLICATION_OBJECTS, owner=REPLICATION_USER,
+                       group=grp.getgrgid(user.pw_gid).gr_name, perms=0o700)
+    replication.install(REPLICATION_LIB)
+    return user.pw_uid, user.pw_gid
+
+
+def authorize_replicas(keys):
+    """Let the units with the public ssh `keys`, and no others, fetch the
+    token store saved in REPLICATION_SOURCE as REPLICATION_USER.
+
+    REPLICATION_AUTHORIZED_KEYS is only written by the charm, so the keys of
+    units that aren't in `keys`, e.g. because they departed, are removed.
+
+    :param keys: dict of unit name to its public key
+    :returns: sorted list of the units authorised
+    """
+    lines = []
+    authorized = []
+    for unit, key in sorted(keys.items()):
+        try:
+            lines.append(replication.authorized_key(key, REPLICATION_SCRIPT,
+                                                    REPLICATION_SOURCE))
+        except replication.ReplicationError as e:
+            hookenv.log("Not letting {} replicate the token store: {}"
+                        .format(unit, e), level=hookenv.WARNING)
+            continue
+        authorized.append(unit)
+    content = ''.join(line + '\n' for line in lines)
+    try:
+        with open(REPLICATION_AUTHORIZED_KEYS) as f:
+            current = f.read()
+    except FileNotFoundError:
+        current = None
+    if current != content and (current is not None or lines):
+        ch_core_host.write_file(REPLICATION_AUTHORIZED_KEYS, content,
+                                perms=0o644)
+    return authorized
+
+
+def stop_serving_token_store():
+    """Revoke the keys of the other units, and remove the copy of the token
+    store and its pins, when this unit isn't the leader.
+    """
+    authorize_replicas({})
+    if os.path.exists(REPLICATION_SOURCE):
+        os.remove(REPLICATION_SOURCE)
+    if os.path.isdir(REPLICATION_OBJECTS):
+        clear_directory(REPLICATION_OBJECTS)
+
+
+def replication_ssh_command(source):
+    """Return the ssh command that fetches the token store from the unit
+    `source`, once it has authorised this unit's key.
+
+    The host key `source` publishes on the peer relation is the only one
+    accepted for its address.
+
+    :param source: the unit name of the leader that published the store
+    :returns: list of args for replication.fetch_manifest(), or None if
+        `source` isn't ready.
+    """
+    for rid in hookenv.relation_ids(PEER_RELATION):
+        if source not in hookenv.related_units(rid):
+            continue
+        data = hookenv.relation_get(unit=source, rid=rid) or {}
+        authorized = json.loads(data.get(AUTHORIZED_SETTING) or '[]')
+        host_key = data.get(HOST_KEY_SETTING)
+        address = data.get('ingress-address') or data.get('private-address')
+        if (hookenv.local_unit() not in authorized or not host_key or
+                not address):
+            return None
+        ch_core_host.write_file(REPLICATION_KNOWN_HOSTS,
+                                "{} {}\n".format(address, host_key),
+                                perms=0o600)
+        return replication.ssh_command(address, REPLICATION_USER,
+                                       REPLICATION_SSH_KEY,
+                                       REPLICATION_KNOWN_HOSTS)
+    return None
+
+
+def get_token_store_backend(configured):
+    """Return the object store backend of the token store.
 
+    The backend is recorded when the token store is created.  A token store
+    that predates the 'objectstore-backend' option uses the 'file' backend,
+    and a token store that doesn't exist yet will use `configured`.
 
+    :param configured: the 'objectstore-backend' config value
+    :returns: str, one of 'file' or 'db'
+    """
+    backend = unitdata.kv().get(OBJECTSTORE_BACKEND_KEY)
+    if backend is not None:
+        return backend
+    pin, _ = read_pins_from_store()
+    if pin is not None:
+        return DEFAULT_OBJECTSTORE_BACKEND
+    return configured or DEFAULT_OBJECTSTORE_BACKEND
+
+
+def get_token_store_dir(configured=None):
+    """Return the directory of the token store.
+
+    The directory is recorded when the token store is created or relocated.
+    A token store that predates the 'token-dir' option is in TOKEN_STORE,
+    and a token store that doesn't exist yet will use `configured`.
+
+    :param configured: the 'token-dir' config value
+    :returns: str, with a trailing '/'
+    """
+    store = unitdata.kv().get(TOKEN_DIR_KEY)
+    if store is None:
+        pin, _ = read_pins_from_store()
+        if pin is not None or not configured:
+            return TOKEN_STORE
+        store = configured
+    return store.rstrip('/') + '/'
+
+
+@timings.timed()
+def init_tokens(labels, pin, so_pin):
+    """Initialise a token for each of `labels` and return their slots.
+
+    The tokens are initialised through libsofthsm2 in a child process
+    running as the barbican user, so that no command lines carry the pins
+    and the library is loaded once for all of the tokens.  The new slots are
+    recorded in the slot cache used by get_slot_id().  If the library can't
+    be loaded, softhsm2-util is used instead.
+
+    :param labels: list of token label strings
+    :param pin: the user pin for the tokens
+    :param so_pin: the security officer pin for the tokens
+    :returns: dict of label to slot id string
+    :raises pkcs11.PKCS11Error: if a token couldn't be initialised.
+    :raises subprocess.CalledProcessError: if a token couldn't be
+        initialised with softhsm2-util.
+    """
+    try:
+        slots = pkcs11.run_in_child(
+            _init_tokens_native, (labels, pin, so_pin),
+            user=TOKEN_STORE_USER, env={'SOFTHSM2_CONF': SOFTHSM2_CONF})
+    except OSError as e:
+        hookenv.log("Couldn't initialise tokens with {}, falling back to "
+                    "softhsm2-util: {}".format(SOFTHSM2_LIB_PATH, e),
+                    level=hookenv.WARNING)
+        init_tokens_softhsm2_util(labels, pin, so_pin)
+        return {label: read_slot_id(label) for label in labels}
+    cache_slots(slots)
+    return {label: slot_id for label, (slot_id, _) in slots.items()}
+
+
+def _init_tokens_native(labels, pin, so_pin):
+    """Initialise the `labels` tokens with libsofthsm2; this runs in the
+    child process started by init_tokens().
+
+    :returns: dict of label to (slot id string, serial) tuples
+    """
+    slots = {}
+    with pkcs11.initialized(SOFTHSM2_LIB_PATH) as lib:
+        for label in labels:
+            slot_id = pkcs11.init_free_token(lib, label, so_pin, pin)
+            slots[label] = (str(slot_id), lib.get_token_info(slot_id).serial)
+    return slots
+
+
+def master_key_attributes(key):
+    """The attributes of a master key to generate, as barbican's PKCS#11
+    plugin would create it.
+
+    The keys are sensitive, so their values never leave the token in the
+    clear, but can be wrapped so that the token can be migrated.
+
+    :param key: a dict from BarbicanSoftHSMCharm.master_keys()
+    :returns: dict of attribute type to value
+    """
+    wrap = key['usage'] == 'wrap'
+    sign = key['usage'] == 'sign'
+    return {
+        pkcs11.CKA_CLASS: pkcs11.CKO_SECRET_KEY,
+        pkcs11.CKA_KEY_TYPE: pkcs11.KEY_TYPES[key['key_type']],
+        pkcs11.CKA_VALUE_LEN: key['length'],
+        pkcs11.CKA_LABEL: key['label'],
+        pkcs11.CKA_TOKEN: True,
+        pkcs11.CKA_PRIVATE: True,
+        pkcs11.CKA_SENSITIVE: True,
+        pkcs11.CKA_EXTRACTABLE: True,
+        pkcs11.CKA_ENCRYPT: wrap,
+        pkcs11.CKA_DECRYPT: wrap,
+        pkcs11.CKA_WRAP: wrap,
+        pkcs11.CKA_UNWRAP: wrap,
+        pkcs11.CKA_SIGN: sign,
+        pkcs11.CKA_VERIFY: sign,
+    }
+
+
+def _provision_master_keys(labels, pin, keys):
+    """Generate the `keys` that are missing from the `labels` tokens; this
+    runs in the child process started by provision_master_keys().
+
+    :returns: list of (token label, key label) tuples of the keys generated
+    """
+    created = []
+    with pkcs11.initialized(SOFTHSM2_LIB_PATH) as lib:
+        for label in labels:
+            slot_id = pkcs11.find_token_slot(lib, label)
+            if slot_id is None:
+                raise RuntimeError("No {} slot in token store?".format(label))
+            with lib.open_session(slot_id) as session:
+                session.login(pin)
+                for key in keys:
+                    found = session.find_object({
+                        pkcs11.CKA_CLASS: pkcs11.CKO_SECRET_KEY,
+                        pkcs11.CKA_LABEL: key['label'],
+                    })
+                    if found is not None:
+                        continue
+                    session.generate_key(
+                        pkcs11.KEY_GEN_MECHANISMS[key['mechanism']],
+                        master_key_attributes(key))
+                    created.append((label, key['label']))
+    return created
+
+
+def init_tokens_softhsm2_util(labels, pin, so_pin):
+    """Initialise a token for each of `labels` in parallel with
+    softhsm2-util.
+
+    The tokens are initialised by a worker pool bounded by the number of
+    CPUs on the unit.
+
+    :param labels: list of token label strings
+    :param pin: the user pin for the tokens
+    :param so_pin: the security officer pin for the tokens
+    :raises subprocess.CalledProcessError: if any of the tokens couldn't be
+        initialised.
+    """
+    workers = max(1, min(len(labels), os.cpu_count() or 1))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as e:
+        futures = [e.submit(init_token_softhsm2_util, label, pin, so_pin)
+                   for label in labels]
+        for future in futures:
+            future.result()
+
+
+def init_token_softhsm2_util(label, pin, so_pin):
+    """Initialise the `label` token in the free slot of the token store, as
+    the barbican user, with softhsm2-util.
+
+    :param label: the token label string
+    :param pin: the user pin for the token
+    :param so_pin: the security officer pin for the token
+    :raises subprocess.CalledProcessError: if the token couldn't be
+        initialised.
+    """
+    cmd = [
+        'sudo', '-u', TOKEN_STORE_USER,
+        SOFTHSM2_UTIL_CMD,
+        '--init-token', '--free',
+        '--label', label,
+        '--pin', pin,
+        '--so-pin', so_pin]
+    subprocess.check_call(cmd)
+
+
+@contextlib.contextmanager
+def token_store_lock():
+    """Hold the exclusive lock on setting up the token store, waiting for
+    any other process that holds it.
+    """
+    fd = os.open(TOKEN_STORE_LOCK, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        # closing the file releases the lock.
+        os.close(fd)
+
+
+def token_store_ready(labels):
+    """Return whether the token store was completely set up with the
+    `labels` tokens, and hasn't been replaced or had tokens added or removed
+    since.
+
+    :param labels: the token labels
+    :returns: boolean
+    """
+    try:
+        with open(TOKEN_STORE_MARKER) as f:
+            marker = json.load(f)
+    except (OSError, ValueError):
+        return False
+    if marker.get('labels') != labels:
+        return False
+    fingerprint = token_store_fingerprint()
+    return (fingerprint is not None and
+            marker.get('fingerprint') == fingerprint and
+            read_pins_from_store()[0] is not None)
+
+
+def mark_token_store_ready(labels):
+    """Record that the token store is set up with the `labels` tokens.
+
+    :param labels: the token labels
+    """
+    tmp = TOKEN_STORE_MARKER + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'labels': labels,
+                   'fingerprint': token_store_fingerprint()}, f)
+    os.rename(tmp, TOKEN_STORE_MARKER)
+
+
+def discard_token_store(store=None):
+    """Move the token store aside and delete it in the background, so that
+    a new store can be set up straight away however big the old one is.
+
+    A store on a mount point (e.g. a tmpfs) is emptied in place.  If the
+    store can't be moved for another reason it is deleted in place instead.
+
+    :param store: the token store directory, the current one by default
+    :returns: the path the store was moved to, or None.
+    """
+    store = (store or get_token_store_dir()).rstrip('/')
+    if not os.path.lexists(store):
+        return None
+    if os.path.ismount(store):
+        # the mount point itself must stay.
+        clear_directory(store)
+        return None
+    discarded = "{}.discard-{}-{}".format(
+        store, time.strftime('%Y%m%d%H%M%S'), os.getpid())
+    try:
+        os.rename(store, discarded)
+    except OSError as e:
+        hookenv.log("Couldn't move {} aside, deleting it in place: {}"
+                    .format(store, e), level=hookenv.WARNING)
+        if os.path.isdir(store) and not os.path.islink(store):
+            shutil.rmtree(store)
+        else:
+            os.remove(store)
+        return None
+    reclaim(discarded)
+    return discarded
+
+
+def set_aside_token_store(store):
+    """Keep a token store that is about to be replaced by a replica of the
+    leader's, with a copy of its pins, next to it.
+
+    Barbican may have stored secrets with this store's keys, so it isn't
+    deleted.  A store on a mount point is replaced in place.
+
+    :param store: the token store directory
+    """
+    store = store.rstrip('/')
+    if os.path.ismount(store):
+        hookenv.log("Replacing the token store on {} with the leader's"
+                    .format(store), level=hookenv.WARNING)
+        return
+    aside = "{}.unreplicated-{}".format(store, time.strftime('%Y%m%d%H%M%S'))
+    os.rename(store, aside)
+    shutil.copy2(STORED_PINS_FILE, aside + '.pins')
+    hookenv.log("Replacing the token store with the leader's; it has been "
+                "kept in {}".format(aside), level=hookenv.WARNING)
+
+
+def clear_directory(path):
+    """Delete everything in the directory `path`, but not `path` itself.
+
+    :param path: the directory
+    """
+    for name in os.listdir(path):
+        entry = os.path.join(path, name)
+        if os.path.isdir(entry) and not os.path.islink(entry):
+            shutil.rmtree(entry)
+        else:
+            os.remove(entry)
+
+
+def mount_tmpfs(store, size):
+    """Mount a tmpfs of `size` on the token store and restore the last
+    snapshot into it.
+
+    A store already on disk is snapshotted first, and then discarded so
+    that it can't reappear, out of date, if the tmpfs isn't mounted.
+
+    :param store: the token store directory
+    :param size: the tmpfs size, e.g. '512M'
+    :raises subprocess.CalledProcessError: if the tmpfs can't be mounted.
+    :raises snapshot.SnapshotError: if the snapshot can't be restored.
+    """
+    if os.path.isdir(store) and os.listdir(store):
+        snapshot.save(store, TOKEN_STORE_SNAPSHOT)
+        discard_token_store(store)
+    os.makedirs(store, exist_ok=True)
+    subprocess.check_call(
+        ['mount', '-t', 'tmpfs', '-o', 'size={},mode=1777'.format(size),
+         'tmpfs', store])
+    if os.path.exists(TOKEN_STORE_SNAPSHOT):
+        count = snapshot.restore(TOKEN_STORE_SNAPSHOT, store)
+        hookenv.log("Restored {} entries from {} into the tmpfs token store"
+                    .format(count, TOKEN_STORE_SNAPSHOT))
+    hookenv.log("Mounted a {} tmpfs on {}".format(size, store))
+
+
+def unmount_tmpfs(store):
+    """Move the token store from its tmpfs back to disk.
+
+    :param store: the token store directory
+    :raises RuntimeError: if the tmpfs can't be unmounted.
+    """
+    snapshot.save(store, TOKEN_STORE_SNAPSHOT)
+    if not ch_core_host.umount(store):
+        raise RuntimeError("Couldn't unmount the tmpfs on {}".format(store))
+    snapshot.restore(TOKEN_STORE_SNAPSHOT, store)
+    os.remove(TOKEN_STORE_SNAPSHOT)
+    hookenv.log("Moved the token store from its tmpfs to disk")
+
+
+def snapshot_token_store():
+    """Snapshot a tmpfs token store to TOKEN_STORE_SNAPSHOT."""
+    store = get_token_store_dir().rstrip('/')
+    if not os.path.ismount(store):
+        return
+    with token_store_lock():
+        snapshot.save(store, TOKEN_STORE_SNAPSHOT)
+    hookenv.log("Saved the token store to {}".format(TOKEN_STORE_SNAPSHOT))
+
+
+def write_snapshot_cron(store, interval):
+    """Snapshot a tmpfs token store from cron every `interval` minutes.
+
+    :param store: the token store directory
+    :param interval: int minutes
+    """
+    script = os.path.join(hookenv.charm_dir(), 'lib', 'charm', 'openstack',
+                          'snapshot.py')
+    ch_core_host.write_file(
+        SNAPSHOT_CRON_FILE,
+        "# Managed by juju: snapshot the tmpfs SoftHSM token store\n"
+        "*/{interval} * * * * root /usr/bin/python3 {script} save "
+        "--mounted --lock {lock} {store} {snapshot} 2>&1 | "
+        "logger -t barbican-softhsm\n".format(
+            interval=interval, script=script, lock=TOKEN_STORE_LOCK,
+            store=store, snapshot=TOKEN_STORE_SNAPSHOT),
+        perms=0o644)
+
+
+def write_proxy_unit(labels):
+    """Write the systemd unit of the PKCS#11 proxy service, a p11-kit
+    server that loads libsofthsm2 as the barbican user and serves the
+    `labels` tokens on PROXY_SOCKET.
+
+    :param labels: list of the token labels to serve
+    :returns: True if the unit file was changed.
+    """
+    tokens = ' '.join('"pkcs11:token={}"'.format(label) for label in labels)
+    content = (
+        "# Managed by juju: PKCS#11 proxy for the SoftHSM2 tokens\n"
+        "[Unit]\n"
+        "Description=PKCS#11 proxy for the barbican SoftHSM2 tokens\n"
+        "After=network.target\n"
+        "\n"
+        "[Service]\n"
+        "User={user}\n"
+        "Group=softhsm\n"
+        "Environment=SOFTHSM2_CONF={conf}\n"
+        "RuntimeDirectory={rundir}\n"
+        "RuntimeDirectoryMode=0750\n"
+        "ExecStart={cmd} server --foreground --provider {lib} --name {socket} "
+        "{tokens}\n"
+        "Restart=on-failure\n"
+        "\n"
+        "[Install]\n"
+        "WantedBy=multi-user.target\n".format(
+            user=TOKEN_STORE_USER, conf=SOFTHSM2_CONF,
+            rundir=os.path.basename(os.path.dirname(PROXY_SOCKET)),
+            cmd=P11_KIT_CMD, lib=SOFTHSM2_LIB_PATH, socket=PROXY_SOCKET,
+            tokens=tokens))
+    try:
+        with open(PROXY_UNIT_FILE) as f:
+            if f.read() == content:
+                return False
+    except FileNotFoundError:
+        pass
+    ch_core_host.write_file(PROXY_UNIT_FILE, content, perms=0o644)
+    return True
+
+
+def write_trace_logrotate():
+    """Rotate the PKCS#11 call trace from cron, every 5 minutes, once it is
+    larger than TRACE_LOG_SIZE, keeping one rotated copy.
+
+    The log is copied and truncated, as barbican keeps it open.
+    """
+    ch_core_host.write_file(
+        TRACE_LOGROTATE_FILE,
+        "# Managed by juju: rotate the SoftHSM2 PKCS#11 call trace\n"
+        "{log} {{\n"
+        "    su {user} softhsm\n"
+        "    size {size}\n"
+        "    rotate 1\n"
+        "    copytruncate\n"
+        "    missingok\n"
+        "    notifempty\n"
+        "}}\n".format(
+            log=TRACE_LOG, user=TOKEN_STORE_USER, size=TRACE_LOG_SIZE),
+        perms=0o644)
+    # logrotate only runs daily by itself, which wouldn't bound the log.
+    ch_core_host.write_file(
+        TRACE_CRON_FILE,
+        "# Managed by juju: rotate the SoftHSM2 PKCS#11 call trace\n"
+        "*/5 * * * * root /usr/sbin/logrotate {conf}\n".format(
+            conf=TRACE_LOGROTATE_FILE),
+        perms=0o644)
+
+
+def proxy_slot_ids(slot_ids):
+    """Return the ids of the slots that the PKCS#11 proxy presents for the
+    tokens in `slot_ids`.
+
+    p11-kit's server numbers the slots of the tokens it serves from 0, in
+    the order libsofthsm2 lists them, which is by slot id.
+
+    :param slot_ids: list of slot id strings, as libsofthsm2 has them
+    :returns: list of slot id strings, in the same order
+    """
+    ordered = sorted(slot_ids, key=int)
+    return [str(ordered.index(slot_id)) for slot_id in slot_ids]
+
+
+def reclaim(path):
+    """Delete `path` in a detached, low priority background process that
+    outlives the hook.
+
+    :param path: the path to delete
+    """
+    proc = subprocess.Popen(RECLAIM_CMD + [path],
+                            stdin=subprocess.DEVNULL,
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL,
+                            close_fds=True,
+                            start_new_session=True)
+    kv = unitdata.kv()
+    pending = kv.get(RECLAIM_KEY) or {}
+    pending[path] = proc.pid
+    kv.set(RECLAIM_KEY, pending)
+    hookenv.log("Deleting {} in the background (pid {})"
+                .format(path, proc.pid))
+
+
+def _pid_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def reclaim_token_stores():
+    """Return the discarded token stores that haven't been deleted yet.
+
+    The deletion of any store whose background process has gone away (e.g.
+    because the unit was rebooted) is started again.
+
+    :returns: dict of path to the number of tokens left in it
+    """
+    kv = unitdata.kv()
+    pending = kv.get(RECLAIM_KEY) or {}
+    left = {}
+    # stores discarded by a relocation are next to the old store.
+    discarded = set(glob.glob(
+        get_token_store_dir().rstrip('/') + '.discard-*'))
+    discarded.update(path for path in pending if os.path.lexists(path))
+    for path in sorted(discarded):
+        pid = pending.get(path)
+        if pid is None or not _pid_running(pid):
+            reclaim(path)
+        try:
+            left[path] = len(os.listdir(path))
+        except NotADirectoryError:
+            left[path] = 1
+        except FileNotFoundError:
+            pass
+    # forget the stores that have gone.
+    pending = kv.get(RECLAIM_KEY) or {}
+    if any(path not in left for path in pending):
+        kv.set(RECLAIM_KEY, {path: pid for path, pid in pending.items()
+                             if path in left})
+    return left
+
+
+@timings.timed(aggregate=True)
 def read_pins_from_store():
     """Read the pin and so_pin from the STORED_PINS_FILE file so that they can
     be retrieved later.
@@ -176,52 +2055,421 @@ def read_pins_from_store():
     JSON format:
 
     {
+      'version': PINS_VERSION,
       'pin': <pin string>,
       'so_pin': <so_pin string>
     }
 
+    Files written before the record was versioned have no 'version'.  The
+    pins are cached against the file's inode, size and mtime, so re-reading
+    an unchanged file only costs a stat().
+
     :returns (pin, so_pin): the pins from the store or None, None
+    :raises ValueError: if the file has a version other than PINS_VERSION,
+        which this charm can't read; it mustn't be mistaken for a missing
+        file, which would discard the token store.
     """
+    global _pins_cache
+    try:
+        st = os.stat(STORED_PINS_FILE)
+    except OSError:
+        _pins_cache = None
+        return None, None
+    key = (STORED_PINS_FILE, st.st_ino, st.st_size, st.st_mtime_ns)
+    if _pins_cache is not None and _pins_cache[0] == key:
+        return _pins_cache[1]
     try:
         with open(STORED_PINS_FILE, 'r') as f:
             o = json.load(f)
-        pin = o['pin']
-        so_pin = o['so_pin']
-        return pin, so_pin
-    except Exception:
+        version = o.get('version', PINS_VERSION)
+    except Exception as e:
+        hookenv.log("Couldn't read pins file: {}".format(str(e)),
+                    level=hookenv.WARNING)
         return None, None
+    if version != PINS_VERSION:
+        raise ValueError("{} has version {}, but only version {} can be read"
+                         .format(STORED_PINS_FILE, version, PINS_VERSION))
+    try:
+        pins = o['pin'], o['so_pin']
+    except KeyError as e:
+        hookenv.log("Couldn't read pins file: no {}".format(str(e)),
+                    level=hookenv.WARNING)
+        return None, None
+    _pins_cache = key, pins
+    return pins
 
 
 def write_pins_to_store(pin, so_pin):
     """Write the pin and so_pin to the STORED_PINS_FILE file so that they can
     be retrieved later.
 
-    The pins are stored in the file with 600 permissions, with the following
-    JSON format:
-
-    {
-      'pin': <pin string>,
-      'so_pin': <so_pin string>
-    }
+    The pins are stored in the file with 600 permissions, in the format
+    described in read_pins_from_store().  They are written to a temporary
+    file that is synced and then renamed over STORED_PINS_FILE, so that a
+    crash leaves either the old or the new pins and never a torn file.
 
     :param pin: string to store
     :param so_pin: string to store
-    :raises OSError: If the file couldn't be written.
+    :raises OSError: If the file couldn't be written; the temporary file is
+        removed and the old pins are left in place.
     :returns None:
     """
+    global _pins_cache
+    _pins_cache = None
+    tmp = STORED_PINS_FILE + '.tmp'
     try:
-        with os.fdopen(os.open(STORED_PINS_FILE,
-                               os.O_WRONLY | os.O_CREAT,
+        with os.fdopen(os.open(tmp,
+                               os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
                                0o600), 'w') as f:
-            json.dump({'pin': pin, 'so_pin': so_pin}, f)
+            json.dump({'version': PINS_VERSION, 'pin': pin, 'so_pin': so_pin},
+                      f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, STORED_PINS_FILE)
+        # make the rename itself durable.
+        fd = os.open(os.path.dirname(STORED_PINS_FILE), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    except OSError as e:
+        hookenv.log("Couldn't write pins file: {}".format(str(e)),
+                    level=hookenv.ERROR)
+        try:
+            os.remove(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def get_mechanisms():
+    """Return the mechanisms that libsofthsm2 supports.
+
+    The library is only probed once per version: the result is cached in the
+    unit's key-value store against the inode and mtime of SOFTHSM2_LIB_PATH,
+    which change whenever the package is upgraded.
+
+    :returns: dict of mechanism name to dict with its 'min_key_size',
+        'max_key_size' and 'flags', or None if the library can't be read.
+    """
+    try:
+        st = os.stat(SOFTHSM2_LIB_PATH)
+    except OSError:
+        return None
+    version = [st.st_ino, st.st_mtime_ns]
+    kv = unitdata.kv()
+    cached = kv.get(MECHANISM_CACHE_KEY)
+    if cached and cached['library'] == version:
+        return cached['mechanisms']
+    try:
+        with timings.span('read_mechanisms'):
+            infos = pkcs11.read_mechanisms(SOFTHSM2_LIB_PATH)
+    except (OSError, pkcs11.PKCS11Error, IndexError) as e:
+        hookenv.log("Couldn't read the mechanisms of {}: {}"
+                    .format(SOFTHSM2_LIB_PATH, str(e)),
+                    level=hookenv.WARNING)
+        return None
+    mechanisms = {name: dict(info._asdict())
+                  for name, info in infos.items()}
+    kv.set(MECHANISM_CACHE_KEY, {'library': version,
+                                 'mechanisms': mechanisms})
+    return mechanisms
+
+
+def token_store_fingerprint():
+    """Return a fingerprint of the token store directory.
+
+    SoftHSM keeps each token in its own sub-directory of the store, so the
+    directory's inode, mtime and the names in it change whenever the store
+    is re-created or a token is added or removed.
+
+    :returns: hex digest string, or None if the store can't be read.
+    """
+    return fastpath.directory_fingerprint(get_token_store_dir())
+
+
+def save_status():
+    """Save the workload status and a digest of the files and relation data
+    it depends on, so that update-status can re-assert it without loading
+    the charm while they are unchanged.
+
+    On a leader with peers, every file in the token store is watched too, so
+    that changes to it are published from update-status.
+
+    Register with hookenv.atexit() before the status is assessed, so that it
+    runs afterwards.
+    """
+    status, message = hookenv.status_get()
+    charm_dir = hookenv.charm_dir()
+    store = get_token_store_dir()
+    watch = {
+        'files': [STORED_PINS_FILE,
+                  SOFTHSM2_CONF,
+                  os.path.join(charm_dir, '.juju-persistent-config'),
+                  os.path.join(charm_dir, health.VERDICT_FILE)],
+        'dirs': [store],
+        'globs': [store.rstrip('/') + '.discard-*'],
+        'relations': ['hsm', PEER_RELATION],
+    }
+    if hookenv.is_leader() and replication_status()[1]:
+        # update-status publishes the changes to the token files to the
+        # peers.
+        for dirpath, _, filenames in os.walk(store):
+            watch['files'].extend(os.path.join(dirpath, name)
+                                  for name in sorted(filenames))
+    try:
+        fastpath.save_state(charm_dir, watch, status, message)
+    except OSError as e:
+        hookenv.log("Couldn't save the status for update-status: {}"
+                    .format(str(e)), level=hookenv.WARNING)
+        fastpath.clear_state(charm_dir)
+
+
+def save_metrics_state():
+    """Save what the update-status hook needs to write the metrics textfile
+    to 'metrics-textfile-dir', or stop it writing one if that is unset.
+
+    Register with hookenv.atexit(), so that the latency of any slot lookup
+    made in the hook is included.  That is the read_slot() span, which
+    get_slot_id() only records when its cache misses, so the latency saved
+    is that of the last lookup that reached the token store.
+    """
+    charm_dir = hookenv.charm_dir()
+    directory = hookenv.config('metrics-textfile-dir')
+    if not directory:
+        metrics.clear_state(charm_dir)
+        return
+    span = timings.last('read_slot')
+    state = {
+        'textfile': os.path.join(directory, metrics.TEXTFILE_NAME),
+        'store': get_token_store_dir(),
+        'pins_file': STORED_PINS_FILE,
+        'library': SOFTHSM2_LIB_PATH,
+        'conf': SOFTHSM2_CONF,
+        'user': TOKEN_STORE_USER,
+        'label': BARBICAN_TOKEN_LABEL,
+        'read_slot': span['seconds'] if span else None,
+        'interval': (hookenv.config('health-probe-interval') or 0) * 60,
+    }
+    try:
+        metrics.save_state(charm_dir, state)
     except OSError as e:
-        hookenv.log("Couldn't write pins file: {}".format(str(e)))
+        hookenv.log("Couldn't save the metrics state: {}".format(str(e)),
+                    level=hookenv.WARNING)
+
+
+def save_health_state():
+    """Save what the update-status hook needs to probe the barbican token in
+    its published slot, or stop it probing if 'health-probe-threshold' is 0.
+
+    Register with hookenv.atexit(), so that the slot published in the hook is
+    probed.
+    """
+    charm_dir = hookenv.charm_dir()
+    threshold = hookenv.config('health-probe-threshold')
+    if not threshold:
+        health.clear_state(charm_dir)
+        return
+    entry = (unitdata.kv().get(SLOT_CACHE_KEY) or {}).get(
+        BARBICAN_TOKEN_LABEL)
+    state = {
+        'library': SOFTHSM2_LIB_PATH,
+        'conf': SOFTHSM2_CONF,
+        'user': TOKEN_STORE_USER,
+        'label': BARBICAN_TOKEN_LABEL,
+        'slot_id': int(entry['slot_id']) if entry else None,
+        'pins_file': STORED_PINS_FILE,
+        'threshold': threshold / 1000.0,
+        'interval': (hookenv.config('health-probe-interval') or 0) * 60,
+    }
+    try:
+        health.save_state(charm_dir, state)
+    except OSError as e:
+        hookenv.log("Couldn't save the health probe state: {}"
+                    .format(str(e)), level=hookenv.WARNING)
+
+
+def health_status():
+    """Return the workload status called for by the health probes of the
+    barbican token made in update-status.
+
+    :returns: (state, message) or (None, None) if the token is healthy, or
+        isn't probed.
+    """
+    if not hookenv.config('health-probe-threshold'):
+        return None, None
+    return health.verdict(hookenv.charm_dir())
+
+
+def token_store_state():
+    """Return the names and mtimes of everything in the token store and its
+    token directories, which change whenever a token or an object is added
+    or removed.
+
+    :returns: list of (name, mtime) tuples, or None if the store can't be
+        read.
+    """
+    store = get_token_store_dir()
+    try:
+        state = [('', os.stat(store).st_mtime_ns)]
+        for name in sorted(os.listdir(store)):
+            state.append(
+                (name, os.stat(os.path.join(store, name)).st_mtime_ns))
+    except OSError:
+        return None
+    return state
+
+
+@timings.timed(aggregate=True)
+def get_slot_id(label):
+    """Return the slot id for the `label` slot, using the value cached in the
+    unit's key-value store if the token store hasn't changed since it was
+    last resolved.
+
+    The cache is keyed on token_store_fingerprint() so re-initialising the
+    token store (e.g. in setup_token_store()) invalidates it.
+
+    :param label: string representing the slot to look for
+    :returns: slot number as String, or None if not found.
+    """
+    fingerprint = token_store_fingerprint()
+    kv = unitdata.kv()
+    cache = kv.get(SLOT_CACHE_KEY) or {}
+    entry = cache.get(label)
+    if (fingerprint is not None and entry is not None and
+            entry.get('fingerprint') == fingerprint):
+        return entry['slot_id']
+    slot = read_slot(label)
+    if slot is None:
+        cache.pop(label, None)
+        kv.set(SLOT_CACHE_KEY, cache)
+        return None
+    slot_id = str(slot.slot_id)
+    cache[label] = {
+        'fingerprint': fingerprint,
+        'slot_id': slot_id,
+        'serial': slot.token.serial if slot.token is not None else None,
+    }
+    kv.set(SLOT_CACHE_KEY, cache)
+    return slot_id
+
+
+def cache_slots(slots):
+    """Record freshly resolved slots in the cache used by get_slot_id().
+
+    :param slots: dict of label to (slot id string, serial) tuples
+    """
+    fingerprint = token_store_fingerprint()
+    if fingerprint is None:
+        return
+    kv = unitdata.kv()
+    cache = kv.get(SLOT_CACHE_KEY) or {}
+    for label, (slot_id, serial) in slots.items():
+        cache[label] = {
+            'fingerprint': fingerprint,
+            'slot_id': slot_id,
+            'serial': serial,
+        }
+    kv.set(SLOT_CACHE_KEY, cache)
 
 
 def read_slot_id(label):
     """Read the slot id for the `label` slot.
 
-    The format of the slot from 'softhsm2-util --show-slots' is:
+    The lookup is timed by read_slot(), so that it is recorded once.
+
+    :param label: string representing the slot to look for
+    :returns: slot number as String, or None if not found.
+    """
+    slot = read_slot(label)
+    if slot is None:
+        return None
+    return str(slot.slot_id)
+
+
+@timings.timed()
+def read_slot(label):
+    """Read the slot for the `label` token.
+
+    The slot is looked up in-process through the PKCS#11 library at
+    SOFTHSM2_LIB_PATH.  If the library can't be loaded or initialised, then
+    this falls back to parsing the output of 'softhsm2-util --show-slots', in
+    which case the slot_id of the returned record is a String.
+
+    :param label: string representing the slot to look for
+    :returns: pkcs11.SlotInfo record, or None if not found.
+    """
+    try:
+        return pkcs11.find_slot(SOFTHSM2_LIB_PATH, label)
+    except (OSError, pkcs11.PKCS11Error) as e:
+        hookenv.log("Couldn't read slots via {}: {}; falling back to {}"
+                    .format(SOFTHSM2_LIB_PATH, str(e), SOFTHSM2_UTIL_CMD),
+                    level=hookenv.WARNING)
+    return read_slot_softhsm2_util(label)
+
+
+def read_slot_softhsm2_util(label):
+    """Read the slot for the `label` token using softhsm2-util.
+
+    The output of softhsm2-util is parsed as it is produced, and the command
+    is stopped as soon as the token is found.  The label must match exactly.
+
+    :param label: string representing the slot to look for
+    :returns: pkcs11.SlotInfo record, or None if not found.
+    :raises subprocess.CalledProcessError: if softhsm2-util fails.
+    """
+    with contextlib.closing(iter_slots_softhsm2_util()) as slots:
+        for slot in slots:
+            if (slot.token is not None and
+                    slot.token.initialized and
+                    slot.token.label == label):
+                return slot
+    return None
+
+
+def read_slots_softhsm2_util():
+    """Read the full slot and token inventory using softhsm2-util.
+
+    :returns: list of pkcs11.SlotInfo records
+    :raises subprocess.CalledProcessError: if softhsm2-util fails.
+    """
+    return list(iter_slots_softhsm2_util())
+
+
+def iter_slots_softhsm2_util():
+    """Run 'softhsm2-util --show-slots' and yield a pkcs11.SlotInfo record for
+    each slot as its output is read from the pipe.
+
+    If the generator is closed before the output is exhausted, the
+    softhsm2-util process is terminated.
+
+    :raises subprocess.CalledProcessError: if softhsm2-util fails.
+    """
+    cmd = [SOFTHSM2_UTIL_CMD, '--show-slots']
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                            universal_newlines=True)
+    finished = False
+    try:
+        for slot in parse_show_slots(proc.stdout):
+            yield slot
+        finished = True
+    finally:
+        proc.stdout.close()
+        if not finished and proc.poll() is None:
+            proc.terminate()
+        proc.wait()
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+
+_SLOT_LINE = re.compile(r'^Slot (\d+)\s*$')
+
+
+def parse_show_slots(lines):
+    """Parse the output of 'softhsm2-util --show-slots', yielding a
+    pkcs11.SlotInfo record for each slot as soon as it is complete.
+
+    The format of the output is:
 
     Available slots:
     Slot 0
@@ -241,21 +2489,51 @@ def read_slot_id(label):
             User PIN init.:   yes
             Label:            barbican_token
 
-    The function reads the text and then looks for the 'Label:' field, to
-    recover the Slot number.
+    The slot id of each record is a String.
 
-    :param label: string representing the slot to look for
-    :returns: slot number as String.
+    :param lines: an iterable of the lines of output
     """
-    cmd = [SOFTHSM2_UTIL_CMD, '--show-slots']
-    results = subprocess.check_output(cmd)
-    lines = results.decode().split("\n")
-    slot = None
+    slot_id = None
+    section = None
+    fields = {}
+
+    def _record():
+        slot = fields.get('Slot info', {})
+        token = fields.get('Token info')
+        if token is not None:
+            token = pkcs11.TokenInfo(
+                label=token.get('Label', ''),
+                manufacturer_id=token.get('Manufacturer ID'),
+                model=token.get('Model'),
+                serial=token.get('Serial number'),
+                initialized=token.get('Initialized') == 'yes',
+                user_pin_initialized=token.get('User PIN init.') == 'yes',
+                hardware_version=token.get('Hardware version'),
+                firmware_version=token.get('Firmware version'))
+        return pkcs11.SlotInfo(
+            slot_id=slot_id,
+            description=slot.get('Description'),
+            token_present=slot.get('Token present', 'yes') == 'yes',
+            hardware_version=slot.get('Hardware version'),
+            firmware_version=slot.get('Firmware version'),
+            token=token)
+
     for line in lines:
-        if line.startswith("Slot "):
-            slot = line[5:]
-        if (line.find('Label:') >= 0 and
-                line.find(label) >= 0 and
-                slot is not None):
-            return slot
-    return None
+        match = _SLOT_LINE.match(line)
+        if match:
+            if slot_id is not None:
+                yield _record()
+            slot_id = match.group(1)
+            section = None
+            fields = {}
+            continue
+        if slot_id is None:
+            continue
+        line = line.strip()
+        if line in ('Slot info:', 'Token info:'):
+            section = fields.setdefault(line[:-1], {})
+        elif section is not None and ':' in line:
+            key, value = line.split(':', 1)
+            section[key.strip()] = value.strip()
+    if slot_id is not None:
+        yield _record()
@@ -0,0 +1,125 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Percentiles and histograms of latencies.
+#
+# These are shared by the hook timings, the benchmark and the PKCS#11 call
+# trace.  The benchmark runs as a script and in the update-status fast path,
+# so only the standard library may be used here.
+
+import bisect
+import collections
+
+
+def _rank(count, pct):
+    return int(max(1, -(-count * pct // 100)))
+
+
+def percentile(values, pct):
+    """The nearest-rank `pct` percentile of the sorted `values`
+
+    :param values: sorted list of numbers
+    :param pct: the percentile, 0 to 100
+    :returns: the value, or None if there are no values.
+    """
+    if not values:
+        return None
+    return values[_rank(len(values), pct) - 1]
+
+
+def log_buckets(low, high, ratio):
+    """Upper bounds from `low` to at least `high`, each `ratio` times the
+    last, for a histogram whose percentiles are within `ratio` of the
+    real ones.
+
+    :param low: the first upper bound
+    :param high: the largest value to bound
+    :param ratio: float greater than 1
+    :returns: list of upper bounds
+    """
+    buckets = [low]
+    while buckets[-1] < high:
+        buckets.append(buckets[-1] * ratio)
+    return buckets
+
+
+class Histogram(object):
+    """Counts of values in buckets, so that a stream of values can be
+    summarised in a fixed amount of memory.
+
+    A value is counted in the first bucket whose upper bound it doesn't
+    exceed, or in a last, unbounded, bucket.  Histograms are plain objects,
+    so they can be pickled between processes and merged.
+
+    :param buckets: the sorted upper bounds of the buckets
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = None
+
+    def add(self, value):
+        """Count `value`.
+
+        :param value: the number to count
+        """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """Add the counts of `other`, which must have the same buckets.
+
+        :param other: a Histogram
+        :raises ValueError: if the buckets differ.
+        """
+        if other.buckets != self.buckets:
+            raise ValueError("Can't merge histograms with different buckets")
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total += other.total
+        if other.max is not None and (self.max is None or
+                                      other.max > self.max):
+            self.max = other.max
+
+    def percentile(self, pct):
+        """The nearest-rank `pct` percentile, as the upper bound of the
+        bucket it is in (or the largest value, if that is smaller).
+
+        :param pct: the percentile, 0 to 100
+        :returns: the value, or None if nothing has been counted.
+        """
+        if not self.count:
+            return None
+        rank = _rank(self.count, pct)
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def bucket_counts(self):
+        """The counts keyed by the upper bound of their bucket.
+
+        :returns: OrderedDict of '{:g}' formatted bound, and '+Inf', to int
+            count.
+        """
+        bounds = ['{:g}'.format(b) for b in self.buckets] + ['+Inf']
+        return collections.OrderedDict(zip(bounds, self.counts))
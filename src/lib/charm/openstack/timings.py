@@ -0,0 +1,197 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Record how long hooks, handlers and the steps within them take.
+#
+# Spans are kept in memory while the hook runs and are saved under a key of
+# their own in the unit's key-value store when it ends, so timing a step costs
+# no more than a couple of clock reads and a hook only writes its own spans.
+# The spans of the last MAX_HOOKS hooks are kept.  Helpers called many times
+# in a hook are aggregated into one span per hook, so that they don't crowd
+# out the others.  The hook-timings action summarises them.
+
+import collections
+import contextlib
+import functools
+import time
+
+import charmhelpers.core.hookenv as hookenv
+import charmhelpers.core.unitdata as unitdata
+
+import charm.openstack.stats as stats
+
+
+# the spans of each hook are saved under TIMINGS_PREFIX and its sequence
+# number.
+TIMINGS_PREFIX = "softhsm.timings."
+SEQUENCE_KEY = "softhsm.timings-sequence"
+# the number of hooks whose spans are kept; the oldest are dropped first.
+MAX_HOOKS = 200
+# the upper bounds, in seconds, of the histogram buckets.
+BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+_pending = []
+_hook_started = None
+
+
+def record(name, seconds, aggregate=False):
+    """Record that the `name` span took `seconds` in this hook.
+
+    :param name: the span name
+    :param seconds: float duration
+    :param aggregate: add to the `name` span already recorded in this hook,
+        if there is one, counting the 'calls'
+    """
+    if aggregate:
+        for s in _pending:
+            if s['span'] == name and 'calls' in s:
+                s['seconds'] = round(s['seconds'] + seconds, 6)
+                s['calls'] += 1
+                return
+    if not _pending:
+        hookenv.atexit(flush)
+    _pending.append({
+        'hook': hookenv.hook_name(),
+        'span': name,
+        'seconds': round(seconds, 6),
+        'at': round(time.time(), 3),
+    })
+    if aggregate:
+        _pending[-1]['calls'] = 1
+
+
+@contextlib.contextmanager
+def span(name, aggregate=False):
+    """Time the body of the with statement as the `name` span.
+
+    :param name: the span name
+    :param aggregate: as record()
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start, aggregate)
+
+
+def timed(name=None, aggregate=False):
+    """Decorate a function to time each call as a span.
+
+    This mustn't be used on reactive handlers, which charms.reactive
+    identifies by their code object; use span() in their body instead.
+
+    :param name: the span name, the function's name by default
+    :param aggregate: time all of the calls in a hook as one span, for
+        functions that are called many times
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            with span(name or f.__name__, aggregate):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def start_hook():
+    """Note the start of the hook; register with hookenv.atstart()."""
+    global _hook_started
+    _hook_started = time.perf_counter()
+
+
+def end_hook():
+    """Record the whole hook as the 'hook' span and save the spans; register
+    with hookenv.atexit() so that it runs after all of the handlers.
+    """
+    if _hook_started is not None:
+        record('hook', time.perf_counter() - _hook_started)
+    # callbacks registered while the atexit callbacks run aren't called.
+    flush()
+
+
+def _key(sequence):
+    return "{}{:010d}".format(TIMINGS_PREFIX, sequence)
+
+
+def flush():
+    """Save the spans recorded in this hook, or action, and drop those of
+    the hooks before the last MAX_HOOKS.
+    """
+    if not _pending:
+        return
+    kv = unitdata.kv()
+    sequence = (kv.get(SEQUENCE_KEY) or 0) + 1
+    kv.set(_key(sequence), list(_pending))
+    if sequence > MAX_HOOKS:
+        kv.unset(_key(sequence - MAX_HOOKS))
+    kv.set(SEQUENCE_KEY, sequence)
+    del _pending[:]
+
+
+def get_spans():
+    """Return the stored spans, oldest first.
+
+    :returns: list of dicts with 'hook', 'span', 'seconds' and 'at' keys,
+        and the number of 'calls' of an aggregated span.
+    """
+    saved = unitdata.kv().getrange(TIMINGS_PREFIX)
+    return [s for key in sorted(saved) for s in saved[key]]
+
+
+def last(name):
+    """Return the most recent `name` span, including those of this hook.
+
+    :param name: the span name
+    :returns: dict as get_spans(), or None if there isn't one.
+    """
+    for s in reversed(get_spans() + _pending):
+        if s['span'] == name:
+            return s
+    return None
+
+
+def clear():
+    """Forget the stored spans."""
+    unitdata.kv().unsetrange(prefix=TIMINGS_PREFIX)
+
+
+def histograms(spans, buckets=BUCKETS):
+    """Summarise the `spans` of each hook and span name.
+
+    :param spans: list of spans, as get_spans()
+    :param buckets: the sorted upper bounds of the histogram buckets
+    :returns: list of dicts with the 'hook' and 'span', the 'count',
+        'total', 'p50', 'p95' and 'max' seconds, and the number of spans in
+        each of the 'buckets' keyed by their upper bound.
+    """
+    groups = collections.defaultdict(list)
+    for s in spans:
+        groups[(s['hook'], s['span'])].append(s['seconds'])
+    summaries = []
+    for (hook, name), values in sorted(groups.items()):
+        values.sort()
+        histogram = stats.Histogram(buckets)
+        for value in values:
+            histogram.add(value)
+        summaries.append({
+            'hook': hook,
+            'span': name,
+            'count': len(values),
+            'total': round(sum(values), 6),
+            'p50': stats.percentile(values, 50),
+            'p95': stats.percentile(values, 95),
+            'max': values[-1],
+            'buckets': histogram.bucket_counts(),
+        })
+    return summaries
@@ -0,0 +1,148 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Summarise the PKCS#11 calls logged by OpenSC's pkcs11-spy.
+#
+# pkcs11-spy logs each call as its number and function name, a line with the
+# process, thread and time it was entered (to the millisecond), the arguments,
+# and then the value it returned.  It doesn't log when a call returns, so the
+# latency of a call is taken as the time until the next call on the same
+# thread was entered, which is an upper bound.  The log is read as a stream,
+# and only the counts and histogram of each function are kept, so that a large
+# log can be summarised in constant memory.
+
+import datetime
+import os
+import re
+
+import charm.openstack.stats as stats
+
+
+# the upper bounds, in seconds, of the latency histogram buckets.
+BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5]
+
+_CALL_RE = re.compile(r'^\d+: (C_\w+)\s*$')
+_STAMP_RE = re.compile(r'^P:(\d+); T:(\w+) '
+                       r'(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d(?:\.\d+)?)\s*$')
+_RETURNED_RE = re.compile(r'^Returned:\s+(\d+)')
+
+
+def _timestamp(text):
+    fmt = '%Y-%m-%d %H:%M:%S.%f' if '.' in text else '%Y-%m-%d %H:%M:%S'
+    return datetime.datetime.strptime(text, fmt).timestamp()
+
+
+def parse(lines):
+    """Parse pkcs11-spy output into calls.
+
+    Lines that aren't understood are skipped, so that a log that was rotated
+    mid-call, or written by several processes at once, can still be read.
+    A 'Returned:' line doesn't say which thread it is from, so it is only
+    attributed when a single call is waiting for its return value; when the
+    calls of several threads are in flight it is dropped, and those calls
+    have no CK_RV.
+
+    :param lines: iterable of lines
+    :returns: iterator of (function, seconds or None, CK_RV or None) of each
+        call.
+    """
+    # the call that each (pid, thread) last entered, as [function, entered,
+    # rv]; its latency is only known once the next one on its thread starts.
+    threads = {}
+    # the call that each (pid, thread) is waiting for the return value of.
+    awaiting = {}
+    # the call whose entry hasn't been timestamped yet.
+    call = None
+    for line in lines:
+        match = _CALL_RE.match(line)
+        if match:
+            if call is not None:
+                # an older pkcs11-spy, which doesn't log the thread.
+                yield call[0], None, call[2]
+            call = [match.group(1), None, None]
+            continue
+        match = _STAMP_RE.match(line)
+        if match and call is not None:
+            try:
+                call[1] = _timestamp(match.group(3))
+            except ValueError:
+                continue
+            key = (match.group(1), match.group(2))
+            previous = threads.get(key)
+            if previous is not None:
+                yield (previous[0], max(0.0, call[1] - previous[1]),
+                       previous[2])
+            # a new call on the thread means the last one has returned.
+            threads[key] = awaiting[key] = call
+            call = None
+            continue
+        match = _RETURNED_RE.match(line)
+        if match:
+            pending = list(awaiting.items())
+            if call is not None and call[2] is None:
+                pending.append((None, call))
+            if len(pending) == 1:
+                key, returned = pending[0]
+                returned[2] = int(match.group(1))
+                awaiting.pop(key, None)
+    if call is not None:
+        yield call[0], None, call[2]
+    for function, _, rv in threads.values():
+        yield function, None, rv
+
+
+def log_files(path):
+    """Return the trace log at `path` and its rotated copy, oldest first.
+
+    :param path: the trace log
+    :returns: list of the paths that exist
+    """
+    return [p for p in (path + '.1', path) if os.path.exists(p)]
+
+
+def summarise(paths, buckets=BUCKETS):
+    """Summarise the calls in the pkcs11-spy logs `paths`.
+
+    :param paths: list of log files, oldest first
+    :param buckets: the sorted upper bounds of the histogram buckets
+    :returns: list of dicts with the 'function', the number of calls
+        ('count'), of those that didn't return CKR_OK ('errors') and of those
+        that were 'timed', their 'total' and 'max' seconds, and the number of
+        timed calls in each of the 'buckets' keyed by their upper bound;
+        the functions that took longest in total first.
+    """
+    functions = {}
+    for path in paths:
+        with open(path, errors='replace') as f:
+            for function, seconds, rv in parse(f):
+                summary = functions.get(function)
+                if summary is None:
+                    summary = functions[function] = {
+                        'function': function, 'count': 0, 'errors': 0,
+                        'latencies': stats.Histogram(buckets)}
+                summary['count'] += 1
+                if rv:
+                    summary['errors'] += 1
+                if seconds is not None:
+                    summary['latencies'].add(seconds)
+    summaries = []
+    for summary in functions.values():
+        latencies = summary.pop('latencies')
+        summary['timed'] = latencies.count
+        summary['total'] = round(latencies.total, 6)
+        summary['max'] = round(latencies.max or 0.0, 6)
+        summary['buckets'] = dict(latencies.bucket_counts())
+        summaries.append(summary)
+    summaries.sort(key=lambda s: (-s['total'], s['function']))
+    return summaries
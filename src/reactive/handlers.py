@@ -14,26 +14,69 @@
 
 import charms.reactive as reactive
 
+import charmhelpers.core.hookenv as hookenv
+
 import charms_openstack.charm
 
 import charm.openstack.softhsm as softhsm
+import charm.openstack.timings as timings
 
 # Use the charms.openstack defaults for common states and hooks
 charms_openstack.charm.use_defaults(
     'config.changed',
     'update-status')
 
+# time every hook, including the charms.openstack default handlers.
+hookenv.atstart(timings.start_hook)
+hookenv.atexit(timings.end_hook)
+# registered before charms.openstack defers assess_status to the end of the
+# hook, so that the status is saved after it has been set.
+hookenv.atexit(softhsm.save_status)
+hookenv.atexit(softhsm.save_metrics_state)
+hookenv.atexit(softhsm.save_health_state)
+
 
 # use a synthetic state to ensure that it get it to be installed independent of
 # the install hook.
 @reactive.when_not('charm.installed')
 def install_packages():
-    softhsm.install()
+    with timings.span('handler.install_packages'):
+        softhsm.install()
     reactive.set_state('charm.installed')
 
 
+@reactive.when('charm.installed')
+@reactive.when('config.changed')
+def render_config():
+    with timings.span('handler.render_config'):
+        softhsm.render_config()
+        softhsm.configure_tmpfs()
+        softhsm.configure_proxy()
+        softhsm.configure_trace()
+
+
+# runs before hsm_connected(), which publishes the slots of a replicated
+# token store.
+@reactive.hook('leader-elected',
+               'leader-settings-changed',
+               'cluster-relation-joined',
+               'cluster-relation-changed',
+               'cluster-relation-departed',
+               'update-status')
+def replicate_token_store():
+    with timings.span('handler.replicate_token_store'):
+        softhsm.replicate_token_store()
+
+
 @reactive.when('hsm.connected')
 def hsm_connected(hsm):
-    softhsm.on_hsm_connected(hsm)
-    reactive.set_state('hsm.available')
-    softhsm.assess_status()
+    with timings.span('handler.hsm_connected'):
+        softhsm.on_hsm_connected(hsm)
+        reactive.set_state('hsm.available')
+        softhsm.assess_status()
+
+
+@reactive.hook('stop')
+def snapshot_token_store():
+    with timings.span('handler.snapshot_token_store'):
+        softhsm.snapshot_token_store()
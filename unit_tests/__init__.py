@@ -14,9 +14,15 @@
 
 import sys
 
+import mock
+
 sys.path.append('src')
 sys.path.append('src/lib')
+sys.path.append('src/actions')
 
 # Mock out charmhelpers so that we can test without it.
 import charms_openstack.test_mocks  # noqa
 charms_openstack.test_mocks.mock_charmhelpers()
+
+# charms.layer is only available in a built charm.
+sys.modules['charms.layer'] = mock.MagicMock()
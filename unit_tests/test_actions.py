@@ -0,0 +1,180 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+
+import actions
+
+import charms_openstack.test_utils as test_utils
+
+
+class TestActions(test_utils.PatchHelper):
+
+    def test_main(self):
+        self.patch_object(actions.hookenv, 'action_fail')
+        self.patch_object(actions.unitdata, 'kv')
+        self.patch_object(actions.timings, 'flush')
+        action = mock.MagicMock()
+        with mock.patch.dict(actions.ACTIONS, {'do-thing': action}):
+            actions.main(['/path/to/do-thing'])
+            action.assert_called_once_with(['/path/to/do-thing'])
+            self.assertFalse(self.action_fail.called)
+            self.kv.return_value.flush.assert_called_once_with()
+            # the spans recorded in the action are saved
+            self.flush.assert_called_once_with()
+            action.side_effect = Exception('it broke')
+            actions.main(['do-thing'])
+            self.action_fail.assert_called_once_with('it broke')
+        self.assertEqual(actions.main(['missing']),
+                         'Action missing undefined')
+
+    def test_republish(self):
+        self.patch_object(actions.reactive.RelationBase, 'from_state')
+        self.patch_object(actions.softhsm, 'on_hsm_connected')
+        self.from_state.return_value = None
+        actions.republish()
+        self.from_state.assert_called_once_with('hsm.connected')
+        self.assertFalse(self.on_hsm_connected.called)
+        self.from_state.return_value = mock.sentinel.hsm
+        actions.republish()
+        self.on_hsm_connected.assert_called_once_with(mock.sentinel.hsm)
+
+    def test_migrate_objectstore(self):
+        self.patch_object(actions.hookenv, 'action_get', return_value=10)
+        self.patch_object(actions.hookenv, 'action_set')
+        self.patch_object(actions.softhsm, 'migrate_objectstore')
+        self.patch_object(actions.softhsm, 'assess_status')
+        self.patch_object(actions, 'republish')
+        self.migrate_objectstore.return_value = {
+            'backup': '/var/lib/softhsm/tokens.file-20200101',
+            'tokens': {'barbican_token': {'objects': 3, 'checksum': 'ab'}},
+        }
+        actions.migrate_objectstore()
+        self.action_get.assert_called_once_with('batch-size')
+        self.migrate_objectstore.assert_called_once_with(10)
+        self.republish.assert_called_once_with()
+        self.assess_status.assert_called_once_with()
+        self.action_set.assert_has_calls([
+            mock.call({'backup': '/var/lib/softhsm/tokens.file-20200101'}),
+            mock.call({'barbican-token.objects': 3,
+                       'barbican-token.checksum': 'ab'})])
+
+    def test_relocate_token_store(self):
+        self.patch_object(actions.hookenv, 'action_set')
+        self.patch_object(actions.softhsm, 'relocate_token_store')
+        self.patch_object(actions.softhsm, 'assess_status')
+        self.patch_object(actions, 'republish')
+        results = {'source': '/var/lib/softhsm/tokens/',
+                   'target': '/srv/tokens/', 'files': 3, 'bytes': 300}
+        self.relocate_token_store.return_value = results
+        actions.relocate_token_store()
+        self.relocate_token_store.assert_called_once_with()
+        self.republish.assert_called_once_with()
+        self.assess_status.assert_called_once_with()
+        self.action_set.assert_called_once_with(results)
+
+    def test_discard_relocated_token_store(self):
+        self.patch_object(actions.hookenv, 'action_set')
+        self.patch_object(actions.softhsm, 'discard_relocated_token_store',
+                          return_value={'discarded': '/srv/old/'})
+        actions.discard_relocated_token_store()
+        self.action_set.assert_called_once_with({'discarded': '/srv/old/'})
+
+    def test_backup_token_store(self):
+        params = {'path': '/srv/b.tgz', 'incremental': True}
+        self.patch_object(actions.hookenv, 'action_get',
+                          side_effect=lambda key: params[key])
+        self.patch_object(actions.hookenv, 'action_set')
+        self.patch_object(actions.softhsm, 'backup_token_store',
+                          return_value={'id': 'abc'})
+        actions.backup_token_store()
+        self.backup_token_store.assert_called_once_with('/srv/b.tgz', True)
+        self.action_set.assert_called_once_with({'id': 'abc'})
+
+    def test_restore_token_store(self):
+        self.patch_object(actions.hookenv, 'action_get',
+                          return_value='/srv/full.tgz, /srv/incr.tgz')
+        self.patch_object(actions.hookenv, 'action_set')
+        self.patch_object(actions.softhsm, 'restore_token_store',
+                          return_value={'id': 'abc'})
+        self.patch_object(actions.softhsm, 'assess_status')
+        self.patch_object(actions, 'republish')
+        actions.restore_token_store()
+        self.restore_token_store.assert_called_once_with(
+            ['/srv/full.tgz', '/srv/incr.tgz'])
+        self.republish.assert_called_once_with()
+        self.assess_status.assert_called_once_with()
+        self.action_set.assert_called_once_with({'id': 'abc'})
+
+    def test_run_benchmark(self):
+        params = {'operations': 'sign', 'payload-sizes': '64,128',
+                  'threads': 2, 'processes': 1, 'duration': 3,
+                  'scratch': True}
+        self.patch_object(actions.hookenv, 'action_get',
+                          side_effect=lambda key: params[key])
+        self.patch_object(actions.hookenv, 'action_set')
+        self.patch_object(actions.softhsm, 'run_benchmark',
+                          return_value={'results': [{'ops': 1}]})
+        actions.run_benchmark()
+        self.run_benchmark.assert_called_once_with(
+            operations=['sign'], payload_sizes=[64, 128], threads=2,
+            processes=1, duration=3, scratch=True)
+        self.action_set.assert_called_once_with(
+            {'results': '{"results": [{"ops": 1}]}'})
+
+    def test_autotune(self):
+        params = {'levels': '1,2', 'operation': 'wrap', 'payload-size': 64,
+                  'duration': 1}
+        self.patch_object(actions.hookenv, 'action_get',
+                          side_effect=lambda key: params[key])
+        self.patch_object(actions.hookenv, 'action_set')
+        self.patch_object(actions.softhsm, 'autotune_concurrency',
+                          return_value={'recommended': 2})
+        self.patch_object(actions, 'republish')
+        actions.autotune()
+        self.autotune_concurrency.assert_called_once_with(
+            levels=[1, 2], operation='wrap', payload_size=64, duration=1)
+        self.republish.assert_called_once_with()
+        self.action_set.assert_called_once_with(
+            {'recommended': 2, 'results': '{"recommended": 2}'})
+
+    def test_hook_timings(self):
+        params = {'hook': 'install', 'reset': True}
+        self.patch_object(actions.hookenv, 'action_get',
+                          side_effect=lambda key: params[key])
+        self.patch_object(actions.hookenv, 'action_set')
+        self.patch_object(actions.timings, 'get_spans', return_value=[
+            {'hook': 'install', 'span': 'hook', 'seconds': 1},
+            {'hook': 'update-status', 'span': 'hook', 'seconds': 1}])
+        self.patch_object(actions.timings, 'histograms', return_value=[])
+        self.patch_object(actions.timings, 'clear')
+        actions.hook_timings()
+        self.histograms.assert_called_once_with(
+            [{'hook': 'install', 'span': 'hook', 'seconds': 1}])
+        self.action_set.assert_called_once_with(
+            {'spans': 1, 'histograms': '[]'})
+        self.clear.assert_called_once_with()
+
+    def test_trace_summary(self):
+        self.patch_object(actions.hookenv, 'action_get', return_value=True)
+        self.patch_object(actions.hookenv, 'action_set')
+        self.patch_object(actions.softhsm, 'trace_summary', return_value=[
+            {'function': 'C_Login', 'count': 2},
+            {'function': 'C_Encrypt', 'count': 3}])
+        actions.trace_summary()
+        self.trace_summary.assert_called_once_with(reset=True)
+        self.action_set.assert_called_once_with({
+            'calls': 5,
+            'functions': '[{"count": 2, "function": "C_Login"}, '
+                         '{"count": 3, "function": "C_Encrypt"}]'})
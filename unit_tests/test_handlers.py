@@ -24,8 +24,18 @@ class TestRegisteredHooks(test_utils.TestRegisteredHooks):
             'config.changed',
             'update-status']
         hook_set = {
+            'hook': {
+                'replicate_token_store': ('leader-elected',
+                                          'leader-settings-changed',
+                                          'cluster-relation-joined',
+                                          'cluster-relation-changed',
+                                          'cluster-relation-departed',
+                                          'update-status', ),
+                'snapshot_token_store': ('stop', ),
+            },
             'when': {
                 'hsm_connected': ('hsm.connected', ),
+                'render_config': ('charm.installed', 'config.changed', ),
             },
             'when_not': {
                 'install_packages': ('charm.installed', ),
@@ -45,6 +55,27 @@ class TestBarbicanHandlers(test_utils.PatchHelper):
         self.install.assert_called_once_with()
         self.set_state.assert_called_once_with('charm.installed')
 
+    def test_render_config(self):
+        self.patch_object(handlers.softhsm, 'render_config')
+        self.patch_object(handlers.softhsm, 'configure_tmpfs')
+        self.patch_object(handlers.softhsm, 'configure_proxy')
+        self.patch_object(handlers.softhsm, 'configure_trace')
+        handlers.render_config()
+        self.render_config.assert_called_once_with()
+        self.configure_tmpfs.assert_called_once_with()
+        self.configure_proxy.assert_called_once_with()
+        self.configure_trace.assert_called_once_with()
+
+    def test_snapshot_token_store(self):
+        self.patch_object(handlers.softhsm, 'snapshot_token_store')
+        handlers.snapshot_token_store()
+        self.snapshot_token_store.assert_called_once_with()
+
+    def test_replicate_token_store(self):
+        self.patch_object(handlers.softhsm, 'replicate_token_store')
+        handlers.replicate_token_store()
+        self.replicate_token_store.assert_called_once_with()
+
     def test_hsm_connected(self):
         self.patch_object(handlers.softhsm, 'on_hsm_connected')
         self.patch_object(handlers.reactive, 'set_state')
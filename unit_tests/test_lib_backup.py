@@ -0,0 +1,169 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+
+import charm.openstack.backup as backup
+
+import charms_openstack.test_utils as test_utils
+
+
+PINS = {'pin': 'p', 'so_pin': 's'}
+
+
+class TestBackup(test_utils.PatchHelper):
+
+    def setUp(self):
+        super(TestBackup, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.store = os.path.join(self.dir, 'tokens')
+        self.target = os.path.join(self.dir, 'restored')
+        os.makedirs(os.path.join(self.store, 'token-1'))
+        os.mkdir(self.target)
+        self._write('token-1/token.object', b'token')
+        self._write('token-1/key.object', b'key' * 1000)
+
+    def _write(self, name, data):
+        with open(os.path.join(self.store, name), 'wb') as f:
+            f.write(data)
+
+    def _read(self, name):
+        with open(os.path.join(self.target, name), 'rb') as f:
+            return f.read()
+
+    def _backup(self, name, previous=None):
+        path = os.path.join(self.dir, name)
+        with open(path, 'wb') as f:
+            manifest = backup.create(self.store, PINS, f, previous,
+                                     {'backend': 'file'})
+        return path, manifest
+
+    def _names(self, path):
+        with tarfile.open(path) as tar:
+            return tar.getnames()
+
+    def test_create(self):
+        out = io.BytesIO()
+        manifest = backup.create(self.store, PINS, out)
+        self.assertIsNone(manifest['base'])
+        self.assertEqual(manifest['archived'], 2)
+        self.assertEqual(manifest['dirs'], ['token-1'])
+        self.assertEqual(sorted(manifest['files']),
+                         ['token-1/key.object', 'token-1/token.object'])
+        self.assertEqual(manifest['files']['token-1/token.object']['sha256'],
+                         '3c469e9d6c5875d37a43f353d4f88e61'
+                         'fcf812c66eee3457465a40b0da4153e0')
+        out.seek(0)
+        with tarfile.open(fileobj=out) as tar:
+            # the manifest comes last, after everything it lists
+            self.assertEqual(tar.getnames(),
+                             ['pins.json', 'tokens', 'tokens/token-1',
+                              'tokens/token-1/key.object',
+                              'tokens/token-1/token.object',
+                              'manifest.json'])
+
+    def test_create_incremental(self):
+        _, full = self._backup('full.tgz')
+        self._write('token-1/token.object', b'changed')
+        self._write('token-1/new.object', b'new')
+        os.remove(os.path.join(self.store, 'token-1', 'key.object'))
+        path, manifest = self._backup('incr.tgz', full)
+        self.assertEqual(manifest['base'], full['id'])
+        self.assertEqual(manifest['archived'], 2)
+        self.assertEqual(sorted(manifest['files']),
+                         ['token-1/new.object', 'token-1/token.object'])
+        self.assertNotIn('tokens/token-1/key.object', self._names(path))
+        # unchanged files are listed but not archived
+        path, manifest = self._backup('incr2.tgz', manifest)
+        self.assertEqual(manifest['archived'], 0)
+        self.assertEqual(len(manifest['files']), 2)
+        self.assertNotIn('tokens/token-1/new.object', self._names(path))
+
+    def test_create_special_file(self):
+        os.mkfifo(os.path.join(self.store, 'fifo'))
+        with self.assertRaises(backup.BackupError):
+            backup.create(self.store, PINS, io.BytesIO())
+
+    def test_manifest(self):
+        path = os.path.join(self.dir, 'manifest.json')
+        self.assertIsNone(backup.read_manifest(path))
+        _, manifest = self._backup('full.tgz')
+        backup.write_manifest(path, manifest)
+        self.assertEqual(backup.read_manifest(path), manifest)
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+
+    def test_restore(self):
+        full_path, full = self._backup('full.tgz')
+        self._write('token-1/token.object', b'changed')
+        os.remove(os.path.join(self.store, 'token-1', 'key.object'))
+        os.mkdir(os.path.join(self.store, 'token-2'))
+        self._write('token-2/token.object', b'two')
+        incr_path, incr = self._backup('incr.tgz', full)
+        manifest, pins, files, size = backup.restore(
+            [full_path, incr_path], self.target)
+        self.assertEqual(manifest['id'], incr['id'])
+        self.assertEqual(manifest['backend'], 'file')
+        self.assertEqual(pins, PINS)
+        self.assertEqual((files, size), (2, 10))
+        self.assertEqual(self._read('token-1/token.object'), b'changed')
+        self.assertEqual(self._read('token-2/token.object'), b'two')
+        # the file deleted after the full backup is removed
+        self.assertFalse(os.path.exists(
+            os.path.join(self.target, 'token-1', 'key.object')))
+
+    def test_restore_removes_directories(self):
+        full_path, full = self._backup('full.tgz')
+        shutil.rmtree(os.path.join(self.store, 'token-1'))
+        incr_path, _ = self._backup('incr.tgz', full)
+        self.assertEqual(
+            backup.restore([full_path, incr_path], self.target)[2:], (0, 0))
+        self.assertEqual(os.listdir(self.target), [])
+
+    def test_restore_broken_chain(self):
+        full_path, full = self._backup('full.tgz')
+        incr_path, _ = self._backup('incr.tgz', full)
+        other_path, _ = self._backup('other.tgz')
+        with self.assertRaises(backup.BackupError):
+            backup.restore([incr_path], self.target)
+        with self.assertRaises(backup.BackupError):
+            backup.restore([other_path, incr_path], self.target)
+        with self.assertRaises(backup.BackupError):
+            backup.restore([], self.target)
+
+    def test_verify(self):
+        manifest = backup.restore([self._backup('full.tgz')[0]],
+                                  self.target)[0]
+        # a file that doesn't match its hash is caught
+        with open(os.path.join(self.target, 'token-1', 'key.object'),
+                  'wb') as f:
+            f.write(b'KEY' * 1000)
+        with self.assertRaises(backup.BackupError):
+            backup.verify(self.target, manifest)
+        # as is a file that is missing
+        os.remove(os.path.join(self.target, 'token-1', 'key.object'))
+        with self.assertRaises(backup.BackupError):
+            backup.verify(self.target, manifest)
+
+    def test_extract_unsafe(self):
+        path = os.path.join(self.dir, 'evil.tgz')
+        with tarfile.open(path, 'w:gz') as tar:
+            info = tarfile.TarInfo('tokens/../../etc/passwd')
+            tar.addfile(info, io.BytesIO())
+        with self.assertRaises(backup.BackupError):
+            backup.extract(path, self.target)
@@ -12,6 +12,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import io
+import json
+import os
+import shutil
+import tempfile
 import textwrap
 
 import mock
@@ -34,70 +39,1024 @@ class TestSoftHSM(test_utils.PatchHelper):
         softhsm.on_hsm_connected('hsm-thing')
         self.on_hsm_connected.assert_called_once_with('hsm-thing')
 
+    def test_setup_token_store_replica(self):
+        self.patch_object(softhsm.hookenv, 'is_leader', return_value=False)
+        self.patch_object(softhsm.hookenv, 'log')
+        self.patch_object(softhsm, 'token_store_replicated',
+                          return_value=False)
+        self.patch_object(softhsm, 'token_store_ready', return_value=False)
+        self.patch_object(softhsm, 'token_store_lock')
+        self.patch_object(softhsm, 'mark_token_store_ready')
+        c = softhsm.BarbicanSoftHSMCharm()
+        c.config = {'token-count': 1}
+        self.patch_object(c, '_setup_token_store')
+        self.patch_object(c, 'provision_master_keys')
+        self.patch_object(c, 'configure_tmpfs')
+        # a unit other than the leader doesn't make a store of its own
+        c.setup_token_store()
+        self.assertFalse(self.configure_tmpfs.called)
+        self.assertFalse(self._setup_token_store.called)
+        self.assertFalse(self.provision_master_keys.called)
+        # until it has replicated the leader's
+        self.token_store_replicated.return_value = True
+        c.setup_token_store()
+        self._setup_token_store.assert_called_once_with(['barbican_token'])
+
+    def test_render_config(self):
+        self.patch_object(softhsm.BarbicanSoftHSMCharm.singleton,
+                          'render_config')
+        softhsm.render_config()
+        self.render_config.assert_called_once_with()
+
+    def test_token_store_dir(self):
+        self.patch_object(softhsm, 'get_token_store_dir',
+                          return_value='/srv/tokens/')
+        config = mock.MagicMock(token_dir='/srv/tokens')
+        self.assertEqual(softhsm.token_store_dir(config), '/srv/tokens/')
+        self.get_token_store_dir.assert_called_once_with('/srv/tokens')
+
+    def test_get_token_store_dir(self):
+        kv = mock.MagicMock()
+        self.patch_object(softhsm.unitdata, 'kv', return_value=kv)
+        self.patch_object(softhsm, 'read_pins_from_store')
+        # the recorded directory wins
+        kv.get.return_value = '/srv/tokens'
+        self.assertEqual(softhsm.get_token_store_dir('/var/lib/softhsm'),
+                         '/srv/tokens/')
+        kv.get.assert_called_once_with(softhsm.TOKEN_DIR_KEY)
+        # an existing store without a recorded directory is in TOKEN_STORE
+        kv.get.return_value = None
+        self.read_pins_from_store.return_value = ('1234', '5678')
+        self.assertEqual(softhsm.get_token_store_dir('/srv/tokens'),
+                         softhsm.TOKEN_STORE)
+        # and with no store, it's the configured directory.
+        self.read_pins_from_store.return_value = (None, None)
+        self.assertEqual(softhsm.get_token_store_dir('/srv/tokens'),
+                         '/srv/tokens/')
+        self.assertEqual(softhsm.get_token_store_dir(), softhsm.TOKEN_STORE)
+
+    def test_relocate_token_store(self):
+        self.patch_object(softhsm.BarbicanSoftHSMCharm.singleton,
+                          'relocate_token_store',
+                          return_value=mock.sentinel.results)
+        self.assertEqual(softhsm.relocate_token_store(),
+                         mock.sentinel.results)
+        self.relocate_token_store.assert_called_once_with()
+
+    def test_discard_relocated_token_store(self):
+        self.patch_object(softhsm.BarbicanSoftHSMCharm.singleton,
+                          'discard_relocated_token_store',
+                          return_value=mock.sentinel.results)
+        self.assertEqual(softhsm.discard_relocated_token_store(),
+                         mock.sentinel.results)
+        self.discard_relocated_token_store.assert_called_once_with()
+
+    def test_backup_token_store(self):
+        self.patch_object(softhsm.BarbicanSoftHSMCharm.singleton,
+                          'backup_token_store',
+                          return_value=mock.sentinel.results)
+        self.assertEqual(softhsm.backup_token_store('/b.tgz', True),
+                         mock.sentinel.results)
+        self.backup_token_store.assert_called_once_with('/b.tgz', True)
+
+    def test_restore_token_store(self):
+        self.patch_object(softhsm.BarbicanSoftHSMCharm.singleton,
+                          'restore_token_store',
+                          return_value=mock.sentinel.results)
+        self.assertEqual(softhsm.restore_token_store(['/b.tgz']),
+                         mock.sentinel.results)
+        self.restore_token_store.assert_called_once_with(['/b.tgz'])
+
+    def test_replicate_token_store(self):
+        self.patch_object(softhsm.BarbicanSoftHSMCharm.singleton,
+                          'replicate_token_store', return_value=True)
+        self.assertTrue(softhsm.replicate_token_store())
+        self.replicate_token_store.assert_called_once_with()
+
+    def test_get_published_manifest(self):
+        self.patch_object(softhsm.hookenv, 'leader_get', return_value=None)
+        self.assertIsNone(softhsm.get_published_manifest())
+        self.leader_get.return_value = (
+            '{"version": 2, "id": "abc", "source": "softhsm/0"}')
+        self.assertEqual(softhsm.get_published_manifest(),
+                         {'version': 2, 'id': 'abc', 'source': 'softhsm/0'})
+        self.leader_get.assert_called_with(softhsm.MANIFEST_SETTING)
+        # a manifest from another version of the charm isn't understood
+        self.leader_get.return_value = '{"version": 1, "id": "abc"}'
+        self.assertIsNone(softhsm.get_published_manifest())
+
+    def test_token_store_replicated(self):
+        self.patch_object(softhsm, 'get_published_manifest',
+                          return_value=None)
+        self.patch_object(softhsm.unitdata, 'kv')
+        self.kv.return_value.get.return_value = 'abc'
+        self.assertFalse(softhsm.token_store_replicated())
+        self.get_published_manifest.return_value = {'id': 'abc'}
+        self.assertTrue(softhsm.token_store_replicated())
+        self.kv.return_value.get.assert_called_with(softhsm.REPLICA_KEY)
+        self.get_published_manifest.return_value = {'id': 'def'}
+        self.assertFalse(softhsm.token_store_replicated())
+
+    def test_replication_status(self):
+        self.patch_object(softhsm.unitdata, 'kv')
+        self.kv.return_value.get.return_value = 'abc'
+        self.patch_object(softhsm.hookenv, 'relation_ids',
+                          return_value=['cluster:1'])
+        self.patch_object(softhsm.hookenv, 'related_units',
+                          return_value=['softhsm/1', 'softhsm/2'])
+        replicas = {'softhsm/1': 'abc', 'softhsm/2': 'old'}
+        self.patch_object(softhsm.hookenv, 'relation_get',
+                          side_effect=lambda k, unit, rid: replicas[unit])
+        self.assertEqual(softhsm.replication_status(), (1, 2))
+        self.relation_ids.assert_called_once_with('cluster')
+        self.relation_get.assert_any_call('token-replica', 'softhsm/1',
+                                          'cluster:1')
+
+    def test_set_aside_token_store(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        store = os.path.join(tmp, 'tokens')
+        os.mkdir(store)
+        pins = os.path.join(tmp, 'pins')
+        with open(pins, 'w') as f:
+            f.write('{}')
+        self.patch_object(softhsm, 'STORED_PINS_FILE', new=pins)
+        self.patch_object(softhsm.hookenv, 'log')
+        self.patch_object(softhsm.time, 'strftime',
+                          return_value='20160101000000')
+        softhsm.set_aside_token_store(store + '/')
+        self.assertEqual(sorted(os.listdir(tmp)),
+                         ['pins', 'tokens.unreplicated-20160101000000',
+                          'tokens.unreplicated-20160101000000.pins'])
+
+    def test_token_store_backend(self):
+        self.patch_object(softhsm, 'get_token_store_backend',
+                          return_value='db')
+        config = mock.MagicMock(objectstore_backend='file')
+        self.assertEqual(softhsm.token_store_backend(config), 'db')
+        self.get_token_store_backend.assert_called_once_with('file')
+
+    def test_get_token_store_backend(self):
+        kv = mock.MagicMock()
+        self.patch_object(softhsm.unitdata, 'kv', return_value=kv)
+        self.patch_object(softhsm, 'read_pins_from_store')
+        # the recorded backend wins
+        kv.get.return_value = 'db'
+        self.assertEqual(softhsm.get_token_store_backend('file'), 'db')
+        kv.get.assert_called_once_with(softhsm.OBJECTSTORE_BACKEND_KEY)
+        # an existing store without a recorded backend is a file store
+        kv.get.return_value = None
+        self.read_pins_from_store.return_value = ('1234', '5678')
+        self.assertEqual(softhsm.get_token_store_backend('db'), 'file')
+        # and with no store, it's the configured backend.
+        self.read_pins_from_store.return_value = (None, None)
+        self.assertEqual(softhsm.get_token_store_backend('db'), 'db')
+        self.assertEqual(softhsm.get_token_store_backend(None), 'file')
+
+    def test_migrate_objectstore(self):
+        self.patch_object(softhsm.BarbicanSoftHSMCharm.singleton,
+                          'migrate_objectstore',
+                          return_value=mock.sentinel.results)
+        self.assertEqual(softhsm.migrate_objectstore(10),
+                         mock.sentinel.results)
+        self.migrate_objectstore.assert_called_once_with(10)
+
+    def test_token_store_state(self):
+        self.patch_object(softhsm, 'get_token_store_dir',
+                          return_value=softhsm.TOKEN_STORE)
+        self.patch_object(softhsm.os, 'stat')
+        self.patch_object(softhsm.os, 'listdir', return_value=['b', 'a'])
+        self.stat.side_effect = lambda p: mock.MagicMock(st_mtime_ns=len(p))
+        store = softhsm.TOKEN_STORE
+        self.assertEqual(softhsm.token_store_state(), [
+            ('', len(store)),
+            ('a', len(store) + 1),
+            ('b', len(store) + 1)])
+        self.stat.side_effect = OSError("not there")
+        self.assertEqual(softhsm.token_store_state(), None)
+
+    def test_discard_token_store(self):
+        self.patch_object(softhsm.os.path, 'lexists', return_value=True)
+        self.patch_object(softhsm.os, 'rename')
+        self.patch_object(softhsm.os, 'getpid', return_value=42)
+        self.patch_object(softhsm.time, 'strftime', return_value='20200101')
+        self.patch_object(softhsm, 'reclaim')
+        self.patch_object(softhsm.shutil, 'rmtree')
+        self.patch_object(softhsm.hookenv, 'log')
+        self.patch_object(softhsm.os.path, 'ismount', return_value=False)
+        self.patch_object(softhsm, 'get_token_store_dir',
+                          return_value=softhsm.TOKEN_STORE)
+        store = softhsm.TOKEN_STORE.rstrip('/')
+        discarded = store + '.discard-20200101-42'
+        self.assertEqual(softhsm.discard_token_store(), discarded)
+        self.rename.assert_called_once_with(store, discarded)
+        self.reclaim.assert_called_once_with(discarded)
+        self.assertFalse(self.rmtree.called)
+        # a store that can't be moved is deleted in place
+        self.reclaim.reset_mock()
+        self.rename.side_effect = OSError("busy")
+        self.patch_object(softhsm.os.path, 'isdir', return_value=True)
+        self.patch_object(softhsm.os.path, 'islink', return_value=False)
+        self.assertEqual(softhsm.discard_token_store(), None)
+        self.rmtree.assert_called_once_with(store)
+        self.assertFalse(self.reclaim.called)
+        # and no store is nothing to do
+        self.lexists.return_value = False
+        self.assertEqual(softhsm.discard_token_store(), None)
+        # another store can be discarded
+        self.lexists.return_value = True
+        self.rename.side_effect = None
+        self.assertEqual(softhsm.discard_token_store('/srv/tokens/'),
+                         '/srv/tokens.discard-20200101-42')
+        self.rename.assert_called_with('/srv/tokens',
+                                       '/srv/tokens.discard-20200101-42')
+
+    def test_discard_token_store_tmpfs(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        store = os.path.join(tmp, 'tokens')
+        os.makedirs(os.path.join(store, 'token-1'))
+        open(os.path.join(store, 'lock'), 'w').close()
+        self.patch_object(softhsm, 'get_token_store_dir',
+                          return_value=store + '/')
+        self.patch_object(softhsm.os.path, 'ismount', return_value=True)
+        self.patch_object(softhsm, 'reclaim')
+        self.assertEqual(softhsm.discard_token_store(), None)
+        self.assertEqual(os.listdir(store), [])
+        self.assertFalse(self.reclaim.called)
+
+    def test_mount_tmpfs(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        store = os.path.join(tmp, 'tokens')
+        self.patch_object(softhsm, 'TOKEN_STORE_SNAPSHOT',
+                          new=os.path.join(tmp, 'snapshot.tar.gz'))
+        self.patch_object(softhsm.subprocess, 'check_call')
+        self.patch_object(softhsm.snapshot, 'save')
+        self.patch_object(softhsm.snapshot, 'restore', return_value=3)
+        self.patch_object(softhsm, 'discard_token_store')
+        self.patch_object(softhsm.hookenv, 'log')
+        mount = ['mount', '-t', 'tmpfs', '-o', 'size=64M,mode=1777',
+                 'tmpfs', store]
+        # no store and no snapshot: just mount
+        softhsm.mount_tmpfs(store, '64M')
+        self.check_call.assert_called_once_with(mount)
+        self.assertFalse(self.save.called)
+        self.assertFalse(self.restore.called)
+        # a store on disk is moved into the tmpfs by way of a snapshot
+        os.mkdir(os.path.join(store, 'token-1'))
+
+        def save(path, snapshot):
+            open(snapshot, 'w').close()
+
+        self.save.side_effect = save
+        softhsm.mount_tmpfs(store, '64M')
+        self.save.assert_called_once_with(store, softhsm.TOKEN_STORE_SNAPSHOT)
+        self.discard_token_store.assert_called_once_with(store)
+        self.restore.assert_called_once_with(softhsm.TOKEN_STORE_SNAPSHOT,
+                                             store)
+
+    def test_unmount_tmpfs(self):
+        self.patch_object(softhsm.snapshot, 'save')
+        self.patch_object(softhsm.snapshot, 'restore')
+        self.patch_object(softhsm.ch_core_host, 'umount', return_value=True)
+        self.patch_object(softhsm.os, 'remove')
+        self.patch_object(softhsm.hookenv, 'log')
+        store = softhsm.TOKEN_STORE.rstrip('/')
+        softhsm.unmount_tmpfs(store)
+        self.save.assert_called_once_with(store, softhsm.TOKEN_STORE_SNAPSHOT)
+        self.umount.assert_called_once_with(store)
+        self.restore.assert_called_once_with(softhsm.TOKEN_STORE_SNAPSHOT,
+                                             store)
+        self.remove.assert_called_once_with(softhsm.TOKEN_STORE_SNAPSHOT)
+        # the snapshot is kept if the tmpfs can't be unmounted
+        self.restore.reset_mock()
+        self.remove.reset_mock()
+        self.umount.return_value = False
+        with self.assertRaises(RuntimeError):
+            softhsm.unmount_tmpfs(store)
+        self.assertFalse(self.restore.called)
+        self.assertFalse(self.remove.called)
+
+    def test_snapshot_token_store(self):
+        self.patch_object(softhsm, 'get_token_store_dir',
+                          return_value=softhsm.TOKEN_STORE)
+        self.patch_object(softhsm.os.path, 'ismount', return_value=False)
+        self.patch_object(softhsm, 'token_store_lock')
+        self.patch_object(softhsm.snapshot, 'save')
+        self.patch_object(softhsm.hookenv, 'log')
+        softhsm.snapshot_token_store()
+        self.assertFalse(self.save.called)
+        self.ismount.return_value = True
+        softhsm.snapshot_token_store()
+        self.token_store_lock.assert_called_once_with()
+        self.save.assert_called_once_with(softhsm.TOKEN_STORE.rstrip('/'),
+                                          softhsm.TOKEN_STORE_SNAPSHOT)
+
+    def test_write_snapshot_cron(self):
+        self.patch_object(softhsm.hookenv, 'charm_dir',
+                          return_value='/var/lib/juju/charm')
+        self.patch_object(softhsm.ch_core_host, 'write_file')
+        softhsm.write_snapshot_cron('/var/lib/softhsm/tokens', 10)
+        path, content = self.write_file.call_args[0]
+        self.assertEqual(path, softhsm.SNAPSHOT_CRON_FILE)
+        self.assertIn(
+            "*/10 * * * * root /usr/bin/python3 "
+            "/var/lib/juju/charm/lib/charm/openstack/snapshot.py save "
+            "--mounted --lock /var/lib/softhsm/token-store.lock "
+            "/var/lib/softhsm/tokens "
+            "/var/lib/softhsm/tokens-snapshot.tar.gz", content)
+
+    def test_configure_tmpfs(self):
+        self.patch_object(softhsm.BarbicanSoftHSMCharm.singleton,
+                          'configure_tmpfs')
+        softhsm.configure_tmpfs()
+        self.configure_tmpfs.assert_called_once_with()
+
+    def test_configure_proxy(self):
+        self.patch_object(softhsm.BarbicanSoftHSMCharm.singleton,
+                          'configure_proxy')
+        softhsm.configure_proxy()
+        self.configure_proxy.assert_called_once_with()
+
+    def test_write_proxy_unit(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        path = os.path.join(tmp, 'proxy.service')
+        self.patch_object(softhsm, 'PROXY_UNIT_FILE', new=path)
+        self.patch_object(softhsm.ch_core_host, 'write_file')
+        self.assertTrue(softhsm.write_proxy_unit(
+            ['barbican_token', 'barbican_token_1']))
+        unit_file, content = self.write_file.call_args[0]
+        self.assertEqual(unit_file, path)
+        self.assertIn("User=barbican\n", content)
+        self.assertIn("RuntimeDirectory=barbican-softhsm\n", content)
+        self.assertIn(
+            "ExecStart=/usr/bin/p11-kit server --foreground --provider {} "
+            "--name /run/barbican-softhsm/pkcs11 "
+            "\"pkcs11:token=barbican_token\" "
+            "\"pkcs11:token=barbican_token_1\"\n"
+            .format(softhsm.SOFTHSM2_LIB_PATH), content)
+        # an unchanged unit isn't written again
+        with open(path, 'w') as f:
+            f.write(content)
+        self.write_file.reset_mock()
+        self.assertFalse(softhsm.write_proxy_unit(
+            ['barbican_token', 'barbican_token_1']))
+        self.assertFalse(self.write_file.called)
+
+    def test_proxy_slot_ids(self):
+        self.assertEqual(
+            softhsm.proxy_slot_ids(['1234', '99', '2000000000']),
+            ['1', '0', '2'])
+
+    def test_configure_trace(self):
+        self.patch_object(softhsm.BarbicanSoftHSMCharm.singleton,
+                          'configure_trace')
+        softhsm.configure_trace()
+        self.configure_trace.assert_called_once_with()
+
+    def test_write_trace_logrotate(self):
+        self.patch_object(softhsm.ch_core_host, 'write_file')
+        softhsm.write_trace_logrotate()
+        (conf, content), _ = self.write_file.call_args_list[0]
+        self.assertEqual(conf, softhsm.TRACE_LOGROTATE_FILE)
+        self.assertIn("/var/log/barbican-softhsm/pkcs11-spy.log {\n"
+                      "    su barbican softhsm\n"
+                      "    size 50M\n"
+                      "    rotate 1\n"
+                      "    copytruncate\n", content)
+        (cron, content), _ = self.write_file.call_args_list[1]
+        self.assertEqual(cron, softhsm.TRACE_CRON_FILE)
+        self.assertIn("*/5 * * * * root /usr/sbin/logrotate "
+                      "/etc/logrotate.d/barbican-softhsm-trace\n", content)
+
+    def test_trace_summary(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        path = os.path.join(tmp, 'pkcs11-spy.log')
+        with open(path, 'w') as f:
+            f.write("0: C_Initialize\nReturned:  0 CKR_OK\n")
+        self.patch_object(softhsm, 'TRACE_LOG', new=path)
+        summaries = softhsm.trace_summary()
+        self.assertEqual([(s['function'], s['count']) for s in summaries],
+                         [('C_Initialize', 1)])
+        # reset empties the log, but leaves it for barbican
+        softhsm.trace_summary(reset=True)
+        self.assertEqual(os.path.getsize(path), 0)
+        self.assertEqual(softhsm.trace_summary(), [])
+
+    def test_reclaim(self):
+        self.patch_object(softhsm.subprocess, 'Popen')
+        self.Popen.return_value.pid = 1234
+        self.patch_object(softhsm.hookenv, 'log')
+        kv = mock.MagicMock()
+        kv.get.return_value = {'/old': 1}
+        self.patch_object(softhsm.unitdata, 'kv', return_value=kv)
+        softhsm.reclaim('/var/lib/softhsm/tokens.discard-1')
+        self.Popen.assert_called_once_with(
+            softhsm.RECLAIM_CMD + ['/var/lib/softhsm/tokens.discard-1'],
+            stdin=softhsm.subprocess.DEVNULL,
+            stdout=softhsm.subprocess.DEVNULL,
+            stderr=softhsm.subprocess.DEVNULL,
+            close_fds=True,
+            start_new_session=True)
+        kv.set.assert_called_once_with(softhsm.RECLAIM_KEY, {
+            '/old': 1, '/var/lib/softhsm/tokens.discard-1': 1234})
+
+    def test_reclaim_token_stores(self):
+        self.patch_object(softhsm, 'get_token_store_dir',
+                          return_value=softhsm.TOKEN_STORE)
+        store = {softhsm.RECLAIM_KEY: {'/t.discard-1': 10, '/t.discard-2': 11,
+                                       '/t.discard-3': 12}}
+        kv = mock.MagicMock()
+        kv.get.side_effect = lambda k: store.get(k)
+        kv.set.side_effect = lambda k, v: store.__setitem__(k, v)
+        self.patch_object(softhsm.unitdata, 'kv', return_value=kv)
+        self.patch_object(softhsm.glob, 'glob',
+                          return_value=['/t.discard-2', '/t.discard-1',
+                                        '/t.discard-4'])
+        self.patch_object(softhsm, '_pid_running',
+                          side_effect=lambda pid: pid == 10)
+        self.patch_object(softhsm, 'reclaim')
+        self.reclaim.side_effect = (
+            lambda path: store[softhsm.RECLAIM_KEY].__setitem__(path, 20))
+        self.patch_object(softhsm.os, 'listdir',
+                          side_effect=lambda path: ['a'] * int(path[-1]))
+        self.assertEqual(softhsm.reclaim_token_stores(), {
+            '/t.discard-1': 1, '/t.discard-2': 2, '/t.discard-4': 4})
+        # the deletion of stores whose process has gone is restarted
+        self.reclaim.assert_has_calls([
+            mock.call('/t.discard-2'), mock.call('/t.discard-4')])
+        self.assertEqual(self.reclaim.call_count, 2)
+        # and stores that have gone are forgotten
+        self.assertEqual(store[softhsm.RECLAIM_KEY], {
+            '/t.discard-1': 10, '/t.discard-2': 20, '/t.discard-4': 20})
+
+    def test_run_benchmark(self):
+        self.patch_object(softhsm.BarbicanSoftHSMCharm.singleton,
+                          'run_benchmark', return_value={'results': []})
+        self.assertEqual(softhsm.run_benchmark(threads=2), {'results': []})
+        self.run_benchmark.assert_called_once_with(threads=2)
+
+    def test_autotune_concurrency(self):
+        self.patch_object(softhsm.BarbicanSoftHSMCharm.singleton,
+                          'autotune_concurrency',
+                          return_value={'recommended': 4})
+        self.assertEqual(softhsm.autotune_concurrency(levels=[1, 4]),
+                         {'recommended': 4})
+        self.autotune_concurrency.assert_called_once_with(levels=[1, 4])
+
     def test_assess_status(self):
         self.patch_object(softhsm.BarbicanSoftHSMCharm.singleton,
                           'assess_status')
         softhsm.assess_status()
         self.assess_status.assert_called_once_with()
 
+    def _pins_file(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        path = os.path.join(tmp, 'stored_pins.txt')
+        self.patch_object(softhsm, 'STORED_PINS_FILE', new=path)
+        softhsm._pins_cache = None
+        self.patch_object(softhsm.hookenv, 'log')
+        return path
+
     def test_read_pins_from_store(self):
-        # test with no file (patch open so that it raises an error)
-        mock_open = mock.MagicMock(return_value=mock.sentinel.file_handle)
-        with mock.patch('builtins.open', mock_open):
-            def raise_exception(*args):
-                raise OSError("Supposed to break")
-            mock_open.side_effect = raise_exception
-            pin, so_pin = softhsm.read_pins_from_store()
-            self.assertEqual(pin, None)
-            self.assertEqual(so_pin, None)
-        # now provide the pin and so pin as a json object
-        d = '{"pin": "1234", "so_pin": "5678"}'
-        with mock.patch('builtins.open',
-                        mock.mock_open(read_data=d),
-                        create=True):
-            pin, so_pin = softhsm.read_pins_from_store()
-            self.assertEqual(pin, '1234')
-            self.assertEqual(so_pin, '5678')
+        path = self._pins_file()
+        # no file
+        self.assertEqual(softhsm.read_pins_from_store(), (None, None))
+        # a file from before the record was versioned
+        with open(path, 'w') as f:
+            f.write('{"pin": "1234", "so_pin": "5678"}')
+        self.assertEqual(softhsm.read_pins_from_store(), ('1234', '5678'))
+        # an unchanged file is only read once
+        with mock.patch('builtins.open') as mock_open:
+            self.assertEqual(softhsm.read_pins_from_store(),
+                             ('1234', '5678'))
+            mock_open.assert_not_called()
+        # a replaced file is read again
+        with open(path + '.new', 'w') as f:
+            f.write('{"version": 1, "pin": "abcd", "so_pin": "efgh"}')
+        os.rename(path + '.new', path)
+        self.assertEqual(softhsm.read_pins_from_store(), ('abcd', 'efgh'))
+        # a corrupt file
+        with open(path + '.new', 'w') as f:
+            f.write('{"pin": "ab')
+        os.rename(path + '.new', path)
+        self.assertEqual(softhsm.read_pins_from_store(), (None, None))
+        os.remove(path)
+        self.assertEqual(softhsm.read_pins_from_store(), (None, None))
+        # a version this charm doesn't know isn't mistaken for no pins
+        with open(path, 'w') as f:
+            f.write('{"version": 2, "pins": {"user": "1234"}}')
+        with self.assertRaises(ValueError):
+            softhsm.read_pins_from_store()
 
     def test_write_pins_to_store(self):
-        f = mock.MagicMock()
-        self.patch_object(softhsm.os, 'fdopen', return_value=f)
-        self.patch_object(softhsm.os, 'open', return_value='opener')
-        self.patch_object(softhsm.json, 'dump')
-        softhsm.write_pins_to_store('1234', '5678')
-        self.open.assert_called_once_with(
-            softhsm.STORED_PINS_FILE,
-            softhsm.os.O_WRONLY | softhsm.os.O_CREAT,
-            0o600)
-        self.fdopen.assert_called_once_with('opener', 'w')
-        self.dump.assert_called_once_with(
-            {'pin': '1234', 'so_pin': '5678'}, f.__enter__())
+        path = self._pins_file()
+        with open(path, 'w') as f:
+            f.write('{"pin": "1234", "so_pin": "5678"}')
+        self.assertEqual(softhsm.read_pins_from_store(), ('1234', '5678'))
+        self.patch_object(softhsm.os, 'fsync', wraps=os.fsync)
+        softhsm.write_pins_to_store('abcd', 'efgh')
+        # the file and its directory are synced
+        self.assertEqual(self.fsync.call_count, 2)
+        self.assertEqual(os.listdir(os.path.dirname(path)),
+                         ['stored_pins.txt'])
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+        with open(path) as f:
+            self.assertEqual(json.load(f), {
+                'version': softhsm.PINS_VERSION,
+                'pin': 'abcd',
+                'so_pin': 'efgh'})
+        self.assertEqual(softhsm.read_pins_from_store(), ('abcd', 'efgh'))
 
-    def test_read_slot_id(self):
-        result = textwrap.dedent("""
+    def test_token_store_ready(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        self.patch_object(softhsm, 'TOKEN_STORE_MARKER',
+                          new=os.path.join(tmp, 'token-store.ready'))
+        self.patch_object(softhsm, 'token_store_fingerprint',
+                          return_value='abc')
+        self.patch_object(softhsm, 'read_pins_from_store',
+                          return_value=('1234', '5678'))
+        self.assertFalse(softhsm.token_store_ready(['a']))
+        softhsm.mark_token_store_ready(['a'])
+        self.assertEqual(os.listdir(tmp), ['token-store.ready'])
+        self.assertTrue(softhsm.token_store_ready(['a']))
+        self.assertFalse(softhsm.token_store_ready(['a', 'b']))
+        self.read_pins_from_store.return_value = None, None
+        self.assertFalse(softhsm.token_store_ready(['a']))
+        self.read_pins_from_store.return_value = '1234', '5678'
+        self.token_store_fingerprint.return_value = 'def'
+        self.assertFalse(softhsm.token_store_ready(['a']))
+
+    def test_token_store_lock(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        lock = os.path.join(tmp, 'token-store.lock')
+        self.patch_object(softhsm, 'TOKEN_STORE_LOCK', new=lock)
+        with softhsm.token_store_lock():
+            fd = os.open(lock, os.O_RDWR)
+            try:
+                with self.assertRaises(BlockingIOError):
+                    softhsm.fcntl.flock(
+                        fd, softhsm.fcntl.LOCK_EX | softhsm.fcntl.LOCK_NB)
+            finally:
+                os.close(fd)
+        # and it's released afterwards
+        with softhsm.token_store_lock():
+            pass
+
+    def test_write_pins_to_store_fails(self):
+        path = self._pins_file()
+        with open(path, 'w') as f:
+            f.write('{"pin": "1234", "so_pin": "5678"}')
+        self.patch_object(softhsm.os, 'rename',
+                          side_effect=OSError("No space left"))
+        with self.assertRaises(OSError):
+            softhsm.write_pins_to_store('abcd', 'efgh')
+        # the old pins are left as they were, without the temporary file
+        self.assertEqual(softhsm.read_pins_from_store(), ('1234', '5678'))
+        self.assertEqual(os.listdir(os.path.dirname(path)),
+                         ['stored_pins.txt'])
+        self.log.assert_called_once_with(
+            "Couldn't write pins file: No space left",
+            level=softhsm.hookenv.ERROR)
+
+    def test_parse_show_slots(self):
+        output = textwrap.dedent("""
+            Available slots:
             Slot 5
                 Slot info:
-                Description: SoftHSM slot 0
-                Manufacturer ID:  SoftHSM project
-                Hardware version: 2.0
-                Firmware version: 2.0
-                Token present:    yes
-            Token info:
-                Manufacturer ID:  SoftHSM project
-                Model:            SoftHSM v2
-                Hardware version: 2.0
-                Firmware version: 2.0
-                Serial number:    02ae3171143498e7
-                Initialized:      yes
-                User PIN init.:   yes
-                Label:            barbican_token
+                    Description:      SoftHSM slot ID 0x5
+                    Manufacturer ID:  SoftHSM project
+                    Hardware version: 2.2
+                    Firmware version: 2.2
+                    Token present:    yes
+                Token info:
+                    Manufacturer ID:  SoftHSM project
+                    Model:            SoftHSM v2
+                    Hardware version: 2.2
+                    Firmware version: 2.2
+                    Serial number:    02ae3171143498e7
+                    Initialized:      yes
+                    User PIN init.:   yes
+                    Label:            barbican_token_old
+            Slot 6
+                Slot info:
+                    Description:      SoftHSM slot ID 0x6
+                    Token present:    yes
+                Token info:
+                    Serial number:    12ae3171143498e7
+                    Initialized:      yes
+                    User PIN init.:   yes
+                    Label:            barbican_token
+            Slot 7
+                Slot info:
+                    Description:      SoftHSM slot ID 0x7
+                    Token present:    yes
+                Token info:
+                    Serial number:
+                    Initialized:      no
+                    User PIN init.:   no
+                    Label:
         """)
-        self.patch_object(softhsm.subprocess, 'check_output',
-                          return_value=result.encode())
-        self.assertEqual(softhsm.read_slot_id('barbican_token'), '5')
-        self.check_output.assert_called_once_with(
-            [softhsm.SOFTHSM2_UTIL_CMD, '--show-slots'])
-        self.assertEqual(softhsm.read_slot_id('not_found'), None)
+        slots = list(softhsm.parse_show_slots(output.splitlines()))
+        self.assertEqual([s.slot_id for s in slots], ['5', '6', '7'])
+        self.assertEqual(slots[0].description, 'SoftHSM slot ID 0x5')
+        self.assertEqual(slots[0].hardware_version, '2.2')
+        self.assertTrue(slots[0].token_present)
+        self.assertEqual(slots[0].token, softhsm.pkcs11.TokenInfo(
+            label='barbican_token_old',
+            manufacturer_id='SoftHSM project',
+            model='SoftHSM v2',
+            serial='02ae3171143498e7',
+            initialized=True,
+            user_pin_initialized=True,
+            hardware_version='2.2',
+            firmware_version='2.2'))
+        self.assertEqual(slots[1].token.label, 'barbican_token')
+        self.assertEqual(slots[1].token.serial, '12ae3171143498e7')
+        self.assertEqual(slots[2].token.label, '')
+        self.assertFalse(slots[2].token.initialized)
+        self.assertFalse(slots[2].token.user_pin_initialized)
+        # records are yielded as soon as they are complete
+        lines = iter(output.splitlines())
+        parser = softhsm.parse_show_slots(lines)
+        self.assertEqual(next(parser).slot_id, '5')
+        self.assertEqual(next(lines).strip(), 'Slot info:')
+        self.assertEqual(list(softhsm.parse_show_slots([])), [])
+
+    def test_iter_slots_softhsm2_util(self):
+        self.patch_object(softhsm.subprocess, 'Popen')
+        proc = self.Popen.return_value
+        proc.stdout = mock.MagicMock()
+        proc.stdout.__iter__.return_value = iter(
+            ['Slot 1\n', 'Slot 2\n', 'Slot 3\n'])
+        proc.returncode = 0
+        slots = softhsm.iter_slots_softhsm2_util()
+        self.assertEqual(next(slots).slot_id, '1')
+        self.Popen.assert_called_once_with(
+            [softhsm.SOFTHSM2_UTIL_CMD, '--show-slots'],
+            stdout=softhsm.subprocess.PIPE, universal_newlines=True)
+        # closing early terminates the process
+        proc.poll.return_value = None
+        slots.close()
+        proc.stdout.close.assert_called_once_with()
+        proc.terminate.assert_called_once_with()
+        proc.wait.assert_called_once_with()
+        # reading everything doesn't
+        proc.reset_mock()
+        proc.stdout.__iter__.return_value = iter(['Slot 1\n', 'Slot 2\n'])
+        self.assertEqual(
+            [s.slot_id for s in softhsm.iter_slots_softhsm2_util()],
+            ['1', '2'])
+        self.assertFalse(proc.terminate.called)
+        # and a failing command raises
+        proc.stdout.__iter__.return_value = iter([])
+        proc.returncode = 1
+        with self.assertRaises(softhsm.subprocess.CalledProcessError):
+            list(softhsm.iter_slots_softhsm2_util())
+
+    def test_read_slots_softhsm2_util(self):
+        self.patch_object(softhsm, 'iter_slots_softhsm2_util',
+                          return_value=iter([1, 2]))
+        self.assertEqual(softhsm.read_slots_softhsm2_util(), [1, 2])
+
+    def test_read_slot_softhsm2_util(self):
+        def token(label, initialized=True):
+            return softhsm.pkcs11.TokenInfo(
+                label, None, None, None, initialized, initialized, None, None)
+
+        def slot(slot_id, token):
+            return softhsm.pkcs11.SlotInfo(
+                slot_id, None, True, None, None, token)
+
+        slots = [
+            slot('1', None),
+            slot('2', token('barbican_token_old')),
+            slot('3', token('barbican_token')),
+            slot('4', token('', initialized=False)),
+        ]
+        closed = []
+
+        def iter_slots():
+            try:
+                for s in slots:
+                    yield s
+            finally:
+                closed.append(True)
+
+        self.patch_object(softhsm, 'iter_slots_softhsm2_util',
+                          side_effect=iter_slots)
+        self.assertEqual(
+            softhsm.read_slot_softhsm2_util('barbican_token'), slots[2])
+        self.assertEqual(closed, [True])
+        self.assertEqual(
+            softhsm.read_slot_softhsm2_util('barbican'), None)
+        self.assertEqual(
+            softhsm.read_slot_softhsm2_util(''), None)
+
+    def test_read_slot_id(self):
+        self.patch_object(softhsm, 'read_slot')
+        self.read_slot.return_value = mock.MagicMock(slot_id=1234)
+        self.assertEqual(softhsm.read_slot_id('barbican_token'), '1234')
+        self.read_slot.assert_called_once_with('barbican_token')
+        self.read_slot.return_value = None
+        self.assertEqual(softhsm.read_slot_id('barbican_token'), None)
+
+    def test_read_slot(self):
+        self.patch_object(softhsm.pkcs11, 'find_slot',
+                          return_value=mock.sentinel.slot)
+        self.patch_object(softhsm, 'read_slot_softhsm2_util',
+                          return_value=mock.sentinel.util_slot)
+        self.patch_object(softhsm.hookenv, 'log')
+        self.assertEqual(softhsm.read_slot('barbican_token'),
+                         mock.sentinel.slot)
+        self.find_slot.assert_called_once_with(
+            softhsm.SOFTHSM2_LIB_PATH, 'barbican_token')
+        self.assertFalse(self.read_slot_softhsm2_util.called)
+        # a token that isn't there doesn't fall back to softhsm2-util
+        self.find_slot.return_value = None
+        self.assertEqual(softhsm.read_slot('barbican_token'), None)
+        self.assertFalse(self.read_slot_softhsm2_util.called)
+        # but a library that can't be loaded does.
+        self.find_slot.side_effect = OSError("no such file")
+        self.assertEqual(softhsm.read_slot('barbican_token'),
+                         mock.sentinel.util_slot)
+        self.read_slot_softhsm2_util.assert_called_once_with(
+            'barbican_token')
+        self.read_slot_softhsm2_util.reset_mock()
+        self.find_slot.side_effect = softhsm.pkcs11.PKCS11Error(
+            'C_Initialize', 0x5)
+        self.assertEqual(softhsm.read_slot('barbican_token'),
+                         mock.sentinel.util_slot)
+        self.read_slot_softhsm2_util.assert_called_once_with(
+            'barbican_token')
+
+    def test_get_mechanisms(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        library = os.path.join(tmp, 'libsofthsm2.so')
+        self.patch_object(softhsm, 'SOFTHSM2_LIB_PATH', new=library)
+        kv = mock.MagicMock()
+        store = {}
+        kv.get.side_effect = lambda k, default=None: store.get(k, default)
+        kv.set.side_effect = lambda k, v: store.__setitem__(k, v)
+        self.patch_object(softhsm.unitdata, 'kv', return_value=kv)
+        self.patch_object(softhsm.pkcs11, 'read_mechanisms', return_value={
+            'CKM_AES_GCM': softhsm.pkcs11.MechanismInfo(16, 32, 0x300)})
+        # no library, no mechanisms
+        self.assertIsNone(softhsm.get_mechanisms())
+        open(library, 'w').close()
+        expected = {'CKM_AES_GCM': {'min_key_size': 16, 'max_key_size': 32,
+                                    'flags': 0x300}}
+        self.assertEqual(softhsm.get_mechanisms(), expected)
+        self.read_mechanisms.assert_called_once_with(library)
+        # the library is only probed again when it changes
+        self.assertEqual(softhsm.get_mechanisms(), expected)
+        self.assertEqual(self.read_mechanisms.call_count, 1)
+        st = os.stat(library)
+        os.utime(library, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+        softhsm.get_mechanisms()
+        self.assertEqual(self.read_mechanisms.call_count, 2)
+        # a library that can't be read isn't cached
+        os.utime(library, ns=(st.st_atime_ns, st.st_mtime_ns + 2 * 10 ** 9))
+        self.read_mechanisms.side_effect = OSError("bad ELF")
+        self.assertIsNone(softhsm.get_mechanisms())
+
+    def test_token_store_fingerprint(self):
+        self.patch_object(softhsm, 'get_token_store_dir',
+                          return_value=softhsm.TOKEN_STORE)
+        self.patch_object(softhsm.os, 'stat')
+        self.patch_object(softhsm.os, 'listdir')
+        self.stat.return_value = mock.MagicMock(st_ino=1, st_mtime_ns=2)
+        self.listdir.return_value = ['b', 'a']
+        fingerprint = softhsm.token_store_fingerprint()
+        self.stat.assert_called_once_with(softhsm.TOKEN_STORE)
+        self.listdir.assert_called_once_with(softhsm.TOKEN_STORE)
+        # the fingerprint changes with the inode, mtime and tokens
+        self.listdir.return_value = ['a', 'b']
+        self.assertEqual(softhsm.token_store_fingerprint(), fingerprint)
+        self.listdir.return_value = ['a', 'b', 'c']
+        self.assertNotEqual(softhsm.token_store_fingerprint(), fingerprint)
+        self.listdir.return_value = ['a', 'b']
+        self.stat.return_value = mock.MagicMock(st_ino=3, st_mtime_ns=2)
+        self.assertNotEqual(softhsm.token_store_fingerprint(), fingerprint)
+        self.stat.side_effect = OSError("not there")
+        self.assertEqual(softhsm.token_store_fingerprint(), None)
+
+    def test_save_status(self):
+        self.patch_object(softhsm, 'get_token_store_dir',
+                          return_value=softhsm.TOKEN_STORE)
+        self.patch_object(softhsm.hookenv, 'status_get',
+                          return_value=('active', 'Unit is ready'))
+        self.patch_object(softhsm.hookenv, 'charm_dir',
+                          return_value='/var/lib/juju/charm')
+        self.patch_object(softhsm.fastpath, 'save_state')
+        self.patch_object(softhsm.fastpath, 'clear_state')
+        softhsm.save_status()
+        self.save_state.assert_called_once_with(
+            '/var/lib/juju/charm',
+            {'files': [softhsm.STORED_PINS_FILE,
+                       softhsm.SOFTHSM2_CONF,
+                       '/var/lib/juju/charm/.juju-persistent-config',
+                       '/var/lib/juju/charm/.softhsm-health-verdict.json'],
+             'dirs': [softhsm.TOKEN_STORE],
+             'globs': ['/var/lib/softhsm/tokens.discard-*'],
+             'relations': ['hsm', 'cluster']},
+            'active', 'Unit is ready')
+        self.clear_state.assert_not_called()
+        # a stale status mustn't be left behind
+        self.save_state.side_effect = OSError("read-only")
+        softhsm.save_status()
+        self.clear_state.assert_called_once_with('/var/lib/juju/charm')
+
+    def test_save_metrics_state(self):
+        self.patch_object(softhsm, 'get_token_store_dir',
+                          return_value=softhsm.TOKEN_STORE)
+        self.patch_object(softhsm.hookenv, 'charm_dir',
+                          return_value='/var/lib/juju/charm')
+        config = {'metrics-textfile-dir': '/var/lib/prometheus/node-exporter',
+                  'health-probe-interval': 15}
+        self.patch_object(softhsm.hookenv, 'config', side_effect=config.get)
+        self.patch_object(softhsm.timings, 'last',
+                          return_value={'seconds': 0.25})
+        self.patch_object(softhsm.metrics, 'save_state')
+        self.patch_object(softhsm.metrics, 'clear_state')
+        softhsm.save_metrics_state()
+        self.last.assert_called_once_with('read_slot')
+        self.save_state.assert_called_once_with('/var/lib/juju/charm', {
+            'textfile':
+                '/var/lib/prometheus/node-exporter/barbican_softhsm.prom',
+            'store': softhsm.TOKEN_STORE,
+            'pins_file': softhsm.STORED_PINS_FILE,
+            'library': softhsm.SOFTHSM2_LIB_PATH,
+            'conf': softhsm.SOFTHSM2_CONF,
+            'user': 'barbican',
+            'label': 'barbican_token',
+            'read_slot': 0.25,
+            'interval': 900,
+        })
+        # unsetting the directory stops the metrics
+        config['metrics-textfile-dir'] = ''
+        softhsm.save_metrics_state()
+        self.clear_state.assert_called_once_with('/var/lib/juju/charm')
+        self.assertEqual(self.save_state.call_count, 1)
+
+    def test_save_metrics_state_slot_lookup(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        store = os.path.join(tmp, 'tokens')
+        textfiles = os.path.join(tmp, 'node-exporter')
+        os.makedirs(os.path.join(store, 'token-1'))
+        os.mkdir(textfiles)
+        kv = mock.MagicMock()
+        saved = {}
+        kv.get.side_effect = lambda k, default=None: saved.get(k, default)
+        kv.set.side_effect = lambda k, v: saved.__setitem__(k, v)
+        kv.getrange.return_value = {}
+        self.patch_object(softhsm.unitdata, 'kv', return_value=kv)
+        self.patch_object(softhsm.hookenv, 'hook_name',
+                          return_value='hsm-relation-changed')
+        self.patch_object(softhsm.hookenv, 'atexit')
+        self.patch_object(softhsm.hookenv, 'charm_dir', return_value=tmp)
+        config = {'metrics-textfile-dir': textfiles,
+                  'health-probe-interval': 15}
+        self.patch_object(softhsm.hookenv, 'config', side_effect=config.get)
+        self.patch_object(softhsm, 'get_token_store_dir', return_value=store)
+        self.patch_object(softhsm, 'STORED_PINS_FILE',
+                          new=os.path.join(tmp, 'pins'))
+        self.patch_object(softhsm, 'token_store_fingerprint',
+                          return_value='fp1')
+        self.patch_object(softhsm.pkcs11, 'find_slot',
+                          return_value=softhsm.pkcs11.SlotInfo(
+                              slot_id=10, description='', token_present=True,
+                              hardware_version='2.0',
+                              firmware_version='2.0', token=None))
+        # read_slot() takes 0.25s of the first get_slot_id(), and the
+        # second is served from the cache
+        self.patch_object(softhsm.timings.time, 'perf_counter',
+                          side_effect=[1.0, 1.25, 1.5, 2.0, 3.0, 3.001])
+        self.addCleanup(softhsm.timings._pending.clear)
+        self.assertEqual(softhsm.get_slot_id('barbican_token'), '10')
+        self.assertEqual(softhsm.get_slot_id('barbican_token'), '10')
+        softhsm.save_metrics_state()
+        # update-status writes it to the textfile
+        self.assertTrue(softhsm.metrics.update(tmp))
+        with open(os.path.join(textfiles,
+                               softhsm.metrics.TEXTFILE_NAME)) as f:
+            self.assertIn('barbican_softhsm_read_slot_seconds 0.25\n',
+                          f.read())
+
+    def test_save_health_state(self):
+        self.patch_object(softhsm.hookenv, 'charm_dir',
+                          return_value='/var/lib/juju/charm')
+        config = {'health-probe-threshold': 250, 'health-probe-interval': 15}
+        self.patch_object(softhsm.hookenv, 'config', side_effect=config.get)
+        kv = mock.MagicMock()
+        kv.get.return_value = {'barbican_token': {'slot_id': '1234'}}
+        self.patch_object(softhsm.unitdata, 'kv', return_value=kv)
+        self.patch_object(softhsm.health, 'save_state')
+        self.patch_object(softhsm.health, 'clear_state')
+        softhsm.save_health_state()
+        kv.get.assert_called_once_with(softhsm.SLOT_CACHE_KEY)
+        self.save_state.assert_called_once_with('/var/lib/juju/charm', {
+            'library': softhsm.SOFTHSM2_LIB_PATH,
+            'conf': softhsm.SOFTHSM2_CONF,
+            'user': 'barbican',
+            'label': 'barbican_token',
+            'slot_id': 1234,
+            'pins_file': softhsm.STORED_PINS_FILE,
+            'threshold': 0.25,
+            'interval': 900,
+        })
+        # without a published slot, the probe looks the token up
+        kv.get.return_value = None
+        softhsm.save_health_state()
+        self.assertIsNone(self.save_state.call_args[0][1]['slot_id'])
+        # a threshold of 0 stops the probes
+        config['health-probe-threshold'] = 0
+        softhsm.save_health_state()
+        self.clear_state.assert_called_once_with('/var/lib/juju/charm')
+        self.assertEqual(self.save_state.call_count, 2)
+
+    def test_health_status(self):
+        self.patch_object(softhsm.hookenv, 'charm_dir',
+                          return_value='/var/lib/juju/charm')
+        self.patch_object(softhsm.hookenv, 'config', return_value=250)
+        self.patch_object(softhsm.health, 'verdict',
+                          return_value=('blocked', 'failing'))
+        self.assertEqual(softhsm.health_status(), ('blocked', 'failing'))
+        self.verdict.assert_called_once_with('/var/lib/juju/charm')
+        # a stale verdict is ignored once the probes are turned off
+        self.config.return_value = 0
+        self.assertEqual(softhsm.health_status(), (None, None))
+
+    def test_save_status_leader(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        os.makedirs(os.path.join(tmp, 'token-1'))
+        open(os.path.join(tmp, 'token-1', 'key.object'), 'w').close()
+        self.patch_object(softhsm, 'get_token_store_dir',
+                          return_value=tmp + '/')
+        self.patch_object(softhsm.hookenv, 'status_get',
+                          return_value=('active', 'Unit is ready'))
+        self.patch_object(softhsm.hookenv, 'charm_dir',
+                          return_value='/var/lib/juju/charm')
+        self.patch_object(softhsm.hookenv, 'is_leader', return_value=True)
+        self.patch_object(softhsm, 'replication_status',
+                          return_value=(1, 1))
+        self.patch_object(softhsm.fastpath, 'save_state')
+        softhsm.save_status()
+        # the leader watches the token files, to publish them
+        self.assertEqual(self.save_state.call_args[0][1]['files'][4:],
+                         [os.path.join(tmp, 'token-1', 'key.object')])
+        self.replication_status.return_value = (0, 0)
+        softhsm.save_status()
+        self.assertEqual(len(self.save_state.call_args[0][1]['files']), 4)
+
+    def test_get_slot_id(self):
+        kv = mock.MagicMock()
+        store = {}
+        kv.get.side_effect = lambda k, default=None: store.get(k, default)
+        kv.set.side_effect = lambda k, v: store.__setitem__(k, v)
+        self.patch_object(softhsm.unitdata, 'kv', return_value=kv)
+        self.patch_object(softhsm, 'token_store_fingerprint',
+                          return_value='fp1')
+        self.patch_object(softhsm, 'read_slot')
+        self.read_slot.return_value = softhsm.pkcs11.SlotInfo(
+            slot_id=10, description='', token_present=True,
+            hardware_version='2.0', firmware_version='2.0',
+            token=mock.MagicMock(serial='abcd'))
+        self.assertEqual(softhsm.get_slot_id('barbican_token'), '10')
+        self.read_slot.assert_called_once_with('barbican_token')
+        self.assertEqual(store[softhsm.SLOT_CACHE_KEY], {
+            'barbican_token': {
+                'fingerprint': 'fp1',
+                'slot_id': '10',
+                'serial': 'abcd'}})
+        # a second call is served from the cache
+        self.read_slot.reset_mock()
+        self.assertEqual(softhsm.get_slot_id('barbican_token'), '10')
+        self.assertFalse(self.read_slot.called)
+        # a changed token store invalidates the cache
+        self.token_store_fingerprint.return_value = 'fp2'
+        self.read_slot.return_value = None
+        self.assertEqual(softhsm.get_slot_id('barbican_token'), None)
+        self.read_slot.assert_called_once_with('barbican_token')
+        self.assertEqual(store[softhsm.SLOT_CACHE_KEY], {})
+        # no token store means no caching
+        self.token_store_fingerprint.return_value = None
+        self.read_slot.reset_mock()
+        self.read_slot.return_value = softhsm.pkcs11.SlotInfo(
+            slot_id='5', description=None, token_present=True,
+            hardware_version=None, firmware_version=None, token=None)
+        self.assertEqual(softhsm.get_slot_id('barbican_token'), '5')
+        self.assertEqual(softhsm.get_slot_id('barbican_token'), '5')
+        self.assertEqual(self.read_slot.call_count, 2)
 
 
 class TestBarbicanSoftHSMCharm(test_utils.PatchHelper):
@@ -107,87 +1066,872 @@ class TestBarbicanSoftHSMCharm(test_utils.PatchHelper):
                           'install')
         self.patch_object(softhsm.ch_core_host, 'add_user_to_group')
         c = softhsm.BarbicanSoftHSMCharm()
+        self.patch_object(c, 'render_config')
         self.patch_object(c, 'setup_token_store')
         self.patch_object(softhsm.hookenv, 'status_set')
         c.install()
         self.install.assert_called_once_with()
         self.add_user_to_group.assert_called_once_with('barbican', 'softhsm')
+        self.render_config.assert_called_once_with()
         self.setup_token_store.assert_called_once_with()
         self.status_set.assert_called_once_with(
             'waiting', 'Charm installed and token store configured')
 
     def test_setup_token_store(self):
         self.patch_object(softhsm, 'read_pins_from_store')
-        self.patch_object(softhsm.os.path, 'exists')
-        self.patch_object(softhsm.os.path, 'isdir')
-        self.patch_object(softhsm.shutil, 'rmtree')
-        self.patch_object(softhsm.os, 'remove')
+        self.patch_object(softhsm, 'get_slot_id')
+        self.patch_object(softhsm, 'discard_token_store')
         self.patch_object(softhsm.os, 'makedirs')
         self.patch_object(softhsm.os, 'chmod')
         self.patch_object(softhsm.ch_core_host, 'pwgen')
         self.patch_object(softhsm, 'write_pins_to_store')
-        self.patch_object(softhsm.subprocess, 'check_call')
+        self.patch_object(softhsm, 'init_tokens')
         self.patch_object(softhsm.hookenv, 'log')
+        self.patch_object(softhsm, 'token_store_lock')
+        self.patch_object(softhsm, 'token_store_ready', return_value=False)
+        self.patch_object(softhsm, 'mark_token_store_ready')
+        kv = mock.MagicMock()
+        self.patch_object(softhsm.unitdata, 'kv', return_value=kv)
         # first, pretend that the token store is already setup.
         self.read_pins_from_store.return_value = ('1234', '5678', )
+        self.get_slot_id.return_value = '10'
         c = softhsm.BarbicanSoftHSMCharm()
+        c.config = {'token-count': 1, 'objectstore-backend': 'db'}
+        self.patch_object(c, 'render_config')
+        self.patch_object(c, 'provision_master_keys')
+        self.patch_object(c, 'configure_tmpfs')
         c.setup_token_store()
+        self.configure_tmpfs.assert_called_once_with()
+        self.provision_master_keys.assert_called_once_with()
+        self.provision_master_keys.reset_mock()
+        self.assertFalse(self.render_config.called)
         self.assertEqual(self.log.call_count, 0)
+        self.assertFalse(self.init_tokens.called)
         # now pretend the token store isn't set up
         self.read_pins_from_store.return_value = None, None
-        # assume that the token store exists and is a dir first:
-        self.exists.return_value = True
-        self.isdir.return_value = True
         # return two values, for each of the two pwgen calls.
         self.pwgen.side_effect = ['abcd', 'efgh']
         c.setup_token_store()
         # now validate it did everything we expected.
-        self.exists.assert_called_once_with(softhsm.TOKEN_STORE)
-        self.isdir.assert_called_once_with(softhsm.TOKEN_STORE)
-        self.rmtree.assert_called_once_with(softhsm.TOKEN_STORE)
-        self.makedirs.assert_called_once_with(softhsm.TOKEN_STORE)
+        self.discard_token_store.assert_called_once_with()
+        self.makedirs.assert_called_once_with(softhsm.TOKEN_STORE,
+                                              exist_ok=True)
         self.chmod.assert_called_once_with(softhsm.TOKEN_STORE, 0o1777)
         self.assertEqual(self.pwgen.call_count, 2)
+        kv.set.assert_has_calls([
+            mock.call(softhsm.TOKEN_DIR_KEY, softhsm.TOKEN_STORE),
+            mock.call(softhsm.OBJECTSTORE_BACKEND_KEY, 'db')])
+        self.render_config.assert_called_once_with()
         self.write_pins_to_store.assert_called_once_with('abcd', 'efgh')
-        self.check_call.called_once_with([
-            'sudo', '-u', 'barbican',
-            softhsm.SOFTHSM2_UTIL_CMD,
-            '--init-token', '--free',
-            '--label', softhsm.BARBICAN_TOKEN_LABEL,
-            '--pin', 'abcd',
-            '--so-pin', 'efgh'])
+        self.init_tokens.assert_called_once_with(
+            [softhsm.BARBICAN_TOKEN_LABEL], 'abcd', 'efgh')
         self.log.assert_called_once_with("Initialised token store.")
+        self.provision_master_keys.assert_called_once_with()
+        self.mark_token_store_ready.assert_called_with(
+            [softhsm.BARBICAN_TOKEN_LABEL])
+
+    def test_setup_token_store_adds_missing_tokens(self):
+        self.patch_object(softhsm, 'read_pins_from_store',
+                          return_value=('1234', '5678'))
+        self.patch_object(softhsm, 'get_slot_id')
+        self.patch_object(softhsm, 'discard_token_store')
+        self.patch_object(softhsm, 'init_tokens')
+        self.patch_object(softhsm.hookenv, 'log')
+        self.patch_object(softhsm, 'token_store_lock')
+        self.patch_object(softhsm, 'token_store_ready', return_value=False)
+        self.patch_object(softhsm, 'mark_token_store_ready')
+        slots = {'barbican_token': '10', 'barbican_token_1': '11'}
+        self.get_slot_id.side_effect = lambda label: slots.get(label)
+        c = softhsm.BarbicanSoftHSMCharm()
+        c.config = {'token-count': 4}
+        self.patch_object(c, 'provision_master_keys')
+        self.patch_object(c, 'configure_tmpfs')
+        c.setup_token_store()
+        self.init_tokens.assert_called_once_with(
+            ['barbican_token_2', 'barbican_token_3'], '1234', '5678')
+        self.assertFalse(self.discard_token_store.called)
+
+    def test_setup_token_store_single_flight(self):
+        self.patch_object(softhsm, 'token_store_lock')
+        self.patch_object(softhsm, 'token_store_ready')
+        self.patch_object(softhsm, 'mark_token_store_ready')
+        c = softhsm.BarbicanSoftHSMCharm()
+        c.config = {'token-count': 1}
+        self.patch_object(c, '_setup_token_store')
+        self.patch_object(c, 'provision_master_keys')
+        self.patch_object(c, 'configure_tmpfs')
+        # a set up store isn't locked or touched
+        self.token_store_ready.return_value = True
+        c.setup_token_store()
+        self.token_store_lock.assert_not_called()
+        self._setup_token_store.assert_not_called()
+        self.provision_master_keys.assert_called_once_with()
+        # nor is one set up by another process while waiting for the lock
+        self.token_store_ready.side_effect = [False, True]
+        c.setup_token_store()
+        self.token_store_lock.assert_called_once_with()
+        self._setup_token_store.assert_not_called()
+        self.mark_token_store_ready.assert_not_called()
+        # otherwise it's set up under the lock and marked as ready
+        self.token_store_ready.side_effect = [False, False]
+        c.setup_token_store()
+        self._setup_token_store.assert_called_once_with(['barbican_token'])
+        self.mark_token_store_ready.assert_called_once_with(
+            ['barbican_token'])
+
+    def test_render_config(self):
+        self.patch_object(softhsm, 'get_token_store_backend')
+        self.patch_object(softhsm.hookenv, 'log')
+        c = softhsm.BarbicanSoftHSMCharm()
+        self.patch_object(c, 'render_configs')
+        c.config = {'objectstore-backend': 'file'}
+        self.get_token_store_backend.return_value = 'file'
+        c.render_config()
+        self.render_configs.assert_called_once_with([softhsm.SOFTHSM2_CONF])
+        self.get_token_store_backend.assert_called_once_with('file')
+        self.assertFalse(self.log.called)
+        # a backend change on an existing store is only logged.
+        c.config = {'objectstore-backend': 'db'}
+        c.render_config()
+        self.assertTrue(self.log.called)
+
+    def test_render_config_bad_master_keys(self):
+        # a bad master key config blocks the unit in assess_status, it
+        # doesn't stop the config being rendered.
+        self.patch_object(softhsm, 'get_token_store_backend',
+                          return_value='file')
+        self.patch_object(softhsm, 'get_mechanisms',
+                          return_value={'CKM_AES_KEY_GEN': {}})
+        self.patch_object(softhsm.hookenv, 'log')
+        c = softhsm.BarbicanSoftHSMCharm()
+        self.patch_object(c, 'render_configs')
+        c.config = {'objectstore-backend': 'db', 'hmac-label': 'hmac',
+                    'hmac-mechanism': 'CKM_BOGUS'}
+        c.render_config()
+        self.render_configs.assert_called_once_with([softhsm.SOFTHSM2_CONF])
+        # and the backend warning isn't skipped
+        self.assertTrue(self.log.called)
+
+    def test_configure_tmpfs(self):
+        self.patch_object(softhsm.os.path, 'ismount', return_value=False)
+        self.patch_object(softhsm, 'get_token_store_dir',
+                          return_value=softhsm.TOKEN_STORE)
+        self.patch_object(softhsm.os.path, 'exists', return_value=False)
+        self.patch_object(softhsm.os, 'remove')
+        self.patch_object(softhsm, 'token_store_lock')
+        self.patch_object(softhsm, 'mount_tmpfs')
+        self.patch_object(softhsm, 'unmount_tmpfs')
+        self.patch_object(softhsm, 'write_snapshot_cron')
+        self.patch_object(softhsm.subprocess, 'check_call')
+        store = {}
+        kv = mock.MagicMock()
+        kv.get.side_effect = lambda k: store.get(k)
+        kv.set.side_effect = lambda k, v: store.__setitem__(k, v)
+        kv.unset.side_effect = lambda k: store.pop(k, None)
+        self.patch_object(softhsm.unitdata, 'kv', return_value=kv)
+        c = softhsm.BarbicanSoftHSMCharm()
+        # disabled, and on disk, is nothing to do
+        c.config = {'tmpfs-size': '', 'tmpfs-snapshot-interval': 10}
+        c.configure_tmpfs()
+        self.assertFalse(self.token_store_lock.called)
+        # enabling it mounts the tmpfs under the lock
+        c.config['tmpfs-size'] = '64M'
+        c.configure_tmpfs()
+        self.token_store_lock.assert_called_once_with()
+        self.mount_tmpfs.assert_called_once_with('/var/lib/softhsm/tokens',
+                                                 '64M')
+        self.write_snapshot_cron.assert_called_once_with(
+            '/var/lib/softhsm/tokens', 10)
+        # once mounted, the same size is left alone
+        self.ismount.return_value = True
+        self.token_store_lock.reset_mock()
+        c.configure_tmpfs()
+        self.assertFalse(self.token_store_lock.called)
+        self.assertFalse(self.check_call.called)
+        # and a new size is remounted
+        c.config['tmpfs-size'] = '128M'
+        c.configure_tmpfs()
+        self.check_call.assert_called_once_with(
+            ['mount', '-o', 'remount,size=128M', '/var/lib/softhsm/tokens'])
+        self.assertEqual(self.mount_tmpfs.call_count, 1)
+        # disabling it moves the store back to disk
+        c.config['tmpfs-size'] = ''
+        self.exists.return_value = True
+        c.configure_tmpfs()
+        self.unmount_tmpfs.assert_called_once_with(
+            '/var/lib/softhsm/tokens')
+        self.remove.assert_called_once_with(softhsm.SNAPSHOT_CRON_FILE)
+        self.assertEqual(store, {})
+
+    def test_configure_proxy_charm(self):
+        self.patch_object(softhsm, 'write_proxy_unit', return_value=True)
+        self.patch_object(softhsm.subprocess, 'check_call')
+        self.patch_object(softhsm.ch_fetch, 'filter_installed_packages',
+                          return_value=['p11-kit-modules'])
+        self.patch_object(softhsm.ch_fetch, 'apt_install')
+        self.patch_object(softhsm.ch_core_host, 'service')
+        self.patch_object(softhsm.ch_core_host, 'service_restart')
+        self.patch_object(softhsm.ch_core_host, 'service_running',
+                          return_value=False)
+        self.patch_object(softhsm.ch_core_host, 'service_start')
+        self.patch_object(softhsm.ch_core_host, 'service_stop')
+        self.patch_object(softhsm.os.path, 'exists', return_value=True)
+        self.patch_object(softhsm.os, 'remove')
+        c = softhsm.BarbicanSoftHSMCharm()
+        c.config = {'pkcs11-proxy': True, 'token-count': 2}
+        c.configure_proxy()
+        self.apt_install.assert_called_once_with(['p11-kit-modules'],
+                                                 fatal=True)
+        self.write_proxy_unit.assert_called_once_with(
+            ['barbican_token', 'barbican_token_1'])
+        self.check_call.assert_called_once_with(
+            ['systemctl', 'daemon-reload'])
+        self.service.assert_called_once_with('enable', softhsm.PROXY_SERVICE)
+        self.service_restart.assert_called_once_with(softhsm.PROXY_SERVICE)
+        # an unchanged unit is only started if it isn't running
+        self.write_proxy_unit.return_value = False
+        c.configure_proxy()
+        self.service_start.assert_called_once_with(softhsm.PROXY_SERVICE)
+        self.assertEqual(self.service_restart.call_count, 1)
+        # turning it off removes the service
+        self.service.reset_mock()
+        self.check_call.reset_mock()
+        c.config = {'pkcs11-proxy': False}
+        c.configure_proxy()
+        self.service_stop.assert_called_once_with(softhsm.PROXY_SERVICE)
+        self.service.assert_called_once_with('disable', softhsm.PROXY_SERVICE)
+        self.remove.assert_called_once_with(softhsm.PROXY_UNIT_FILE)
+        self.check_call.assert_called_once_with(
+            ['systemctl', 'daemon-reload'])
+
+    def test_configure_trace_charm(self):
+        self.patch_object(softhsm, 'write_trace_logrotate')
+        self.patch_object(softhsm.ch_fetch, 'filter_installed_packages',
+                          return_value=['opensc-pkcs11'])
+        self.patch_object(softhsm.ch_fetch, 'apt_install')
+        self.patch_object(softhsm.ch_core_host, 'mkdir')
+        self.patch_object(softhsm.os.path, 'exists', return_value=True)
+        self.patch_object(softhsm.os, 'remove')
+        c = softhsm.BarbicanSoftHSMCharm()
+        c.config = {'trace': True}
+        c.configure_trace()
+        self.apt_install.assert_called_once_with(['opensc-pkcs11'],
+                                                 fatal=True)
+        self.mkdir.assert_called_once_with(
+            softhsm.TRACE_LOG_DIR, owner='barbican', group='softhsm',
+            perms=0o770)
+        self.write_trace_logrotate.assert_called_once_with()
+        self.assertFalse(self.remove.called)
+        # turning it off stops the rotation
+        c.config = {'trace': False}
+        c.configure_trace()
+        self.remove.assert_has_calls([
+            mock.call(softhsm.TRACE_CRON_FILE),
+            mock.call(softhsm.TRACE_LOGROTATE_FILE)])
+
+    def test_token_labels(self):
+        c = softhsm.BarbicanSoftHSMCharm()
+        c.config = {'token-count': 1}
+        self.assertEqual(c.token_labels(), ['barbican_token'])
+        c.config = {'token-count': 3}
+        self.assertEqual(
+            c.token_labels(),
+            ['barbican_token', 'barbican_token_1', 'barbican_token_2'])
+        c.config = {'token-count': 0}
+        self.assertEqual(c.token_labels(), ['barbican_token'])
+        c.config = {}
+        self.assertEqual(c.token_labels(), ['barbican_token'])
+
+    def test_custom_assess_status_check(self):
+        self.patch_object(softhsm, 'get_token_store_backend')
+        self.patch_object(softhsm, 'reclaim_token_stores', return_value={})
+        self.patch_object(softhsm, 'health_status',
+                          return_value=(None, None))
+        self.patch_object(softhsm, 'get_token_store_dir',
+                          return_value=softhsm.TOKEN_STORE)
+        c = softhsm.BarbicanSoftHSMCharm()
+        c.config = {'objectstore-backend': 'file'}
+        self.get_token_store_backend.return_value = 'file'
+        self.assertEqual(c.custom_assess_status_check(), (None, None))
+        self.get_token_store_backend.assert_called_once_with('file')
+        # an old store being deleted is reported
+        self.reclaim_token_stores.return_value = {'/a': 2, '/b': 1}
+        self.assertEqual(c.custom_assess_status_check(), (
+            'maintenance', "Deleting old token store: 3 tokens left"))
+        self.reclaim_token_stores.return_value = {}
+        c.config = {'objectstore-backend': 'db'}
+        state, message = c.custom_assess_status_check()
+        self.assertEqual(state, 'blocked')
+        self.assertIn('migrate-objectstore', message)
+        c.config = {'objectstore-backend': 'file'}
+        self.get_token_store_backend.return_value = 'db'
+        state, message = c.custom_assess_status_check()
+        self.assertEqual(state, 'blocked')
+        self.assertNotIn('migrate-objectstore', message)
+        # a store that isn't in token-dir needs relocating
+        self.get_token_store_backend.return_value = 'file'
+        c.config = {'objectstore-backend': 'file', 'token-dir': '/srv/tokens'}
+        state, message = c.custom_assess_status_check()
+        self.assertEqual(state, 'blocked')
+        self.assertEqual(
+            message,
+            "token-dir is /srv/tokens/ but the token store is in "
+            "/var/lib/softhsm/tokens/: run the relocate-token-store action")
+        self.get_token_store_dir.assert_called_with('/srv/tokens/')
+
+    def test_custom_assess_status_check_replication(self):
+        self.patch_object(softhsm, 'get_token_store_backend',
+                          return_value='file')
+        self.patch_object(softhsm, 'reclaim_token_stores', return_value={})
+        self.patch_object(softhsm, 'get_token_store_dir',
+                          return_value=softhsm.TOKEN_STORE)
+        self.patch_object(softhsm.hookenv, 'is_leader', return_value=False)
+        self.patch_object(softhsm, 'token_store_replicated',
+                          return_value=False)
+        self.patch_object(softhsm, 'replication_status',
+                          return_value=(1, 2))
+        self.patch_object(softhsm, 'health_status',
+                          return_value=(None, None))
+        c = softhsm.BarbicanSoftHSMCharm()
+        c.config = {'objectstore-backend': 'file'}
+        self.assertEqual(c.custom_assess_status_check(), (
+            'waiting', "Waiting to replicate the leader's token store"))
+        self.token_store_replicated.return_value = True
+        self.assertEqual(c.custom_assess_status_check(), (None, None))
+        # the leader reports the peers that aren't in sync
+        self.is_leader.return_value = True
+        self.assertEqual(c.custom_assess_status_check(), (
+            'active', "Unit is ready; token store replicated to 1 of 2 "
+            "peers"))
+        self.replication_status.return_value = (2, 2)
+        self.assertEqual(c.custom_assess_status_check(), (None, None))
+
+    def test_custom_assess_status_check_health(self):
+        self.patch_object(softhsm, 'get_token_store_backend',
+                          return_value='file')
+        self.patch_object(softhsm, 'reclaim_token_stores', return_value={})
+        self.patch_object(softhsm, 'get_token_store_dir',
+                          return_value=softhsm.TOKEN_STORE)
+        self.patch_object(softhsm.hookenv, 'is_leader', return_value=False)
+        self.patch_object(softhsm, 'token_store_replicated',
+                          return_value=False)
+        self.patch_object(softhsm, 'health_status',
+                          return_value=('blocked', "Token probe failing"))
+        c = softhsm.BarbicanSoftHSMCharm()
+        c.config = {'objectstore-backend': 'file'}
+        # a failing token blocks even a unit waiting to replicate
+        self.assertEqual(c.custom_assess_status_check(),
+                         ('blocked', "Token probe failing"))
+        self.token_store_replicated.return_value = True
+        self.health_status.return_value = ('active', "Degraded: slow")
+        self.assertEqual(c.custom_assess_status_check(),
+                         ('active', "Degraded: slow"))
+
+    def test_missing_mechanisms(self):
+        self.patch_object(softhsm, 'get_mechanisms', return_value=None)
+        c = softhsm.BarbicanSoftHSMCharm()
+        c.config = {'hmac-label': 'hmac',
+                    'hmac-mechanism': 'CKM_GENERIC_SECRET_KEY_GEN'}
+        self.assertEqual(c.missing_mechanisms(), [])
+        self.get_mechanisms.return_value = {
+            name: {} for name in softhsm.REQUIRED_MECHANISMS}
+        self.assertEqual(c.missing_mechanisms(),
+                         ['CKM_GENERIC_SECRET_KEY_GEN'])
+        del self.get_mechanisms.return_value['CKM_AES_KEY_WRAP_PAD']
+        c.config = {}
+        self.assertEqual(c.missing_mechanisms(), ['CKM_AES_KEY_WRAP_PAD'])
+        self.assertEqual(c.custom_assess_status_check(), (
+            'blocked', "libsofthsm2 doesn't support CKM_AES_KEY_WRAP_PAD: "
+            "upgrade to a SoftHSM2 built with OpenSSL >= 1.0.2h"))
+
+    def test_custom_assess_status_check_master_keys(self):
+        c = softhsm.BarbicanSoftHSMCharm()
+        c.config = {'hmac-label': 'hmac', 'hmac-key-type': 'CKK_DES'}
+        self.assertEqual(c.custom_assess_status_check(), (
+            'blocked', "Unknown key type 'CKK_DES' for hmac"))
+
+    def test_invalid_config(self):
+        c = softhsm.BarbicanSoftHSMCharm()
+        c.config = {'objectstore-backend': 'db', 'log-level': 'INFO',
+                    'slots-mechanisms': 'ALL'}
+        self.assertIsNone(c.invalid_config())
+        c.config['slots-mechanisms'] = 'CKM_AES_CBC, -CKM_DES3_CBC'
+        self.assertIsNone(c.invalid_config())
+        c.config['slots-mechanisms'] = 'all'
+        self.assertEqual(
+            c.invalid_config(),
+            "slots-mechanisms 'all' isn't ALL or a comma separated list of "
+            "mechanisms")
+        c.config['log-level'] = 'debug'
+        self.assertEqual(c.invalid_config(),
+                         "log-level 'debug' isn't one of ERROR, WARNING, "
+                         "INFO, DEBUG")
+        c.config['objectstore-backend'] = 'sqlite'
+        self.assertEqual(c.invalid_config(),
+                         "objectstore-backend 'sqlite' isn't one of file, db")
+
+    def test_custom_assess_status_check_invalid_config(self):
+        c = softhsm.BarbicanSoftHSMCharm()
+        c.config = {'objectstore-backend': 'sqlite'}
+        self.assertEqual(c.custom_assess_status_check(), (
+            'blocked', "objectstore-backend 'sqlite' isn't one of file, db"))
+
+    def test_invalid_config_not_rendered(self):
+        self.patch_object(softhsm.hookenv, 'log')
+        self.patch_object(softhsm, 'token_store_ready')
+        c = softhsm.BarbicanSoftHSMCharm()
+        self.patch_object(c, 'render_configs')
+        self.patch_object(c, 'configure_tmpfs')
+        c.config = {'log-level': 'debug'}
+        c.render_config()
+        c.setup_token_store()
+        self.assertFalse(self.render_configs.called)
+        self.assertFalse(self.configure_tmpfs.called)
+        self.assertFalse(self.token_store_ready.called)
+
+    def test_run_benchmark(self):
+        self.patch_object(softhsm.benchmark, 'run_benchmark',
+                          return_value=mock.sentinel.report)
+        self.patch_object(softhsm.benchmark, 'scratch_token')
+        self.scratch_token.return_value.__enter__.return_value = (
+            '/tmp/b/softhsm2.conf', 'abcd')
+        self.patch_object(softhsm, 'read_pins_from_store',
+                          return_value=('1234', '5678'))
+        self.patch_object(softhsm, 'get_token_store_backend',
+                          return_value='db')
+        self.patch_object(softhsm, 'get_slot_id',
+                          side_effect={'barbican_token': '10',
+                                       'barbican_token_1': '3'}.get)
+        c = softhsm.BarbicanSoftHSMCharm()
+        c.config = {'objectstore-backend': 'db'}
+        self.assertEqual(c.run_benchmark(['sign'], [64], threads=2),
+                         mock.sentinel.report)
+        self.run_benchmark.assert_called_once_with(
+            softhsm.SOFTHSM2_LIB_PATH, 'barbican_token', '1234',
+            operations=['sign'], payload_sizes=[64], threads=2,
+            processes=1, duration=5, user='barbican',
+            env={'SOFTHSM2_CONF': softhsm.SOFTHSM2_CONF}, slot_id=10)
+        self.assertFalse(self.scratch_token.called)
+        # the token is benchmarked through the proxy and spy barbican uses
+        c.config.update({'pkcs11-proxy': True, 'trace': True,
+                         'token-count': 2})
+        self.run_benchmark.reset_mock()
+        c.run_benchmark(['sign'], [64])
+        self.run_benchmark.assert_called_once_with(
+            softhsm.PKCS11_SPY_PATH, 'barbican_token', '1234',
+            operations=['sign'], payload_sizes=[64], threads=1,
+            processes=1, duration=5, user='barbican',
+            env={'SOFTHSM2_CONF': softhsm.SOFTHSM2_CONF,
+                 'P11_KIT_SERVER_ADDRESS':
+                     'unix:path=' + softhsm.PROXY_SOCKET,
+                 'PKCS11SPY': softhsm.P11_KIT_CLIENT_PATH,
+                 'PKCS11SPY_OUTPUT': softhsm.TRACE_LOG},
+            slot_id=1)
+        # a scratch token uses its own store and pin
+        self.run_benchmark.reset_mock()
+        c.run_benchmark(scratch=True)
+        self.scratch_token.assert_called_once_with(
+            softhsm.SOFTHSM2_LIB_PATH, 'barbican_token', 'db',
+            user='barbican')
+        self.run_benchmark.assert_called_once_with(
+            softhsm.SOFTHSM2_LIB_PATH, 'barbican_token', 'abcd',
+            operations=None, payload_sizes=None, threads=1, processes=1,
+            duration=5, user='barbican',
+            env={'SOFTHSM2_CONF': '/tmp/b/softhsm2.conf'})
+        # the token store must be set up for a real benchmark
+        self.read_pins_from_store.return_value = (None, None)
+        with self.assertRaises(RuntimeError):
+            c.run_benchmark()
+        self.read_pins_from_store.return_value = ('1234', '5678')
+        self.get_slot_id.side_effect = None
+        self.get_slot_id.return_value = None
+        with self.assertRaises(RuntimeError):
+            c.run_benchmark()
+
+    def test_autotune_concurrency(self):
+        result = {'recommended': 4, 'levels': []}
+        self.patch_object(softhsm.benchmark, 'autotune', return_value=result)
+        self.patch_object(softhsm, 'read_pins_from_store',
+                          return_value=('1234', '5678'))
+        self.patch_object(softhsm.unitdata, 'kv')
+        self.patch_object(softhsm, 'get_slot_id', return_value='10')
+        c = softhsm.BarbicanSoftHSMCharm()
+        c.config = {}
+        self.assertEqual(c.autotune_concurrency([1, 4], 'sign', 64, 2),
+                         result)
+        self.autotune.assert_called_once_with(
+            softhsm.SOFTHSM2_LIB_PATH, 'barbican_token', '1234',
+            levels=[1, 4], operation='sign', payload_size=64, duration=2,
+            user='barbican', env={'SOFTHSM2_CONF': softhsm.SOFTHSM2_CONF},
+            slot_id=10)
+        self.kv.return_value.set.assert_called_once_with(
+            softhsm.CONCURRENCY_KEY, result)
+        self.read_pins_from_store.return_value = (None, None)
+        with self.assertRaises(RuntimeError):
+            c.autotune_concurrency()
+
+    def test_master_keys(self):
+        c = softhsm.BarbicanSoftHSMCharm()
+        c.config = {}
+        self.assertEqual(c.master_keys(), [])
+        c.config = {'mkek-label': 'mkek', 'mkek-length': 16,
+                    'mkek-mechanism': 'CKM_AES_KEY_GEN',
+                    'hmac-label': 'hmac', 'hmac-length': 32,
+                    'hmac-key-type': 'CKK_GENERIC_SECRET',
+                    'hmac-mechanism': 'CKM_GENERIC_SECRET_KEY_GEN'}
+        self.assertEqual(c.master_keys(), [
+            {'label': 'mkek', 'key_type': 'CKK_AES', 'length': 16,
+             'mechanism': 'CKM_AES_KEY_GEN', 'usage': 'wrap'},
+            {'label': 'hmac', 'key_type': 'CKK_GENERIC_SECRET', 'length': 32,
+             'mechanism': 'CKM_GENERIC_SECRET_KEY_GEN', 'usage': 'sign'}])
+        c.config['mkek-mechanism'] = 'CKM_DES_KEY_GEN'
+        with self.assertRaises(ValueError):
+            c.master_keys()
+
+    def test_provision_master_keys(self):
+        self.patch_object(softhsm, 'read_pins_from_store',
+                          return_value=('1234', '5678'))
+        self.patch_object(softhsm, 'token_store_fingerprint',
+                          return_value='fp1')
+        self.patch_object(softhsm.pkcs11, 'run_in_child',
+                          return_value=[('barbican_token', 'mkek')])
+        self.patch_object(softhsm.hookenv, 'log')
+        store = {}
+        kv = mock.MagicMock()
+        kv.get.side_effect = lambda k: store.get(k)
+        kv.set.side_effect = lambda k, v: store.__setitem__(k, v)
+        self.patch_object(softhsm.unitdata, 'kv', return_value=kv)
+        c = softhsm.BarbicanSoftHSMCharm()
+        # nothing to provision
+        c.config = {}
+        c.provision_master_keys()
+        self.assertFalse(self.run_in_child.called)
+        # a key is provisioned once for the token store
+        c.config = {'mkek-label': 'mkek'}
+        c.provision_master_keys()
+        self.run_in_child.assert_called_once_with(
+            softhsm._provision_master_keys,
+            (['barbican_token'], '1234', c.master_keys()),
+            user='barbican', env={'SOFTHSM2_CONF': softhsm.SOFTHSM2_CONF})
+        self.log.assert_called_once_with(
+            "Generated mkek in token barbican_token")
+        c.provision_master_keys()
+        self.assertEqual(self.run_in_child.call_count, 1)
+        # and again if the token store changes
+        self.token_store_fingerprint.return_value = 'fp2'
+        c.provision_master_keys()
+        self.assertEqual(self.run_in_child.call_count, 2)
+        # but not with bad config
+        c.config = {'mkek-label': 'mkek', 'mkek-mechanism': 'CKM_X'}
+        c.provision_master_keys()
+        self.assertEqual(self.run_in_child.call_count, 2)
+
+    def _patch_migration(self):
+        self.patch_object(softhsm, 'get_token_store_backend',
+                          return_value='file')
+        self.patch_object(softhsm, 'read_pins_from_store',
+                          return_value=('1234', '5678'))
+        self.patch_object(softhsm.os.path, 'exists', return_value=False)
+        self.patch_object(softhsm.os, 'makedirs')
+        self.patch_object(softhsm.os, 'chmod')
+        self.patch_object(softhsm.os, 'rename')
+        self.patch_object(softhsm.shutil, 'rmtree')
+        self.patch_object(softhsm.tempfile, 'mkdtemp', return_value='/tmp/m')
+        self.patch_object(softhsm.time, 'strftime', return_value='20200101')
+        self.patch_object(softhsm.migrate, 'write_conf')
+        self.patch_object(softhsm.migrate, 'migrate_token')
+        self.patch_object(softhsm, 'token_store_state', return_value=[1])
+        self.patch_object(softhsm.hookenv, 'log')
+        self.patch_object(softhsm, 'get_token_store_dir',
+                          return_value=softhsm.TOKEN_STORE)
+        kv = mock.MagicMock()
+        self.patch_object(softhsm.unitdata, 'kv', return_value=kv)
+        c = softhsm.BarbicanSoftHSMCharm()
+        c.config = {'token-count': 2}
+        self.patch_object(c, 'render_config')
+        return c
+
+    def test_migrate_objectstore(self):
+        c = self._patch_migration()
+        self.migrate_token.side_effect = lambda *args: {'objects': args[1]}
+        results = c.migrate_objectstore(50)
+        store = softhsm.TOKEN_STORE.rstrip('/')
+        staging = store + '.migrating'
+        self.makedirs.assert_called_once_with(staging)
+        self.write_conf.assert_has_calls([
+            mock.call('/tmp/m/source.conf', softhsm.TOKEN_STORE, 'file'),
+            mock.call('/tmp/m/target.conf', staging + '/', 'db')])
+        self.migrate_token.assert_has_calls([
+            mock.call(softhsm.SOFTHSM2_LIB_PATH, label, '1234', '5678',
+                      '/tmp/m/source.conf', '/tmp/m/target.conf',
+                      'barbican', 50)
+            for label in ('barbican_token', 'barbican_token_1')])
+        self.rename.assert_has_calls([
+            mock.call(store, store + '.file-20200101'),
+            mock.call(staging, store)])
+        self.rmtree.assert_called_once_with('/tmp/m', ignore_errors=True)
+        self.kv.return_value.set.assert_called_once_with(
+            softhsm.OBJECTSTORE_BACKEND_KEY, 'db')
+        self.render_config.assert_called_once_with()
+        self.assertEqual(results, {
+            'backup': store + '.file-20200101',
+            'tokens': {
+                'barbican_token': {'objects': 'barbican_token'},
+                'barbican_token_1': {'objects': 'barbican_token_1'}}})
+
+    def test_migrate_objectstore_failures(self):
+        c = self._patch_migration()
+        store = softhsm.TOKEN_STORE.rstrip('/')
+        # a failed migration leaves the store as it was
+        self.migrate_token.side_effect = softhsm.migrate.MigrationError('x')
+        with self.assertRaises(softhsm.migrate.MigrationError):
+            c.migrate_objectstore()
+        self.rmtree.assert_has_calls([
+            mock.call(store + '.migrating', ignore_errors=True),
+            mock.call('/tmp/m', ignore_errors=True)])
+        self.assertFalse(self.rename.called)
+        self.assertFalse(self.kv.return_value.set.called)
+        # as does a store that changed while it was being migrated
+        self.migrate_token.side_effect = None
+        self.token_store_state.side_effect = [[1], [2]]
+        with self.assertRaises(softhsm.migrate.MigrationError):
+            c.migrate_objectstore()
+        self.assertFalse(self.rename.called)
+        # a store that isn't set up, or is already a db store, isn't migrated
+        self.read_pins_from_store.return_value = (None, None)
+        with self.assertRaises(RuntimeError):
+            c.migrate_objectstore()
+        self.get_token_store_backend.return_value = 'db'
+        with self.assertRaises(RuntimeError):
+            c.migrate_objectstore()
+        self.assertFalse(self.kv.return_value.set.called)
+
+    def _patch_relocation(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        target = os.path.join(tmp, 'nvme', 'tokens')
+        self.patch_object(softhsm, 'get_token_store_dir',
+                          return_value=softhsm.TOKEN_STORE)
+        self.patch_object(softhsm, 'read_pins_from_store',
+                          return_value=('1234', '5678'))
+        self.patch_object(softhsm.os.path, 'ismount', return_value=False)
+        self.patch_object(softhsm, 'token_store_lock')
+        self.patch_object(softhsm.relocate, 'sync')
+        self.patch_object(softhsm.relocate, 'verify', return_value=(3, 300))
+        self.patch_object(softhsm, 'discard_token_store')
+        self.patch_object(softhsm.hookenv, 'log')
+        self.patch_object(softhsm.unitdata, 'kv')
+        self.kv.return_value.get.return_value = None
+        c = softhsm.BarbicanSoftHSMCharm()
+        c.config = {'token-dir': target}
+        self.patch_object(c, 'render_config')
+        return c, target
+
+    def test_relocate_token_store(self):
+        c, target = self._patch_relocation()
+        self.sync.side_effect = [{'a': 1}, {'a': 2}]
+        self.assertEqual(c.relocate_token_store(), {
+            'source': softhsm.TOKEN_STORE, 'target': target + '/',
+            'files': 3, 'bytes': 300})
+        self.assertEqual(os.stat(target).st_mode & 0o7777, 0o1777)
+        # the second, cut-over, sync starts from the first
+        self.sync.assert_has_calls([
+            mock.call(softhsm.TOKEN_STORE, target + '/'),
+            mock.call(softhsm.TOKEN_STORE, target + '/', {'a': 1})])
+        self.token_store_lock.assert_called_once_with()
+        self.verify.assert_called_once_with(target + '/', {'a': 2})
+        self.render_config.assert_called_once_with()
+        # the old store is kept for barbican's workers until they restart
+        self.kv.return_value.set.assert_has_calls([
+            mock.call(softhsm.TOKEN_DIR_KEY, target + '/'),
+            mock.call(softhsm.RELOCATED_KEY, softhsm.TOKEN_STORE)])
+        self.assertFalse(self.discard_token_store.called)
+        # and another relocation waits until it has been discarded
+        self.kv.return_value.get.return_value = softhsm.TOKEN_STORE
+        shutil.rmtree(target)
+        with self.assertRaises(RuntimeError):
+            c.relocate_token_store()
+        self.assertEqual(self.sync.call_count, 2)
+
+    def test_discard_relocated_token_store(self):
+        store = {}
+        kv = mock.MagicMock()
+        kv.get.side_effect = lambda k: store.get(k)
+        kv.unset.side_effect = lambda k: store.pop(k, None)
+        self.patch_object(softhsm.unitdata, 'kv', return_value=kv)
+        self.patch_object(softhsm, 'get_token_store_dir',
+                          return_value='/srv/tokens/')
+        self.patch_object(softhsm, 'discard_token_store')
+        self.patch_object(softhsm.hookenv, 'log')
+        c = softhsm.BarbicanSoftHSMCharm()
+        with self.assertRaises(RuntimeError):
+            c.discard_relocated_token_store()
+        store[softhsm.RELOCATED_KEY] = softhsm.TOKEN_STORE
+        self.assertEqual(c.discard_relocated_token_store(),
+                         {'discarded': softhsm.TOKEN_STORE})
+        self.discard_token_store.assert_called_once_with(softhsm.TOKEN_STORE)
+        self.assertEqual(store, {})
+        # a store that has been relocated back is never discarded
+        store[softhsm.RELOCATED_KEY] = '/srv/tokens/'
+        with self.assertRaises(RuntimeError):
+            c.discard_relocated_token_store()
+        self.assertEqual(self.discard_token_store.call_count, 1)
+        self.assertEqual(store, {})
+
+    def test_relocate_token_store_failures(self):
+        c, target = self._patch_relocation()
+        # a copy that fails verification is removed, and the store stays put
+        self.verify.side_effect = softhsm.relocate.RelocationError('x')
+
+        def sync(source, target, copied=None):
+            open(os.path.join(target, 'token.object'), 'w').close()
+
+        self.sync.side_effect = sync
+        with self.assertRaises(softhsm.relocate.RelocationError):
+            c.relocate_token_store()
+        self.assertEqual(os.listdir(target), [])
+        self.kv.return_value.set.assert_called_once_with(
+            softhsm.TOKEN_DIR_KEY, softhsm.TOKEN_STORE)
+        self.assertFalse(self.render_config.called)
+        self.assertFalse(self.discard_token_store.called)
+        # a non-empty target isn't used
+        self.sync.reset_mock()
+        open(os.path.join(target, 'other'), 'w').close()
+        with self.assertRaises(RuntimeError):
+            c.relocate_token_store()
+        self.assertFalse(self.sync.called)
+        # nor is a store that is already there, or on a tmpfs
+        c.config = {}
+        with self.assertRaises(RuntimeError):
+            c.relocate_token_store()
+        c.config = {'token-dir': '/srv/tokens'}
+        self.ismount.return_value = True
+        with self.assertRaises(RuntimeError):
+            c.relocate_token_store()
+        self.assertFalse(self.sync.called)
+
+    def _patch_backup(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        store = os.path.join(tmp, 'tokens')
+        os.makedirs(os.path.join(store, 'token-1'))
+        with open(os.path.join(store, 'token-1', 'token.object'), 'w') as f:
+            f.write('token')
+        self.patch_object(softhsm, 'BACKUP_MANIFEST',
+                          new=os.path.join(tmp, 'manifest.json'))
+        self.patch_object(softhsm, 'get_token_store_dir',
+                          return_value=store + '/')
+        self.patch_object(softhsm, 'get_token_store_backend',
+                          return_value='db')
+        self.patch_object(softhsm, 'read_pins_from_store',
+                          return_value=('1234', '5678'))
+        self.patch_object(softhsm, 'token_store_lock')
+        self.patch_object(softhsm.hookenv, 'log')
+        return tmp, store
+
+    def test_backup_token_store_charm(self):
+        tmp, store = self._patch_backup()
+        path = os.path.join(tmp, 'full.tgz')
+        c = softhsm.BarbicanSoftHSMCharm()
+        results = c.backup_token_store(path)
+        self.assertEqual(results['base'], '')
+        self.assertEqual((results['files'], results['archived']), (1, 1))
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+        self.assertFalse(os.path.exists(path + '.tmp'))
+        self.token_store_lock.assert_called_once_with()
+        # an incremental backup is taken on top of the last one
+        incr = c.backup_token_store(os.path.join(tmp, 'incr.tgz'), True)
+        self.assertEqual(incr['base'], results['id'])
+        self.assertEqual((incr['files'], incr['archived']), (1, 0))
+        # and there is nothing to back up without pins
+        self.read_pins_from_store.return_value = (None, None)
+        with self.assertRaises(RuntimeError):
+            c.backup_token_store(path)
+
+    def test_backup_token_store_failure(self):
+        tmp, store = self._patch_backup()
+        path = os.path.join(tmp, 'full.tgz')
+        os.mkfifo(os.path.join(store, 'fifo'))
+        c = softhsm.BarbicanSoftHSMCharm()
+        with self.assertRaises(softhsm.backup.BackupError):
+            c.backup_token_store(path)
+        self.assertEqual(sorted(os.listdir(tmp)), ['tokens'])
+
+    def test_restore_token_store_charm(self):
+        tmp, store = self._patch_backup()
+        path = os.path.join(tmp, 'full.tgz')
+        c = softhsm.BarbicanSoftHSMCharm()
+        c.config = {'token-count': 2}
+        backup_id = c.backup_token_store(path)['id']
+        shutil.rmtree(os.path.join(store, 'token-1'))
+        self.patch_object(softhsm.os.path, 'ismount', return_value=False)
+        self.patch_object(softhsm, 'discard_token_store',
+                          side_effect=shutil.rmtree)
+        self.patch_object(softhsm, 'write_pins_to_store')
+        self.patch_object(softhsm, 'read_slot_id',
+                          side_effect=['1', None])
+        self.patch_object(softhsm.unitdata, 'kv')
+        self.patch_object(c, 'render_config')
+        self.assertEqual(c.restore_token_store([path]), {
+            'id': backup_id, 'files': 1, 'bytes': 5,
+            'slots': '{"barbican_token": "1", "barbican_token_1": null}'})
+        self.assertEqual(os.listdir(os.path.join(store, 'token-1')),
+                         ['token.object'])
+        self.assertEqual(os.stat(store).st_mode & 0o7777, 0o1777)
+        self.assertFalse(os.path.exists(store + '.restoring'))
+        self.discard_token_store.assert_called_once_with(store)
+        self.write_pins_to_store.assert_called_once_with('1234', '5678')
+        self.kv.return_value.set.assert_called_once_with(
+            softhsm.OBJECTSTORE_BACKEND_KEY, 'db')
+        self.kv.return_value.unset.assert_called_once_with(
+            softhsm.SLOT_CACHE_KEY)
+        self.render_config.assert_called_once_with()
+        # a broken chain leaves the store as it was
+        self.discard_token_store.reset_mock()
+        with self.assertRaises(softhsm.backup.BackupError):
+            c.restore_token_store([])
+        self.assertFalse(self.discard_token_store.called)
+        self.assertFalse(os.path.exists(store + '.restoring'))
 
     def test_on_hsm_connected(self):
         hsm = mock.MagicMock()
         self.patch_object(softhsm, 'read_pins_from_store')
-        self.patch_object(softhsm, 'read_slot_id')
+        self.patch_object(softhsm, 'get_slot_id')
         self.patch_object(softhsm.hookenv, 'status_set')
         self.patch_object(softhsm.hookenv, 'log')
+        self.patch_object(softhsm.ch_core_host, 'file_hash',
+                          return_value='abcdef')
+        self.patch_object(softhsm.hookenv, 'relation_ids',
+                          return_value=['hsm:1'])
+        self.patch_object(softhsm.unitdata, 'kv')
+        self.kv.return_value.get.return_value = None
         c = softhsm.BarbicanSoftHSMCharm()
+        c.config = {'token-count': 1}
         self.patch_object(c, 'setup_token_store')
+        self.patch_object(c, 'provision_master_keys')
         # simulate not being able to set up the token store
         self.read_pins_from_store.return_value = None, None
         with self.assertRaises(RuntimeError):
             c.on_hsm_connected(hsm)
-            self.status_set.assert_called_once_with(
-                'error', "Couldn't set up the token store?")
-            self.setup_token_store.assert_called_once_with()
-            self.log.assert_called_once_with(
-                "Setting plugin name to softhsm2",
-                level=softhsm.hookenv.DEBUG)
+        self.status_set.assert_called_once_with(
+            'error', "Couldn't set up the token store?")
+        self.setup_token_store.assert_called_once_with()
+        hsm.set_name.assert_not_called()
         # now assume that the pins can be read, but no slot is set up.
         self.read_pins_from_store.return_value = '1234', '5678'
-        self.read_slot_id.return_value = None
+        self.get_slot_id.return_value = None
         with self.assertRaises(RuntimeError):
             c.on_hsm_connected(hsm)
         # now assume that the slot is also set up.
-        self.read_slot_id.return_value = '10'
+        self.get_slot_id.return_value = '10'
         c.on_hsm_connected(hsm)
+        hsm.set_name.assert_called_once_with('softhsm2')
         hsm.set_plugin_data.assert_called_once_with({
             "library_path": softhsm.SOFTHSM2_LIB_PATH,
             "login": '1234',
-            "slot_id": '10'
+            "slot_id": '10',
+            "slot_ids": ['10'],
+            "conf_hash": 'abcdef',
         })
         # finally test corner case where token store isn't set up already
         self.read_pins_from_store.side_effect = [
@@ -199,5 +1943,679 @@ class TestBarbicanSoftHSMCharm(test_utils.PatchHelper):
         hsm.set_plugin_data.assert_called_once_with({
             "library_path": softhsm.SOFTHSM2_LIB_PATH,
             "login": 'abcd',
-            "slot_id": '10'
+            "slot_id": '10',
+            "slot_ids": ['10'],
+            "conf_hash": 'abcdef',
+        })
+        # the labels of provisioned master keys are sent too
+        self.read_pins_from_store.side_effect = None
+        self.read_pins_from_store.return_value = '1234', '5678'
+        c.config = {'token-count': 1, 'mkek-label': 'mkek',
+                    'hmac-label': 'hmac'}
+        hsm.reset_mock()
+        self.provision_master_keys.reset_mock()
+        c.on_hsm_connected(hsm)
+        self.provision_master_keys.assert_called_once_with()
+        hsm.set_plugin_data.assert_called_once_with({
+            "library_path": softhsm.SOFTHSM2_LIB_PATH,
+            "login": '1234',
+            "slot_id": '10',
+            "slot_ids": ['10'],
+            "conf_hash": 'abcdef',
+            "mkek_label": 'mkek',
+            "hmac_label": 'hmac',
+        })
+
+    def test_on_hsm_connected_mechanisms(self):
+        hsm = mock.MagicMock()
+        self.patch_object(softhsm, 'read_pins_from_store',
+                          return_value=('1234', '5678'))
+        self.patch_object(softhsm, 'get_slot_id', return_value='10')
+        self.patch_object(softhsm, 'get_mechanisms', return_value={
+            'CKM_AES_CBC_PAD': {}, 'CKM_AES_KEY_WRAP': {}, 'CKM_AES_GCM': {},
+            'CKM_SHA256_HMAC': {}})
+        self.patch_object(softhsm.hookenv, 'log')
+        self.patch_object(softhsm.ch_core_host, 'file_hash',
+                          return_value='abcdef')
+        self.patch_object(softhsm.hookenv, 'relation_ids',
+                          return_value=['hsm:1'])
+        self.patch_object(softhsm.unitdata, 'kv')
+        self.kv.return_value.get.return_value = None
+        c = softhsm.BarbicanSoftHSMCharm()
+        c.config = {'token-count': 1}
+        self.patch_object(c, 'provision_master_keys')
+        c.on_hsm_connected(hsm)
+        # the fast mechanisms are published, fastest first
+        self.assertEqual(
+            hsm.set_plugin_data.call_args[0][0]['mechanisms'],
+            ['CKM_AES_GCM', 'CKM_AES_KEY_WRAP', 'CKM_AES_CBC_PAD'])
+
+    def test_on_hsm_connected_proxy(self):
+        hsm = mock.MagicMock()
+        self.patch_object(softhsm, 'read_pins_from_store',
+                          return_value=('1234', '5678'))
+        self.patch_object(softhsm, 'get_slot_id',
+                          side_effect=['20', '10'])
+        self.patch_object(softhsm, 'get_mechanisms', return_value=None)
+        self.patch_object(softhsm.hookenv, 'log')
+        self.patch_object(softhsm.ch_core_host, 'file_hash',
+                          return_value='abcdef')
+        self.patch_object(softhsm.ch_core_host, 'service_restart')
+        self.patch_object(softhsm.hookenv, 'relation_ids',
+                          return_value=['hsm:1'])
+        self.patch_object(softhsm.unitdata, 'kv')
+        self.kv.return_value.get.return_value = None
+        c = softhsm.BarbicanSoftHSMCharm()
+        c.config = {'token-count': 2, 'pkcs11-proxy': True}
+        self.patch_object(c, 'provision_master_keys')
+        c.on_hsm_connected(hsm)
+        # barbican is sent the client module and the proxy's slots
+        hsm.set_plugin_data.assert_called_once_with({
+            "library_path": softhsm.P11_KIT_CLIENT_PATH,
+            "login": '1234',
+            "slot_id": '1',
+            "slot_ids": ['1', '0'],
+            "conf_hash": 'abcdef',
+            "p11_kit_server_address":
+                "unix:path=/run/barbican-softhsm/pkcs11",
         })
+        self.service_restart.assert_called_once_with(softhsm.PROXY_SERVICE)
+
+    def test_on_hsm_connected_trace(self):
+        hsm = mock.MagicMock()
+        self.patch_object(softhsm, 'read_pins_from_store',
+                          return_value=('1234', '5678'))
+        self.patch_object(softhsm, 'get_slot_id', return_value='10')
+        self.patch_object(softhsm, 'get_mechanisms', return_value=None)
+        self.patch_object(softhsm.hookenv, 'log')
+        self.patch_object(softhsm.ch_core_host, 'file_hash',
+                          return_value='abcdef')
+        self.patch_object(softhsm.ch_core_host, 'service_restart')
+        self.patch_object(softhsm.hookenv, 'relation_ids',
+                          return_value=['hsm:1'])
+        self.patch_object(softhsm.unitdata, 'kv')
+        self.kv.return_value.get.return_value = None
+        c = softhsm.BarbicanSoftHSMCharm()
+        c.config = {'token-count': 1, 'trace': True}
+        self.patch_object(c, 'provision_master_keys')
+        c.on_hsm_connected(hsm)
+        # barbican is sent pkcs11-spy, wrapping libsofthsm2
+        hsm.set_plugin_data.assert_called_once_with({
+            "library_path": softhsm.PKCS11_SPY_PATH,
+            "login": '1234',
+            "slot_id": '10',
+            "slot_ids": ['10'],
+            "conf_hash": 'abcdef',
+            "pkcs11spy": softhsm.SOFTHSM2_LIB_PATH,
+            "pkcs11spy_output": "/var/log/barbican-softhsm/pkcs11-spy.log",
+        })
+        # or wrapping the proxy's client module
+        hsm.set_plugin_data.reset_mock()
+        c.config['pkcs11-proxy'] = True
+        c.on_hsm_connected(hsm)
+        plugin_data = hsm.set_plugin_data.call_args[0][0]
+        self.assertEqual(plugin_data['library_path'], softhsm.PKCS11_SPY_PATH)
+        self.assertEqual(plugin_data['pkcs11spy'], softhsm.P11_KIT_CLIENT_PATH)
+
+    def test_on_hsm_connected_concurrency(self):
+        hsm = mock.MagicMock()
+        self.patch_object(softhsm, 'read_pins_from_store',
+                          return_value=('1234', '5678'))
+        self.patch_object(softhsm, 'get_slot_id', return_value='10')
+        self.patch_object(softhsm, 'get_mechanisms', return_value=None)
+        self.patch_object(softhsm.hookenv, 'log')
+        self.patch_object(softhsm.ch_core_host, 'file_hash',
+                          return_value='abcdef')
+        self.patch_object(softhsm.hookenv, 'relation_ids',
+                          return_value=['hsm:1'])
+        store = {softhsm.CONCURRENCY_KEY: {'recommended': 4}}
+        kv = mock.MagicMock()
+        kv.get.side_effect = lambda k: store.get(k)
+        self.patch_object(softhsm.unitdata, 'kv', return_value=kv)
+        c = softhsm.BarbicanSoftHSMCharm()
+        c.config = {'token-count': 1}
+        self.patch_object(c, 'provision_master_keys')
+        c.on_hsm_connected(hsm)
+        # the autotuned worker count is published
+        self.assertEqual(
+            hsm.set_plugin_data.call_args[0][0]['concurrency'], 4)
+
+    def test_on_hsm_connected_token_pool(self):
+        hsm = mock.MagicMock()
+        self.patch_object(softhsm, 'read_pins_from_store',
+                          return_value=('1234', '5678'))
+        self.patch_object(softhsm, 'get_slot_id')
+        self.patch_object(softhsm.hookenv, 'log')
+        self.patch_object(softhsm.ch_core_host, 'file_hash',
+                          return_value='abcdef')
+        c = softhsm.BarbicanSoftHSMCharm()
+        c.config = {'token-count': 3}
+        self.patch_object(c, 'provision_master_keys')
+        slots = {'barbican_token': '10', 'barbican_token_1': '11'}
+
+        def setup_token_store():
+            slots['barbican_token_2'] = '12'
+
+        self.get_slot_id.side_effect = lambda label: slots.get(label)
+        self.patch_object(c, 'setup_token_store',
+                          side_effect=setup_token_store)
+        self.patch_object(softhsm.hookenv, 'relation_ids',
+                          return_value=['hsm:1'])
+        self.patch_object(softhsm.unitdata, 'kv')
+        self.kv.return_value.get.return_value = None
+        c.on_hsm_connected(hsm)
+        self.setup_token_store.assert_called_once_with()
+        hsm.set_plugin_data.assert_called_once_with({
+            "library_path": softhsm.SOFTHSM2_LIB_PATH,
+            "login": '1234',
+            "slot_id": '10',
+            "slot_ids": ['10', '11', '12'],
+            "conf_hash": 'abcdef',
+        })
+
+    def _patch_replication(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        leader = os.path.join(tmp, 'leader')
+        os.makedirs(os.path.join(leader, 'token-1'))
+        with open(os.path.join(leader, 'token-1', 'token.object'), 'w') as f:
+            f.write('token')
+        follower = os.path.join(tmp, 'follower')
+        with open(os.path.join(tmp, 'host.pub'), 'w') as f:
+            f.write('ssh-ed25519 AAAAhost root@leader\n')
+        for name, path in [
+                ('REPLICATION_HOME', 'replica'),
+                ('REPLICATION_SOURCE', 'replica/source.json'),
+                ('REPLICATION_OBJECTS', 'replica/objects'),
+                ('REPLICATION_LIB', 'replica/lib'),
+                ('REPLICATION_SCRIPT',
+                 'replica/lib/charm/openstack/replication.py'),
+                ('REPLICATION_AUTHORIZED_KEYS',
+                 'replica/.ssh/authorized_keys'),
+                ('SSH_HOST_KEY', 'host.pub'),
+                ('REPLICATION_KNOWN_HOSTS', 'known_hosts')]:
+            self.patch_object(softhsm, name, new=os.path.join(tmp, path))
+        self.settings = {'softhsm-object-abc': 'old', 'softhsm-pins': 'old'}
+        # the peer relation settings of each unit.
+        self.relations = {'softhsm/0': {'private-address': '10.0.0.1'},
+                          'softhsm/1': {'private-address': '10.0.0.2'}}
+        self.unit = 'softhsm/0'
+
+        def leader_get(key=None):
+            if key is None:
+                return dict(self.settings)
+            return self.settings.get(key)
+
+        def leader_set(settings):
+            for key, value in settings.items():
+                if value is None:
+                    self.settings.pop(key, None)
+                else:
+                    self.settings[key] = value
+
+        def relation_get(attribute=None, unit=None, rid=None):
+            if attribute is None:
+                return self.relations[unit]
+            return self.relations[unit].get(attribute)
+
+        def relation_set(rid, settings):
+            self.relations[self.unit].update(settings)
+
+        def write_file(path, content, perms):
+            with open(path, 'w') as f:
+                f.write(content)
+
+        def popen(args, **kwargs):
+            # run the forced command of the key, as sshd would.
+            self.assertEqual(args[-2], 'softhsm-replica@10.0.0.1')
+            proc = mock.MagicMock(returncode=0)
+
+            def communicate(data):
+                out = io.StringIO()
+                stdin = io.StringIO(data.decode() if data else '')
+                try:
+                    softhsm.replication.serve(args[-1], self.source, stdin,
+                                              out)
+                except softhsm.replication.ReplicationError as e:
+                    proc.returncode = 1
+                    return b'', str(e).encode()
+                return out.getvalue().encode(), b''
+            proc.communicate.side_effect = communicate
+            return proc
+
+        self.source = softhsm.REPLICATION_SOURCE
+        self.patch_object(softhsm.hookenv, 'leader_get',
+                          side_effect=leader_get)
+        self.patch_object(softhsm.hookenv, 'leader_set',
+                          side_effect=leader_set)
+        self.patch_object(softhsm.hookenv, 'is_leader', return_value=True)
+        self.patch_object(softhsm.hookenv, 'local_unit',
+                          side_effect=lambda: self.unit)
+        self.patch_object(softhsm.hookenv, 'log')
+        self.patch_object(softhsm.hookenv, 'relation_ids',
+                          return_value=['cluster:1'])
+        self.patch_object(softhsm.hookenv, 'related_units',
+                          side_effect=lambda rid: sorted(
+                              set(self.relations) - {self.unit}))
+        self.patch_object(softhsm.hookenv, 'relation_get',
+                          side_effect=relation_get)
+        self.patch_object(softhsm.hookenv, 'relation_set',
+                          side_effect=relation_set)
+        self.patch_object(softhsm.ch_core_host, 'write_file',
+                          side_effect=write_file)
+        self.patch_object(softhsm.ch_core_host, 'mkdir',
+                          side_effect=lambda path, **kwargs: os.makedirs(
+                              path, exist_ok=True))
+        self.patch_object(softhsm.ch_core_host, 'adduser')
+        self.patch_object(softhsm.grp, 'getgrgid',
+                          return_value=mock.MagicMock(gr_name='group'))
+        self.patch_object(softhsm.replication.subprocess, 'Popen',
+                          side_effect=popen)
+        self.patch_object(softhsm, 'replication_public_key',
+                          return_value=self.KEY)
+        self.patch_object(softhsm, 'get_token_store_dir',
+                          return_value=leader + '/')
+        self.patch_object(softhsm, 'get_token_store_backend',
+                          return_value='file')
+        self.patch_object(softhsm, 'read_pins_from_store',
+                          return_value=('1234', '5678'))
+        self.patch_object(softhsm, 'write_pins_to_store')
+        self.patch_object(softhsm, 'token_store_lock')
+        self.patch_object(softhsm.pwd, 'getpwnam',
+                          return_value=mock.MagicMock(pw_uid=os.getuid(),
+                                                      pw_gid=os.getgid()))
+        self.kv_store = {}
+        kv = mock.MagicMock()
+        kv.get.side_effect = lambda k: self.kv_store.get(k)
+        kv.set.side_effect = lambda k, v: self.kv_store.__setitem__(k, v)
+        kv.unset.side_effect = lambda k: self.kv_store.pop(k, None)
+        self.patch_object(softhsm.unitdata, 'kv', return_value=kv)
+        c = softhsm.BarbicanSoftHSMCharm()
+        self.patch_object(c, 'render_config')
+        return c, leader, follower
+
+    KEY = 'ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIA=='
+    KEY2 = 'ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIB=='
+
+    def _become_follower(self, follower):
+        self.unit = 'softhsm/1'
+        self.kv_store.pop(softhsm.REPLICA_KEY, None)
+        self.is_leader.return_value = False
+        self.get_token_store_dir.return_value = follower + '/'
+        self.read_pins_from_store.return_value = (None, None)
+        # the leader's copy is on another machine.
+        self.patch_object(softhsm, 'stop_serving_token_store')
+
+    def test_replicate_token_store_leader(self):
+        c, leader, _ = self._patch_replication()
+        self.assertFalse(c.replicate_token_store())
+        # only the id of the manifest is published, and the settings of
+        # older charms are withdrawn
+        published = json.loads(self.settings.pop(softhsm.MANIFEST_SETTING))
+        self.assertEqual(self.settings, {})
+        saved = softhsm.replication.read_source(self.source)
+        self.assertEqual(published, {'version': 2,
+                                     'id': saved['manifest']['id'],
+                                     'source': 'softhsm/0'})
+        self.assertEqual(sorted(saved['manifest']['files']),
+                         ['token-1/token.object'])
+        self.assertEqual(saved['pins'], {'pin': '1234', 'so_pin': '5678'})
+        self.assertEqual(os.stat(self.source).st_mode & 0o777, 0o600)
+        # the store is served from a copy, by an unprivileged user
+        self.assertEqual(os.listdir(softhsm.REPLICATION_OBJECTS),
+                         [saved['manifest']['files']
+                          ['token-1/token.object'][0]])
+        self.adduser.assert_called_with(
+            'softhsm-replica', shell='/bin/sh', system_user=True,
+            home_dir=softhsm.REPLICATION_HOME)
+        self.mkdir.assert_any_call(softhsm.REPLICATION_OBJECTS,
+                                   owner='softhsm-replica', group='group',
+                                   perms=0o700)
+        self.assertTrue(os.path.exists(softhsm.REPLICATION_SCRIPT))
+        self.assertEqual(self.kv_store[softhsm.REPLICA_KEY], published['id'])
+        self.assertEqual(self.relations['softhsm/0'], {
+            'private-address': '10.0.0.1',
+            'replication-host-key': 'ssh-ed25519 AAAAhost',
+            'replication-authorized': '[]'})
+        # nothing is published again until the store changes
+        self.settings[softhsm.MANIFEST_SETTING] = json.dumps(published)
+        self.leader_set.reset_mock()
+        c.replicate_token_store()
+        self.assertFalse(self.leader_set.called)
+        with open(os.path.join(leader, 'token-1', 'token.object'), 'w') as f:
+            f.write('changed')
+        c.replicate_token_store()
+        self.assertNotEqual(
+            json.loads(self.settings[softhsm.MANIFEST_SETTING])['id'],
+            published['id'])
+        self.assertEqual(
+            softhsm.replication.read_source(self.source)['manifest']['id'],
+            json.loads(self.settings[softhsm.MANIFEST_SETTING])['id'])
+        # a store with no pins isn't published
+        self.leader_set.reset_mock()
+        self.read_pins_from_store.return_value = (None, None)
+        c.replicate_token_store()
+        self.assertFalse(self.leader_set.called)
+
+    def test_replicate_token_store_authorize(self):
+        c, leader, _ = self._patch_replication()
+        self.relations['softhsm/1']['replication-key'] = self.KEY
+        self.relations['softhsm/2'] = {'replication-key': 'ssh-rsa AAAA'}
+        self.relations['softhsm/3'] = {'replication-key': self.KEY2}
+        c.replicate_token_store()
+        # only a well formed key is authorised, for the forced command
+        self.assertEqual(
+            self.relations['softhsm/0']['replication-authorized'],
+            '["softhsm/1", "softhsm/3"]')
+        with open(softhsm.REPLICATION_AUTHORIZED_KEYS) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines, [
+            softhsm.replication.authorized_key(
+                key, softhsm.REPLICATION_SCRIPT, self.source)
+            for key in (self.KEY, self.KEY2)])
+        self.assertTrue(all(',restrict ' in line for line in lines))
+        # the key of a departed unit is removed
+        del self.relations['softhsm/1']
+        c.replicate_token_store()
+        self.assertEqual(
+            self.relations['softhsm/0']['replication-authorized'],
+            '["softhsm/3"]')
+        with open(softhsm.REPLICATION_AUTHORIZED_KEYS) as f:
+            self.assertEqual(f.read().splitlines(), lines[1:])
+        # and all of them once this unit isn't the leader
+        self.is_leader.return_value = False
+        self.unit = 'softhsm/3'
+        c.replicate_token_store()
+        with open(softhsm.REPLICATION_AUTHORIZED_KEYS) as f:
+            self.assertEqual(f.read(), '')
+        self.assertFalse(os.path.exists(self.source))
+        self.assertEqual(os.listdir(softhsm.REPLICATION_OBJECTS), [])
+
+    def test_replicate_token_store_follower(self):
+        c, leader, follower = self._patch_replication()
+        self.relations['softhsm/1']['replication-key'] = self.KEY
+        c.replicate_token_store()
+        published = self.kv_store[softhsm.REPLICA_KEY]
+        self.kv_store[softhsm.PUBLISHED_KEY] = {'hsm:1': 'abc'}
+        self._become_follower(follower)
+        self.assertTrue(c.replicate_token_store())
+        with open(os.path.join(follower, 'token-1', 'token.object')) as f:
+            self.assertEqual(f.read(), 'token')
+        self.assertEqual(os.stat(follower).st_mode & 0o7777, 0o1777)
+        self.write_pins_to_store.assert_called_once_with('1234', '5678')
+        self.assertEqual(self.kv_store[softhsm.REPLICA_KEY], published)
+        self.assertEqual(self.kv_store[softhsm.OBJECTSTORE_BACKEND_KEY],
+                         'file')
+        self.render_config.assert_called_once_with()
+        self.assertEqual(self.relations['softhsm/1'], {
+            'private-address': '10.0.0.2',
+            'replication-key': self.KEY,
+            'token-replica': published})
+        # the leader's host key is the only one accepted for its address
+        with open(softhsm.REPLICATION_KNOWN_HOSTS) as f:
+            self.assertEqual(f.read(), '10.0.0.1 ssh-ed25519 AAAAhost\n')
+        # an up to date replica is left alone
+        self.Popen.reset_mock()
+        self.assertFalse(c.replicate_token_store())
+        self.assertFalse(self.Popen.called)
+        # a store of its own that barbican used is kept
+        self.kv_store.pop(softhsm.REPLICA_KEY)
+        self.read_pins_from_store.return_value = ('own', 'pins')
+        self.patch_object(softhsm, 'set_aside_token_store')
+        self.assertTrue(c.replicate_token_store())
+        self.set_aside_token_store.assert_called_once_with(follower + '/')
+
+    def test_replicate_token_store_follower_waits(self):
+        c, leader, follower = self._patch_replication()
+        c.replicate_token_store()
+        self._become_follower(follower)
+        # the leader hasn't authorised this unit's key yet
+        self.assertFalse(c.replicate_token_store())
+        self.assertFalse(self.Popen.called)
+        self.assertEqual(self.relations['softhsm/1']['replication-key'],
+                         self.KEY)
+        self.assertNotIn(softhsm.REPLICA_KEY, self.kv_store)
+        # a former leader stops serving its own store
+        self.stop_serving_token_store.assert_called_with()
+
+    def test_replicate_token_store_follower_failure(self):
+        c, leader, follower = self._patch_replication()
+        self.relations['softhsm/1']['replication-key'] = self.KEY
+        c.replicate_token_store()
+        self._become_follower(follower)
+        # the leader's store changed since it published its manifest
+        published = json.loads(self.settings[softhsm.MANIFEST_SETTING])
+        self.settings[softhsm.MANIFEST_SETTING] = json.dumps(
+            dict(published, id='old'))
+        self.assertFalse(c.replicate_token_store())
+        self.assertNotIn(softhsm.REPLICA_KEY, self.kv_store)
+        # or the leader's copy of a file is corrupt
+        self.settings[softhsm.MANIFEST_SETTING] = json.dumps(published)
+        for name in os.listdir(softhsm.REPLICATION_OBJECTS):
+            with open(os.path.join(softhsm.REPLICATION_OBJECTS, name),
+                      'w') as f:
+                f.write('corrupt')
+        self.assertFalse(c.replicate_token_store())
+        self.assertNotIn(softhsm.REPLICA_KEY, self.kv_store)
+        self.assertFalse(self.write_pins_to_store.called)
+        self.assertNotIn('token-replica', self.relations['softhsm/1'])
+        self.assertEqual(os.listdir(os.path.join(follower, 'token-1')), [])
+        # and with nothing published there is nothing to do
+        self.settings.clear()
+        self.Popen.reset_mock()
+        self.assertFalse(c.replicate_token_store())
+        self.assertFalse(self.Popen.called)
+
+    def test_replication_public_key(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        key = os.path.join(tmp, 'key')
+        self.patch_object(softhsm, 'REPLICATION_SSH_KEY', new=key)
+
+        def keygen(args):
+            with open(key + '.pub', 'w') as f:
+                f.write(self.KEY + ' comment\n')
+            with open(key, 'w'):
+                pass
+        self.patch_object(softhsm.subprocess, 'check_call',
+                          side_effect=keygen)
+        self.assertEqual(softhsm.replication_public_key(), self.KEY)
+        self.check_call.assert_called_once_with(
+            ['ssh-keygen', '-q', '-t', 'ed25519', '-N', '',
+             '-C', 'juju-barbican-softhsm-replica', '-f', key])
+        # the key pair is only made once
+        self.assertEqual(softhsm.replication_public_key(), self.KEY)
+        self.assertEqual(self.check_call.call_count, 1)
+
+    def test_on_hsm_connected_replica(self):
+        hsm = mock.MagicMock()
+        self.patch_object(softhsm.hookenv, 'is_leader', return_value=False)
+        self.patch_object(softhsm.hookenv, 'log')
+        self.patch_object(softhsm, 'token_store_replicated',
+                          return_value=False)
+        self.patch_object(softhsm, 'read_pins_from_store',
+                          return_value=('1234', '5678'))
+        self.patch_object(softhsm, 'get_slot_id', return_value=None)
+        self.patch_object(softhsm.hookenv, 'relation_ids',
+                          return_value=['hsm:1'])
+        self.patch_object(softhsm.ch_core_host, 'file_hash',
+                          return_value='abcdef')
+        self.patch_object(softhsm.unitdata, 'kv')
+        self.kv.return_value.get.return_value = None
+        c = softhsm.BarbicanSoftHSMCharm()
+        c.config = {'token-count': 1}
+        self.patch_object(c, 'setup_token_store')
+        self.patch_object(c, 'provision_master_keys')
+        # nothing is published until the replica is in sync
+        c.on_hsm_connected(hsm)
+        self.assertFalse(self.read_pins_from_store.called)
+        self.token_store_replicated.return_value = True
+        c.on_hsm_connected(hsm)
+        self.assertFalse(self.setup_token_store.called)
+        hsm.set_plugin_data.assert_not_called()
+        # and the replica's slots are published, without changing the store
+        self.get_slot_id.return_value = '10'
+        c.on_hsm_connected(hsm)
+        self.assertFalse(self.provision_master_keys.called)
+        self.assertEqual(hsm.set_plugin_data.call_args[0][0]['slot_id'], '10')
+
+    def test_on_hsm_connected_unchanged(self):
+        hsm = mock.MagicMock()
+        self.patch_object(softhsm, 'read_pins_from_store',
+                          return_value=('1234', '5678'))
+        self.patch_object(softhsm, 'get_slot_id', return_value='10')
+        self.patch_object(softhsm.hookenv, 'log')
+        self.patch_object(softhsm.hookenv, 'relation_ids',
+                          return_value=['hsm:1'])
+        self.patch_object(softhsm.ch_core_host, 'file_hash',
+                          return_value='abcdef')
+        store = {}
+        kv = mock.MagicMock()
+        kv.get.side_effect = lambda k: store.get(k)
+        kv.set.side_effect = lambda k, v: store.__setitem__(k, v)
+        self.patch_object(softhsm.unitdata, 'kv', return_value=kv)
+        c = softhsm.BarbicanSoftHSMCharm()
+        c.config = {'token-count': 1}
+        self.patch_object(c, 'provision_master_keys')
+        c.on_hsm_connected(hsm)
+        self.assertEqual(hsm.set_plugin_data.call_count, 1)
+        digest = store[softhsm.PUBLISHED_KEY]['hsm:1']
+        # nothing has changed, so the relation isn't written again
+        hsm.reset_mock()
+        c.on_hsm_connected(hsm)
+        hsm.set_name.assert_not_called()
+        hsm.set_plugin_data.assert_not_called()
+        # a new relation id is written to, and the departed one forgotten
+        self.relation_ids.return_value = ['hsm:2']
+        c.on_hsm_connected(hsm)
+        hsm.set_name.assert_called_once_with('softhsm2')
+        self.assertEqual(hsm.set_plugin_data.call_count, 1)
+        self.assertEqual(store[softhsm.PUBLISHED_KEY], {'hsm:2': digest})
+        # as is changed data
+        hsm.reset_mock()
+        self.file_hash.return_value = '123456'
+        c.on_hsm_connected(hsm)
+        self.assertEqual(hsm.set_plugin_data.call_count, 1)
+        self.assertNotEqual(store[softhsm.PUBLISHED_KEY]['hsm:2'], digest)
+
+
+class TestTokenInit(test_utils.PatchHelper):
+
+    def test_init_tokens(self):
+        self.patch_object(softhsm.pkcs11, 'run_in_child')
+        self.patch_object(softhsm, 'cache_slots')
+        self.patch_object(softhsm, 'init_tokens_softhsm2_util')
+        self.patch_object(softhsm, 'read_slot_id')
+        self.patch_object(softhsm.hookenv, 'log')
+        self.run_in_child.return_value = {'a': ('10', 's1'),
+                                          'b': ('11', 's2')}
+        self.assertEqual(softhsm.init_tokens(['a', 'b'], '1234', '5678'),
+                         {'a': '10', 'b': '11'})
+        self.run_in_child.assert_called_once_with(
+            softhsm._init_tokens_native, (['a', 'b'], '1234', '5678'),
+            user='barbican', env={'SOFTHSM2_CONF': softhsm.SOFTHSM2_CONF})
+        self.cache_slots.assert_called_once_with(
+            {'a': ('10', 's1'), 'b': ('11', 's2')})
+        self.assertFalse(self.init_tokens_softhsm2_util.called)
+        # a library that can't be loaded falls back to softhsm2-util
+        self.run_in_child.side_effect = OSError("no such file")
+        self.read_slot_id.side_effect = lambda label: label.upper()
+        self.assertEqual(softhsm.init_tokens(['a'], '1234', '5678'),
+                         {'a': 'A'})
+        self.init_tokens_softhsm2_util.assert_called_once_with(
+            ['a'], '1234', '5678')
+        # but a failed initialisation doesn't
+        self.run_in_child.side_effect = softhsm.pkcs11.PKCS11Error(
+            'C_InitToken', 0x5)
+        with self.assertRaises(softhsm.pkcs11.PKCS11Error):
+            softhsm.init_tokens(['a'], '1234', '5678')
+
+    def test_init_tokens_native(self):
+        self.patch_object(softhsm.pkcs11, 'initialized')
+        lib = self.initialized.return_value.__enter__.return_value
+        self.patch_object(softhsm.pkcs11, 'init_free_token')
+        self.init_free_token.side_effect = [10, 11]
+        lib.get_token_info.side_effect = (
+            lambda slot_id: mock.MagicMock(serial='s{}'.format(slot_id)))
+        self.assertEqual(
+            softhsm._init_tokens_native(['a', 'b'], '1234', '5678'),
+            {'a': ('10', 's10'), 'b': ('11', 's11')})
+        self.initialized.assert_called_once_with(softhsm.SOFTHSM2_LIB_PATH)
+        self.init_free_token.assert_has_calls([
+            mock.call(lib, 'a', '5678', '1234'),
+            mock.call(lib, 'b', '5678', '1234')])
+
+    def test_cache_slots(self):
+        kv = mock.MagicMock()
+        kv.get.return_value = {'old': {'fingerprint': 'fp0'}}
+        self.patch_object(softhsm.unitdata, 'kv', return_value=kv)
+        self.patch_object(softhsm, 'token_store_fingerprint',
+                          return_value='fp1')
+        softhsm.cache_slots({'a': ('10', 's1')})
+        kv.set.assert_called_once_with(softhsm.SLOT_CACHE_KEY, {
+            'old': {'fingerprint': 'fp0'},
+            'a': {'fingerprint': 'fp1', 'slot_id': '10', 'serial': 's1'}})
+        kv.set.reset_mock()
+        self.token_store_fingerprint.return_value = None
+        softhsm.cache_slots({'a': ('10', 's1')})
+        self.assertFalse(kv.set.called)
+
+    def test_master_key_attributes(self):
+        pkcs11 = softhsm.pkcs11
+        attributes = softhsm.master_key_attributes({
+            'label': 'mkek', 'key_type': 'CKK_AES', 'length': 32,
+            'mechanism': 'CKM_AES_KEY_GEN', 'usage': 'wrap'})
+        self.assertEqual(attributes[pkcs11.CKA_KEY_TYPE], pkcs11.CKK_AES)
+        self.assertEqual(attributes[pkcs11.CKA_VALUE_LEN], 32)
+        self.assertEqual(attributes[pkcs11.CKA_LABEL], 'mkek')
+        self.assertTrue(attributes[pkcs11.CKA_SENSITIVE])
+        self.assertTrue(attributes[pkcs11.CKA_WRAP])
+        self.assertFalse(attributes[pkcs11.CKA_SIGN])
+
+    def test_provision_master_keys_native(self):
+        pkcs11 = softhsm.pkcs11
+        self.patch_object(pkcs11, 'initialized')
+        lib = self.initialized.return_value.__enter__.return_value
+        self.patch_object(pkcs11, 'find_token_slot', return_value=3)
+        session = lib.open_session.return_value.__enter__.return_value
+        session.find_object.side_effect = (
+            lambda attributes: (5 if attributes[pkcs11.CKA_LABEL] == 'mkek'
+                                else None))
+        keys = [{'label': 'mkek', 'key_type': 'CKK_AES', 'length': 32,
+                 'mechanism': 'CKM_AES_KEY_GEN', 'usage': 'wrap'},
+                {'label': 'hmac', 'key_type': 'CKK_GENERIC_SECRET',
+                 'length': 32, 'mechanism': 'CKM_GENERIC_SECRET_KEY_GEN',
+                 'usage': 'sign'}]
+        self.assertEqual(
+            softhsm._provision_master_keys(['barbican_token'], '1234', keys),
+            [('barbican_token', 'hmac')])
+        session.login.assert_called_once_with('1234')
+        session.generate_key.assert_called_once_with(
+            pkcs11.CKM_GENERIC_SECRET_KEY_GEN,
+            softhsm.master_key_attributes(keys[1]))
+        self.find_token_slot.return_value = None
+        with self.assertRaises(RuntimeError):
+            softhsm._provision_master_keys(['barbican_token'], '1234', keys)
+
+    def test_init_tokens_softhsm2_util(self):
+        self.patch_object(softhsm, 'init_token_softhsm2_util')
+        self.patch_object(softhsm.os, 'cpu_count', return_value=2)
+        softhsm.init_tokens_softhsm2_util(['a', 'b', 'c'], '1234', '5678')
+        self.init_token_softhsm2_util.assert_has_calls([
+            mock.call('a', '1234', '5678'),
+            mock.call('b', '1234', '5678'),
+            mock.call('c', '1234', '5678')], any_order=True)
+        self.init_token_softhsm2_util.side_effect = OSError("failed")
+        with self.assertRaises(OSError):
+            softhsm.init_tokens_softhsm2_util(['a'], '1234', '5678')
+
+    def test_init_token_softhsm2_util(self):
+        self.patch_object(softhsm.subprocess, 'check_call')
+        softhsm.init_token_softhsm2_util('barbican_token_1', 'abcd', 'efgh')
+        self.check_call.assert_called_once_with([
+            'sudo', '-u', 'barbican',
+            softhsm.SOFTHSM2_UTIL_CMD,
+            '--init-token', '--free',
+            '--label', 'barbican_token_1',
+            '--pin', 'abcd',
+            '--so-pin', 'efgh'])
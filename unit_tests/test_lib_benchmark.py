@@ -0,0 +1,232 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import threading
+
+import mock
+
+import charm.openstack.benchmark as benchmark
+import charm.openstack.pkcs11 as pkcs11
+import charm.openstack.stats as stats
+
+import charms_openstack.test_utils as test_utils
+
+
+def histogram(*latencies):
+    h = stats.Histogram(benchmark.LATENCY_BUCKETS)
+    for latency in latencies:
+        h.add(latency)
+    return h
+
+
+class TestBenchmark(test_utils.PatchHelper):
+
+    def test_parse_operations(self):
+        self.assertEqual(benchmark.parse_operations(''),
+                         benchmark.OPERATIONS)
+        self.assertEqual(benchmark.parse_operations(' sign, encrypt '),
+                         ['sign', 'encrypt'])
+        with self.assertRaises(ValueError):
+            benchmark.parse_operations('sign,frobnicate')
+
+    def test_parse_sizes(self):
+        self.assertEqual(benchmark.parse_sizes(None),
+                         benchmark.DEFAULT_PAYLOAD_SIZES)
+        self.assertEqual(benchmark.parse_sizes('16, 4096'), [16, 4096])
+        with self.assertRaises(ValueError):
+            benchmark.parse_sizes('16,big')
+        with self.assertRaises(ValueError):
+            benchmark.parse_sizes('0')
+
+    def test_parse_levels(self):
+        self.assertEqual(benchmark.parse_levels(''),
+                         benchmark.DEFAULT_CONCURRENCY_LEVELS)
+        self.assertEqual(benchmark.parse_levels('8, 2,8'), [2, 8])
+        with self.assertRaises(ValueError):
+            benchmark.parse_levels('0')
+
+    def test_find_knee(self):
+        def point(concurrency, ops, p99):
+            return {'concurrency': concurrency, 'ops_per_second': ops,
+                    'latency_ms': {'p99': p99}}
+
+        # throughput stops growing
+        self.assertEqual(benchmark.find_knee([
+            point(1, 100, 1), point(2, 190, 1.1), point(4, 350, 1.3),
+            point(8, 360, 2.5), point(16, 400, 5)]), 4)
+        # latency collapses before throughput stops growing
+        self.assertEqual(benchmark.find_knee([
+            point(1, 100, 1), point(2, 190, 3), point(4, 350, 5)]), 2)
+        self.assertEqual(benchmark.find_knee([point(1, 100, 1)]), 1)
+
+    def test_autotune(self):
+        reports = {
+            1: {'ops_per_second': 100.0, 'latency_ms': {'p99': 1.0}},
+            2: {'ops_per_second': 150.0, 'latency_ms': {'p99': 1.5}},
+            4: {'ops_per_second': 155.0, 'latency_ms': {'p99': 3.0}},
+        }
+        self.patch_object(
+            benchmark, 'run_benchmark',
+            side_effect=lambda *args, **kwargs: {
+                'results': [reports[kwargs['processes']]]})
+        result = benchmark.autotune('/lib.so', 'barbican_token', '1234',
+                                    levels=[4, 1, 2], user='barbican')
+        self.assertEqual(result['recommended'], 2)
+        self.assertEqual([p['concurrency'] for p in result['levels']],
+                         [1, 2, 4])
+        self.assertEqual(result['payload_size'], 1024)
+        self.run_benchmark.assert_called_with(
+            '/lib.so', 'barbican_token', '1234', ['encrypt'], [1024],
+            threads=1, processes=4, duration=3, user='barbican', env=None,
+            slot_id=None)
+
+    def test_build_plan(self):
+        self.assertEqual(
+            benchmark.build_plan(['generate', 'sign'], [16, 32]),
+            [('generate', None), ('sign', 16), ('sign', 32)])
+
+    def test_time_operation(self):
+        times = iter([0.0, 0.0, 0.5, 0.5, 1.5])
+        self.patch_object(benchmark.time, 'perf_counter',
+                          side_effect=lambda: next(times))
+        func = mock.MagicMock()
+        latencies, elapsed = benchmark.time_operation(func, 16, 1)
+        self.assertEqual(latencies.count, 2)
+        self.assertEqual(latencies.max, 1.0)
+        self.assertEqual(len(latencies.counts),
+                         len(benchmark.LATENCY_BUCKETS) + 1)
+        self.assertEqual(elapsed, 1.5)
+        func.assert_called_with(16)
+        self.assertEqual(func.call_count, 2)
+
+    def test_summarise(self):
+        runs = [(histogram(0.001, 0.002), 1.0),
+                (histogram(0.003, 0.004, 0.005, 0.006), 2.0)]
+        summary = benchmark.summarise('sign', 64, runs)
+        self.assertEqual(summary['ops'], 6)
+        self.assertEqual(summary['ops_per_second'], 4.0)
+        # the percentiles are within the 2% of the histogram buckets
+        for pct, expected in (('p50', 3.0), ('p95', 6.0), ('p99', 6.0)):
+            self.assertGreaterEqual(summary['latency_ms'][pct], expected)
+            self.assertLess(summary['latency_ms'][pct], expected * 1.02)
+
+    def test_worker(self):
+        session = mock.MagicMock()
+        session.generate_key.side_effect = [1, 2, 3, 4]
+        session.encrypt.side_effect = lambda m, k, data, iv: data[::-1]
+        worker = benchmark.Worker(session, [16])
+        self.assertEqual(session.generate_key.call_args_list[2][0][0],
+                         pkcs11.CKM_GENERIC_SECRET_KEY_GEN)
+        self.assertEqual(worker.ciphertexts[16], worker.payloads[16][::-1])
+        session.wrap_key.assert_called_once_with(pkcs11.CKM_AES_KEY_WRAP,
+                                                 2, 1)
+        worker.generate(None)
+        session.destroy_object.assert_called_once_with(4)
+        worker.decrypt(16)
+        session.decrypt.assert_called_once_with(
+            pkcs11.CKM_AES_CBC_PAD, 1, worker.ciphertexts[16], worker.iv)
+        worker.sign(16)
+        session.sign.assert_called_once_with(
+            pkcs11.CKM_SHA256_HMAC, 3, worker.payloads[16])
+        worker.unwrap(None)
+        attributes = session.unwrap_key.call_args[0][3]
+        self.assertNotIn(pkcs11.CKA_VALUE_LEN, attributes)
+
+    def test_run_process(self):
+        self.patch_object(benchmark.pkcs11, 'initialized')
+        lib = self.initialized.return_value.__enter__.return_value
+        self.patch_object(benchmark.pkcs11, 'find_token_slot',
+                          return_value=3)
+        self.patch_object(benchmark, 'Worker')
+        self.patch_object(benchmark, 'time_operation',
+                          side_effect=lambda func, size, d: (size, d))
+        barrier = threading.Barrier(2)
+        result = benchmark._run_process(
+            '/lib.so', 'barbican_token', None, '1234',
+            [('generate', None), ('sign', 16)], [16], 2, 5, barrier)
+        self.assertEqual(result, [[(None, 5), (None, 5)],
+                                  [(16, 5), (16, 5)]])
+        self.assertEqual(lib.open_session.call_count, 2)
+        lib.open_session.return_value.login.assert_called_once_with('1234')
+        self.assertEqual(lib.open_session.return_value.close.call_count, 2)
+        lib.open_session.assert_called_with(3)
+        # a published slot is used as it is, if it has the token
+        lib.get_token_info.return_value.label = 'barbican_token'
+        benchmark._run_process('/lib.so', 'barbican_token', 7, '1234',
+                               [], [16], 1, 5, threading.Barrier(1))
+        lib.get_token_info.assert_called_once_with(7)
+        lib.open_session.assert_called_with(7)
+        self.assertEqual(self.find_token_slot.call_count, 1)
+        # a missing token breaks the barrier for the other processes
+        lib.get_token_info.return_value.label = 'other'
+        with self.assertRaises(RuntimeError):
+            benchmark._run_process('/lib.so', 'barbican_token', 7, '1234',
+                                   [], [16], 2, 5, barrier)
+        self.assertTrue(barrier.broken)
+
+    def test_run_benchmark(self):
+        self.patch_object(benchmark.pkcs11, 'Child')
+        child = self.Child.return_value
+        child.result.return_value = [[(histogram(0.001), 1.0)],
+                                     [(histogram(0.002), 1.0)]]
+        report = benchmark.run_benchmark(
+            '/lib.so', 'barbican_token', '1234', ['generate', 'sign'], [64],
+            threads=1, processes=2, duration=1, user='barbican',
+            env={'SOFTHSM2_CONF': '/tmp/x.conf'})
+        self.assertEqual(self.Child.call_count, 2)
+        self.assertEqual(self.Child.call_args[1], {
+            'user': 'barbican', 'env': {'SOFTHSM2_CONF': '/tmp/x.conf'}})
+        self.assertIsNone(self.Child.call_args[0][1][2])
+        # the processes are killed once the plan should have finished
+        timeout = child.result.call_args[0][0]
+        self.assertLessEqual(timeout, 3 * benchmark.BARRIER_TIMEOUT + 2)
+        self.assertGreater(timeout, 3 * benchmark.BARRIER_TIMEOUT + 1)
+        self.assertEqual(report['config']['processes'], 2)
+        self.assertEqual(
+            [(r['operation'], r['payload_size'], r['ops'])
+             for r in report['results']],
+            [('generate', None, 2), ('sign', 64, 2)])
+        self.assertEqual(report['results'][0]['ops_per_second'], 2.0)
+        # the real error is raised rather than a broken barrier
+        child.result.side_effect = [threading.BrokenBarrierError(),
+                                    pkcs11.PKCS11Error('C_Login', 0xa0)]
+        with self.assertRaises(pkcs11.PKCS11Error):
+            benchmark.run_benchmark('/lib.so', 'barbican_token', '1234',
+                                    processes=2)
+        with self.assertRaises(ValueError):
+            benchmark.run_benchmark('/lib.so', 'barbican_token', '1234',
+                                    threads=0)
+        # a published slot is passed on to the processes
+        child.result.side_effect = None
+        child.result.return_value = [[(histogram(0.001), 1.0)]]
+        benchmark.run_benchmark('/lib.so', 'barbican_token', '1234',
+                                ['generate'], slot_id=7)
+        self.assertEqual(self.Child.call_args[0][1][2], 7)
+
+    def test_scratch_token(self):
+        self.patch_object(benchmark.pkcs11, 'run_in_child')
+        token = benchmark.scratch_token('/lib.so', user='barbican')
+        with token as (conf, pin):
+            self.assertTrue(os.path.isfile(conf))
+            with open(conf) as f:
+                self.assertIn('objectstore.backend = file', f.read())
+            args = self.run_in_child.call_args
+            self.assertEqual(args[0][0], benchmark._init_scratch_token)
+            self.assertEqual(args[0][1][0], '/lib.so')
+            self.assertEqual(args[0][1][1], 'barbican_token')
+            self.assertEqual(args[0][1][3], pin)
+            self.assertEqual(args[1], {'user': 'barbican',
+                                       'env': {'SOFTHSM2_CONF': conf}})
+        self.assertFalse(os.path.exists(os.path.dirname(conf)))
@@ -0,0 +1,115 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+
+import charm.openstack.fastpath as fastpath
+
+import charms_openstack.test_utils as test_utils
+
+
+class TestFastPath(test_utils.PatchHelper):
+
+    def setUp(self):
+        super(TestFastPath, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.pins = os.path.join(self.dir, 'stored_pins.txt')
+        self.tokens = os.path.join(self.dir, 'tokens')
+        os.mkdir(self.tokens)
+        with open(self.pins, 'w') as f:
+            f.write('{}')
+        self.watch = {
+            'files': [self.pins],
+            'dirs': [self.tokens],
+            'globs': [self.tokens + '.discard-*'],
+        }
+        self.patch_object(fastpath.subprocess, 'check_call')
+
+    def test_digest(self):
+        digest = fastpath.digest(self.watch)
+        self.assertEqual(fastpath.digest(self.watch), digest)
+        os.mkdir(os.path.join(self.tokens, 'token-1'))
+        self.assertNotEqual(fastpath.digest(self.watch), digest)
+        digest = fastpath.digest(self.watch)
+        os.mkdir(self.tokens + '.discard-1')
+        self.assertNotEqual(fastpath.digest(self.watch), digest)
+        digest = fastpath.digest(self.watch)
+        os.remove(self.pins)
+        self.assertNotEqual(fastpath.digest(self.watch), digest)
+
+    def test_digest_relations(self):
+        settings = {'slot_id': '10'}
+
+        def hook_tool(args, stderr=None):
+            self.assertEqual(args[-1], '--format=json')
+            if args[0] == 'relation-ids':
+                return b'["hsm:1"]'
+            if args[0] == 'relation-list':
+                return b'["barbican/0"]'
+            self.assertEqual(args[:5],
+                             ['relation-get', '-r', 'hsm:1', '-',
+                              'barbican/0'])
+            return json.dumps(settings).encode()
+
+        self.patch_object(fastpath.subprocess, 'check_output',
+                          side_effect=hook_tool)
+        self.watch['relations'] = ['hsm']
+        digest = fastpath.digest(self.watch)
+        self.assertEqual(fastpath.digest(self.watch), digest)
+        # a change to the relation data means the hook has to run in full
+        settings['slot_id'] = '11'
+        self.assertNotEqual(fastpath.digest(self.watch), digest)
+        # as does a hook tool failing
+        digest = fastpath.digest(self.watch)
+        self.check_output.side_effect = OSError()
+        self.assertNotEqual(fastpath.digest(self.watch), digest)
+
+    def test_update_status(self):
+        # nothing saved yet
+        self.assertFalse(fastpath.update_status(self.dir))
+        fastpath.save_state(self.dir, self.watch, 'active', 'Unit is ready')
+        self.assertTrue(fastpath.update_status(self.dir))
+        self.check_call.assert_called_once_with(
+            ['status-set', 'active', 'Unit is ready'])
+        # a change means the hook has to run in full
+        self.check_call.reset_mock()
+        with open(self.pins, 'w') as f:
+            f.write('{"pin": "1234"}')
+        self.assertFalse(fastpath.update_status(self.dir))
+        self.check_call.assert_not_called()
+
+    def test_update_status_status_set_fails(self):
+        fastpath.save_state(self.dir, self.watch, 'active', 'Unit is ready')
+        self.check_call.side_effect = subprocess.CalledProcessError(1, 'x')
+        self.assertFalse(fastpath.update_status(self.dir))
+
+    def test_save_state_transient(self):
+        fastpath.save_state(self.dir, self.watch, 'active', 'Unit is ready')
+        fastpath.save_state(self.dir, self.watch, 'maintenance',
+                            'Deleting old token store: 1 tokens left')
+        self.assertIsNone(fastpath.load_state(self.dir))
+        self.assertFalse(fastpath.update_status(self.dir))
+
+    def test_load_state_corrupt(self):
+        with open(os.path.join(self.dir, fastpath.STATE_FILE), 'w') as f:
+            f.write('{"digest": ')
+        self.assertIsNone(fastpath.load_state(self.dir))
+        with open(os.path.join(self.dir, fastpath.STATE_FILE), 'w') as f:
+            f.write('{"digest": "abc"}')
+        self.assertIsNone(fastpath.load_state(self.dir))
@@ -0,0 +1,127 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import shutil
+import tempfile
+
+import charm.openstack.health as health
+
+import charms_openstack.test_utils as test_utils
+
+
+def ok(seconds):
+    return {'at': 0, 'ok': True, 'seconds': seconds, 'login': seconds / 2,
+            'encrypt': seconds / 2}
+
+
+def failed(error='CKR_PIN_INCORRECT'):
+    return {'at': 0, 'ok': False, 'error': error}
+
+
+class TestHealth(test_utils.PatchHelper):
+
+    def setUp(self):
+        super(TestHealth, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.pins = os.path.join(self.dir, 'pins')
+        with open(self.pins, 'w') as f:
+            json.dump({'pin': '1234', 'so_pin': '5678'}, f)
+        self.state = {
+            'library': '/usr/lib/softhsm/libsofthsm2.so',
+            'conf': '/etc/softhsm/softhsm2.conf',
+            'user': 'barbican',
+            'label': 'barbican_token',
+            'slot_id': 1234,
+            'pins_file': self.pins,
+            'threshold': 0.1,
+            'interval': 0,
+        }
+
+    def test_run_probe(self):
+        self.patch_object(health.pkcs11, 'run_in_child',
+                          return_value={'login': 0.01, 'encrypt': 0.02})
+        sample = health.run_probe(self.state, now=1000.0)
+        self.assertEqual(sample['at'], 1000.0)
+        self.assertTrue(sample['ok'])
+        self.assertAlmostEqual(sample['seconds'], 0.03)
+        self.run_in_child.assert_called_once_with(
+            health.probe,
+            ('/usr/lib/softhsm/libsofthsm2.so', 'barbican_token', '1234',
+             1234),
+            user='barbican',
+            env={'SOFTHSM2_CONF': '/etc/softhsm/softhsm2.conf'},
+            timeout=health.PROBE_TIMEOUT)
+        # a failure is recorded, not raised
+        self.run_in_child.side_effect = TimeoutError()
+        self.assertEqual(health.run_probe(self.state, now=1000.0),
+                         {'at': 1000.0, 'ok': False,
+                          'error': 'TimeoutError'})
+
+    def test_assess(self):
+        self.assertEqual(health.assess([], 0.1), (None, None))
+        self.assertEqual(health.assess([ok(0.01)] * 5, 0.1), (None, None))
+        # one slow or failed sample doesn't change the status
+        self.assertEqual(health.assess([ok(0.01)] * 4 + [ok(5)], 0.1),
+                         (None, None))
+        self.assertEqual(health.assess([ok(0.01)] * 4 + [failed()], 0.1),
+                         (None, None))
+        self.assertEqual(
+            health.assess([ok(0.01)] * 2 + [ok(0.2)] * 3, 0.1),
+            ('active', "Degraded: token probe median latency 200ms is "
+             "above 100ms"))
+        self.assertEqual(
+            health.assess([ok(0.01)] * 2 + [failed()] * 3, 0.1),
+            ('blocked', "Token probe failing (3 of the last 5): "
+             "CKR_PIN_INCORRECT"))
+        # a recovered token isn't blocked
+        self.assertEqual(
+            health.assess([failed()] * 4 + [ok(0.01)], 0.1), (None, None))
+
+    def test_update(self):
+        self.assertIsNone(health.update(self.dir))
+        self.assertEqual(health.verdict(self.dir), (None, None))
+        health.save_state(self.dir, self.state)
+        self.patch_object(health, 'run_probe',
+                          side_effect=lambda state, now: failed())
+        for _ in range(health.WINDOW_SIZE + 2):
+            self.assertFalse(health.update(self.dir)['ok'])
+        self.assertEqual(len(health.load_samples(self.dir)),
+                         health.WINDOW_SIZE)
+        self.assertEqual(health.verdict(self.dir)[0], 'blocked')
+        # the verdict file is only rewritten when the verdict changes
+        path = os.path.join(self.dir, health.VERDICT_FILE)
+        mtime = os.stat(path).st_mtime_ns
+        os.utime(path, ns=(mtime - 10 ** 9, mtime - 10 ** 9))
+        health.update(self.dir)
+        self.assertEqual(os.stat(path).st_mtime_ns, mtime - 10 ** 9)
+        health.clear_state(self.dir)
+        self.assertEqual(os.listdir(self.dir), ['pins'])
+
+    def test_update_interval(self):
+        self.state['interval'] = 900
+        health.save_state(self.dir, self.state)
+        self.patch_object(health, 'run_probe',
+                          side_effect=lambda state, now: dict(ok(0.01),
+                                                              at=now))
+        self.assertTrue(health.update(self.dir, now=1000.0)['ok'])
+        # the token isn't probed again until the interval has passed
+        self.assertIsNone(health.update(self.dir, now=1899.0))
+        self.assertEqual(self.run_probe.call_count, 1)
+        self.assertEqual(health.update(self.dir, now=1900.0)['at'], 1900.0)
+        # nor does a clock stepped back stop the probes
+        self.assertEqual(health.update(self.dir, now=100.0)['at'], 100.0)
+        self.assertEqual(len(health.load_samples(self.dir)), 3)
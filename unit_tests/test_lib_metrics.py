@@ -0,0 +1,182 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import charm.openstack.metrics as metrics
+
+import charms_openstack.test_utils as test_utils
+
+
+class TestMetrics(test_utils.PatchHelper):
+
+    def setUp(self):
+        super(TestMetrics, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.store = os.path.join(self.dir, 'tokens')
+        self.textfiles = os.path.join(self.dir, 'node-exporter')
+        os.makedirs(os.path.join(self.store, 'token-1'))
+        os.mkdir(self.textfiles)
+        self._write('token-1/token.object', b'token')
+        self._write('token-1/token.lock', b'')
+        self._write('token-1/key.object', b'key' * 100)
+        self.pins = os.path.join(self.dir, 'pins')
+        with open(self.pins, 'w') as f:
+            json.dump({'pin': '1234', 'so_pin': '5678'}, f)
+        self.state = {
+            'textfile': os.path.join(self.textfiles, 'barbican_softhsm.prom'),
+            'store': self.store,
+            'pins_file': self.pins,
+            'library': '/usr/lib/softhsm/libsofthsm2.so',
+            'conf': '/etc/softhsm/softhsm2.conf',
+            'user': 'barbican',
+            'label': 'barbican_token',
+            'read_slot': 0.25,
+            'interval': 0,
+        }
+
+    def _write(self, name, data):
+        with open(os.path.join(self.store, name), 'wb') as f:
+            f.write(data)
+
+    def test_scan_tokens(self):
+        os.mkdir(os.path.join(self.store, 'token-2'))
+        self._write('token-2/sqlite3.db', b'db' * 10)
+        tokens, cache = metrics.scan_tokens(self.store, now=1000.0)
+        self.assertEqual(tokens, {'token-1': (1, 305), 'token-2': (None, 20)})
+        # an unchanged directory isn't listed again until it is stale
+        self.patch_object(metrics.os, 'scandir', wraps=metrics.os.scandir)
+        self.assertEqual(metrics.scan_tokens(self.store, cache, now=1001.0),
+                         (tokens, cache))
+        self.assertFalse(self.scandir.called)
+        metrics.scan_tokens(self.store, cache,
+                            now=1000.0 + metrics.RESCAN_INTERVAL)
+        self.assertEqual(self.scandir.call_count, 2)
+        # an object added to a token changes its directory
+        self.scandir.reset_mock()
+        self._write('token-1/new.object', b'new')
+        tokens, _ = metrics.scan_tokens(self.store, cache, now=1002.0)
+        self.assertEqual(tokens['token-1'], (2, 308))
+        self.scandir.assert_called_once_with(
+            os.path.join(self.store, 'token-1'))
+
+    def test_render(self):
+        text = metrics.render([
+            ('a_total', "The a.", [({}, 1)]),
+            ('b_bytes', "The b.", [({'token': 'x"y'}, 2), ({'token': 'z'},
+                                                           None)]),
+            ('c_seconds', "The c.", [({}, None)]),
+        ])
+        self.assertEqual(text, (
+            '# HELP a_total The a.\n'
+            '# TYPE a_total gauge\n'
+            'a_total 1.0\n'
+            '# HELP b_bytes The b.\n'
+            '# TYPE b_bytes gauge\n'
+            'b_bytes{token="x\\"y"} 2.0\n'))
+
+    def test_collect(self):
+        self.patch_object(metrics.pkcs11, 'run_in_child', return_value=0.01)
+        collected, cache = metrics.collect(self.state, now=2000.0)
+        values = {name: samples for name, _, samples in collected}
+        self.assertEqual(values['barbican_softhsm_tokens'], [({}, 1)])
+        self.assertEqual(values['barbican_softhsm_token_bytes'],
+                         [({'token': 'token-1'}, 305)])
+        self.assertEqual(values['barbican_softhsm_read_slot_seconds'],
+                         [({}, 0.25)])
+        self.assertEqual(values['barbican_softhsm_login_probe_seconds'],
+                         [({'token': 'barbican_token'}, 0.01)])
+        self.assertEqual(values['barbican_softhsm_login_probe_success'],
+                         [({'token': 'barbican_token'}, 1)])
+        self.assertIn('token-1', cache)
+        self.run_in_child.assert_called_once_with(
+            metrics.probe_login,
+            ('/usr/lib/softhsm/libsofthsm2.so', 'barbican_token', '1234'),
+            user='barbican',
+            env={'SOFTHSM2_CONF': '/etc/softhsm/softhsm2.conf'},
+            timeout=metrics.PROBE_TIMEOUT)
+        # a failed probe is reported, not raised
+        self.run_in_child.side_effect = TimeoutError()
+        collected, _ = metrics.collect(self.state, now=2000.0)
+        values = {name: samples for name, _, samples in collected}
+        self.assertEqual(values['barbican_softhsm_login_probe_success'],
+                         [({'token': 'barbican_token'}, 0)])
+        self.assertEqual(values['barbican_softhsm_login_probe_seconds'],
+                         [({'token': 'barbican_token'}, None)])
+        # and there's no probe without pins
+        self.run_in_child.reset_mock()
+        os.remove(self.pins)
+        collected, _ = metrics.collect(self.state, now=2000.0)
+        self.assertFalse(self.run_in_child.called)
+
+    def test_collect_health_sample(self):
+        self.patch_object(metrics.pkcs11, 'run_in_child')
+        sample = {'at': 2000.0, 'ok': True, 'seconds': 0.03, 'login': 0.01,
+                  'encrypt': 0.02}
+        collected, _ = metrics.collect(self.state, now=2000.0, sample=sample)
+        values = {name: samples for name, _, samples in collected}
+        self.assertEqual(values['barbican_softhsm_login_probe_seconds'],
+                         [({'token': 'barbican_token'}, 0.01)])
+        self.assertEqual(values['barbican_softhsm_encrypt_probe_seconds'],
+                         [({'token': 'barbican_token'}, 0.02)])
+        # the token isn't probed twice
+        self.assertFalse(self.run_in_child.called)
+        collected, _ = metrics.collect(
+            self.state, now=2000.0, sample={'at': 2000.0, 'ok': False,
+                                            'error': 'TimeoutError'})
+        values = {name: samples for name, _, samples in collected}
+        self.assertEqual(values['barbican_softhsm_login_probe_success'],
+                         [({'token': 'barbican_token'}, 0)])
+
+    def test_update(self):
+        self.patch_object(metrics.pkcs11, 'run_in_child', return_value=0.01)
+        self.assertFalse(metrics.update(self.dir))
+        metrics.save_state(self.dir, self.state)
+        self.assertTrue(metrics.update(self.dir))
+        with open(self.state['textfile']) as f:
+            text = f.read()
+        self.assertIn('barbican_softhsm_token_objects{token="token-1"} 1.0\n',
+                      text)
+        self.assertTrue(os.path.exists(
+            os.path.join(self.dir, metrics.CACHE_FILE)))
+        # without a health probe sample, the textfile is only rewritten once
+        # it is the probe interval old
+        self.state['interval'] = 900
+        metrics.save_state(self.dir, self.state)
+        mtime = os.stat(self.state['textfile']).st_mtime
+        self.assertFalse(metrics.update(self.dir, now=mtime + 899))
+        self.assertEqual(self.run_in_child.call_count, 1)
+        self.assertTrue(metrics.update(self.dir, {'ok': False},
+                                       now=mtime + 899))
+        self.assertEqual(self.run_in_child.call_count, 1)
+        self.assertTrue(metrics.update(self.dir, now=time.time() + 900))
+        self.assertEqual(self.run_in_child.call_count, 2)
+        # nothing is written without node-exporter's directory
+        os.remove(self.state['textfile'])
+        shutil.rmtree(self.textfiles)
+        self.assertFalse(metrics.update(self.dir))
+
+    def test_clear_state(self):
+        metrics.clear_state(self.dir)
+        metrics.save_state(self.dir, self.state)
+        open(self.state['textfile'], 'w').close()
+        metrics.clear_state(self.dir)
+        self.assertFalse(os.path.exists(self.state['textfile']))
+        self.assertFalse(os.path.exists(
+            os.path.join(self.dir, metrics.STATE_FILE)))
@@ -0,0 +1,165 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+
+import charm.openstack.migrate as migrate
+import charm.openstack.pkcs11 as pkcs11
+
+import charms_openstack.test_utils as test_utils
+
+
+class TestMigrate(test_utils.PatchHelper):
+
+    def test_write_conf(self):
+        self.patch_object(migrate.os, 'chmod')
+        with mock.patch('builtins.open', mock.mock_open()) as m:
+            migrate.write_conf('/tmp/x.conf', '/var/lib/softhsm/tokens/',
+                               'db')
+        m.assert_called_once_with('/tmp/x.conf', 'w')
+        written = m.return_value.write.call_args[0][0]
+        self.assertIn('directories.tokendir = /var/lib/softhsm/tokens/',
+                      written)
+        self.assertIn('objectstore.backend = db', written)
+        self.chmod.assert_called_once_with('/tmp/x.conf', 0o644)
+
+    def test_totals(self):
+        a, b = migrate.Totals(), migrate.Totals()
+        a.add('01' * 32)
+        a.add('ff' * 32)
+        b.add('ff' * 32)
+        b.add('01' * 32)
+        self.assertEqual(a.as_dict(), b.as_dict())
+        self.assertEqual(a.as_dict()['objects'], 2)
+        b.add('02' * 32)
+        self.assertNotEqual(a.as_dict(), b.as_dict())
+
+    def test_export_object(self):
+        session = mock.MagicMock()
+        values = {pkcs11.CKA_CLASS: pkcs11.CKO_SECRET_KEY,
+                  pkcs11.CKA_LABEL: b'mkek',
+                  pkcs11.CKA_TRUSTED: False,
+                  pkcs11.CKA_SENSITIVE: False,
+                  pkcs11.CKA_VALUE: b'key'}
+        session.get_attributes.return_value = values
+        record = migrate.export_object(session, 5, 9)
+        session.get_attributes.assert_called_once_with(
+            5, migrate.CHECKSUM_ATTRIBUTES)
+        self.assertEqual(record['attributes'], {
+            pkcs11.CKA_CLASS: pkcs11.CKO_SECRET_KEY,
+            pkcs11.CKA_LABEL: b'mkek',
+            pkcs11.CKA_SENSITIVE: False,
+            pkcs11.CKA_VALUE: b'key'})
+        self.assertEqual(record['checksum'], pkcs11.object_checksum(values))
+        self.assertIsNone(record['wrapped'])
+        # sensitive keys are wrapped
+        values = {pkcs11.CKA_CLASS: pkcs11.CKO_SECRET_KEY,
+                  pkcs11.CKA_SENSITIVE: True,
+                  pkcs11.CKA_EXTRACTABLE: True}
+        session.get_attributes.return_value = values
+        session.wrap_key.return_value = b'wrapped'
+        record = migrate.export_object(session, 5, 9)
+        session.wrap_key.assert_called_once_with(
+            pkcs11.CKM_AES_KEY_WRAP_PAD, 9, 5)
+        self.assertEqual(record['mechanism'], pkcs11.CKM_AES_KEY_WRAP_PAD)
+        self.assertEqual(record['wrapped'], b'wrapped')
+        self.assertNotIn(pkcs11.CKA_VALUE, record['attributes'])
+        # unless they can't be
+        values[pkcs11.CKA_EXTRACTABLE] = False
+        with self.assertRaises(migrate.MigrationError):
+            migrate.export_object(session, 5, 9)
+
+    def test_wrap(self):
+        session = mock.MagicMock()
+        session.wrap_key.side_effect = [
+            pkcs11.PKCS11Error('C_WrapKey', pkcs11.CKR_MECHANISM_INVALID),
+            b'wrapped']
+        self.assertEqual(migrate.wrap(session, 9, 5),
+                         (pkcs11.CKM_AES_KEY_WRAP, b'wrapped'))
+        session.wrap_key.side_effect = pkcs11.PKCS11Error('C_WrapKey', 0x5)
+        with self.assertRaises(pkcs11.PKCS11Error):
+            migrate.wrap(session, 9, 5)
+
+    def test_import_object(self):
+        session = mock.MagicMock()
+        values = {pkcs11.CKA_LABEL: b'mkek'}
+        session.get_attributes.return_value = values
+        session.create_object.return_value = 7
+        record = {'attributes': values, 'mechanism': None, 'wrapped': None,
+                  'checksum': pkcs11.object_checksum(values)}
+        self.assertEqual(migrate.import_object(session, record, 9),
+                         record['checksum'])
+        session.create_object.assert_called_once_with(values)
+        session.get_attributes.assert_called_once_with(
+            7, migrate.CHECKSUM_ATTRIBUTES)
+        record.update(mechanism=pkcs11.CKM_AES_KEY_WRAP, wrapped=b'w')
+        migrate.import_object(session, record, 9)
+        session.unwrap_key.assert_called_once_with(
+            pkcs11.CKM_AES_KEY_WRAP, 9, b'w', values)
+        record['checksum'] = 'different'
+        with self.assertRaises(migrate.MigrationError):
+            migrate.import_object(session, record, 9)
+
+    def test_migrate_token(self):
+        self.patch_object(migrate.pkcs11, 'Child')
+        source, target = mock.MagicMock(), mock.MagicMock()
+        self.Child.side_effect = [source, target]
+        source.result.return_value = {'objects': 2, 'checksum': 'ab'}
+        target.result.return_value = {'objects': 2, 'checksum': 'ab'}
+        self.assertEqual(
+            migrate.migrate_token('/lib.so', 'barbican_token', '1234',
+                                  '5678', '/tmp/s.conf', '/tmp/t.conf',
+                                  'barbican', 10),
+            {'objects': 2, 'checksum': 'ab'})
+        calls = self.Child.call_args_list
+        self.assertEqual(calls[0][0][0], migrate._export_token)
+        self.assertEqual(calls[0][1], {'user': 'barbican',
+                                       'env': {'SOFTHSM2_CONF':
+                                               '/tmp/s.conf'}})
+        self.assertEqual(calls[1][0][0], migrate._import_token)
+        self.assertEqual(calls[1][1]['env'], {'SOFTHSM2_CONF': '/tmp/t.conf'})
+        # mismatched totals fail
+        self.Child.side_effect = [source, target]
+        target.result.return_value = {'objects': 1, 'checksum': 'ab'}
+        with self.assertRaises(migrate.MigrationError):
+            migrate.migrate_token('/lib.so', 'barbican_token', '1234',
+                                  '5678', '/tmp/s.conf', '/tmp/t.conf',
+                                  'barbican')
+        # and the target's error is raised when both fail
+        self.Child.side_effect = [source, target]
+        source.result.side_effect = BrokenPipeError()
+        target.result.side_effect = migrate.MigrationError('no free token')
+        with self.assertRaises(migrate.MigrationError):
+            migrate.migrate_token('/lib.so', 'barbican_token', '1234',
+                                  '5678', '/tmp/s.conf', '/tmp/t.conf',
+                                  'barbican')
+        self.assertEqual(source.result.call_count, 3)
+        # but the source's error is raised when the target only saw it stop
+        self.Child.side_effect = [source, target]
+        source.result.side_effect = migrate.pkcs11.PKCS11Error(
+            'C_FindObjects', 0x30)
+        eof = EOFError()
+        target.result.side_effect = eof
+        with self.assertRaises(migrate.pkcs11.PKCS11Error) as cm:
+            migrate.migrate_token('/lib.so', 'barbican_token', '1234',
+                                  '5678', '/tmp/s.conf', '/tmp/t.conf',
+                                  'barbican')
+        self.assertIs(cm.exception.__cause__, eof)
+        # a source that finished leaves the target's EOFError
+        self.Child.side_effect = [source, target]
+        source.result.side_effect = None
+        with self.assertRaises(EOFError):
+            migrate.migrate_token('/lib.so', 'barbican_token', '1234',
+                                  '5678', '/tmp/s.conf', '/tmp/t.conf',
+                                  'barbican')
@@ -0,0 +1,425 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+
+import charm.openstack.pkcs11 as pkcs11
+
+import charms_openstack.test_utils as test_utils
+
+
+def fake_token_info(label, serial, flags):
+    """Return a fake C_GetTokenInfo that fills in the passed CK_TOKEN_INFO"""
+    def _f(slot_id, info):
+        info._obj.label = label.ljust(32).encode()
+        info._obj.serialNumber = serial.ljust(16).encode()
+        info._obj.flags = flags
+        info._obj.hardwareVersion.major = 2
+        info._obj.firmwareVersion.major = 2
+        info._obj.firmwareVersion.minor = 6
+        return pkcs11.CKR_OK
+    return _f
+
+
+class TestPKCS11Library(test_utils.PatchHelper):
+
+    def setUp(self):
+        super(TestPKCS11Library, self).setUp()
+        self.patch_object(pkcs11.ctypes, 'CDLL')
+        self.cdll = mock.MagicMock()
+        self.CDLL.return_value = self.cdll
+
+    def test_library(self):
+        lib = pkcs11.Library('/path/to/lib.so')
+        self.CDLL.assert_called_once_with('/path/to/lib.so')
+        self.assertEqual(lib.path, '/path/to/lib.so')
+
+    def test_initialize(self):
+        self.cdll.C_Initialize.return_value = pkcs11.CKR_OK
+        lib = pkcs11.Library('/path/to/lib.so')
+        lib.initialize()
+        args = self.cdll.C_Initialize.call_args[0][0]._obj
+        self.assertEqual(args.flags, pkcs11.CKF_OS_LOCKING_OK)
+        # already initialised is fine
+        self.cdll.C_Initialize.return_value = (
+            pkcs11.CKR_CRYPTOKI_ALREADY_INITIALIZED)
+        lib.initialize()
+        # anything else is not.
+        self.cdll.C_Initialize.return_value = 0x5
+        with self.assertRaises(pkcs11.PKCS11Error) as e:
+            lib.initialize()
+        self.assertEqual(e.exception.function, 'C_Initialize')
+        self.assertEqual(e.exception.rv, 0x5)
+
+    def test_get_slot_list(self):
+        def get_slot_list(flag, slots, count):
+            self.assertEqual(flag.value, pkcs11.CK_TRUE)
+            if slots is None:
+                count._obj.value = 2
+            else:
+                slots[0] = 10
+                slots[1] = 20
+            return pkcs11.CKR_OK
+
+        self.cdll.C_GetSlotList.side_effect = get_slot_list
+        lib = pkcs11.Library('/path/to/lib.so')
+        self.assertEqual(lib.get_slot_list(), [10, 20])
+        self.assertEqual(self.cdll.C_GetSlotList.call_count, 2)
+
+    def test_get_slot_list_retries_buffer_too_small(self):
+        rvs = [pkcs11.CKR_OK, pkcs11.CKR_BUFFER_TOO_SMALL,
+               pkcs11.CKR_OK, pkcs11.CKR_OK]
+
+        def get_slot_list(flag, slots, count):
+            if slots is None:
+                count._obj.value = 1
+            else:
+                slots[0] = 3
+            return rvs.pop(0)
+
+        self.cdll.C_GetSlotList.side_effect = get_slot_list
+        lib = pkcs11.Library('/path/to/lib.so')
+        self.assertEqual(lib.get_slot_list(), [3])
+        self.assertEqual(self.cdll.C_GetSlotList.call_count, 4)
+
+    def test_get_token_info(self):
+        self.cdll.C_GetTokenInfo.side_effect = fake_token_info(
+            'barbican_token', '02ae3171143498e7',
+            pkcs11.CKF_TOKEN_INITIALIZED | pkcs11.CKF_USER_PIN_INITIALIZED)
+        lib = pkcs11.Library('/path/to/lib.so')
+        token = lib.get_token_info(5)
+        self.assertEqual(token.label, 'barbican_token')
+        self.assertEqual(token.serial, '02ae3171143498e7')
+        self.assertTrue(token.initialized)
+        self.assertTrue(token.user_pin_initialized)
+        self.assertEqual(token.hardware_version, '2.0')
+        self.assertEqual(token.firmware_version, '2.6')
+
+    def test_get_slot_info(self):
+        def get_slot_info(slot_id, info):
+            info._obj.slotDescription = b'SoftHSM slot ID 0x5'.ljust(64)
+            info._obj.flags = pkcs11.CKF_TOKEN_PRESENT
+            return pkcs11.CKR_OK
+
+        self.cdll.C_GetSlotInfo.side_effect = get_slot_info
+        self.cdll.C_GetTokenInfo.side_effect = fake_token_info(
+            'barbican_token', '1234', pkcs11.CKF_TOKEN_INITIALIZED)
+        lib = pkcs11.Library('/path/to/lib.so')
+        slot = lib.get_slot_info(5)
+        self.assertEqual(slot.slot_id, 5)
+        self.assertEqual(slot.description, 'SoftHSM slot ID 0x5')
+        self.assertTrue(slot.token_present)
+        self.assertEqual(slot.token.label, 'barbican_token')
+
+    def test_get_mechanism_list(self):
+        def get_mechanism_list(slot_id, mechanisms, count):
+            self.assertEqual(slot_id.value, 5)
+            if mechanisms is None:
+                count._obj.value = 2
+            else:
+                mechanisms[0] = pkcs11.CKM_AES_GCM
+                mechanisms[1] = pkcs11.CKM_AES_KEY_WRAP
+            return pkcs11.CKR_OK
+
+        self.cdll.C_GetMechanismList.side_effect = get_mechanism_list
+        lib = pkcs11.Library('/path/to/lib.so')
+        self.assertEqual(lib.get_mechanism_list(5),
+                         [pkcs11.CKM_AES_GCM, pkcs11.CKM_AES_KEY_WRAP])
+
+    def test_get_mechanism_info(self):
+        def get_mechanism_info(slot_id, mechanism, info):
+            self.assertEqual(mechanism.value, pkcs11.CKM_AES_GCM)
+            info._obj.ulMinKeySize = 16
+            info._obj.ulMaxKeySize = 32
+            info._obj.flags = pkcs11.CKF_ENCRYPT | pkcs11.CKF_DECRYPT
+            return pkcs11.CKR_OK
+
+        self.cdll.C_GetMechanismInfo.side_effect = get_mechanism_info
+        lib = pkcs11.Library('/path/to/lib.so')
+        self.assertEqual(
+            lib.get_mechanism_info(5, pkcs11.CKM_AES_GCM),
+            pkcs11.MechanismInfo(16, 32,
+                                 pkcs11.CKF_ENCRYPT | pkcs11.CKF_DECRYPT))
+
+
+class TestPKCS11Helpers(test_utils.PatchHelper):
+
+    def test_initialized(self):
+        self.patch_object(pkcs11, 'Library')
+        lib = self.Library.return_value
+        with pkcs11.initialized('/path/to/lib.so') as loaded:
+            self.assertEqual(loaded, lib)
+            lib.initialize.assert_called_once_with()
+            self.assertFalse(lib.finalize.called)
+        lib.finalize.assert_called_once_with()
+        self.Library.assert_called_once_with('/path/to/lib.so')
+
+    def test_find_slot(self):
+        self.patch_object(pkcs11, 'Library')
+        lib = self.Library.return_value
+        lib.get_slot_list.return_value = [1, 2, 3]
+        tokens = {
+            1: pkcs11.TokenInfo('barbican_token_old', '', '', 'a', True,
+                                True, '2.0', '2.0'),
+            2: pkcs11.TokenInfo('barbican_token', '', '', 'b', True,
+                                True, '2.0', '2.0'),
+            3: pkcs11.TokenInfo('', '', '', '', False, False, '2.0', '2.0'),
+        }
+        lib.get_token_info.side_effect = lambda s: tokens[s]
+        lib.get_slot_info.return_value = mock.sentinel.slot
+        self.assertEqual(pkcs11.find_slot('/lib.so', 'barbican_token'),
+                         mock.sentinel.slot)
+        lib.get_slot_info.assert_called_once_with(2)
+        lib.finalize.assert_called_once_with()
+        self.assertEqual(pkcs11.find_slot('/lib.so', 'missing'), None)
+
+    def test_read_mechanisms(self):
+        self.patch_object(pkcs11, 'Library')
+        lib = self.Library.return_value
+        lib.get_slot_list.return_value = [3, 4]
+        # mechanisms the charm doesn't know are left out
+        lib.get_mechanism_list.return_value = [pkcs11.CKM_AES_GCM, 0x1]
+        lib.get_mechanism_info.return_value = mock.sentinel.info
+        self.assertEqual(pkcs11.read_mechanisms('/lib.so'),
+                         {'CKM_AES_GCM': mock.sentinel.info})
+        lib.get_slot_list.assert_called_once_with(token_present=False)
+        lib.get_mechanism_info.assert_called_once_with(3, pkcs11.CKM_AES_GCM)
+        lib.finalize.assert_called_once_with()
+
+
+def _child_add(a, b):
+    return a + b
+
+
+def _child_env():
+    return pkcs11.os.environ.get('SOFTHSM2_CONF')
+
+
+def _child_raise():
+    raise ValueError("in the child")
+
+
+class TestPKCS11Session(test_utils.PatchHelper):
+
+    def setUp(self):
+        super(TestPKCS11Session, self).setUp()
+        self.patch_object(pkcs11.ctypes, 'CDLL')
+        self.cdll = mock.MagicMock()
+        self.CDLL.return_value = self.cdll
+        for name in ('C_OpenSession', 'C_CloseSession', 'C_Login',
+                     'C_FindObjectsInit', 'C_FindObjectsFinal'):
+            getattr(self.cdll, name).return_value = pkcs11.CKR_OK
+        self.lib = pkcs11.Library('/path/to/lib.so')
+
+    def test_encode_decode_attribute(self):
+        for attr, value in ((pkcs11.CKA_TOKEN, True),
+                            (pkcs11.CKA_SENSITIVE, False),
+                            (pkcs11.CKA_CLASS, pkcs11.CKO_SECRET_KEY),
+                            (pkcs11.CKA_VALUE, b'\x00\x01')):
+            self.assertEqual(
+                pkcs11.decode_attribute(
+                    attr, pkcs11.encode_attribute(attr, value)),
+                value)
+        self.assertEqual(
+            pkcs11.encode_attribute(pkcs11.CKA_LABEL, 'mkek'), b'mkek')
+
+    def test_open_session(self):
+        with self.lib.open_session(3) as session:
+            slot_id, flags = self.cdll.C_OpenSession.call_args[0][:2]
+            self.assertEqual(slot_id.value, 3)
+            self.assertEqual(
+                flags.value, pkcs11.CKF_SERIAL_SESSION | pkcs11.CKF_RW_SESSION)
+            session.login('1234')
+            user_type, pin, length = self.cdll.C_Login.call_args[0][1:]
+            self.assertEqual(user_type.value, pkcs11.CKU_USER)
+            self.assertEqual((pin, length.value), (b'1234', 4))
+        self.assertEqual(self.cdll.C_CloseSession.call_count, 1)
+
+    def test_find_objects(self):
+        counts = [2, 1, 0]
+
+        def find_objects(session, handles, batch_size, count):
+            self.assertEqual(batch_size.value, 2)
+            count._obj.value = counts.pop(0)
+            for i in range(count._obj.value):
+                handles[i] = 10 + len(counts) * 2 + i
+            return pkcs11.CKR_OK
+
+        self.cdll.C_FindObjects.side_effect = find_objects
+        session = pkcs11.Session(self.lib, 1)
+        batches = list(session.find_objects({pkcs11.CKA_TOKEN: True}, 2))
+        self.assertEqual(batches, [[14, 15], [12]])
+        self.assertEqual(self.cdll.C_FindObjectsInit.call_args[0][2].value, 1)
+        self.assertEqual(self.cdll.C_FindObjectsFinal.call_count, 1)
+
+    def test_find_object(self):
+        found = [7]
+
+        def find_objects(session, handles, batch_size, count):
+            count._obj.value = len(found)
+            if found:
+                handles[0] = found[0]
+            return pkcs11.CKR_OK
+
+        self.cdll.C_FindObjects.side_effect = find_objects
+        session = pkcs11.Session(self.lib, 1)
+        self.assertEqual(session.find_object({pkcs11.CKA_LABEL: 'mkek'}), 7)
+        # the find operation is finished even though there may be more
+        self.assertEqual(self.cdll.C_FindObjectsFinal.call_count, 1)
+        found.pop()
+        self.assertEqual(session.find_object({pkcs11.CKA_LABEL: 'x'}), None)
+        self.assertEqual(self.cdll.C_FindObjectsFinal.call_count, 2)
+
+    def test_generate_key(self):
+        def generate_key(session, mech, template, count, handle):
+            self.assertEqual(mech._obj.mechanism, pkcs11.CKM_AES_KEY_GEN)
+            self.assertEqual(count.value, 2)
+            handle._obj.value = 42
+            return pkcs11.CKR_OK
+
+        self.cdll.C_GenerateKey.side_effect = generate_key
+        session = pkcs11.Session(self.lib, 1)
+        self.assertEqual(
+            session.generate_key(pkcs11.CKM_AES_KEY_GEN,
+                                 {pkcs11.CKA_VALUE_LEN: 32,
+                                  pkcs11.CKA_LABEL: 'mkek'}),
+            42)
+
+    def test_encrypt(self):
+        self.cdll.C_EncryptInit.return_value = pkcs11.CKR_OK
+
+        def encrypt(session, data, length, out, out_length):
+            if out is None:
+                out_length._obj.value = 32
+            else:
+                out.value = data[::-1]
+                out_length._obj.value = len(data)
+            return pkcs11.CKR_OK
+
+        self.cdll.C_Encrypt.side_effect = encrypt
+        session = pkcs11.Session(self.lib, 1)
+        self.assertEqual(
+            session.encrypt(pkcs11.CKM_AES_CBC_PAD, 5, b'abc', b'\x01' * 16),
+            b'cba')
+        mech = self.cdll.C_EncryptInit.call_args[0][1]._obj
+        self.assertEqual(mech.mechanism, pkcs11.CKM_AES_CBC_PAD)
+        self.assertEqual(mech.ulParameterLen, 16)
+        self.assertEqual(self.cdll.C_EncryptInit.call_args[0][2].value, 5)
+        self.assertEqual(self.cdll.C_Encrypt.call_count, 2)
+
+    def test_sign(self):
+        self.cdll.C_SignInit.return_value = pkcs11.CKR_OK
+
+        def sign(session, data, length, out, out_length):
+            out_length._obj.value = 4
+            if out is not None:
+                out.value = b'sig!'
+            return pkcs11.CKR_OK
+
+        self.cdll.C_Sign.side_effect = sign
+        session = pkcs11.Session(self.lib, 1)
+        self.assertEqual(session.sign(pkcs11.CKM_SHA256_HMAC, 5, b'data'),
+                         b'sig!')
+        mech = self.cdll.C_SignInit.call_args[0][1]._obj
+        self.assertEqual(mech.mechanism, pkcs11.CKM_SHA256_HMAC)
+        self.assertEqual(mech.ulParameterLen, 0)
+
+    def test_get_attributes(self):
+        def get_attribute_value(session, handle, template, count):
+            # CKA_CLASS is readable, CKA_VALUE is sensitive
+            if not template[0].pValue:
+                template[0].ulValueLen = pkcs11.ctypes.sizeof(pkcs11.CK_ULONG)
+                template[1].ulValueLen = pkcs11.CK_UNAVAILABLE_INFORMATION
+            else:
+                pkcs11.ctypes.memmove(
+                    template[0].pValue,
+                    pkcs11.encode_attribute(pkcs11.CKA_CLASS,
+                                            pkcs11.CKO_SECRET_KEY),
+                    template[0].ulValueLen)
+                template[1].ulValueLen = pkcs11.CK_UNAVAILABLE_INFORMATION
+            return pkcs11.CKR_ATTRIBUTE_SENSITIVE
+
+        self.cdll.C_GetAttributeValue.side_effect = get_attribute_value
+        session = pkcs11.Session(self.lib, 1)
+        self.assertEqual(
+            session.get_attributes(5, [pkcs11.CKA_CLASS, pkcs11.CKA_VALUE]),
+            {pkcs11.CKA_CLASS: pkcs11.CKO_SECRET_KEY})
+        self.cdll.C_GetAttributeValue.side_effect = None
+        self.cdll.C_GetAttributeValue.return_value = 0x5
+        with self.assertRaises(pkcs11.PKCS11Error):
+            session.get_attributes(5, [pkcs11.CKA_CLASS])
+
+
+class TestPKCS11Tokens(test_utils.PatchHelper):
+
+    def test_init_free_token(self):
+        lib = mock.MagicMock()
+        tokens = {
+            1: pkcs11.TokenInfo('barbican_token', '', '', 'a', True, True,
+                                '2.0', '2.0'),
+            2: pkcs11.TokenInfo('', '', '', 'b', False, False, '2.0', '2.0'),
+        }
+        lib.get_token_info.side_effect = lambda s: tokens[s]
+
+        def get_slot_list(token_present):
+            # SoftHSM moves an initialised token to a new slot and presents
+            # a new free token when the slots are next listed.
+            if tokens[2].initialized:
+                tokens[7] = tokens[2]
+                tokens[2] = pkcs11.TokenInfo('', '', '', 'c', False, False,
+                                             '2.0', '2.0')
+            return sorted(tokens)
+
+        def init_token(slot_id, so_pin, label):
+            tokens[slot_id] = tokens[slot_id]._replace(
+                label=label, initialized=True)
+
+        lib.get_slot_list.side_effect = get_slot_list
+        lib.init_token.side_effect = init_token
+        session = lib.open_session.return_value.__enter__.return_value
+        self.assertEqual(
+            pkcs11.init_free_token(lib, 'barbican_token_1', '5678', '1234'),
+            7)
+        lib.init_token.assert_called_once_with(2, '5678', 'barbican_token_1')
+        session.login.assert_called_once_with('5678', pkcs11.CKU_SO)
+        session.init_pin.assert_called_once_with('1234')
+        # no free token
+        lib.get_slot_list.side_effect = None
+        lib.get_slot_list.return_value = [1, 7]
+        with self.assertRaises(RuntimeError):
+            pkcs11.init_free_token(lib, 'barbican_token_2', '5678', '1234')
+
+    def test_object_checksum(self):
+        values = {pkcs11.CKA_CLASS: pkcs11.CKO_SECRET_KEY,
+                  pkcs11.CKA_LABEL: b'mkek',
+                  pkcs11.CKA_TOKEN: True}
+        checksum = pkcs11.object_checksum(values)
+        self.assertEqual(len(checksum), 64)
+        self.assertEqual(pkcs11.object_checksum(dict(values)), checksum)
+        values[pkcs11.CKA_TOKEN] = False
+        self.assertNotEqual(pkcs11.object_checksum(values), checksum)
+
+
+class TestPKCS11Child(test_utils.PatchHelper):
+
+    def test_run_in_child(self):
+        self.assertEqual(pkcs11.run_in_child(_child_add, (1, 2)), 3)
+        self.assertEqual(
+            pkcs11.run_in_child(_child_env,
+                                env={'SOFTHSM2_CONF': '/tmp/x.conf'}),
+            '/tmp/x.conf')
+        self.assertNotEqual(pkcs11.os.environ.get('SOFTHSM2_CONF'),
+                            '/tmp/x.conf')
+        with self.assertRaises(ValueError):
+            pkcs11.run_in_child(_child_raise)
@@ -0,0 +1,95 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+
+import charm.openstack.relocate as relocate
+
+import charms_openstack.test_utils as test_utils
+
+
+class TestRelocate(test_utils.PatchHelper):
+
+    def setUp(self):
+        super(TestRelocate, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.source = os.path.join(self.dir, 'tokens')
+        self.target = os.path.join(self.dir, 'nvme')
+        os.makedirs(os.path.join(self.source, 'token-1'))
+        os.mkdir(self.target)
+        self._write('token-1/token.object', b'token')
+        self._write('token-1/key.object', b'key' * 1000)
+        os.chmod(os.path.join(self.source, 'token-1'), 0o700)
+
+    def _write(self, name, data):
+        with open(os.path.join(self.source, name), 'wb') as f:
+            f.write(data)
+
+    def _read(self, name):
+        with open(os.path.join(self.target, name), 'rb') as f:
+            return f.read()
+
+    def test_sync(self):
+        copied = relocate.sync(self.source, self.target)
+        self.assertEqual(sorted(copied),
+                         ['token-1', 'token-1/key.object',
+                          'token-1/token.object'])
+        self.assertIsNone(copied['token-1'])
+        self.assertEqual(self._read('token-1/key.object'), b'key' * 1000)
+        self.assertEqual(
+            os.stat(os.path.join(self.target, 'token-1')).st_mode & 0o777,
+            0o700)
+        self.assertEqual(relocate.verify(self.target, copied), (2, 3005))
+
+    def test_sync_again(self):
+        copied = relocate.sync(self.source, self.target)
+        self.patch_object(relocate, 'copy_file', wraps=relocate.copy_file)
+        # only what changed is copied, and what has gone is removed
+        self._write('token-1/token.object', b'changed')
+        self._write('token-1/new.object', b'new')
+        os.remove(os.path.join(self.source, 'token-1', 'key.object'))
+        copied = relocate.sync(self.source, self.target, copied)
+        self.assertEqual(
+            sorted(call[0][0] for call in self.copy_file.call_args_list),
+            [os.path.join(self.source, 'token-1', 'new.object'),
+             os.path.join(self.source, 'token-1', 'token.object')])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.target,
+                                                        'token-1'))),
+                         ['new.object', 'token.object'])
+        self.assertEqual(self._read('token-1/token.object'), b'changed')
+        self.assertEqual(relocate.verify(self.target, copied), (2, 10))
+        # a removed token directory is removed too
+        shutil.rmtree(os.path.join(self.source, 'token-1'))
+        copied = relocate.sync(self.source, self.target, copied)
+        self.assertEqual(copied, {})
+        self.assertEqual(os.listdir(self.target), [])
+
+    def test_verify(self):
+        copied = relocate.sync(self.source, self.target)
+        with open(os.path.join(self.target, 'token-1', 'key.object'),
+                  'r+b') as f:
+            f.write(b'x')
+        with self.assertRaises(relocate.RelocationError):
+            relocate.verify(self.target, copied)
+        os.remove(os.path.join(self.target, 'token-1', 'key.object'))
+        with self.assertRaises(relocate.RelocationError):
+            relocate.verify(self.target, copied)
+
+    def test_sync_unexpected(self):
+        os.symlink('/etc/passwd', os.path.join(self.source, 'link'))
+        with self.assertRaises(relocate.RelocationError):
+            relocate.sync(self.source, self.target)
@@ -0,0 +1,347 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+
+import mock
+
+import charm.openstack.replication as replication
+
+import charms_openstack.test_utils as test_utils
+
+PINS = {'pin': '1234', 'so_pin': '5678'}
+
+
+def sha(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class TestReplication(test_utils.PatchHelper):
+
+    def setUp(self):
+        super(TestReplication, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.leader = os.path.join(self.dir, 'leader')
+        self.follower = os.path.join(self.dir, 'follower')
+        os.makedirs(os.path.join(self.leader, 'token-1'))
+        os.mkdir(self.follower)
+        self._write('token-1/token.object', b'token')
+        self._write('token-1/key.object', b'key' * 1000)
+        os.chmod(os.path.join(self.leader, 'token-1'), 0o700)
+        self.source = os.path.join(self.dir, 'source.json')
+        self.objects = os.path.join(self.dir, 'objects')
+        os.mkdir(self.objects)
+        self.fetched = []
+
+    def _write(self, name, data):
+        with open(os.path.join(self.leader, name), 'wb') as f:
+            f.write(data)
+
+    def _read(self, name):
+        with open(os.path.join(self.follower, name), 'rb') as f:
+            return f.read()
+
+    def _save(self):
+        manifest, _ = replication.scan(self.leader)
+        manifest['pins'] = hashlib.sha256(
+            json.dumps(PINS, sort_keys=True).encode()).hexdigest()
+        manifest['id'] = replication.manifest_id(manifest)
+        replication.export(self.leader, manifest, self.objects)
+        replication.write_source(self.source, self.objects, manifest, PINS)
+        replication.prune(self.objects, manifest)
+        return manifest
+
+    def _serve(self, command, request=None):
+        out = io.StringIO()
+        replication.serve(command, self.source,
+                          io.StringIO(json.dumps(request)), out)
+        return out.getvalue()
+
+    def _fetch(self, digests):
+        self.fetched.append(digests)
+        return dict(json.loads(line) for line in
+                    self._serve('objects', digests).splitlines())
+
+    def test_scan(self):
+        manifest, cache = replication.scan(self.leader)
+        self.assertEqual(manifest['dirs'], {'token-1': 0o700})
+        self.assertEqual(manifest['files']['token-1/token.object'][0],
+                         sha(b'token'))
+        self.assertEqual(manifest['files']['token-1/token.object'][2], 5)
+        self.assertEqual(cache['token-1/token.object'][0], 5)
+        # unchanged files aren't hashed again
+        self.patch_object(replication.relocate, 'file_digest')
+        self.assertEqual(replication.scan(self.leader, cache),
+                         (manifest, cache))
+        self.assertFalse(self.file_digest.called)
+
+    def test_scan_special_file(self):
+        os.mkfifo(os.path.join(self.leader, 'fifo'))
+        with self.assertRaises(replication.ReplicationError):
+            replication.scan(self.leader)
+
+    def test_manifest_id(self):
+        manifest, _ = replication.scan(self.leader)
+        first = replication.manifest_id(manifest)
+        self._write('token-1/token.object', b'changed')
+        manifest, _ = replication.scan(self.leader)
+        self.assertNotEqual(replication.manifest_id(manifest), first)
+
+    def test_encode_decode(self):
+        path = os.path.join(self.leader, 'token-1', 'key.object')
+        value = replication.encode(path, sha(b'key' * 1000))
+        self.assertEqual(replication.decode(value, sha(b'key' * 1000)),
+                         b'key' * 1000)
+        with self.assertRaises(replication.ReplicationError):
+            replication.decode(value, sha(b'other'))
+        with self.assertRaises(replication.ReplicationError):
+            replication.decode('not base64!', sha(b'other'))
+        # a file that changed since it was scanned isn't published
+        with self.assertRaises(replication.ReplicationError):
+            replication.encode(path, sha(b'other'))
+
+    def test_export(self):
+        manifest, _ = replication.scan(self.leader)
+        self.assertEqual(
+            replication.export(self.leader, manifest, self.objects), 2)
+        self.assertEqual(sorted(os.listdir(self.objects)),
+                         sorted([sha(b'token'), sha(b'key' * 1000)]))
+        path = os.path.join(self.objects, sha(b'token'))
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'token')
+        # only new files are copied, and the old ones are kept until pruned
+        self._write('token-1/token.object', b'changed')
+        manifest, _ = replication.scan(self.leader)
+        self.assertEqual(
+            replication.export(self.leader, manifest, self.objects), 1)
+        self.assertEqual(len(os.listdir(self.objects)), 3)
+        self.assertEqual(replication.prune(self.objects, manifest), 1)
+        self.assertEqual(sorted(os.listdir(self.objects)),
+                         sorted([sha(b'changed'), sha(b'key' * 1000)]))
+        # a file that changed since it was scanned isn't copied
+        self._write('token-1/token.object', b'changed again')
+        os.remove(os.path.join(self.objects, sha(b'changed')))
+        with self.assertRaises(replication.ReplicationError):
+            replication.export(self.leader, manifest, self.objects)
+        self.assertEqual(os.listdir(self.objects), [sha(b'key' * 1000)])
+
+    def test_write_source(self):
+        self.assertIsNone(replication.read_source(self.source))
+        manifest = self._save()
+        self.assertEqual(os.stat(self.source).st_mode & 0o777, 0o600)
+        self.assertEqual(replication.read_source(self.source),
+                         {'objects': self.objects, 'manifest': manifest,
+                          'pins': PINS})
+
+    def test_serve(self):
+        manifest = self._save()
+        self.assertEqual(json.loads(self._serve('manifest')),
+                         {'manifest': manifest, 'pins': PINS})
+        lines = self._serve('objects', [sha(b'token')]).splitlines()
+        self.assertEqual(len(lines), 1)
+        digest, value = json.loads(lines[0])
+        self.assertEqual(replication.decode(value, digest), b'token')
+        # only the files in the manifest are sent
+        with self.assertRaises(replication.ReplicationError):
+            self._serve('objects', [sha(b'other')])
+        with self.assertRaises(replication.ReplicationError):
+            self._serve('shell')
+        # the copies are sent, so the store can change meanwhile
+        self._write('token-1/token.object', b'changed')
+        self.assertEqual(len(self._serve('objects', [sha(b'token')])
+                             .splitlines()), 1)
+        # but not a corrupt copy
+        with open(os.path.join(self.objects, sha(b'token')), 'wb') as f:
+            f.write(b'corrupt')
+        with self.assertRaises(replication.ReplicationError):
+            self._serve('objects', [sha(b'token')])
+
+    def test_serve_nothing_saved(self):
+        with self.assertRaises(replication.ReplicationError):
+            self._serve('manifest')
+
+    def test_main(self):
+        self._save()
+        self.patch_object(replication.os, 'environ',
+                          new={'SSH_ORIGINAL_COMMAND': 'manifest'})
+        self.patch_object(replication.sys, 'stdout', new=io.StringIO())
+        self.assertEqual(replication.main(['serve', self.source]), 0)
+        self.assertIn(PINS['pin'], replication.sys.stdout.getvalue())
+        self.patch_object(replication.sys, 'stderr', new=io.StringIO())
+        self.assertEqual(replication.main(['serve']), 2)
+        self.assertEqual(replication.main(['serve', self.source + '.x']), 1)
+        replication.os.environ['SSH_ORIGINAL_COMMAND'] = 'cat /etc/shadow'
+        self.assertEqual(replication.main(['serve', self.source]), 1)
+
+    def test_install(self):
+        lib = os.path.join(self.dir, 'lib')
+        script = replication.install(lib)
+        self.assertEqual(script,
+                         os.path.join(lib, 'charm', 'openstack',
+                                      'replication.py'))
+        self.assertEqual(sorted(os.listdir(os.path.dirname(script))),
+                         ['relocate.py', 'replication.py'])
+        self.assertEqual(os.stat(script).st_mode & 0o777, 0o644)
+        with open(script) as f, open(replication.__file__) as g:
+            self.assertEqual(f.read(), g.read())
+        # an up to date copy isn't written again
+        mtime = os.stat(script).st_mtime_ns
+        os.utime(script, ns=(mtime - 10 ** 9, mtime - 10 ** 9))
+        replication.install(lib)
+        self.assertEqual(os.stat(script).st_mtime_ns, mtime - 10 ** 9)
+
+    def test_authorized_key(self):
+        key = 'ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIA=='
+        line = replication.authorized_key(key, '/lib/replication.py',
+                                          self.source)
+        self.assertEqual(
+            line,
+            'command="/usr/bin/python3 /lib/replication.py serve {}",'
+            'restrict {} juju-barbican-softhsm-replica'.format(
+                self.source, key))
+        for bad in (None, 'ssh-rsa AAAA', key + ' comment',
+                    'no-pty ' + key, key + '\nssh-ed25519 AAAA'):
+            with self.assertRaises(replication.ReplicationError):
+                replication.authorized_key(bad, '/lib/replication.py',
+                                           self.source)
+
+    def test_ssh_command(self):
+        self.assertEqual(
+            replication.ssh_command('10.0.0.1', 'softhsm-replica', '/key',
+                                    '/known'),
+            ['ssh', '-i', '/key', '-o', 'BatchMode=yes',
+             '-o', 'IdentitiesOnly=yes', '-o', 'StrictHostKeyChecking=yes',
+             '-o', 'UserKnownHostsFile=/known', '-o', 'ConnectTimeout=30',
+             'softhsm-replica@10.0.0.1'])
+
+    def _patch_ssh(self):
+        def popen(args, **kwargs):
+            proc = mock.MagicMock(returncode=0)
+
+            def communicate(data):
+                request = json.loads(data.decode()) if data else None
+                try:
+                    out = self._serve(args[-1], request)
+                except replication.ReplicationError as e:
+                    proc.returncode = 1
+                    return b'', str(e).encode()
+                return out.encode(), b''
+            proc.communicate.side_effect = communicate
+            return proc
+        self.patch_object(replication.subprocess, 'Popen', side_effect=popen)
+
+    def test_fetch_manifest(self):
+        self._patch_ssh()
+        manifest = self._save()
+        self.assertEqual(replication.fetch_manifest(['ssh']),
+                         (manifest, PINS))
+        self.Popen.assert_called_once_with(
+            ['ssh', 'manifest'], stdin=replication.subprocess.PIPE,
+            stdout=replication.subprocess.PIPE,
+            stderr=replication.subprocess.PIPE)
+        # pins that don't match the manifest aren't used
+        replication.write_source(self.source, self.objects, manifest,
+                                 {'pin': 'other', 'so_pin': '5678'})
+        with self.assertRaises(replication.ReplicationError):
+            replication.fetch_manifest(['ssh'])
+        # nor is a manifest that doesn't match its id
+        manifest['dirs'] = {}
+        replication.write_source(self.source, self.objects, manifest, PINS)
+        with self.assertRaises(replication.ReplicationError):
+            replication.fetch_manifest(['ssh'])
+        os.remove(self.source)
+        with self.assertRaises(replication.ReplicationError):
+            replication.fetch_manifest(['ssh'])
+
+    def test_fetch_objects(self):
+        self._patch_ssh()
+        self._save()
+        objects = replication.fetch_objects(['ssh'], [sha(b'token')])
+        self.assertEqual(list(objects), [sha(b'token')])
+        with self.assertRaises(replication.ReplicationError):
+            replication.fetch_objects(['ssh'], [sha(b'other')])
+
+    def test_apply(self):
+        manifest = self._save()
+        os.mkdir(os.path.join(self.follower, 'own-token'))
+        with open(os.path.join(self.follower, 'own-token', 'x'), 'w'):
+            pass
+        self.assertEqual(
+            replication.apply(self.follower, manifest, self._fetch), 2)
+        self.assertEqual(os.listdir(self.follower), ['token-1'])
+        self.assertEqual(self._read('token-1/key.object'), b'key' * 1000)
+        self.assertEqual(
+            os.stat(os.path.join(self.follower, 'token-1')).st_mode & 0o777,
+            0o700)
+        # only what changed is fetched and written
+        self._write('token-1/token.object', b'changed')
+        os.remove(os.path.join(self.leader, 'token-1', 'key.object'))
+        manifest = self._save()
+        self.fetched = []
+        self.assertEqual(
+            replication.apply(self.follower, manifest, self._fetch), 1)
+        self.assertEqual(self.fetched, [[sha(b'changed')]])
+        self.assertEqual(os.listdir(os.path.join(self.follower, 'token-1')),
+                         ['token.object'])
+        self.assertEqual(self._read('token-1/token.object'), b'changed')
+        # and nothing is fetched when nothing changed
+        self.fetched = []
+        self.assertEqual(
+            replication.apply(self.follower, manifest, self._fetch), 0)
+        self.assertEqual(self.fetched, [])
+
+    def test_apply_batches(self):
+        manifest = self._save()
+        self.assertEqual(
+            replication.apply(self.follower, manifest, self._fetch,
+                              batch_objects=1), 2)
+        self.assertEqual(sorted(self.fetched),
+                         sorted([[sha(b'token')], [sha(b'key' * 1000)]]))
+        # an object larger than a batch is fetched by itself
+        shutil.rmtree(self.follower)
+        os.mkdir(self.follower)
+        self.fetched = []
+        self.assertEqual(
+            replication.apply(self.follower, manifest, self._fetch,
+                              batch_bytes=100), 2)
+        self.assertEqual(len(self.fetched), 2)
+        self.assertEqual(self._read('token-1/key.object'), b'key' * 1000)
+
+    def test_apply_missing_object(self):
+        manifest = self._save()
+        with self.assertRaises(replication.ReplicationError):
+            replication.apply(self.follower, manifest,
+                              lambda digests: {sha(b'token'): 'x'})
+        # nothing in the batch is written
+        self.assertEqual(os.listdir(os.path.join(self.follower, 'token-1')),
+                         [])
+        # but the batches before a failed one are kept
+        first = min(sha(b'token'), sha(b'key' * 1000))
+
+        def fetch(digests):
+            if digests != [first]:
+                raise replication.ReplicationError("lost the connection")
+            return self._fetch(digests)
+        with self.assertRaises(replication.ReplicationError):
+            replication.apply(self.follower, manifest, fetch,
+                              batch_objects=1)
+        self.assertEqual(len(os.listdir(os.path.join(self.follower,
+                                                     'token-1'))), 1)
@@ -0,0 +1,87 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+
+import charm.openstack.snapshot as snapshot
+
+import charms_openstack.test_utils as test_utils
+
+
+class TestSnapshot(test_utils.PatchHelper):
+
+    def setUp(self):
+        super(TestSnapshot, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.store = os.path.join(self.dir, 'tokens')
+        self.snapshot = os.path.join(self.dir, 'tokens-snapshot.tar.gz')
+        os.makedirs(os.path.join(self.store, 'token-1'))
+        with open(os.path.join(self.store, 'token-1', 'token.object'),
+                  'wb') as f:
+            f.write(b'token data')
+        os.chmod(os.path.join(self.store, 'token-1'), 0o700)
+
+    def test_save_restore(self):
+        snapshot.save(self.store, self.snapshot)
+        self.assertEqual(sorted(os.listdir(self.dir)),
+                         ['tokens', 'tokens-snapshot.tar.gz'])
+        self.assertEqual(os.stat(self.snapshot).st_mode & 0o777, 0o600)
+        target = os.path.join(self.dir, 'restored')
+        os.mkdir(target)
+        self.assertEqual(snapshot.restore(self.snapshot, target), 2)
+        with open(os.path.join(target, 'token-1', 'token.object'),
+                  'rb') as f:
+            self.assertEqual(f.read(), b'token data')
+        self.assertEqual(
+            os.stat(os.path.join(target, 'token-1')).st_mode & 0o777, 0o700)
+
+    def test_save_failure_keeps_snapshot(self):
+        snapshot.save(self.store, self.snapshot)
+        with self.assertRaises(OSError):
+            snapshot.save(os.path.join(self.dir, 'missing'), self.snapshot)
+        self.assertEqual(sorted(os.listdir(self.dir)),
+                         ['tokens', 'tokens-snapshot.tar.gz'])
+
+    def test_restore_unsafe(self):
+        for name, kind in [('../escape', tarfile.REGTYPE),
+                           ('/etc/escape', tarfile.REGTYPE),
+                           ('link', tarfile.SYMTYPE)]:
+            with tarfile.open(self.snapshot, mode='w:gz') as tar:
+                info = tarfile.TarInfo(name)
+                info.type = kind
+                info.linkname = '/etc/passwd'
+                tar.addfile(info, io.BytesIO(b''))
+            target = tempfile.mkdtemp(dir=self.dir)
+            with self.assertRaises(snapshot.SnapshotError):
+                snapshot.restore(self.snapshot, target)
+            self.assertEqual(os.listdir(target), [])
+
+    def test_main(self):
+        lock = os.path.join(self.dir, 'lock')
+        # an unmounted store isn't saved with --mounted
+        self.assertEqual(snapshot.main(
+            ['save', '--mounted', '--lock', lock,
+             self.store, self.snapshot]), 0)
+        self.assertFalse(os.path.exists(self.snapshot))
+        self.assertEqual(snapshot.main(
+            ['save', '--lock', lock, self.store, self.snapshot]), 0)
+        self.assertTrue(os.path.exists(self.snapshot))
+        self.assertEqual(snapshot.main(
+            ['restore', os.path.join(self.dir, 'missing.tar.gz'),
+             self.store]), 1)
@@ -0,0 +1,63 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pickle
+
+import charm.openstack.stats as stats
+
+import charms_openstack.test_utils as test_utils
+
+
+class TestStats(test_utils.PatchHelper):
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(stats.percentile(values, 50), 50)
+        self.assertEqual(stats.percentile(values, 99), 99)
+        self.assertEqual(stats.percentile([7], 95), 7)
+        self.assertEqual(stats.percentile([], 50), None)
+
+    def test_log_buckets(self):
+        self.assertEqual(stats.log_buckets(1, 8, 2), [1, 2, 4, 8])
+        self.assertEqual(stats.log_buckets(1, 5, 2), [1, 2, 4, 8])
+
+    def test_histogram(self):
+        h = stats.Histogram([1, 10, 100])
+        self.assertIsNone(h.percentile(50))
+        for value in (0.5, 2, 3, 50, 1000):
+            h.add(value)
+        self.assertEqual(h.count, 5)
+        self.assertEqual(h.total, 1055.5)
+        self.assertEqual(h.max, 1000)
+        self.assertEqual(dict(h.bucket_counts()),
+                         {'1': 1, '10': 2, '100': 1, '+Inf': 1})
+        self.assertEqual(h.percentile(20), 1)
+        self.assertEqual(h.percentile(50), 10)
+        self.assertEqual(h.percentile(100), 1000)
+        # the bound is capped at the largest value
+        small = stats.Histogram([1, 10, 100])
+        small.add(4)
+        self.assertEqual(small.percentile(50), 4)
+
+    def test_histogram_merge(self):
+        a = stats.Histogram([1, 10])
+        a.add(0.5)
+        b = pickle.loads(pickle.dumps(stats.Histogram([1, 10])))
+        b.add(5)
+        b.add(20)
+        a.merge(b)
+        self.assertEqual(a.counts, [1, 1, 1])
+        self.assertEqual((a.count, a.total, a.max), (3, 25.5, 20))
+        with self.assertRaises(ValueError):
+            a.merge(stats.Histogram([1]))
@@ -0,0 +1,145 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+
+import charm.openstack.timings as timings
+
+import charms_openstack.test_utils as test_utils
+
+
+class TestTimings(test_utils.PatchHelper):
+
+    def setUp(self):
+        super(TestTimings, self).setUp()
+        del timings._pending[:]
+        self.patch_object(timings.hookenv, 'hook_name', return_value='install')
+        self.patch_object(timings.hookenv, 'atexit')
+        self.patch_object(timings.time, 'time', return_value=1000.0)
+        self.store = {}
+        kv = mock.MagicMock()
+        kv.get.side_effect = lambda k: self.store.get(k)
+        kv.set.side_effect = lambda k, v: self.store.__setitem__(k, v)
+        kv.unset.side_effect = lambda k: self.store.pop(k, None)
+        kv.getrange.side_effect = lambda prefix: {
+            k: v for k, v in self.store.items() if k.startswith(prefix)}
+
+        def unsetrange(prefix):
+            for k in [k for k in self.store if k.startswith(prefix)]:
+                del self.store[k]
+        kv.unsetrange.side_effect = unsetrange
+        self.patch_object(timings.unitdata, 'kv', return_value=kv)
+
+    def tearDown(self):
+        del timings._pending[:]
+        super(TestTimings, self).tearDown()
+
+    def test_span(self):
+        self.patch_object(timings.time, 'perf_counter',
+                          side_effect=[1.0, 1.5, 2.0, 2.25])
+        with timings.span('setup_token_store'):
+            pass
+        self.assertEqual(timings._pending, [{
+            'hook': 'install', 'span': 'setup_token_store', 'seconds': 0.5,
+            'at': 1000.0}])
+        self.atexit.assert_called_once_with(timings.flush)
+        # a failing step is still timed
+        with self.assertRaises(ValueError):
+            with timings.span('read_slot'):
+                raise ValueError()
+        self.assertEqual(timings._pending[-1]['seconds'], 0.25)
+        self.assertEqual(self.atexit.call_count, 1)
+
+    def test_last(self):
+        self.assertIsNone(timings.last('read_slot_id'))
+        self.store[timings.TIMINGS_PREFIX + '0000000001'] = [
+            {'hook': 'install', 'span': 'read_slot_id', 'seconds': 0.1,
+             'at': 1.0},
+            {'hook': 'install', 'span': 'hook', 'seconds': 1.0, 'at': 2.0}]
+        self.assertEqual(timings.last('read_slot_id')['seconds'], 0.1)
+        # a span of this hook is more recent
+        timings.record('read_slot_id', 0.2)
+        self.assertEqual(timings.last('read_slot_id')['seconds'], 0.2)
+
+    def test_timed(self):
+        @timings.timed()
+        def read_pins_from_store(a):
+            return a * 2
+
+        self.assertEqual(read_pins_from_store(2), 4)
+        self.assertEqual(read_pins_from_store.__name__, 'read_pins_from_store')
+        self.assertEqual(timings._pending[0]['span'], 'read_pins_from_store')
+
+    def test_timed_aggregate(self):
+        self.patch_object(timings.time, 'perf_counter',
+                          side_effect=[1.0, 1.5, 2.0, 2.25, 3.0, 3.5])
+
+        @timings.timed(aggregate=True)
+        def get_slot_id(label):
+            return label
+
+        get_slot_id('a')
+        get_slot_id('b')
+        timings.record('hook', 1)
+        get_slot_id('c')
+        # all of the calls in the hook are one span
+        self.assertEqual(timings._pending, [
+            {'hook': 'install', 'span': 'get_slot_id', 'seconds': 1.25,
+             'calls': 3, 'at': 1000.0},
+            {'hook': 'install', 'span': 'hook', 'seconds': 1, 'at': 1000.0}])
+
+    def test_hook(self):
+        self.patch_object(timings.time, 'perf_counter',
+                          side_effect=[10.0, 12.0])
+        timings.start_hook()
+        timings.end_hook()
+        self.assertEqual(timings.get_spans(), [{
+            'hook': 'install', 'span': 'hook', 'seconds': 2.0,
+            'at': 1000.0}])
+        self.assertEqual(timings._pending, [])
+
+    def test_flush(self):
+        self.patch_object(timings, 'MAX_HOOKS', new=2)
+        timings.flush()
+        self.assertEqual(self.store, {})
+        for i in range(3):
+            timings.record('step{}'.format(i), i)
+            timings.record('hook', i)
+            timings.flush()
+        # only the spans of the last 2 hooks are kept, each in a key of its
+        # own
+        self.assertEqual([s['span'] for s in timings.get_spans()],
+                         ['step1', 'hook', 'step2', 'hook'])
+        self.assertEqual(
+            sorted(self.store),
+            [timings.SEQUENCE_KEY, timings.TIMINGS_PREFIX + '0000000002',
+             timings.TIMINGS_PREFIX + '0000000003'])
+        timings.clear()
+        self.assertEqual(timings.get_spans(), [])
+
+    def test_histograms(self):
+        spans = [
+            {'hook': 'install', 'span': 'hook', 'seconds': s}
+            for s in (0.005, 0.2, 3, 100)] + [
+            {'hook': 'update-status', 'span': 'hook', 'seconds': 0.02}]
+        summaries = timings.histograms(spans, buckets=[0.01, 1, 10])
+        self.assertEqual(len(summaries), 2)
+        self.assertEqual(summaries[0]['hook'], 'install')
+        self.assertEqual(summaries[0]['count'], 4)
+        self.assertEqual(summaries[0]['total'], 103.205)
+        self.assertEqual(summaries[0]['p50'], 0.2)
+        self.assertEqual(summaries[0]['max'], 100)
+        self.assertEqual(dict(summaries[0]['buckets']),
+                         {'0.01': 1, '1': 1, '10': 1, '+Inf': 1})
+        self.assertEqual(summaries[1]['count'], 1)
@@ -0,0 +1,123 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+
+import charm.openstack.trace as trace
+
+import charms_openstack.test_utils as test_utils
+
+
+SPY_LOG = """\
+*************** OpenSC PKCS#11 spy *****************
+Loaded: "/usr/lib/softhsm/libsofthsm2.so"
+
+0: C_GetFunctionList
+P:100; T:0x7f01 2016-10-18 10:00:00.000
+Returned:  0 CKR_OK
+
+1: C_OpenSession
+P:100; T:0x7f01 2016-10-18 10:00:00.002
+[in] slotID = 0x4d2
+[in] flags = 0x4
+Returned:  0 CKR_OK
+
+2: C_Login
+P:200; T:0x7f02 2016-10-18 10:00:00.003
+[in] hSession = 0x1
+Returned:  160 CKR_PIN_INCORRECT
+
+3: C_Login
+P:100; T:0x7f01 2016-10-18 10:00:00.010
+[in] hSession = 0x1
+Returned:  0 CKR_OK
+
+4: C_Encrypt
+P:200; T:0x7f02 2016-10-18 10:00:00.503
+Returned:  0 CKR_OK
+"""
+
+
+class TestTrace(test_utils.PatchHelper):
+
+    def test_parse(self):
+        calls = list(trace.parse(SPY_LOG.splitlines(True)))
+        self.assertEqual(
+            [(f, None if s is None else round(s, 3), rv)
+             for f, s, rv in calls],
+            [('C_GetFunctionList', 0.002, 0),
+             # timed to the next call on the same process and thread
+             ('C_OpenSession', 0.008, 0),
+             ('C_Login', 0.5, 160),
+             # the last calls of each thread can't be timed
+             ('C_Login', None, 0),
+             ('C_Encrypt', None, 0)])
+
+    def test_parse_interleaved_threads(self):
+        calls = list(trace.parse([
+            "0: C_Encrypt\n", "P:100; T:0x1 2016-10-18 10:00:00.000\n",
+            "1: C_Sign\n", "P:200; T:0x1 2016-10-18 10:00:00.001\n",
+            # both calls are in flight, so these can't be attributed
+            "Returned:  0 CKR_OK\n", "Returned:  5 CKR_GENERAL_ERROR\n",
+            "2: C_Encrypt\n", "P:100; T:0x1 2016-10-18 10:00:00.010\n"]))
+        self.assertCountEqual(
+            [(f, None if s is None else round(s, 3), rv)
+             for f, s, rv in calls],
+            [('C_Encrypt', 0.01, None),
+             ('C_Sign', None, None),
+             ('C_Encrypt', None, None)])
+        # once only one call is in flight, its return value is known
+        calls = list(trace.parse([
+            "0: C_Encrypt\n", "P:100; T:0x1 2016-10-18 10:00:00.000\n",
+            "Returned:  0 CKR_OK\n",
+            "1: C_Sign\n", "P:100; T:0x2 2016-10-18 10:00:00.001\n",
+            "Returned:  5 CKR_GENERAL_ERROR\n"]))
+        self.assertCountEqual(calls, [('C_Encrypt', None, 0),
+                                      ('C_Sign', None, 5)])
+
+    def test_parse_without_threads(self):
+        calls = list(trace.parse([
+            "0: C_Initialize\n", "Returned:  0 CKR_OK\n",
+            "1: C_Finalize\n", "Returned:  5 CKR_GENERAL_ERROR\n"]))
+        self.assertEqual(calls, [('C_Initialize', None, 0),
+                                 ('C_Finalize', None, 5)])
+
+    def test_summarise(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        path = os.path.join(tmp, 'pkcs11-spy.log')
+        with open(path, 'w') as f:
+            f.write(SPY_LOG)
+        summaries = trace.summarise([path], buckets=[0.005, 0.1])
+        self.assertEqual(
+            [s['function'] for s in summaries],
+            ['C_Login', 'C_OpenSession', 'C_GetFunctionList', 'C_Encrypt'])
+        self.assertEqual(summaries[0], {
+            'function': 'C_Login', 'count': 2, 'errors': 1, 'timed': 1,
+            'total': 0.5, 'max': 0.5,
+            'buckets': {'0.005': 0, '0.1': 0, '+Inf': 1}})
+        self.assertEqual(summaries[1]['buckets'],
+                         {'0.005': 0, '0.1': 1, '+Inf': 0})
+        self.assertEqual(summaries[3]['timed'], 0)
+
+    def test_log_files(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        path = os.path.join(tmp, 'pkcs11-spy.log')
+        self.assertEqual(trace.log_files(path), [])
+        for name in (path, path + '.1'):
+            open(name, 'w').close()
+        self.assertEqual(trace.log_files(path), [path + '.1', path])